@@ -11,6 +11,16 @@ config_lib.DEFINE_integer(
     "AFF4.cache_max_size", 10000,
     "Maximum size of the AFF4 objects cache.")
 
+config_lib.DEFINE_string(
+    "AFF4.cache_invalidation_subject", "",
+    "If set, writes to AFF4 objects are announced to other processes through "
+    "this data store subject (e.g. aff4:/cache_invalidation) so they can drop "
+    "the object from their cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.cache_invalidation_interval", 2,
+    "How often (in seconds) other processes' cache invalidations are read.")
+
 config_lib.DEFINE_integer(
     "AFF4.intermediate_cache_age", 600,
     "The number of seconds AFF4 urns live in index cache.")
@@ -19,6 +29,11 @@ config_lib.DEFINE_integer(
     "AFF4.intermediate_cache_max_size", 2000,
     "Maximum size of the AFF4 index cache.")
 
+config_lib.DEFINE_integer(
+    "AFF4.image_read_ahead", 10,
+    "The number of chunks an AFF4Image fetches in one data store request when "
+    "it is read sequentially.")
+
 config_lib.DEFINE_integer(
     "AFF4.notification_rules_cache_age", 60,
     "The number of seconds AFF4 notification rules are cached.")
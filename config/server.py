@@ -30,6 +30,27 @@ config_lib.DEFINE_list("Frontend.well_known_flows",
                        "Allow these well known flows to run directly on the "
                        "frontend. Other flows are scheduled as normal.")
 
+config_lib.DEFINE_string("LocalExport.root", "/tmp/grr_exports",
+                         "The local_export hunt output plugin only writes "
+                         "to directories inside this one.")
+
+config_lib.DEFINE_list("Events.batched_events",
+                       ["FileStore.AddFileToStore", "ClientCrash"],
+                       "Events with these names which are published together "
+                       "are written to each listener as one batched record, "
+                       "instead of one record and notification per event.")
+
+config_lib.DEFINE_list("Events.inline_events", [],
+                       "Events with these names are delivered directly to the "
+                       "listeners in the publishing process instead of being "
+                       "queued in the data store. These events are lost if "
+                       "the process dies before they are processed.")
+
+config_lib.DEFINE_bool("Frontend.passthrough_messages", False,
+                       "If set, messages received from clients are stored "
+                       "using the serialized form they were sent in, without "
+                       "decoding and encoding them again.")
+
 # Smtp settings.
 config_lib.DEFINE_string("Worker.smtp_server", "localhost",
                          "The smpt server for sending email alerts.")
@@ -60,6 +81,30 @@ config_lib.DEFINE_string("Datastore.security_manager",
 config_lib.DEFINE_string("Datastore.implementation", "FakeDataStore",
                          "Storage subsystem to use.")
 
+config_lib.DEFINE_integer("Blobstore.segment_prefix_length", 3,
+                          "File content blobs are packed into segments "
+                          "selected by this many hex digits of their digest.")
+
+config_lib.DEFINE_integer("Blobstore.compression_level", 6,
+                          "The zlib compression level for file content blobs, "
+                          "0 stores them uncompressed.")
+
+config_lib.DEFINE_bool("HashFilter.enabled", True,
+                       "Keep Bloom filters of the blob and file hashes in the "
+                       "stores, so lookups of unknown hashes skip the data "
+                       "store.")
+
+config_lib.DEFINE_integer("HashFilter.capacity", 10000000,
+                          "The number of hashes each hash filter is sized "
+                          "for.")
+
+config_lib.DEFINE_float("HashFilter.error_rate", 0.01,
+                        "The target false positive rate of the hash filters.")
+
+config_lib.DEFINE_integer("HashFilter.refresh_interval", 60,
+                          "How often hash filters pick up hashes added by "
+                          "other processes, in seconds.")
+
 config_lib.DEFINE_integer("Datastore.transaction_timeout", default=600,
                           help="How long do we wait for a transaction lock.")
 
@@ -89,6 +134,63 @@ config_lib.DEFINE_string("Mysql.database_username", default="root",
 config_lib.DEFINE_string("Mysql.database_password", default="",
                          help="The password to connect to the database.")
 
+config_lib.DEFINE_integer("Mysql.conn_pool_min", default=5,
+                          help="The number of connections the MySQL "
+                          "connection pool keeps open.")
+
+config_lib.DEFINE_integer("Mysql.conn_pool_max", default=50,
+                          help="The maximum number of connections the MySQL "
+                          "connection pool opens. This should usually match "
+                          "Threadpool.size.")
+
+config_lib.DEFINE_integer("Mysql.conn_pool_idle_timeout", default=300,
+                          help="Connections above Mysql.conn_pool_min which "
+                          "are idle for this many seconds are closed.")
+
+config_lib.DEFINE_bool("Mysql.pin_transaction_connections", default=True,
+                       help="If set, a thread holding a MySQL transaction "
+                       "uses a single connection for all its queries.")
+
+config_lib.DEFINE_integer("Mysql.max_pending_rows", default=50000,
+                          help="The maximum number of rows waiting to be "
+                          "written before asynchronous writers block.")
+
+config_lib.DEFINE_integer("Mysql.write_batch_rows", default=1000,
+                          help="The number of rows written in a single insert "
+                          "statement.")
+
+config_lib.DEFINE_float("Mysql.flush_interval", default=0.5,
+                        help="How often (in seconds) pending writes are "
+                        "flushed to the database.")
+
+# Sharded data store.
+config_lib.DEFINE_list("ShardedDatastore.shards", [],
+                       "The data store implementations used as shards by the "
+                       "ShardedDataStore. Adding or removing a shard moves the "
+                       "subjects on the hash ring next to it.")
+
+config_lib.DEFINE_list("ShardedDatastore.prefix_overrides", [],
+                       "Subjects starting with these prefixes are stored on a "
+                       "fixed shard, given as prefix=shard_index, e.g. "
+                       "aff4:/blobs=2.")
+
+config_lib.DEFINE_integer("ShardedDatastore.virtual_nodes", 100,
+                          "The number of points each shard has on the "
+                          "consistent hash ring.")
+
+config_lib.DEFINE_integer("ShardedDatastore.fanout_threads", 10,
+                          "The number of threads used to query shards in "
+                          "parallel.")
+
+# SQLite data store.
+config_lib.DEFINE_string("Sqlite.database_path",
+                         default="/var/lib/grr/grr-data.sqlite",
+                         help="The path of the SQLite database file.")
+
+config_lib.DEFINE_integer("Sqlite.busy_timeout", default=30,
+                          help="How long (in seconds) to wait for another "
+                          "process to release the database lock.")
+
 
 config_lib.DEFINE_bool("Cron.active", False,
                        "Set to true to run a cron thread on this binary.")
@@ -108,6 +210,28 @@ config_lib.DEFINE_integer("Frontend.bind_port", 8080, "The port to bind.")
 config_lib.DEFINE_integer("Frontend.processes", 1,
                           "Number of processes to use for the HTTP server")
 
+config_lib.DEFINE_integer("Frontend.shared_cache_size", 10000,
+                          "When the HTTP server runs several processes, this "
+                          "many verified client ciphers and certificates are "
+                          "shared between them.")
+
+config_lib.DEFINE_integer("Frontend.shared_cache_cert_max_age", 600,
+                          "Client certificates are shared between the HTTP "
+                          "server processes for this many seconds.")
+
+config_lib.DEFINE_bool("Frontend.event_loop", False,
+                       "If set, the HTTP server serves all connections from a "
+                       "single event loop and handles requests on a bounded "
+                       "pool of worker threads.")
+
+config_lib.DEFINE_integer("Frontend.event_loop_workers", 50,
+                          "The maximum number of requests the event loop HTTP "
+                          "server processes at the same time.")
+
+config_lib.DEFINE_integer("Frontend.keep_alive_timeout", 60,
+                          "Idle keep-alive connections to the event loop HTTP "
+                          "server are closed after this many seconds.")
+
 config_lib.DEFINE_integer("Frontend.max_queue_size", 500,
                           "Maximum number of messages to queue for the client.")
 
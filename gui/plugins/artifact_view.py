@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 """This plugin adds artifact functionality to the UI."""
 
-import itertools
 import StringIO
 
 from grr.gui import renderers
@@ -176,7 +175,7 @@ class ArtifactManagerView(renderers.TableRenderer):
 
     self.size = len(collection)
     row_index = start_row
-    for value in itertools.islice(collection, start_row, end_row):
+    for value in collection[start_row:end_row]:
       self.AddCell(row_index, "Artifact Name", value.name)
       self.AddCell(row_index, "Artifact Details", value)
       self.AddCell(row_index, "Artifact Raw", value)
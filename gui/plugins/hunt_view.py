@@ -462,17 +462,26 @@ back to hunt view</a>
         if resource_max[i] < resource[i]:
           resource_max[i] = resource[i]
 
-    results = {}
-    for status, client_list in self.hunt.GetClientsByStatus().items():
-      if (completion_status_filter == "ALL" or
-          status == completion_status_filter):
-        for client in client_list:
-          results[client] = status
-
-    # Get the list of clients and sort so that we can page accurately.
-    client_list = results.keys()
-    client_list.sort()
-    client_list = client_list[start_row:end_row]
+    # Only the clients on the requested page are read from the client sets.
+    count = end_row - start_row
+    if completion_status_filter == "COMPLETED":
+      client_list = self.hunt.GetCompletedClients(offset=start_row, count=count)
+      results = dict.fromkeys(client_list, "COMPLETED")
+      self.size = self.hunt.NumCompleted()
+
+    elif completion_status_filter == "OUTSTANDING":
+      client_list = self.hunt.GetOutstandingClients(offset=start_row,
+                                                    count=count)
+      results = dict.fromkeys(client_list, "OUTSTANDING")
+      self.size = self.hunt.NumOutstanding()
+
+    else:
+      client_list = self.hunt.GetClients(offset=start_row, count=count)
+      completed = self.hunt.GetClientSet(
+          self.hunt.COMPLETED_SET).Filter(client_list)
+      results = dict((client, "COMPLETED" if client in completed
+                      else "OUTSTANDING") for client in client_list)
+      self.size = self.hunt.NumClients()
 
     row_index = start_row
     for c_urn, cdict in self.hunt.GetClientStates(client_list):
@@ -506,7 +515,6 @@ back to hunt view</a>
 
       self.AddRow(row, row_index)
       row_index += 1
-    self.size = len(results)
 
 
 class AbstractLogRenderer(renderers.TemplateRenderer):
@@ -834,7 +842,7 @@ No data to graph yet.
     self.hunt_id = request.REQ.get("hunt_id")
     hunt = aff4.FACTORY.Open(self.hunt_id, token=request.token)
 
-    self.clients = bool(hunt.Get(hunt.Schema.CLIENTS))
+    self.clients = bool(hunt.NumClients())
     response = super(HuntClientGraphRenderer, self).Layout(request, response)
     return self.CallJavascript(response, "HuntClientGraphRenderer.Layout",
                                hunt_id=self.hunt_id)
@@ -845,9 +853,10 @@ class HuntClientCompletionGraphRenderer(renderers.ImageDownloadRenderer):
   def Content(self, request, _):
     """Generates the actual image to display."""
     hunt_id = request.REQ.get("hunt_id")
-    hunt = aff4.FACTORY.Open(hunt_id, age=aff4.ALL_TIMES, token=request.token)
-    cl = hunt.GetValuesForAttribute(hunt.Schema.CLIENTS)
-    fi = hunt.GetValuesForAttribute(hunt.Schema.FINISHED)
+    hunt = aff4.FACTORY.Open(hunt_id, token=request.token)
+    # The age of each client is the time it was added to the set.
+    cl = hunt.GetClients()
+    fi = hunt.GetCompletedClients()
 
     cdict = {}
     for c in cl:
@@ -1164,16 +1173,11 @@ class HuntOutstandingRenderer(renderers.TableRenderer):
       return
 
     hunt_id = rdfvalue.RDFURN(hunt_id)
-    hunt = aff4.FACTORY.Open(hunt_id, aff4_type="GRRHunt", age=aff4.ALL_TIMES,
-                             token=token)
-
-    started = hunt.GetValuesForAttribute(hunt.Schema.CLIENTS)
-    finished = hunt.GetValuesForAttribute(hunt.Schema.FINISHED)
-    outstanding = set(started) - set(finished)
-
-    self.size = len(outstanding)
+    hunt = aff4.FACTORY.Open(hunt_id, aff4_type="GRRHunt", token=token)
 
-    outstanding = sorted(outstanding)[start_row:end_row]
+    self.size = hunt.NumOutstanding()
+    outstanding = hunt.GetOutstandingClients(offset=start_row,
+                                             count=end_row - start_row)
 
     all_flow_urns = self.GetAllSubflows(hunt_id, outstanding, token)
 
@@ -90,7 +90,7 @@ class TestHuntView(test_lib.GRRSeleniumTest):
     test_lib.TestHuntHelper(client_mock, self.client_ids, False, self.token)
 
     hunt = aff4.FACTORY.Open(hunt.urn, token=self.token, age=aff4.ALL_TIMES)
-    started = hunt.GetValuesForAttribute(hunt.Schema.CLIENTS)
+    started = hunt.GetClients()
     self.assertEqual(len(set(started)), 10)
 
   def CheckState(self, state):
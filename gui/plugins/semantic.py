@@ -5,7 +5,6 @@ Other files may also contain specialized renderers for semantic types relevant
 to their function, but here we include the most basic and common renderers.
 """
 
-import itertools
 import urllib
 
 import logging
@@ -497,7 +496,7 @@ class RDFValueCollectionRenderer(renderers.TableRenderer):
     self.size = len(collection)
 
     row_index = start_row
-    for value in itertools.islice(collection, start_row, end_row):
+    for value in collection[start_row:end_row]:
       self.AddCell(row_index, "Value", value)
       row_index += 1
 
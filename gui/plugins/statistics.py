@@ -327,6 +327,85 @@ class AFF4ClientStats(Report):
       self.fd = fd
     super(AFF4ClientStats, self).__init__(**kwargs)
 
+  # How each metric is plotted from the rollups: the aggregate value and the
+  # divisor. Counters only grow, so their maximum is the value at the end of
+  # each bucket.
+  ROLLUP_VALUES = {
+      "cpu_percent": ("mean", 1),
+      "io_read_bytes": ("maximum", 1024 * 1024),
+      "io_write_bytes": ("maximum", 1024 * 1024),
+      "rss_size": ("mean", 1024 * 1024),
+      "vms_size": ("mean", 1024 * 1024),
+      "bytes_received": ("maximum", 1024 * 1024),
+      "bytes_sent": ("maximum", 1024 * 1024),
+  }
+
+  def _SeriesFromRollups(self, fd, max_samples):
+    """Reads the series from the time series rollups.
+
+    The number of rollups read does not depend on the number of samples in the
+    time range.
+
+    Args:
+      fd: The ClientStats object.
+      max_samples: The maximum number of points per series.
+
+    Returns:
+      A dict of metric -> {time in ms: value}, or None if there are no rollups
+      in the time range.
+    """
+    rollups = fd.QueryTimeSeries(self.start_time, self.end_time,
+                                 max_points=max_samples)
+    if not any(rollups.values()):
+      return None
+
+    result = {}
+    for metric, (value_name, divisor) in self.ROLLUP_VALUES.iteritems():
+      series = result[metric] = {}
+      for timestamp, aggregate in rollups.get(metric, []):
+        value = getattr(aggregate, value_name)
+        if divisor != 1:
+          value = int(value / divisor)
+        series[int(timestamp / 1e3)] = value
+
+    return result
+
+  def _SeriesFromStats(self, fd):
+    """Reads the series from the versioned STATS attribute.
+
+    Stats which were collected before the time series store existed only have
+    this attribute.
+
+    Args:
+      fd: The ClientStats object.
+
+    Returns:
+      A dict of metric -> {time in ms: value}, or None if there are no stats in
+      the time range.
+    """
+    stats = list(fd.GetValuesForAttribute(fd.Schema.STATS))
+    if not stats:
+      return None
+
+    result = dict((metric, {}) for metric in self.ROLLUP_VALUES)
+    for stat_entry in stats:
+      for s in stat_entry.cpu_samples:
+        result["cpu_percent"][int(s.timestamp/1e3)] = s.cpu_percent
+
+      for s in stat_entry.io_samples:
+        result["io_read_bytes"][int(s.timestamp/1e3)] = int(
+            s.read_bytes/1024/1024)
+        result["io_write_bytes"][int(s.timestamp/1e3)] = int(
+            s.write_bytes/1024/1024)
+
+      age = int(stat_entry.age/1e3)
+      result["rss_size"][age] = int(stat_entry.RSS_size/1024/1024)
+      result["vms_size"][age] = int(stat_entry.VMS_size/1024/1024)
+      result["bytes_received"][age] = int(stat_entry.bytes_received/1024/1024)
+      result["bytes_sent"][age] = int(stat_entry.bytes_sent/1024/1024)
+
+    return result
+
   def Layout(self, request, response):
     """This renders graphs for the various client statistics."""
 
@@ -338,77 +417,61 @@ class AFF4ClientStats(Report):
 
     self.graphs = []
 
-    stats = list(fd.GetValuesForAttribute(fd.Schema.STATS))
-
-    # Work out a downsample ratio. Max samples controls samples per graph.
+    # Max samples controls samples per graph.
     max_samples = 500
 
-    if not stats:
+    if not isinstance(fd, aff4.AFF4Object.classes["ClientStats"]):
+      return super(AFF4ClientStats, self).Layout(request, response)
+
+    series = self._SeriesFromRollups(fd, max_samples)
+    if series is None:
+      series = self._SeriesFromStats(fd)
+
+    if series is None:
       return super(AFF4ClientStats, self).Layout(request, response)
 
     # CPU usage graph.
-    series = dict()
-    for stat_entry in stats:
-      for s in stat_entry.cpu_samples:
-        series[int(s.timestamp/1e3)] = s.cpu_percent
     graph = StatGraph(name="CPU Usage", graph_id="cpu",
                       click_text="CPU usage on %date: %value")
-    graph.AddSeries(series, "CPU Usage in %", max_samples)
+    graph.AddSeries(series["cpu_percent"], "CPU Usage in %", max_samples)
     self.graphs.append(graph)
 
     # IO graphs.
-    series = dict()
-    for stat_entry in stats:
-      for s in stat_entry.io_samples:
-        series[int(s.timestamp/1e3)] = int(s.read_bytes/1024/1024)
     graph = StatGraph(
         name="IO Bytes Read", graph_id="io_read",
         click_text="Number of bytes received (IO) until %date: %value")
-    graph.AddSeries(series, "IO Bytes Read in MB", max_samples)
+    graph.AddSeries(series["io_read_bytes"], "IO Bytes Read in MB",
+                    max_samples)
     self.graphs.append(graph)
 
-    series = dict()
-    for stat_entry in stats:
-      for s in stat_entry.io_samples:
-        series[int(s.timestamp/1e3)] = int(s.write_bytes/1024/1024)
     graph = StatGraph(
         name="IO Bytes Written", graph_id="io_write",
         click_text="Number of bytes written (IO) until %date: %value")
-    graph.AddSeries(series, "IO Bytes Written in MB", max_samples)
+    graph.AddSeries(series["io_write_bytes"], "IO Bytes Written in MB",
+                    max_samples)
     self.graphs.append(graph)
 
     # Memory usage graph.
     graph = StatGraph(
         name="Memory Usage", graph_id="memory",
         click_text="Memory usage on %date: %value")
-    series = dict()
-    for stat_entry in stats:
-      series[int(stat_entry.age/1e3)] = int(stat_entry.RSS_size/1024/1024)
-    graph.AddSeries(series, "RSS size in MB", max_samples)
-    series = dict()
-    for stat_entry in stats:
-      series[int(stat_entry.age/1e3)] = int(stat_entry.VMS_size/1024/1024)
-    graph.AddSeries(series, "VMS size in MB", max_samples)
+    graph.AddSeries(series["rss_size"], "RSS size in MB", max_samples)
+    graph.AddSeries(series["vms_size"], "VMS size in MB", max_samples)
     self.graphs.append(graph)
 
     # Network traffic graphs.
     graph = StatGraph(
         name="Network Bytes Received", graph_id="nw_received",
         click_text="Network bytes received until %date: %value")
-    series = dict()
-    for stat_entry in stats:
-      series[int(stat_entry.age/1e3)] = int(
-          stat_entry.bytes_received/1024/1024)
-    graph.AddSeries(series, "Network Bytes Received in MB", max_samples)
+    graph.AddSeries(series["bytes_received"], "Network Bytes Received in MB",
+                    max_samples)
     self.graphs.append(graph)
 
     graph = StatGraph(
         name="Network Bytes Sent", graph_id="nw_sent",
         click_text="Network bytes sent until %date: %value")
-    series = dict()
-    for stat_entry in stats:
-      series[int(stat_entry.age/1e3)] = int(stat_entry.bytes_sent/1024/1024)
-    graph.AddSeries(series, "Network Bytes Sent in MB", max_samples)
+    graph.AddSeries(series["bytes_sent"], "Network Bytes Sent in MB",
+                    max_samples)
     self.graphs.append(graph)
 
     response = super(AFF4ClientStats, self).Layout(request, response)
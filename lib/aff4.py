@@ -7,6 +7,7 @@ This contains an AFF4 data model implementation.
 import __builtin__
 import abc
 import StringIO
+import threading
 import time
 import zlib
 
@@ -20,6 +21,7 @@ from grr.lib import data_store
 from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import stats
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import grr_rdf
@@ -55,14 +57,90 @@ class ChunkNotFoundError(IOError):
   pass
 
 
+class AttributeCache(utils.FastStore):
+  """A cache of the AFF4 attributes read from the data store.
+
+  Entries are keyed by urn only, so all users of the factory share them
+  regardless of their token. Callers must therefore check access to the urns
+  before using cached values. Each urn maps to the values read for every age
+  specification, so writing to an urn invalidates all of them at once.
+  """
+
+  def __init__(self, max_size=10000, max_age=5):
+    super(AttributeCache, self).__init__(max_size=max_size)
+    self.max_age = max_age
+
+  @utils.Synchronized
+  def Get(self, urn, age):
+    """Returns the cached values for this urn and age specification.
+
+    Args:
+      urn: The urn as a unicode string.
+      age: A data store age specification.
+
+    Returns:
+      The list of (attribute, value, timestamp) tuples read from the data store.
+
+    Raises:
+      KeyError: If the values are not cached.
+    """
+    try:
+      stored, values = super(AttributeCache, self).Get(urn)[age]
+      if stored + self.max_age >= time.time():
+        stats.STATS.IncrementCounter("aff4_cache_hits")
+        return values
+
+    except KeyError:
+      pass
+
+    stats.STATS.IncrementCounter("aff4_cache_misses")
+    raise KeyError(urn)
+
+  @utils.Synchronized
+  def Put(self, urn, age, values):
+    try:
+      entry = super(AttributeCache, self).Get(urn)
+    except KeyError:
+      entry = {}
+      super(AttributeCache, self).Put(urn, entry)
+
+    entry[age] = (time.time(), values)
+
+  @utils.Synchronized
+  def Expire(self):
+    evicted = len(self._age) - self._limit
+    if evicted > 0:
+      stats.STATS.IncrementCounter("aff4_cache_evictions", evicted)
+
+    super(AttributeCache, self).Expire()
+
+  def Invalidate(self, urn):
+    if self.ExpireObject(urn) is not None:
+      stats.STATS.IncrementCounter("aff4_cache_invalidations")
+
+
 class Factory(object):
   """A central factory for AFF4 objects."""
 
+  # The attribute in the invalidation subject which names written urns.
+  INVALIDATION_ATTRIBUTE = "cache:invalidate"
+
   def __init__(self):
-    # This is a relatively short lived cache of objects.
-    self.cache = utils.AgeBasedCache(
+    # This is a relatively short lived cache of the attributes read from the
+    # data store.
+    self.cache = AttributeCache(
         max_size=config_lib.CONFIG["AFF4.cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.cache_age"])
+
+    # If set, writes are announced to other processes through this subject.
+    self.invalidation_subject = config_lib.CONFIG[
+        "AFF4.cache_invalidation_subject"]
+    self.invalidation_interval = config_lib.CONFIG[
+        "AFF4.cache_invalidation_interval"]
+    self.invalidation_lock = threading.Lock()
+    self.last_invalidation_poll = time.time()
+    self.last_invalidation_cleanup = time.time()
+
     self.intermediate_cache = utils.AgeBasedCache(
         max_size=config_lib.CONFIG["AFF4.intermediate_cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.intermediate_cache_age"])
@@ -94,42 +172,71 @@ class Factory(object):
     raise RuntimeError("Unknown age specification: %s" % age)
 
   def GetAttributes(self, urns, ignore_cache=False, token=None,
-                    age=NEWEST_TIME):
-    """Retrieves all the attributes for all the urns."""
+                    age=NEWEST_TIME, attributes=None):
+    """Retrieves the attributes for all the urns.
+
+    Args:
+      urns: The urns to read.
+      ignore_cache: Forces a data store read.
+      token: The Security Token to use.
+      age: The age policy of the attributes to read.
+      attributes: If set, only these attributes (Attribute instances or
+        predicate names) are read instead of all the AFF4 attributes.
+
+    Yields:
+      Tuples of (urn, list of (predicate, value, timestamp)).
+    """
     urns = set([utils.SmartUnicode(u) for u in urns])
+    age_specification = self.ParseAgeSpecification(age)
+
+    if attributes is None:
+      regexes = AFF4_PREFIXES
+      cache_key = age_specification
+    else:
+      predicates = tuple(sorted(set(utils.SmartUnicode(a)
+                                    for a in attributes)))
+      regexes = [utils.EscapeRegex(p) + "$" for p in predicates]
+      cache_key = (age_specification, predicates)
+
     if not ignore_cache:
-      for subject in list(urns):
-        key = self._MakeCacheInvariant(subject, token, age)
+      self._PollInvalidations()
 
+      cached = []
+      for subject in urns:
         try:
-          yield subject, self.cache.Get(key)
-          urns.remove(subject)
+          values = self.cache.Get(subject, cache_key)
+          cached.append((subject, values))
         except KeyError:
           pass
 
+      if cached:
+        # The cache is shared by all tokens so this is where we check access,
+        # just like the data store would have.
+        data_store.DB.security_manager.CheckDataStoreAccess(
+            token, [subject for subject, _ in cached], "r")
+
+        for subject, values in cached:
+          urns.remove(subject)
+          yield subject, values
+
     # If there are any urns left we get them from the database.
     if urns:
       for subject, values in data_store.DB.MultiResolveRegex(
-          urns, AFF4_PREFIXES, timestamp=self.ParseAgeSpecification(age),
+          urns, regexes, timestamp=age_specification,
           token=token, limit=None):
 
         # Ensure the values are sorted.
         values.sort(key=lambda x: x[-1], reverse=True)
 
-        key = self._MakeCacheInvariant(subject, token, age)
-        self.cache.Put(key, values)
+        subject = utils.SmartUnicode(subject)
+        self.cache.Put(subject, cache_key, values)
 
-        yield utils.SmartUnicode(subject), values
+        yield subject, values
 
   def SetAttributes(self, urn, attributes, to_delete, sync=False, token=None):
     """Sets the attributes in the data store and update the cache."""
     # Force a data_store lookup next.
-    try:
-      # Expire all entries in the cache for this urn (for all tokens, and
-      # timestamps)
-      self.cache.ExpirePrefix(utils.SmartStr(urn) + ":")
-    except KeyError:
-      pass
+    self.InvalidateCache(urn)
 
     attributes[AFF4Object.SchemaCls.LAST] = [
         rdfvalue.RDFDatetime().Now().SerializeToDataStore()]
@@ -141,6 +248,58 @@ class Factory(object):
     # critical.
     self._UpdateIndex(urn, attributes, token)
 
+  def InvalidateCache(self, urn):
+    """Removes the urn from the attribute cache of all processes.
+
+    Other processes only notice the write if AFF4.cache_invalidation_subject
+    is set, and then only after AFF4.cache_invalidation_interval seconds.
+
+    Args:
+      urn: The urn which was written to.
+    """
+    urn = utils.SmartUnicode(urn)
+    self.cache.Invalidate(urn)
+
+    if self.invalidation_subject:
+      data_store.DB.Set(self.invalidation_subject, self.INVALIDATION_ATTRIBUTE,
+                        urn, replace=False, sync=False, token=self.root_token)
+
+  def _PollInvalidations(self):
+    """Expires cached urns which other processes have written to."""
+    if not self.invalidation_subject:
+      return
+
+    now = time.time()
+    if now - self.last_invalidation_poll < self.invalidation_interval:
+      return
+
+    # Only one thread polls, the others keep using the cache meanwhile.
+    if not self.invalidation_lock.acquire(False):
+      return
+
+    try:
+      # The overlap catches asynchronous writes which arrive late.
+      start = self.last_invalidation_poll - self.invalidation_interval
+      self.last_invalidation_poll = now
+
+      for _, urn, _ in data_store.DB.ResolveRegex(
+          self.invalidation_subject, self.INVALIDATION_ATTRIBUTE,
+          timestamp=(int(start * MICROSECONDS), int(now * MICROSECONDS)),
+          token=self.root_token, limit=None):
+        self.cache.Invalidate(utils.SmartUnicode(urn))
+
+      # Notifications older than the cache age are not needed any more.
+      max_age = max(self.cache.max_age, self.invalidation_interval) * 2
+      if now - self.last_invalidation_cleanup > max_age:
+        self.last_invalidation_cleanup = now
+        data_store.DB.DeleteAttributes(
+            self.invalidation_subject, [self.INVALIDATION_ATTRIBUTE],
+            start=0, end=int((now - max_age) * MICROSECONDS),
+            token=self.root_token)
+
+    finally:
+      self.invalidation_lock.release()
+
   def _UpdateIndex(self, urn, attributes, token):
     """Updates any indexes we need."""
     index = {}
@@ -240,25 +399,6 @@ class Factory(object):
         x = x.Add(component)
         unique_urns.add(x)
 
-  def _MakeCacheInvariant(self, urn, token, age):
-    """Returns an invariant key for an AFF4 object.
-
-    The object will be cached based on this key. This function is specifically
-    extracted to ensure that we encapsulate all security critical aspects of the
-    AFF4 object so that objects do not leak across security boundaries.
-
-    Args:
-       urn: The urn of the object.
-       token: The access token used to receive the object.
-       age: The age policy used to build this object. Should be one
-            of ALL_TIMES, NEWEST_TIME or a range.
-
-    Returns:
-       A key into the cache.
-    """
-    return "%s:%s:%s" % (utils.SmartStr(urn), utils.SmartStr(token),
-                         self.ParseAgeSpecification(age))
-
   def OpenWithLock(self, urn, aff4_type=None, token=None,
                    age=NEWEST_TIME, blocking=True, blocking_lock_timeout=10,
                    blocking_sleep_interval=1, lease_time=100):
@@ -429,16 +569,49 @@ class Factory(object):
     return result
 
   def MultiOpen(self, urns, mode="rw", ignore_cache=False, token=None,
-                aff4_type=None, age=NEWEST_TIME):
-    """Opens a bunch of urns efficiently."""
+                aff4_type=None, age=NEWEST_TIME, attributes=None):
+    """Opens a bunch of urns efficiently.
+
+    All the objects are read in a single data store round trip. Attribute
+    values are only decoded when they are first accessed.
+
+    Args:
+      urns: The urns to open.
+      mode: The mode to open the objects with.
+      ignore_cache: Forces a data store read.
+      token: The Security Token to use for opening the objects.
+      aff4_type: If set, only objects of this type are returned.
+      age: The age policy used to build the objects.
+      attributes: If set, only these attributes are read from the data store
+        (together with the type and symlink target needed to build the
+        objects). All other attributes read as unset, so the objects can only
+        be opened read only.
+
+    Yields:
+      The AFF4 objects which exist.
+
+    Raises:
+      RuntimeError: If the mode is invalid.
+    """
     if token is None:
       token = data_store.default_token
 
     if mode not in ["w", "r", "rw"]:
       raise RuntimeError("Invalid mode %s" % mode)
 
+    if attributes is not None:
+      if mode != "r":
+        raise RuntimeError("Objects opened with an attribute projection are "
+                           "read only.")
+
+      attributes = set(attributes)
+      attributes.update([AFF4Object.SchemaCls.TYPE,
+                         AFF4Symlink.SchemaCls.SYMLINK_TARGET])
+
     symlinks = []
-    for urn, values in self.GetAttributes(urns, token=token, age=age):
+    for urn, values in self.GetAttributes(urns, token=token, age=age,
+                                          ignore_cache=ignore_cache,
+                                          attributes=attributes):
       try:
         obj = self.Open(urn, mode=mode, ignore_cache=ignore_cache, token=token,
                         local_cache={urn: values}, aff4_type=aff4_type, age=age,
@@ -453,7 +626,8 @@ class Factory(object):
 
     if symlinks:
       for obj in self.MultiOpen(symlinks, mode=mode, ignore_cache=ignore_cache,
-                                token=token, aff4_type=aff4_type, age=age):
+                                token=token, aff4_type=aff4_type, age=age,
+                                attributes=attributes):
         yield obj
 
   def OpenDiscreteVersions(self, urn, mode="r", ignore_cache=False, token=None,
@@ -2077,8 +2251,24 @@ class AFF4Image(AFF4Stream):
     super(AFF4Image, self).Initialize()
 
     self.offset = 0
+
+    # How many chunks are fetched at once when reading sequentially.
+    self.read_ahead = config_lib.CONFIG["AFF4.image_read_ahead"]
+
+    # Used to detect sequential reads.
+    self._last_read_chunk = None
+    self.sequential = False
+
+    # Where the current Read() call ends.
+    self.read_end = 0
+
     # A cache for segments - When we get pickled we want to discard them.
-    self.chunk_cache = AFF4ObjectCache(100)
+    chunk_cache_size = max(100, 2 * self.read_ahead)
+    self.chunk_cache = AFF4ObjectCache(chunk_cache_size)
+
+    # The most chunks fetched at once. Fetching more than the cache holds
+    # would evict the chunk being read before we get to it.
+    self.max_chunks_to_fetch = chunk_cache_size / 2
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -2134,6 +2324,31 @@ class AFF4Image(AFF4Stream):
 
     return fd
 
+  def _GetChunksToFetch(self, chunk):
+    """Returns the chunks to fetch from the data store when chunk is missing.
+
+    Random reads only fetch the chunks needed by the current Read() call. When
+    the reads are sequential, the next read_ahead chunks are fetched as well
+    so a large file can be read with few round trips.
+
+    Args:
+      chunk: The number of the chunk which is not in the cache.
+
+    Returns:
+      A list of chunk numbers, starting with chunk.
+    """
+    count = (self.read_end - 1) / self.chunksize - chunk + 1
+    if self.sequential:
+      count = max(count, self.read_ahead)
+
+    # Large reads fetch their chunks in several round trips.
+    count = min(count, self.max_chunks_to_fetch)
+
+    # Do not read past the end of the image.
+    count = min(count, (self.size - 1) / self.chunksize - chunk + 1)
+
+    return range(chunk, chunk + max(1, count))
+
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
 
@@ -2144,7 +2359,7 @@ class AFF4Image(AFF4Stream):
       # The most common read access pattern is contiguous reading. Here we
       # readahead to reduce round trips.
       missing_chunks = []
-      for chunk_number in range(chunk, chunk + 10):
+      for chunk_number in self._GetChunksToFetch(chunk):
         new_chunk_name = self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk_number)
         try:
           self.chunk_cache.Get(new_chunk_name)
@@ -2171,6 +2386,15 @@ class AFF4Image(AFF4Stream):
 
     available_to_read = min(length, self.chunksize - chunk_offset)
 
+    # Reads continuing in the chunk we read last, or the one after it, are
+    # sequential. So is reading a file from the start.
+    if self._last_read_chunk is None:
+      self.sequential = chunk == 0
+    else:
+      self.sequential = (self._last_read_chunk <= chunk <=
+                         self._last_read_chunk + 1)
+    self._last_read_chunk = chunk
+
     retries = 0
     while retries < self.NUM_RETRIES:
       fd = self._GetChunkForReading(chunk)
@@ -2200,6 +2424,7 @@ class AFF4Image(AFF4Stream):
     # The total available size in the file
     length = int(length)
     length = min(length, self.size - self.offset)
+    self.read_end = self.offset + length
 
     while length > 0:
       data = self._ReadPartial(length)
@@ -2281,6 +2506,12 @@ class AFF4InitHook(registry.InitHook):
     FACTORY = Factory()  # pylint: disable=g-bad-name
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
 
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("aff4_cache_hits")
+    stats.STATS.RegisterCounterMetric("aff4_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_cache_evictions")
+    stats.STATS.RegisterCounterMetric("aff4_cache_invalidations")
+
 
 class AFF4Filter(object):
   """A simple filtering system to be used with Query()."""
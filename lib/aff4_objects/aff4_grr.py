@@ -429,97 +429,111 @@ class GRRForeman(aff4.AFF4Object):
       self.Set(self.Schema.RULES, new_rules)
       self.Flush()
 
-  def _CheckIfHuntTaskWasAssigned(self, client_id, hunt_id):
-    """Will return True if hunt's task was assigned to this client before."""
-    for _ in aff4.FACTORY.Stat(
-        [client_id.Add("flows/%s:hunt" %
-                       rdfvalue.RDFURN(hunt_id).Basename())],
-        token=self.token):
-      return True
+  # The compiled version of the rules in RULES.
+  compiled_rules = None
+  compiled_rules_source = None
 
-    return False
+  def _GetCompiledRules(self, rules):
+    """Returns the rules compiled, compiling them only when they change."""
+    if self.compiled_rules_source is not rules:
+      self.compiled_rules = [CompiledForemanRule(rule) for rule in rules]
+      self.compiled_rules_source = rules
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    try:
-      # Do the attribute regex first.
-      for regex_rule in rule.regex_rules:
-        path = client_id.Add(regex_rule.path)
-        fd = objects[path]
-        attribute = aff4.Attribute.NAMES[regex_rule.attribute_name]
-        value = utils.SmartStr(fd.Get(attribute))
-        if not regex_rule.attribute_regex.Search(value):
-          return False
+    return self.compiled_rules
 
-      # Now the integer rules.
-      for integer_rule in rule.integer_rules:
-        path = client_id.Add(integer_rule.path)
-        fd = objects[path]
-        attribute = aff4.Attribute.NAMES[integer_rule.attribute_name]
-        try:
-          value = int(fd.Get(attribute))
-        except (ValueError, TypeError):
-          # Not an integer attribute.
-          return False
-        op = integer_rule.operator
-        if op == rdfvalue.ForemanAttributeInteger.Operator.LESS_THAN:
-          if value >= integer_rule.value:
-            return False
-        elif op == rdfvalue.ForemanAttributeInteger.Operator.GREATER_THAN:
-          if value <= integer_rule.value:
-            return False
-        elif op == rdfvalue.ForemanAttributeInteger.Operator.EQUAL:
-          if value != integer_rule.value:
-            return False
-        else:
-          # Unknown operator.
-          return False
+  def _GetAssignedHunts(self, client_hunts):
+    """Checks which hunts were already started on which clients.
 
-      return True
+    Args:
+      client_hunts: A list of (client_id, hunt_id) tuples.
 
-    except KeyError:
-      # The requested attribute was not found.
-      return False
+    Returns:
+      The set of (client_id, hunt_id) tuples where the hunt's task was assigned
+      to the client before.
+    """
+    links = {}
+    for client_id, hunt_id in client_hunts:
+      link = client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())
+      links[utils.SmartUnicode(link)] = (client_id, hunt_id)
+
+    # A single multi subject query for all the pairs.
+    return set(links[utils.SmartUnicode(stat["urn"])]
+               for stat in aff4.FACTORY.Stat(links.keys(), token=self.token))
 
-  def _RunActions(self, rule, client_id):
-    """Run all the actions specified in the rule.
+  def _RunActions(self, matches):
+    """Run the actions of all the rules which matched.
+
+    Hunts are started on all their new clients with a single StartClients
+    call.
 
     Args:
-      rule: Rule which actions are to be executed.
-      client_id: Id of a client where rule's actions are to be executed.
+      matches: A list of (rule, client_id) tuples, in the order the actions
+        should run.
 
     Returns:
       Number of actions started.
     """
     actions_count = 0
 
-    for action in rule.actions:
-      try:
-        # Say this flow came from the foreman.
-        token = self.token.Copy()
-        token.username = "Foreman"
+    # Say this flow came from the foreman.
+    token = self.token.Copy()
+    token.username = "Foreman"
 
+    client_hunts = []
+    for rule, client_id in matches:
+      for action in rule.actions:
         if action.HasField("hunt_id"):
-          if self._CheckIfHuntTaskWasAssigned(client_id, action.hunt_id):
+          client_hunts.append((client_id, action.hunt_id))
+
+    assigned = self._GetAssignedHunts(client_hunts) if client_hunts else set()
+
+    # Hunt id -> (hunt name, client ids). Hunts are started in the order we saw
+    # them.
+    hunt_clients = {}
+    hunt_ids = []
+
+    for rule, client_id in matches:
+      for action in rule.actions:
+        if action.HasField("hunt_id"):
+          if (client_id, action.hunt_id) in assigned:
             logging.info("Foreman: ignoring hunt %s on client %s: was started "
-                         "here before", client_id, action.hunt_id)
+                         "here before", action.hunt_id, client_id)
           else:
-            logging.info("Foreman: Starting hunt %s on client %s.",
-                         action.hunt_id, client_id)
+            # Do not start the same hunt twice if several rules match.
+            assigned.add((client_id, action.hunt_id))
+            if action.hunt_id not in hunt_clients:
+              hunt_ids.append(action.hunt_id)
+              hunt_clients[action.hunt_id] = (action.hunt_name, [])
+
+            hunt_clients[action.hunt_id][1].append(client_id)
+
+          continue
 
-            flow_cls = flow.GRRFlow.classes[action.hunt_name]
-            flow_cls.StartClients(action.hunt_id, [client_id])
-            actions_count += 1
-        else:
+        try:
           flow.GRRFlow.StartFlow(
               client_id=client_id, flow_name=action.flow_name, token=token,
               **action.argv.ToDict())
           actions_count += 1
-      # There could be all kinds of errors we don't know about when starting the
-      # flow/hunt so we catch everything here.
+        # There could be all kinds of errors we don't know about when starting
+        # the flow so we catch everything here.
+        except Exception as e:  # pylint: disable=broad-except
+          logging.exception("Failure running foreman action on client %s: %s",
+                            client_id, e)
+
+    for hunt_id in hunt_ids:
+      hunt_name, client_ids = hunt_clients[hunt_id]
+      try:
+        logging.info("Foreman: Starting hunt %s on %d clients.", hunt_id,
+                     len(client_ids))
+
+        flow_cls = flow.GRRFlow.classes[hunt_name]
+        flow_cls.StartClients(hunt_id, client_ids)
+        actions_count += len(client_ids)
+      # There could be all kinds of errors we don't know about when starting
+      # the hunt so we catch everything here.
       except Exception as e:  # pylint: disable=broad-except
-        logging.exception("Failure running foreman action on client %s: %s",
-                          action.hunt_id, e)
+        logging.exception("Failure starting hunt %s on %d clients: %s",
+                          hunt_id, len(client_ids), e)
 
     return actions_count
 
@@ -532,58 +546,93 @@ class GRRForeman(aff4.AFF4Object):
     Returns:
       Number of assigned tasks.
     """
-    client_id = rdfvalue.ClientURN(client_id)
+    return self.AssignTasksToClients([client_id])
+
+  def AssignTasksToClients(self, client_ids):
+    """Examines our rules and starts up flows for a batch of clients.
+
+    All the data store reads are done for the whole batch at once: the last
+    time the foreman ran on each client, the attributes the rules look at and
+    whether the hunts were already started on the clients.
+
+    Args:
+      client_ids: A list of client ids for tasks to be assigned.
 
+    Returns:
+      Number of assigned tasks.
+    """
     rules = self.Get(self.Schema.RULES)
     if not rules: return 0
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
-    try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
-    except AttributeError:
-      last_foreman_run = 0
+    compiled_rules = self._GetCompiledRules(rules)
+    latest_rule = max([rule.created for rule in compiled_rules])
 
-    latest_rule = max([rule.created for rule in rules])
+    client_ids = [rdfvalue.ClientURN(client_id) for client_id in client_ids]
+    last_foreman_time = VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME
 
-    if latest_rule <= int(last_foreman_run):
-      return 0
+    last_foreman_runs = {}
+    for client in aff4.FACTORY.MultiOpen(client_ids, mode="r",
+                                         token=self.token,
+                                         attributes=[last_foreman_time]):
+      try:
+        last_foreman_runs[client.urn] = int(client.Get(last_foreman_time) or 0)
+      except AttributeError:
+        pass
 
-    # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
+    now = time.time() * 1e6
+    expired_rules = False
 
     # For efficiency we collect all the objects we want to open first and then
     # open them all in one round trip.
     object_urns = {}
-    relevant_rules = []
-    expired_rules = False
-
-    now = time.time() * 1e6
+    attributes = set()
+    client_rules = []
 
-    for rule in rules:
-      if rule.expires < now:
-        expired_rules = True
-        continue
-      if rule.created <= int(last_foreman_run):
+    for client_id in client_ids:
+      last_foreman_run = last_foreman_runs.get(client_id, 0)
+      if latest_rule <= last_foreman_run:
         continue
 
-      relevant_rules.append(rule)
-      for regex in rule.regex_rules:
-        aff4_object = client_id.Add(regex.path)
-        object_urns[str(aff4_object)] = aff4_object
-      for int_rule in rule.integer_rules:
-        aff4_object = client_id.Add(int_rule.path)
-        object_urns[str(aff4_object)] = aff4_object
-
-    # Retrieve all aff4 objects we need.
+      # Update the latest checked rule on the client.
+      last_foreman_runs[client_id] = latest_rule
+      value = last_foreman_time(latest_rule)
+      aff4.FACTORY.SetAttributes(
+          client_id, {last_foreman_time: [(value.SerializeToDataStore(),
+                                           rdfvalue.RDFDatetime().Now())]},
+          set([last_foreman_time]), sync=False, token=self.token)
+
+      relevant_rules = []
+      for rule in compiled_rules:
+        if rule.expires < now:
+          expired_rules = True
+          continue
+        if rule.created <= last_foreman_run:
+          continue
+
+        relevant_rules.append(rule)
+        for path, attribute in rule.GetReads():
+          aff4_object = client_id.Add(path)
+          object_urns[str(aff4_object)] = aff4_object
+          attributes.add(attribute)
+
+      if relevant_rules:
+        client_rules.append((client_id, relevant_rules))
+
+    # Retrieve all aff4 objects we need, reading only the attributes the rules
+    # look at.
     objects = {}
-    for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
-      objects[fd.urn] = fd
+    if object_urns:
+      for fd in aff4.FACTORY.MultiOpen(object_urns, mode="r", token=self.token,
+                                       attributes=attributes):
+        objects[fd.urn] = fd
 
-    actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+    matches = []
+    for client_id, relevant_rules in client_rules:
+      for rule in relevant_rules:
+        if rule.Evaluate(objects, client_id):
+          matches.append((rule, client_id))
+
+    actions_count = self._RunActions(matches)
 
     if expired_rules:
       self.ExpireRules()
@@ -591,6 +640,102 @@ class GRRForeman(aff4.AFF4Object):
     return actions_count
 
 
+class CompiledForemanRule(object):
+  """A foreman rule prepared to be evaluated against many clients.
+
+  The regexes are compiled and the attributes are looked up once, instead of
+  every time the rule is checked for a client.
+  """
+
+  def __init__(self, rule):
+    self.created = rule.created
+    self.expires = rule.expires
+    self.actions = list(rule.actions)
+
+    # Rules referring to unknown attributes or operators never match.
+    self.valid = True
+
+    self.regex_checks = []
+    for regex_rule in rule.regex_rules:
+      attribute = aff4.Attribute.NAMES.get(regex_rule.attribute_name)
+      if attribute is None:
+        self.valid = False
+        continue
+
+      # Same flags as RegularExpression.Search().
+      regex = re.compile(regex_rule.attribute_regex.SerializeToString(),
+                         flags=re.I | re.S | re.M)
+      self.regex_checks.append((regex_rule.path, attribute, regex))
+
+    operators = rdfvalue.ForemanAttributeInteger.Operator
+    self.integer_checks = []
+    for integer_rule in rule.integer_rules:
+      attribute = aff4.Attribute.NAMES.get(integer_rule.attribute_name)
+      operator = integer_rule.operator
+      if attribute is None or operator not in (operators.LESS_THAN,
+                                               operators.GREATER_THAN,
+                                               operators.EQUAL):
+        self.valid = False
+        continue
+
+      self.integer_checks.append((integer_rule.path, attribute, int(operator),
+                                  integer_rule.value))
+
+  def GetReads(self):
+    """Returns the (path, attribute) tuples the rule looks at."""
+    if not self.valid:
+      return []
+
+    return ([(path, attribute) for path, attribute, _ in self.regex_checks] +
+            [(path, attribute) for path, attribute, _, _ in
+             self.integer_checks])
+
+  def Evaluate(self, objects, client_id):
+    """Evaluates the rule for a client.
+
+    Args:
+      objects: A dict of the opened aff4 objects, keyed by urn.
+      client_id: The client to check.
+
+    Returns:
+      True if the rule matches the client.
+    """
+    if not self.valid:
+      return False
+
+    operators = rdfvalue.ForemanAttributeInteger.Operator
+    try:
+      # Do the attribute regex first.
+      for path, attribute, regex in self.regex_checks:
+        fd = objects[client_id.Add(path)]
+        if not regex.search(utils.SmartStr(fd.Get(attribute))):
+          return False
+
+      # Now the integer rules.
+      for path, attribute, operator, expected in self.integer_checks:
+        fd = objects[client_id.Add(path)]
+        try:
+          value = int(fd.Get(attribute))
+        except (ValueError, TypeError):
+          # Not an integer attribute.
+          return False
+
+        if operator == operators.LESS_THAN:
+          if value >= expected:
+            return False
+        elif operator == operators.GREATER_THAN:
+          if value <= expected:
+            return False
+        elif value != expected:
+          return False
+
+      return True
+
+    except KeyError:
+      # The requested object was not found.
+      return False
+
+
 class GRRAFF4Init(registry.InitHook):
   """Ensure critical AFF4 objects exist for GRR."""
 
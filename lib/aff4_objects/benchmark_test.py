@@ -90,3 +90,61 @@ class AFF4Benchmark(test_lib.MicroBenchmarks):
 
     self.TimeIt(ReadAVersionedAFF4Attribute,
                 name="Read one versioned Attributes")
+
+  def testMultiOpenAttributeProjection(self):
+    """How much faster is opening objects when reading only some attributes."""
+    client_info = rdfvalue.ClientInformation(client_name="GRR",
+                                             client_description="Description")
+
+    urns = []
+    for i in range(100):
+      urn = rdfvalue.ClientURN("C.%016X" % i)
+      urns.append(urn)
+
+      fd = aff4.FACTORY.Create(urn, "VFSGRRClient", token=self.token)
+      fd.Set(fd.Schema.HOSTNAME("host%d" % i))
+      for _ in range(20):
+        fd.AddAttribute(fd.Schema.CLIENT_INFO, client_info)
+      fd.Close()
+
+    hostname = aff4.AFF4Object.classes["VFSGRRClient"].SchemaCls.HOSTNAME
+
+    def MultiOpenAll():
+      for fd in aff4.FACTORY.MultiOpen(urns, mode="r", ignore_cache=True,
+                                       token=self.token, age=aff4.ALL_TIMES):
+        fd.Get(hostname)
+
+    def MultiOpenProjected():
+      for fd in aff4.FACTORY.MultiOpen(urns, mode="r", ignore_cache=True,
+                                       token=self.token, age=aff4.ALL_TIMES,
+                                       attributes=[hostname]):
+        fd.Get(hostname)
+
+    self.TimeIt(MultiOpenAll, name="MultiOpen all attributes", repetitions=10)
+    self.TimeIt(MultiOpenProjected, name="MultiOpen one attribute",
+                repetitions=10)
+
+  def testCollectionPaging(self):
+    """Reading a page from the end of growing collections."""
+    urn = "aff4:/test/collection"
+    fd = aff4.FACTORY.Create(urn, "RDFValueCollection", mode="w",
+                             token=self.token)
+
+    size = 0
+    for collection_size in [1000, 10000, 100000, 1000000]:
+      while size < collection_size:
+        batch_size = min(10000, collection_size - size)
+        fd.AddAll([rdfvalue.GrrMessage(request_id=i)
+                   for i in xrange(size, size + batch_size)])
+        size += batch_size
+      fd.Flush()
+
+      def ReadLastPage():
+        collection = aff4.FACTORY.Open(urn, token=self.token)
+        page = collection[size - 50:size]
+        self.assertEqual(page[-1].request_id, size - 1)  # pylint: disable=cell-var-from-loop
+
+      self.TimeIt(ReadLastPage, name="Page 50 items at %d" % size,
+                  repetitions=10)
+
+    fd.Close()
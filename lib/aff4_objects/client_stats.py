@@ -5,12 +5,67 @@
 
 from grr.lib import aff4
 from grr.lib import rdfvalue
+from grr.lib import timeseries_store
 from grr.lib.aff4_objects import standard
 
 
 class ClientStats(standard.VFSDirectory):
-  """A container for all client statistics."""
+  """A container for all client statistics.
+
+  Next to the STATS attribute, the samples are written to a time series store
+  at the same urn, which keeps rollups for graphs over long time ranges.
+  """
+
+  # The metrics in the time series store.
+  METRICS = ["cpu_percent", "io_read_bytes", "io_write_bytes", "rss_size",
+             "vms_size", "bytes_received", "bytes_sent"]
 
   class SchemaCls(standard.VFSDirectory.SchemaCls):
     STATS = aff4.Attribute("aff4:stats", rdfvalue.ClientStats,
                            "Client Stats.", "Client stats")
+
+  def GetTimeSeriesStore(self):
+    return timeseries_store.TimeSeriesStore(self.urn, token=self.token)
+
+  def AddTimeSeriesSamples(self, client_stats, timestamp=None):
+    """Writes the samples in a ClientStats response to the time series store.
+
+    Args:
+      client_stats: A ClientStats rdfvalue.
+      timestamp: The time of the values which are not samples, such as memory
+        sizes, defaults to now.
+    """
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime().Now()
+    timestamp = timestamp.AsMicroSecondsFromEpoch()
+
+    samples = []
+    for sample in client_stats.cpu_samples:
+      samples.append(("cpu_percent", sample.timestamp.AsMicroSecondsFromEpoch(),
+                      sample.cpu_percent))
+
+    for sample in client_stats.io_samples:
+      sample_time = sample.timestamp.AsMicroSecondsFromEpoch()
+      samples.append(("io_read_bytes", sample_time, sample.read_bytes))
+      samples.append(("io_write_bytes", sample_time, sample.write_bytes))
+
+    samples.extend([("rss_size", timestamp, client_stats.RSS_size),
+                    ("vms_size", timestamp, client_stats.VMS_size),
+                    ("bytes_received", timestamp, client_stats.bytes_received),
+                    ("bytes_sent", timestamp, client_stats.bytes_sent)])
+
+    self.GetTimeSeriesStore().WriteSamples(samples)
+
+  def QueryTimeSeries(self, start, end, max_points=500):
+    """Returns the rollups of all metrics in a time range.
+
+    Args:
+      start: The start of the range in microseconds since the epoch.
+      end: The end of the range in microseconds since the epoch.
+      max_points: The maximum number of points per metric.
+
+    Returns:
+      A dict of metric -> list of (timestamp, Aggregate).
+    """
+    return self.GetTimeSeriesStore().Query(self.METRICS, start, end,
+                                           max_points=max_points)
@@ -4,6 +4,7 @@
 
 
 import cStringIO
+import itertools
 import struct
 
 import logging
@@ -11,12 +12,19 @@ import logging
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.flows.cron import compactors
 
 
 class RDFValueCollection(aff4.AFF4Object):
-  """This is a collection of RDFValues."""
+  """This is a collection of RDFValues.
+
+  The values are stored one after the other in an AFF4Image stream. To reach an
+  item without reading all the items before it, the stream offset of every
+  INDEX_INTERVAL'th item is kept in a sparse index stored in "index:offset/"
+  attributes beside the stream.
+  """
   # If this is set to an RDFValue class implementation, all the contained
   # objects must be instances of this class.
   _rdf_type = None
@@ -27,6 +35,10 @@ class RDFValueCollection(aff4.AFF4Object):
   # The file object for the underlying AFF4Image stream.
   fd = None
 
+  # The stream offset of every INDEX_INTERVAL'th item is stored in the index.
+  INDEX_INTERVAL = 1000
+  INDEX_PREFIX = "index:offset/"
+
   class SchemaCls(aff4.AFF4Object.SchemaCls):
     SIZE = aff4.AFF4Stream.SchemaCls.SIZE
 
@@ -39,6 +51,9 @@ class RDFValueCollection(aff4.AFF4Object):
 
   def Initialize(self):
     """Initialize the internal storage stream."""
+    # Index entries which were not yet written: item index -> stream offset.
+    self.index_updates = {}
+
     try:
       self.fd = aff4.FACTORY.Open(self.urn.Add("Stream"),
                                   aff4_type="AFF4Image", mode=self.mode,
@@ -66,9 +81,54 @@ class RDFValueCollection(aff4.AFF4Object):
     if self._dirty and self.fd:
       self.fd.Flush(sync=sync)
       self.Set(self.Schema.SIZE(self.size))
+      self._FlushIndex(sync=sync)
 
     super(RDFValueCollection, self).Flush(sync=sync)
 
+  def _IndexPredicate(self, index):
+    return "%s%016d" % (self.INDEX_PREFIX, index)
+
+  def _FlushIndex(self, sync=False):
+    """Writes the new index entries to the data store."""
+    if not self.index_updates:
+      return
+
+    data_store.DB.MultiSet(
+        self.urn, dict((self._IndexPredicate(index), [offset])
+                       for index, offset in self.index_updates.iteritems()),
+        token=self.token, sync=sync)
+    self.index_updates = {}
+
+  def _UpdateIndex(self, index, offset):
+    """Records the stream offset of the item at index if it is indexed."""
+    # The first item is always at offset 0 so it needs no index entry.
+    if index and index % self.INDEX_INTERVAL == 0:
+      self.index_updates[index] = offset
+
+  def _FindIndexedItem(self, index):
+    """Finds the closest indexed item at or before an item.
+
+    Args:
+      index: The index of the item we want to read.
+
+    Returns:
+      A tuple of (item index, stream offset) to start reading from. This is
+      (0, 0) for collections written before the index existed.
+    """
+    indexed_item = index - index % self.INDEX_INTERVAL
+    if indexed_item == 0:
+      return 0, 0
+
+    offset = self.index_updates.get(indexed_item)
+    if offset is None:
+      offset, _ = data_store.DB.Resolve(
+          self.urn, self._IndexPredicate(indexed_item), token=self.token)
+
+    if offset is None:
+      return 0, 0
+
+    return indexed_item, int(offset)
+
   def Close(self, sync=False):
     self.Flush(sync=sync)
 
@@ -89,6 +149,7 @@ class RDFValueCollection(aff4.AFF4Object):
 
     data = rdfvalue.EmbeddedRDFValue(payload=rdf_value).SerializeToString()
     self.fd.Seek(0, 2)
+    self._UpdateIndex(self.size, self.fd.Tell())
     self.fd.Write(struct.pack("<i", len(data)))
     self.fd.Write(data)
     self.size += 1
@@ -107,12 +168,15 @@ class RDFValueCollection(aff4.AFF4Object):
       if not rdf_value.age:
         rdf_value.age.Now()
 
+    self.fd.Seek(0, 2)
+    start_offset = self.fd.Tell()
+
     buf = cStringIO.StringIO()
-    for rdf_value in rdf_values:
+    for i, rdf_value in enumerate(rdf_values):
+      self._UpdateIndex(self.size + i, start_offset + buf.tell())
       data = rdfvalue.EmbeddedRDFValue(payload=rdf_value).SerializeToString()
       buf.write(struct.pack("<i", len(data)))
       buf.write(data)
-    self.fd.Seek(0, 2)
     self.fd.Write(buf.getvalue())
     self.size += len(rdf_values)
     self._dirty = True
@@ -135,11 +199,13 @@ class RDFValueCollection(aff4.AFF4Object):
   def current_offset(self):
     return self.fd.Tell()
 
-  def GenerateItems(self, offset=0):
+  def GenerateItems(self, offset=0, start_index=None):
     """Iterate over all contained RDFValues.
 
     Args:
       offset: The offset in the stream to start reading from.
+      start_index: If set, the index of the first item to return. The stream
+        offset is then found using the index and offset is ignored.
 
     Yields:
       RDFValues stored in the collection.
@@ -153,8 +219,24 @@ class RDFValueCollection(aff4.AFF4Object):
     if self.mode == "w":
       raise RuntimeError("Can not read when in write mode.")
 
-    self.fd.seek(offset)
     count = 0
+    if start_index:
+      count, offset = self._FindIndexedItem(start_index)
+    else:
+      start_index = 0
+
+    self.fd.seek(offset)
+
+    # Skip the items between the indexed item and the first one we want
+    # without decoding them.
+    while count < start_index:
+      try:
+        length = struct.unpack("<i", self.fd.Read(4))[0]
+      except struct.error:
+        return
+
+      self.fd.Seek(length, 1)
+      count += 1
 
     while True:
       offset = self.fd.Tell()
@@ -186,10 +268,23 @@ class RDFValueCollection(aff4.AFF4Object):
       return item
 
   def __getitem__(self, index):
+    if isinstance(index, slice):
+      start = index.start or 0
+      if start < 0 or (index.stop is not None and index.stop < 0):
+        raise RuntimeError("Index must be >= 0")
+
+      if index.step not in (None, 1):
+        raise RuntimeError("Slices with a step are not supported.")
+
+      items = self.GenerateItems(start_index=start)
+      if index.stop is None:
+        return list(items)
+
+      return list(itertools.islice(items, max(0, index.stop - start)))
+
     if index >= 0:
-      for i, item in enumerate(self):
-        if i == index:
-          return item
+      for item in self.GenerateItems(start_index=index):
+        return item
     else:
       raise RuntimeError("Index must be >= 0")
 
@@ -290,13 +385,15 @@ class VersionedCollection(RDFValueCollection):
     self.AddAttribute(self.Schema.DATA(payload=rdf_value,
                                        age=rdf_value.age), age=rdf_value.age)
 
-  def GenerateItems(self, timestamp=None):
+  def GenerateItems(self, timestamp=None, start_index=None):
     if timestamp is None:
       timestamp = data_store.DB.ALL_TIMESTAMPS
 
-    for _, value, ts in data_store.DB.ResolveMulti(
+    values = data_store.DB.ResolveMulti(
         self.urn, [self.Schema.DATA.predicate], token=self.token,
-        timestamp=timestamp):
+        timestamp=timestamp)
+
+    for _, value, ts in itertools.islice(values, start_index or 0, None):
       yield self.Schema.DATA(value, age=ts).payload
 
 
@@ -309,14 +406,54 @@ class PackedVersionedCollection(RDFValueCollection):
 
   Unfortunately reading from versioned data store attributes is slow. Therefore
   this object implements a compaction strategy, where writes are versioned,
-  until they can be compacted into a regular RDFValueCollection by then
-  VersionedCollectionCompactor cron job.
+  until they are compacted by the PackedVersionedCollectionCompactor cron job.
+
+  Compaction streams the versions in timestamp windows, which are resized so
+  each one holds about COMPACTION_BATCH_SIZE items, into segments. A segment is
+  an RDFValueCollection below the collection, and a new one is started once
+  the last one holds more than SEGMENT_SIZE bytes. The number of items and bytes
+  of each segment is committed after each window, so readers can skip whole
+  segments and a crashed compaction resumes without duplicating items. Items
+  compacted before segments existed are kept in the collection's own stream.
   """
 
   class SchemaCls(RDFValueCollection.SchemaCls):
     DATA = aff4.Attribute("aff4:data", rdfvalue.EmbeddedRDFValue,
                           "The embedded semantic value.", versioned=True)
 
+  # Segments are rolled over once they hold more than this many bytes.
+  SEGMENT_SIZE = 64 * 1024 * 1024
+
+  # The number of versions compacted at once, windows holding more than twice
+  # this many are split.
+  COMPACTION_BATCH_SIZE = 10000
+
+  # The width of the first compaction window in microseconds.
+  COMPACTION_WINDOW = 60 * 1000000
+
+  # "<item count>:<stream size>" of each segment, by segment number.
+  SEGMENT_PREFIX = "compaction:segment/"
+
+  # "<start>:<end>" of the last committed window whose versions may not be
+  # deleted yet.
+  CHECKPOINT = "compaction:checkpoint"
+
+  def Initialize(self):
+    super(PackedVersionedCollection, self).Initialize()
+
+    # The number of items in our own stream.
+    self.legacy_size = self.size
+
+    self.segments = []
+    if "r" in self.mode:
+      self.segments = self._ReadSegments()
+      self.size += sum(count for _, count, _ in self.segments)
+
+  def Flush(self, sync=False):
+    # New items are only written as versions, the stream and the segments are
+    # written by Compact().
+    aff4.AFF4Object.Flush(self, sync=sync)
+
   def Add(self, rdf_value=None, **kwargs):
     """Add the rdf value to the collection."""
     if rdf_value is None and self._rdf_type:
@@ -332,17 +469,191 @@ class PackedVersionedCollection(RDFValueCollection):
                       "index:changed/%s" % self.urn, self.urn,
                       replace=True, token=self.token, sync=False)
 
-  def GenerateItems(self):
+  def _SegmentUrn(self, number):
+    return self.urn.Add("Segments").Add("%08d" % number)
+
+  def _ReadSegments(self):
+    """Returns a sorted list of (number, item count, stream size)."""
+    segments = []
+    for predicate, value, _ in data_store.DB.ResolveRegex(
+        self.urn, self.SEGMENT_PREFIX + ".+",
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, limit=None,
+        token=self.token):
+      count, size = [int(x) for x in utils.SmartStr(value).split(":")]
+      segments.append((int(predicate[len(self.SEGMENT_PREFIX):]), count, size))
+
+    return sorted(segments)
+
+  def GenerateItems(self, start_index=None):
+    start_index = start_index or 0
+
     # First iterate over the versions, and then iterate over the stream.
+    versions = 0
     for _, value, _ in data_store.DB.ResolveMulti(
         self.urn, [self.Schema.DATA.predicate], token=self.token,
         timestamp=data_store.DB.ALL_TIMESTAMPS):
-      yield self.Schema.DATA(value).payload
+      if versions >= start_index:
+        yield self.Schema.DATA(value).payload
+      versions += 1
 
-    for x in super(
-        PackedVersionedCollection, self).GenerateItems():
+    start_index = max(0, start_index - versions)
+    for x in super(PackedVersionedCollection, self).GenerateItems(
+        start_index=start_index):
       yield x
 
+    # Segments before the start index are skipped without opening them, and
+    # only the committed items of each segment are read.
+    first_index = self.legacy_size
+    for number, count, _ in self.segments:
+      if start_index < first_index + count:
+        skip = max(0, start_index - first_index)
+        segment = aff4.FACTORY.Open(self._SegmentUrn(number),
+                                    aff4_type="RDFValueCollection",
+                                    token=self.token)
+        for x in itertools.islice(segment.GenerateItems(start_index=skip),
+                                  count - skip):
+          x.id += first_index
+          yield x
+
+      first_index += count
+
+  def _OpenLastSegment(self):
+    """Opens the segment to append to, dropping any uncommitted items."""
+    if self.segments:
+      number, count, size = self.segments[-1]
+    else:
+      number, count, size = 0, 0, 0
+
+    if size >= self.SEGMENT_SIZE:
+      number, count, size = number + 1, 0, 0
+
+    segment = aff4.FACTORY.Create(self._SegmentUrn(number),
+                                  "RDFValueCollection", mode="rw",
+                                  token=self.token)
+
+    # A compaction may have crashed after writing the segment but before
+    # committing it.
+    if segment.fd.size > size:
+      segment.fd.Truncate(size)
+      segment.size = count
+      segment.Set(segment.Schema.SIZE(count))
+
+    return number, segment
+
+  def _Commit(self, number, segment, window, sync=True):
+    """Commits the items written to a segment from a window of versions."""
+    segment.Flush(sync=sync)
+    data_store.DB.MultiSet(
+        self.urn, {self.SEGMENT_PREFIX + "%08d" % number:
+                   ["%d:%d" % (segment.size, segment.fd.size)],
+                   self.CHECKPOINT: ["%d:%d" % window]},
+        token=self.token, sync=sync)
+
+    # The versions are deleted after the commit, so if we crash in between
+    # the next compaction deletes them instead of adding them again.
+    data_store.DB.DeleteAttributes(self.urn, [self.Schema.DATA.predicate],
+                                   start=window[0], end=window[1], sync=sync,
+                                   token=self.token)
+
+  def _ReadWindow(self, start, end, limit):
+    """Returns the versions in a window, or None if there are over limit."""
+    results = []
+    for _, value, timestamp in data_store.DB.ResolveMulti(
+        self.urn, [self.Schema.DATA.predicate], token=self.token,
+        timestamp=(start, end)):
+      results.append((timestamp, value))
+      if limit is not None and len(results) > limit:
+        return None
+
+    results.sort(key=lambda x: x[0])
+    return results
+
+  def Compact(self, heartbeat=None):
+    """Moves the versions into the segments.
+
+    Args:
+      heartbeat: A callable called after each window.
+
+    Returns:
+      A tuple of the number of compacted items and the age in seconds of the
+      oldest one.
+    """
+    # Finish the last window of a compaction which crashed.
+    value, _ = data_store.DB.Resolve(self.urn, self.CHECKPOINT,
+                                     token=self.token)
+    if value:
+      start, end = [int(x) for x in utils.SmartStr(value).split(":")]
+      data_store.DB.DeleteAttributes(self.urn, [self.Schema.DATA.predicate],
+                                     start=start, end=end, sync=True,
+                                     token=self.token)
+
+    self.segments = self._ReadSegments()
+    number, segment = self._OpenLastSegment()
+
+    now = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+    oldest = None
+    compacted = 0
+
+    # Empty windows double in size, so the first items are found quickly.
+    start = 0
+    width = self.COMPACTION_WINDOW
+    while True:
+      end = start + width - 1
+      last_window = end >= now
+      if last_window:
+        # Also compact items with ages in the future.
+        end = (1 << 63) - 1
+
+      limit = 2 * self.COMPACTION_BATCH_SIZE if width > 1 else None
+      items = self._ReadWindow(start, end, limit)
+      if items is None:
+        width = max(1, width / 2)
+        continue
+
+      if items:
+        if oldest is None:
+          oldest = items[0][0]
+
+        if segment.fd.size >= self.SEGMENT_SIZE:
+          segment.Close()
+          number += 1
+          segment = aff4.FACTORY.Create(self._SegmentUrn(number),
+                                        "RDFValueCollection", mode="rw",
+                                        token=self.token)
+
+        payloads = [self.Schema.DATA(serialized, age=age).payload
+                    for age, serialized in items]
+        segment.AddAll([payload for payload in payloads if payload is not None])
+
+        # Only the versions we read are deleted, items added since then are
+        # left for the next compaction.
+        self._Commit(number, segment, (start, items[-1][0]))
+        compacted += len(items)
+
+        if heartbeat:
+          heartbeat()
+
+      if last_window:
+        break
+
+      if len(items) < self.COMPACTION_BATCH_SIZE / 2:
+        width *= 2
+
+      start = end + 1
+
+    segment.Close()
+    data_store.DB.DeleteAttributes(self.urn, [self.CHECKPOINT], sync=True,
+                                   token=self.token)
+
+    self.segments = self._ReadSegments()
+    self.size = self.legacy_size + sum(count for _, count, _ in self.segments)
+
+    lag = 0
+    if oldest is not None:
+      lag = max(0, now - oldest) / 1e6
+
+    return compacted, lag
+
   def __len__(self):
     logging.warning(
         "Len called on a PackedVersionedCollection, this will not work.")
@@ -2,11 +2,14 @@
 """Test the various collection objects."""
 
 
+import threading
+
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib.aff4_objects import collections
+from grr.lib.flows.cron import compactors
 
 
 class TypedRDFValueCollection(collections.RDFValueCollection):
@@ -148,6 +151,138 @@ class TestCollections(test_lib.AFF4ObjectTest):
     # of records.
     self.assertEqual(fd.size, 5)
 
+  def testCompactorNeverCompactsInTheFlowThread(self):
+    urns = ["aff4:/test/packed_collection%d" % i for i in range(5)]
+    for urn in urns:
+      self._AddPackedItems(urn, 0, 3)
+
+    compact = compactors.PackedVersionedCollectionCompactor.Compact
+    threads = []
+
+    def Compact(flow_obj, urn):
+      threads.append(threading.current_thread())
+      return compact(flow_obj, urn)
+
+    # A single worker gets a full queue, so the flow has to wait for it.
+    with test_lib.MultiStubber(
+        (compactors.PackedVersionedCollectionCompactor, "Compact", Compact),
+        (compactors.PackedVersionedCollectionCompactor, "THREAD_POOL_NAME",
+         "CollectionCompactorTest"),
+        (compactors.PackedVersionedCollectionCompactor, "MAX_THREADS", 1)):
+      for _ in test_lib.TestFlowHelper("PackedVersionedCollectionCompactor",
+                                       token=self.token):
+        pass
+
+    self.assertEqual(len(threads), 5)
+    self.assertFalse(threading.current_thread() in threads)
+    for urn in urns:
+      self.assertEqual([x.request_id for x in self._OpenPacked(urn)],
+                       range(3))
+
+  def _AddPackedItems(self, urn, start, count):
+    fd = aff4.FACTORY.Create(urn, "PackedVersionedCollection",
+                             mode="w", token=self.token)
+    for i in range(start, start + count):
+      with test_lib.FakeTime(1000 + i):
+        fd.Add(rdfvalue.GrrMessage(request_id=i))
+
+    fd.Close()
+
+  def _OpenPacked(self, urn):
+    return aff4.FACTORY.Open(urn, aff4_type="PackedVersionedCollection",
+                             token=self.token, ignore_cache=True)
+
+  def testPackedVersionedCollectionRollsSegments(self):
+    urn = "aff4:/test/packed_collection"
+    self._AddPackedItems(urn, 0, 20)
+
+    with test_lib.Stubber(collections.PackedVersionedCollection,
+                          "SEGMENT_SIZE", 100):
+      with test_lib.Stubber(collections.PackedVersionedCollection,
+                            "COMPACTION_BATCH_SIZE", 3):
+        fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+        self.assertEqual(fd.Compact()[0], 20)
+
+        # Items added later go into the last segment.
+        self._AddPackedItems(urn, 20, 5)
+        fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+        self.assertEqual(fd.Compact()[0], 5)
+
+    fd = self._OpenPacked(urn)
+    self.assertTrue(len(fd.segments) > 1)
+    self.assertEqual(fd.size, 25)
+    self.assertEqual([x.request_id for x in fd], range(25))
+
+    # Reads from an index skip the segments before it.
+    self.assertEqual([x.request_id for x in fd.GenerateItems(start_index=17)],
+                     range(17, 25))
+    self.assertEqual(fd[17].id, 17)
+
+  def testPackedVersionedCollectionCompactionResumes(self):
+    urn = "aff4:/test/packed_collection"
+    self._AddPackedItems(urn, 0, 10)
+
+    data_predicate = collections.PackedVersionedCollection.SchemaCls.DATA
+    delete_attributes = data_store.DB.DeleteAttributes
+
+    def CrashingDeleteAttributes(subject, predicates, **kwargs):
+      if predicates == [data_predicate.predicate]:
+        raise RuntimeError("Crashed before deleting the versions.")
+      return delete_attributes(subject, predicates, **kwargs)
+
+    with test_lib.Stubber(data_store.DB, "DeleteAttributes",
+                          CrashingDeleteAttributes):
+      fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+      self.assertRaises(RuntimeError, fd.Compact)
+
+    # The items were committed to a segment but are still in the versions.
+    self.assertEqual(len(self._OpenPacked(urn).segments), 1)
+
+    fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+    self.assertEqual(fd.Compact()[0], 0)
+    self.assertEqual([x.request_id for x in self._OpenPacked(urn)], range(10))
+
+    # A crash after writing a segment but before committing it.
+    self._AddPackedItems(urn, 10, 5)
+    multi_set = data_store.DB.MultiSet
+
+    def CrashingMultiSet(subject, values, **kwargs):
+      if collections.PackedVersionedCollection.CHECKPOINT in values:
+        raise RuntimeError("Crashed before committing the segment.")
+      return multi_set(subject, values, **kwargs)
+
+    with test_lib.Stubber(data_store.DB, "MultiSet", CrashingMultiSet):
+      fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+      self.assertRaises(RuntimeError, fd.Compact)
+
+    fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+    self.assertEqual(fd.Compact()[0], 5)
+    self.assertEqual([x.request_id for x in self._OpenPacked(urn)], range(15))
+
+  def testPackedVersionedCollectionKeepsItemsAddedDuringCompaction(self):
+    urn = "aff4:/test/packed_collection"
+    self._AddPackedItems(urn, 0, 5)
+
+    read_window = collections.PackedVersionedCollection._ReadWindow
+    added = []
+
+    def ReadWindow(fd, start, end, limit):
+      items = read_window(fd, start, end, limit)
+      if items and not added:
+        # Another item is added after the window was read.
+        self._AddPackedItems(urn, 5, 1)
+        added.append(True)
+      return items
+
+    with test_lib.Stubber(collections.PackedVersionedCollection,
+                          "_ReadWindow", ReadWindow):
+      fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+      self.assertEqual(fd.Compact()[0], 5)
+
+    fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+    self.assertEqual(fd.Compact()[0], 1)
+    self.assertEqual([x.request_id for x in self._OpenPacked(urn)], range(6))
+
   def testChunkSize(self):
 
     urn = "aff4:/test/chunktest"
@@ -181,6 +316,43 @@ class TestCollections(test_lib.AFF4ObjectTest):
                            mode="rw", token=self.token)
     self.assertRaises(ValueError, fd.SetChunksize, (2 * 1024 * 1024))
 
+  def testRandomAccessUsesTheIndex(self):
+    urn = "aff4:/test/collection"
+
+    with test_lib.Stubber(collections.RDFValueCollection, "INDEX_INTERVAL", 10):
+      fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                               mode="w", token=self.token)
+      for i in range(25):
+        fd.Add(rdfvalue.GrrMessage(request_id=i))
+      fd.AddAll([rdfvalue.GrrMessage(request_id=i) for i in range(25, 95)])
+      fd.Close()
+
+      # Every tenth item is in the index.
+      index = [predicate for predicate, _, _ in data_store.DB.ResolveRegex(
+          urn, "index:offset/.*", token=self.token, limit=None)]
+      self.assertEqual(len(index), 9)
+
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      for i in [0, 9, 10, 11, 47, 90, 94]:
+        item = fd[i]
+        self.assertEqual(item.request_id, i)
+        self.assertEqual(item.id, i)
+
+      self.assertEqual(fd[95], None)
+
+      self.assertEqual([x.request_id for x in fd[38:43]], range(38, 43))
+      self.assertEqual([x.request_id for x in fd[90:]], range(90, 95))
+      self.assertEqual(fd[100:110], [])
+
+      self.assertEqual([x.request_id for x in fd.GenerateItems(start_index=58)],
+                       range(58, 95))
+
+      # Collections without an index are read from the start.
+      data_store.DB.DeleteAttributesRegex(urn, ["index:offset/.*"],
+                                          token=self.token)
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      self.assertEqual(fd[47].request_id, 47)
+
   def testAddingNoneToUntypedCollectionRaises(self):
     urn = "aff4:/test/collection"
     fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
@@ -11,8 +11,10 @@ from grr.parsers import fingerprint
 from grr.lib import access_control
 from grr.lib import aff4
 from grr.lib import data_store
+from grr.lib import hash_filter
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import utils
 
 
 class FileStoreInit(registry.InitHook):
@@ -151,9 +153,23 @@ class HashFileStore(FileStore):
       hash_map[aff4.ROOT_URN.Add("files/hash/generic").Add(hash_type).Add(
           str(digest))] = digest
 
-    for metadata in aff4.FACTORY.Stat(list(hash_map), token=self.token):
+    urns = list(hash_map)
+
+    # Files which the filter rules out are not in the store.
+    file_filter = hash_filter.FILTERS.get(FileHashFilter.name)
+    if file_filter:
+      keys = dict((utils.SmartStr(urn), urn) for urn in urns)
+      urns = [keys[key] for key in file_filter.MayContain(keys,
+                                                          token=self.token)]
+
+    found = 0
+    for metadata in aff4.FACTORY.Stat(urns, token=self.token):
+      found += 1
       yield metadata["urn"], hash_map[metadata["urn"]]
 
+    if file_filter:
+      file_filter.RecordFalsePositives(len(urns) - found)
+
   def AddFile(self, blob_fd, sync=False):
     """Accept a blobimage, hash the content, and create FileStoreImage objects.
 
@@ -238,6 +254,11 @@ class HashFileStore(FileStore):
       fd.Set(hashes)
       fd.Close(sync=sync)
 
+    file_filter = hash_filter.FILTERS.get(FileHashFilter.name)
+    if file_filter:
+      file_filter.Add([utils.SmartStr(fd.urn) for fd in file_store_files],
+                      token=self.token)
+
     blob_fd.Set(hashes)
 
     # We do not want to be externally written here.
@@ -334,6 +355,16 @@ class HashFileStore(FileStore):
              [hit_urn for _, hit_urn, _ in hash_hits])
 
 
+class FileHashFilter(hash_filter.HashFilter):
+  """A filter over the urns of the files in the HashFileStore."""
+
+  name = "file_hashes"
+
+  def ListKeys(self, token=None):
+    for file_store_hash in HashFileStore.ListHashes(token=token):
+      yield utils.SmartStr(file_store_hash)
+
+
 class FileStoreImage(aff4.VFSBlobImage):
   """The AFF4 files that are stored in the file store area.
 
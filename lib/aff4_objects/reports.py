@@ -202,7 +202,10 @@ class ClientReportIterator(export_utils.IterateAllClients):
       extended_report_attrs: Path, Attribute tuples to retrieve.
       **kwargs: Additional args to fall through to client iterator.
     """
-    super(ClientReportIterator, self).__init__(**kwargs)
+    # Only the report attributes are read from the clients, extended
+    # attributes are read from their members.
+    super(ClientReportIterator, self).__init__(attributes=report_attrs,
+                                               **kwargs)
     self.report_attrs = report_attrs
     self.extended_report_attrs = extended_report_attrs
 
@@ -2,10 +2,10 @@
 """These are standard aff4 objects."""
 
 
-import hashlib
 import StringIO
 
 from grr.lib import aff4
+from grr.lib import blob_store
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import rdfvalue
@@ -115,6 +115,46 @@ class HashList(rdfvalue.RDFBytes):
         self._value[idx * self.HASH_SIZE: (idx + 1) * self.HASH_SIZE])
 
 
+class BlobChunk(object):
+  """A chunk of a hash based image, read from the blob store."""
+
+  def __init__(self, data):
+    self.fd = StringIO.StringIO(data)
+
+  def Seek(self, offset, whence=0):
+    self.fd.seek(offset, whence)
+
+  def Read(self, length):
+    return self.fd.read(length)
+
+  def Close(self, sync=True):
+    _ = sync
+
+
+def FetchBlobChunks(names, chunk_cache, token=None):
+  """Reads blobs which are not cached yet into an image's chunk cache.
+
+  Args:
+    names: A list of blob digests.
+    chunk_cache: The chunk cache of the image, keyed by digest.
+    token: The token to use for data store access.
+
+  Returns:
+    A dict of digest -> BlobChunk with the chunks which were read.
+  """
+  names = [name for name in names if name and name not in chunk_cache]
+  if not names:
+    return {}
+
+  chunks = {}
+  for name, data in blob_store.BLOB_STORE.ReadBlobs(
+      names, token=token).iteritems():
+    chunks[name] = BlobChunk(data)
+    chunk_cache.Put(name, chunks[name])
+
+  return chunks
+
+
 class BlobImage(aff4.AFF4Image):
   """An AFF4 stream which stores chunks by hashes.
 
@@ -124,8 +164,8 @@ class BlobImage(aff4.AFF4Image):
   # Size of a sha256 hash
   _HASH_SIZE = 32
 
-  # How many chunks we read ahead
-  _READAHEAD = 5
+  # AppendContent() writes this many blobs to the blob store at a time.
+  BLOB_WRITE_BATCH = 10
 
   def Initialize(self):
     super(BlobImage, self).Initialize()
@@ -160,24 +200,10 @@ class BlobImage(aff4.AFF4Image):
     except KeyError:
       # Read ahead a few chunks.
       self.index.seek(offset)
-      readahead = {}
-
-      for _ in range(self._READAHEAD):
-        name = self.index.read(self._HASH_SIZE)
-        if name and name not in self.chunk_cache:
-          urn = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
-          readahead[urn] = name
-
-      fds = aff4.FACTORY.MultiOpen(readahead, mode="r", token=self.token)
-      for fd in fds:
-        name = readahead[fd.urn]
-
-        # Remember the right fd
-        if name == chunk_name:
-          result = fd
-
-        # Put back into the cache
-        self.chunk_cache.Put(readahead[fd.urn], fd)
+      chunks = FetchBlobChunks([self.index.read(self._HASH_SIZE)
+                                for _ in self._GetChunksToFetch(chunk)],
+                               self.chunk_cache, token=self.token)
+      result = chunks.get(chunk_name)
 
     if result is None:
       raise IOError("Chunk '%s' not found for reading!" % chunk)
@@ -211,22 +237,19 @@ class BlobImage(aff4.AFF4Image):
       IOError: if blob has already been finalized.
     """
     while 1:
-      blob = src_fd.read(self.chunksize)
-      if not blob:
+      blobs = []
+      for _ in range(self.BLOB_WRITE_BATCH):
+        blob = src_fd.read(self.chunksize)
+        if not blob:
+          break
+        blobs.append(blob)
+
+      if not blobs:
         break
-      blob_hash = hashlib.sha256(blob).digest()
-      blob_urn = rdfvalue.RDFURN("aff4:/blobs").Add(blob_hash.encode("hex"))
-
-      try:
-        fd = aff4.FACTORY.Open(blob_urn, "AFF4MemoryStream", mode="r",
-                               token=self.token)
-      except IOError:
-        fd = aff4.FACTORY.Create(blob_urn, "AFF4MemoryStream", mode="w",
-                                 token=self.token)
-        fd.Write(blob)
-        fd.Close(sync=True)
 
-      self.AddBlob(blob_hash, len(blob))
+      digests = blob_store.BLOB_STORE.WriteBlobs(blobs, token=self.token)
+      for blob, blob_hash in zip(blobs, digests):
+        self.AddBlob(blob_hash, len(blob))
 
     self.Flush()
 
@@ -287,9 +310,6 @@ class HashImage(aff4.AFF4Image):
 
   # Size of a sha256 hash
   _HASH_SIZE = 32
-
-  # How many chunks we read ahead
-  _READAHEAD = 5
   _data_dirty = False
 
   def Initialize(self):
@@ -318,24 +338,10 @@ class HashImage(aff4.AFF4Image):
     except KeyError:
       # Read ahead a few chunks.
       self.index.Seek(-self._HASH_SIZE, whence=1)
-      readahead = {}
-
-      for _ in range(self._READAHEAD):
-        name = self.index.Read(self._HASH_SIZE)
-        if name and name not in self.chunk_cache:
-          urn = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
-          readahead[urn] = name
-
-      fds = aff4.FACTORY.MultiOpen(readahead, mode="r", token=self.token)
-      for fd in fds:
-        name = readahead[fd.urn]
-
-        # Remember the right fd
-        if name == chunk_name:
-          result = fd
-
-        # Put back into the cache
-        self.chunk_cache.Put(readahead[fd.urn], fd)
+      chunks = FetchBlobChunks([self.index.Read(self._HASH_SIZE)
+                                for _ in self._GetChunksToFetch(chunk)],
+                               self.chunk_cache, token=self.token)
+      result = chunks.get(chunk_name)
 
     return result
 
@@ -417,35 +423,17 @@ class AFF4SparseImage(BlobImage):
     except KeyError:
       # Read ahead a few chunks.
       self.index.seek(offset)
-      readahead = {}
 
       # Read all the hashes in one go, then split up the result.
-      chunks = self.index.read(self._HASH_SIZE * self._READAHEAD)
-      chunk_names = [chunks[i:i + self._HASH_SIZE]
-                     for i in xrange(0, len(chunks), self._HASH_SIZE)]
-
-      for name in chunk_names:
-        # Try and read ahead a few chunks from the datastore and add them to the
-        # cache. If the chunks ahead aren't there, that's okay, we just can't
-        # cache them. We still keep reading to see if chunks after them are
-        # there, since the image is sparse.
-        try:
-          if name not in self.chunk_cache:
-            urn = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
-            readahead[urn] = name
-        except aff4.ChunkNotFoundError:
-          pass
-
-      fds = aff4.FACTORY.MultiOpen(readahead, mode="r", token=self.token)
-      for fd in fds:
-        name = readahead[fd.urn]
-
-        # Remember the right fd
-        if name == chunk_name:
-          result = fd
-
-        # Put back into the cache
-        self.chunk_cache.Put(readahead[fd.urn], fd)
+      hashes = self.index.read(self._HASH_SIZE * self.read_ahead)
+      chunk_names = [hashes[i:i + self._HASH_SIZE]
+                     for i in xrange(0, len(hashes), self._HASH_SIZE)]
+
+      # Try and read ahead a few chunks from the blob store and add them to the
+      # cache. If the chunks ahead aren't there, that's okay, we just can't
+      # cache them, since the image is sparse.
+      chunks = FetchBlobChunks(chunk_names, self.chunk_cache, token=self.token)
+      result = chunks.get(chunk_name)
 
       if result is None:
         raise aff4.ChunkNotFoundError("Chunk '%s' (urn: %s) not "
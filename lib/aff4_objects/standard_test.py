@@ -233,6 +233,33 @@ class AFF4SparseImageTest(test_lib.GRRBaseTest):
     self.assertEqual(fd.Read(fd.chunksize * num_chunks),
                      "".join(blobs))
 
+  def testReadingKeepsTheIndexLastChunk(self):
+    urn = aff4.ROOT_URN.Add("temp_sparse_image.dd")
+    fd = aff4.FACTORY.Create(urn, aff4_type="AFF4SparseImage",
+                             token=self.token, mode="rw")
+
+    # Reading an empty index returns nothing.
+    fd.index.Seek(0)
+    self.assertEqual(fd.index.Read(fd.index.chunksize), "")
+
+    blob_hashes = []
+    for chunk in [3, 5]:
+      blob_contents = str(chunk) * 64 * 1024
+      blob_hashes.append(self.AddBlobToBlobStore(blob_contents))
+      fd.AddBlob(blob_hash=blob_hashes[-1], length=len(blob_contents),
+                 chunk_number=chunk)
+
+    # Reads of the index must not change the highest chunk it has seen.
+    fd.index.Seek(3 * fd.index.chunksize)
+    self.assertEqual(fd.index.Read(fd.index.chunksize), blob_hashes[0])
+    self.assertEqual(fd.index.last_chunk, 5)
+    fd.Close()
+
+    index = aff4.FACTORY.Open(fd.index.urn, token=self.token)
+    self.assertEqual(index.Get(index.Schema.LAST_CHUNK), 5)
+    index.Seek(5 * index.chunksize)
+    self.assertEqual(index.Read(10 * index.chunksize), blob_hashes[1])
+
   def testReadingAfterLastChunk(self):
     urn = aff4.ROOT_URN.Add("temp_sparse_image.dd")
     fd = aff4.FACTORY.Create(urn, aff4_type="AFF4SparseImage",
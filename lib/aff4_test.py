@@ -13,11 +13,14 @@ from grr.lib import server_plugins
 from grr.lib.aff4_objects import tests
 # pylint: enable=unused-import,g-bad-import-order
 
+from grr.lib import access_control
 from grr.lib import aff4
 from grr.lib import config_lib
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
@@ -44,6 +47,16 @@ class ObjectWithLockProtectedAttribute(aff4.AFF4Volume):
                                       lock_protected=False)
 
 
+class ForemanTestHunt(flow.GRRFlow):
+  """Records the clients the foreman starts this hunt on."""
+
+  started = []
+
+  @classmethod
+  def StartClients(cls, hunt_id, client_ids, token=None):
+    cls.started.append((hunt_id, list(client_ids)))
+
+
 class AFF4Tests(test_lib.AFF4ObjectTest):
   """Test the AFF4 abstraction."""
 
@@ -336,6 +349,40 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertTrue("XXXHello WorldXXX" in data)
     self.assertTrue("XXXYYY" in data)
 
+  def testAFF4ImageReadAhead(self):
+    path = "/C.12345/aff4imagereadahead"
+
+    fd = aff4.FACTORY.Create(path, "AFF4Image", token=self.token)
+    fd.SetChunksize(10)
+    fd.Write("".join("Chunk%04d\n" % i for i in range(100)))
+    fd.Close()
+
+    fetched = []
+    multi_open = aff4.FACTORY.MultiOpen
+
+    def MultiOpen(urns, **kwargs):
+      urns = list(urns)
+      fetched.append(len(urns))
+      return multi_open(urns, **kwargs)
+
+    with test_lib.Stubber(aff4.FACTORY, "MultiOpen", MultiOpen):
+      # Reading the whole file fetches read_ahead chunks at a time.
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      for i in range(100):
+        self.assertEqual(fd.Read(10), "Chunk%04d\n" % i)
+
+      self.assertEqual(fetched, [fd.read_ahead] * (100 / fd.read_ahead))
+
+      # Random reads only fetch the chunks they need.
+      fetched = []
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      fd.Seek(505)
+      self.assertEqual(fd.Read(20), "0050\nChunk0051\nChunk")
+      fd.Seek(305)
+      self.assertEqual(fd.Read(5), "0030\n")
+
+      self.assertEqual(fetched, [3, 1])
+
   def testAFF4ImageSize(self):
     path = "/C.12345/aff4imagesize"
 
@@ -756,6 +803,75 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertListEqual(children[client2_urn],
                          [client2_urn.Add("some2")])
 
+  def testAttributeCacheIsSharedByTokens(self):
+    urn = self.client_id.Add("cached")
+    aff4.FACTORY.Create(urn, "AFF4Volume", token=self.token).Close()
+
+    list(aff4.FACTORY.GetAttributes([urn], token=self.token))
+    hits = stats.STATS.GetMetricValue("aff4_cache_hits")
+
+    other_token = access_control.ACLToken(username="other", reason="testing")
+    list(aff4.FACTORY.GetAttributes([urn], token=other_token))
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_cache_hits"), hits + 1)
+
+    # Access to cached urns is still checked.
+    def Deny(token, subjects, requested_access="r"):
+      raise access_control.UnauthorizedAccess(
+          "Denied %s to %s" % (subjects, token.username),
+          requested_access=requested_access)
+
+    with test_lib.Stubber(data_store.DB.security_manager,
+                          "CheckDataStoreAccess", Deny):
+      self.assertRaises(access_control.UnauthorizedAccess, list,
+                        aff4.FACTORY.GetAttributes([urn], token=other_token))
+
+  def testAttributeCacheInvalidationAcrossFactories(self):
+    urn = self.client_id.Add("cached")
+    type_attribute = aff4.AFF4Object.SchemaCls.TYPE
+
+    # Two factories stand in for two processes.
+    factories = [aff4.Factory(), aff4.Factory()]
+    for factory in factories:
+      factory.invalidation_subject = "aff4:/cache_invalidation"
+      factory.invalidation_interval = 0
+
+    def Write(value):
+      factories[0].SetAttributes(urn, {type_attribute: [value]},
+                                 set([type_attribute]), sync=True,
+                                 token=self.token)
+
+    def Read():
+      for _, values in factories[1].GetAttributes([urn], token=self.token):
+        return [v for a, v, _ in values if a == str(type_attribute)]
+
+    Write("AFF4Volume")
+    self.assertEqual(Read(), ["AFF4Volume"])
+
+    Write("AFF4MemoryStream")
+    self.assertEqual(Read(), ["AFF4MemoryStream"])
+
+  def testMultiOpenWithAttributes(self):
+    client = aff4.FACTORY.Create(self.client_id, "VFSGRRClient", mode="w",
+                                 token=self.token)
+    client.Set(client.Schema.HOSTNAME("hostname"))
+    client.Set(client.Schema.SYSTEM("Linux"))
+    client.Close()
+
+    fds = list(aff4.FACTORY.MultiOpen(
+        [self.client_id], mode="r", token=self.token,
+        attributes=[client.Schema.HOSTNAME]))
+    self.assertEqual(len(fds), 1)
+
+    # The object still has the right type but only the requested attribute.
+    self.assertTrue(isinstance(fds[0], aff4_grr.VFSGRRClient))
+    self.assertEqual(fds[0].Get(fds[0].Schema.HOSTNAME), "hostname")
+    self.assertEqual(fds[0].Get(fds[0].Schema.SYSTEM), None)
+
+    # Partially read objects can not be written.
+    self.assertRaises(RuntimeError, list, aff4.FACTORY.MultiOpen(
+        [self.client_id], mode="rw", token=self.token,
+        attributes=[client.Schema.HOSTNAME]))
+
   def testIndexNotUpdatedWhenWrittenWithinIntermediateCacheAge(self):
     with test_lib.Stubber(time, "time", lambda: 100):
       fd = aff4.FACTORY.Create(
@@ -1336,6 +1452,44 @@ class ForemanTests(test_lib.AFF4ObjectTest):
                        rdfvalue.ClientURN("C.0000000000000014"))
       self.assertEqual(self.clients_launched[3][1], eq_flow)
 
+  def testHuntIsStartedOnABatchOfClients(self):
+    client_ids = ["C.00000000000000%02X" % i for i in range(0x30, 0x35)]
+    for i, client_id in enumerate(client_ids):
+      fd = aff4.FACTORY.Create(client_id, "VFSGRRClient", token=self.token)
+      fd.Set(fd.Schema.SYSTEM,
+             rdfvalue.RDFString("Windows" if i % 2 == 0 else "Linux"))
+      fd.Close()
+
+    foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+    rule = rdfvalue.ForemanRule(created=int(time.time() * 1e6),
+                                expires=int((time.time() + 3600) * 1e6),
+                                description="Test rule")
+    rule.regex_rules.Append(attribute_name=aff4_grr.VFSGRRClient.SchemaCls.
+                            SYSTEM.name, attribute_regex="Windows")
+    rule.actions.Append(hunt_id="aff4:/hunts/W:123456",
+                        hunt_name="ForemanTestHunt")
+
+    rule_set = foreman.Schema.RULES()
+    rule_set.Append(rule)
+    foreman.Set(foreman.Schema.RULES, rule_set)
+    foreman.Close()
+
+    ForemanTestHunt.started = []
+    foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+    foreman.AssignTasksToClients(client_ids)
+
+    # All the matching clients are passed to a single StartClients call.
+    self.assertEqual(len(ForemanTestHunt.started), 1)
+    hunt_id, started_clients = ForemanTestHunt.started[0]
+    self.assertEqual(hunt_id, "aff4:/hunts/W:123456")
+    self.assertEqual(started_clients,
+                     [rdfvalue.ClientURN(client_ids[i]) for i in (0, 2, 4)])
+
+    # The foreman already checked these clients so nothing happens again.
+    ForemanTestHunt.started = []
+    foreman.AssignTasksToClients(client_ids)
+    self.assertEqual(ForemanTestHunt.started, [])
+
   def testRuleExpiration(self):
     with test_lib.FakeTime(1000):
       foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""The store for the content blobs of files downloaded from clients.
+
+Clients send files in blobs which are stored once, keyed on the sha256 digest
+of their content, so identical content is only stored once no matter how many
+files contain it.
+
+Storing every blob as its own AFF4 object costs a subject with its AFF4
+metadata per blob and one synchronous data store write each. Instead, blobs are
+packed into segments: the segment of a blob is chosen by the first
+Blobstore.segment_prefix_length hex digits of its digest, and each segment is a
+single data store subject holding many blobs as attributes. Since the segment
+follows from the digest, no index is needed to find a blob, and all the blobs
+in a batch which fall into the same segment are written with one MultiSet.
+
+Blobs written before segments existed are AFF4MemoryStreams under
+aff4:/blobs/<hex digest>. They are still found by ReadBlobs and BlobsExist.
+
+BlobsExist only queries the data store for blobs which the "blobs" hash filter
+does not rule out, see hash_filter.py.
+"""
+
+
+import hashlib
+import itertools
+import zlib
+
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import hash_filter
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+# The blob store, set by BlobStoreInit.
+BLOB_STORE = None
+
+
+class BlobStore(object):
+  """Writes and reads blobs in batches."""
+
+  ROOT = rdfvalue.RDFURN("aff4:/blobs")
+  SEGMENT_ROOT = ROOT.Add("segments")
+
+  # A blob is stored under one of the content predicates, depending on whether
+  # it is compressed. The size predicate is used to check if blobs exist
+  # without reading their content.
+  RAW_PREFIX = "blob:raw/"
+  ZLIB_PREFIX = "blob:zlib/"
+  SIZE_PREFIX = "blob:size/"
+
+  def __init__(self, segment_prefix_length=None, compression_level=None):
+    """Constructor.
+
+    Args:
+      segment_prefix_length: The number of hex digits of the digest which
+        select the segment of a blob.
+      compression_level: The zlib compression level for stored blobs, 0
+        stores blobs uncompressed.
+    """
+    if segment_prefix_length is None:
+      segment_prefix_length = config_lib.CONFIG[
+          "Blobstore.segment_prefix_length"]
+
+    if compression_level is None:
+      compression_level = config_lib.CONFIG["Blobstore.compression_level"]
+
+    self.segment_prefix_length = segment_prefix_length
+    self.compression_level = compression_level
+
+  def GetSegment(self, digest):
+    """Returns the urn of the segment a blob is stored in."""
+    return self.SEGMENT_ROOT.Add(
+        digest.encode("hex")[:self.segment_prefix_length])
+
+  def _GroupBySegment(self, digests):
+    return utils.GroupBy(digests, self.GetSegment).iteritems()
+
+  def _GetFilter(self):
+    return hash_filter.FILTERS.get(BlobHashFilter.name)
+
+  def _LegacyUrn(self, digest):
+    return utils.SmartUnicode(self.ROOT.Add(digest.encode("hex")))
+
+  def WriteBlobs(self, blobs, compressed_blobs=None, sync=True, token=None):
+    """Stores blobs which are not in the store yet.
+
+    Args:
+      blobs: A list of blob contents.
+      compressed_blobs: An optional list with the zlib compressed content of
+        each blob, in the same order, or None for blobs which were not
+        compressed. These are stored instead of compressing the blobs again.
+      sync: Should the writes be synced immediately.
+      token: The token to use for data store access.
+
+    Returns:
+      A list with the sha256 digest of each blob.
+    """
+    digests = [hashlib.sha256(blob).digest() for blob in blobs]
+
+    exists = self.BlobsExist(digests, token=token)
+    new_blobs = {}
+    for i, digest in enumerate(digests):
+      if not exists[digest] and digest not in new_blobs:
+        new_blobs[digest] = i
+
+    stats.STATS.IncrementCounter("grr_blobs_deduplicated",
+                                 len(digests) - len(new_blobs))
+
+    for segment, segment_digests in self._GroupBySegment(new_blobs):
+      values = {}
+      for digest in segment_digests:
+        i = new_blobs[digest]
+        hex_digest = digest.encode("hex")
+        values[self.SIZE_PREFIX + hex_digest] = [len(blobs[i])]
+
+        if not self.compression_level:
+          values[self.RAW_PREFIX + hex_digest] = [blobs[i]]
+        elif compressed_blobs and compressed_blobs[i] is not None:
+          values[self.ZLIB_PREFIX + hex_digest] = [compressed_blobs[i]]
+        else:
+          values[self.ZLIB_PREFIX + hex_digest] = [
+              zlib.compress(blobs[i], self.compression_level)]
+
+      data_store.DB.MultiSet(segment, values, sync=sync, token=token)
+
+    stats.STATS.IncrementCounter("grr_blobs_written", len(new_blobs))
+
+    blob_filter = self._GetFilter()
+    if blob_filter:
+      blob_filter.Add(new_blobs, token=token)
+
+    return digests
+
+  def ReadBlobs(self, digests, token=None):
+    """Reads blobs from the store.
+
+    Args:
+      digests: A list of sha256 digests.
+      token: The token to use for data store access.
+
+    Returns:
+      A dict of digest -> blob content. Blobs which are not in the store are
+      left out.
+    """
+    results = {}
+    for segment, segment_digests in self._GroupBySegment(set(digests)):
+      predicates = {}
+      for digest in segment_digests:
+        hex_digest = digest.encode("hex")
+        predicates[self.RAW_PREFIX + hex_digest] = (digest, False)
+        predicates[self.ZLIB_PREFIX + hex_digest] = (digest, True)
+
+      for predicate, value, _ in data_store.DB.ResolveMulti(
+          segment, predicates.keys(), timestamp=data_store.DB.NEWEST_TIMESTAMP,
+          token=token):
+        digest, compressed = predicates[predicate]
+        value = utils.SmartStr(value)
+        results[digest] = zlib.decompress(value) if compressed else value
+
+    missing = [missing_digest for missing_digest in set(digests)
+               if missing_digest not in results]
+    if missing:
+      results.update(self._ReadLegacyBlobs(missing, token=token))
+
+    return results
+
+  def _ReadLegacyBlobs(self, digests, token=None):
+    """Reads blobs stored as AFF4MemoryStreams."""
+    urns = dict((self._LegacyUrn(digest), digest) for digest in digests)
+
+    results = {}
+    for subject, values in data_store.DB.MultiResolveRegex(
+        list(urns), "aff4:content", timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        token=token):
+      content = utils.SmartStr(values[0][1])
+      try:
+        content = zlib.decompress(content)
+      except zlib.error:
+        pass
+
+      results[urns[utils.SmartUnicode(subject)]] = content
+
+    return results
+
+  def BlobsExist(self, digests, token=None):
+    """Checks which blobs are in the store.
+
+    Args:
+      digests: A list of sha256 digests.
+      token: The token to use for data store access.
+
+    Returns:
+      A dict of digest -> bool.
+    """
+    results = dict.fromkeys(digests, False)
+
+    # Blobs which the filter rules out are not in the store.
+    blob_filter = self._GetFilter()
+    if blob_filter:
+      candidates = blob_filter.MayContain(list(results), token=token)
+    else:
+      candidates = list(results)
+
+    for segment, segment_digests in self._GroupBySegment(candidates):
+      predicates = dict((self.SIZE_PREFIX + digest.encode("hex"), digest)
+                        for digest in segment_digests)
+
+      for predicate, _, _ in data_store.DB.ResolveMulti(
+          segment, predicates.keys(), timestamp=data_store.DB.NEWEST_TIMESTAMP,
+          token=token):
+        results[predicates[predicate]] = True
+
+    urns = dict((self._LegacyUrn(digest), digest)
+                for digest in candidates if not results[digest])
+    if urns:
+      for subject, _ in data_store.DB.MultiResolveRegex(
+          list(urns), "aff4:type", token=token):
+        results[urns[utils.SmartUnicode(subject)]] = True
+
+    if blob_filter:
+      blob_filter.RecordFalsePositives(
+          len([digest for digest in candidates if not results[digest]]))
+
+    return results
+
+  def ListBlobs(self, token=None):
+    """Yields the digests of all blobs in the store."""
+    prefixes = itertools.product("0123456789abcdef",
+                                 repeat=self.segment_prefix_length)
+    segments = [self.SEGMENT_ROOT.Add("".join(prefix)) for prefix in prefixes]
+
+    for batch in utils.Grouper(segments, 256):
+      for _, values in data_store.DB.MultiResolveRegex(
+          batch, self.SIZE_PREFIX + ".*", token=token):
+        for predicate, _, _ in values:
+          yield predicate[len(self.SIZE_PREFIX):].decode("hex")
+
+    # Legacy blobs are listed in the AFF4 directory index of the root.
+    for _, values in data_store.DB.MultiResolveRegex(
+        [self.ROOT], "index:dir/.*", token=token):
+      for predicate, _, _ in values:
+        name = predicate[len("index:dir/"):]
+        if len(name) == 64:
+          yield name.decode("hex")
+
+
+class BlobHashFilter(hash_filter.HashFilter):
+  """A filter over the digests of the blobs in the blob store."""
+
+  name = "blobs"
+
+  def ListKeys(self, token=None):
+    return BLOB_STORE.ListBlobs(token=token)
+
+
+class BlobStoreInit(registry.InitHook):
+  """Creates the blob store."""
+
+  pre = ["DataStoreInit"]
+
+  def Run(self):
+    global BLOB_STORE  # pylint: disable=global-statement
+    BLOB_STORE = BlobStore()
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("grr_blobs_written")
+    stats.STATS.RegisterCounterMetric("grr_blobs_deduplicated")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Tests for the blob store."""
+
+
+import hashlib
+import zlib
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import aff4
+from grr.lib import blob_store
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+
+class BlobStoreTest(test_lib.GRRBaseTest):
+  """Tests the BlobStore."""
+
+  def setUp(self):
+    super(BlobStoreTest, self).setUp()
+    self.store = blob_store.BlobStore(segment_prefix_length=1)
+
+  def testWriteAndRead(self):
+    blobs = ["blob%d" % i * 1000 for i in range(100)]
+    digests = self.store.WriteBlobs(blobs, token=self.token)
+    self.assertEqual(digests, [hashlib.sha256(blob).digest() for blob in blobs])
+
+    result = self.store.ReadBlobs(digests + ["X" * 32], token=self.token)
+    self.assertEqual(len(result), 100)
+    for blob, digest in zip(blobs, digests):
+      self.assertEqual(result[digest], blob)
+
+    exists = self.store.BlobsExist(digests[:5] + ["X" * 32], token=self.token)
+    self.assertEqual(sum(exists.values()), 5)
+    self.assertFalse(exists["X" * 32])
+
+  def testBlobsArePackedIntoSegments(self):
+    blobs = ["blob%d" % i for i in range(100)]
+
+    written = []
+    multi_set = data_store.DB.MultiSet
+
+    def MultiSet(subject, values, **kwargs):
+      written.append(subject)
+      return multi_set(subject, values, **kwargs)
+
+    with test_lib.Stubber(data_store.DB, "MultiSet", MultiSet):
+      self.store.WriteBlobs(blobs, token=self.token)
+
+      # One write per segment, with a segment prefix of 1 there are at most 16.
+      self.assertTrue(len(written) <= 16)
+      self.assertEqual(len(written), len(set(written)))
+
+      # Blobs which are already in the store are not written again.
+      written = []
+      self.store.WriteBlobs(blobs[:10], token=self.token)
+      self.assertEqual(written, [])
+
+  def testCompressionLevel(self):
+    blob = "A" * 10000
+    digest = hashlib.sha256(blob).digest()
+    hex_digest = digest.encode("hex")
+
+    for level in [0, 1, 9]:
+      data_store.DB.Clear()
+      store = blob_store.BlobStore(segment_prefix_length=1,
+                                   compression_level=level)
+      store.WriteBlobs([blob], token=self.token)
+      self.assertEqual(store.ReadBlobs([digest], token=self.token)[digest],
+                       blob)
+
+      prefix = store.RAW_PREFIX if level == 0 else store.ZLIB_PREFIX
+      value, _ = data_store.DB.Resolve(store.GetSegment(digest),
+                                       prefix + hex_digest, token=self.token)
+      if level == 0:
+        self.assertEqual(value, blob)
+      else:
+        self.assertEqual(value, zlib.compress(blob, level))
+
+  def testCompressedBlobsAreStoredAsTheyAre(self):
+    blob = "B" * 10000
+    compressed = zlib.compress(blob, 1)
+    digest, = self.store.WriteBlobs([blob], compressed_blobs=[compressed],
+                                    token=self.token)
+
+    value, _ = data_store.DB.Resolve(
+        self.store.GetSegment(digest),
+        self.store.ZLIB_PREFIX + digest.encode("hex"), token=self.token)
+    self.assertEqual(value, compressed)
+
+  def testLegacyBlobs(self):
+    blob = "legacy blob" * 100
+    digest = hashlib.sha256(blob).digest()
+
+    fd = aff4.FACTORY.Create(rdfvalue.RDFURN("aff4:/blobs").Add(
+        digest.encode("hex")), "AFF4MemoryStream", token=self.token)
+    fd.Write(blob)
+    fd.Close(sync=True)
+
+    self.assertTrue(self.store.BlobsExist([digest], token=self.token)[digest])
+    self.assertEqual(self.store.ReadBlobs([digest], token=self.token)[digest],
+                     blob)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -238,6 +238,7 @@ class ReceivedCipher(Cipher):
       # The encrypted_cipher contains the session key, iv and hmac_key.
       self.encrypted_cipher = response_comms.encrypted_cipher
 
+      stats.STATS.IncrementCounter("grr_rsa_operations")
       # M2Crypto verifies the key on each private_decrypt call which is horribly
       # slow therefore we just call the swig wrapped method directly.
       self.serialized_cipher = m2.rsa_private_decrypt(
@@ -266,6 +267,36 @@ class ReceivedCipher(Cipher):
     except RSA.RSAError as e:
       raise DecryptionError(e)
 
+  @classmethod
+  def FromSerializedCipher(cls, encrypted_cipher, serialized_cipher,
+                           serialized_metadata, private_key=None,
+                           pub_key_cache=None):
+    """Recreates a cipher which was already decrypted and verified.
+
+    This skips the RSA operations, so it must only be used for ciphers whose
+    signature was verified before, e.g. by another frontend process.
+
+    Args:
+      encrypted_cipher: The encrypted cipher as sent by the peer.
+      serialized_cipher: The decrypted CipherProperties.
+      serialized_metadata: The decrypted CipherMetadata.
+      private_key: Our private key.
+      pub_key_cache: The cache of our peers' public keys.
+
+    Returns:
+      A ReceivedCipher with a verified signature.
+    """
+    result = cls.__new__(cls)
+    result.private_key = private_key
+    result.pub_key_cache = pub_key_cache
+    result.encrypted_cipher = encrypted_cipher
+    result.serialized_cipher = serialized_cipher
+    result.cipher = rdfvalue.CipherProperties(serialized_cipher)
+    result.cipher_metadata = rdfvalue.CipherMetadata(serialized_metadata)
+    result.signature_verified = True
+
+    return result
+
   def IsEqual(self, a, b):
     """A Constant time comparison."""
     if len(a) != len(b):
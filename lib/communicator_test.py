@@ -21,6 +21,7 @@ from grr.lib import communicator
 from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import flow
+from grr.lib import frontend_cache
 from grr.lib import rdfvalue
 # pylint: disable=unused-import
 from grr.lib import server_plugins
@@ -119,6 +120,38 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(decoded_messages[i].auth_state,
                        rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
 
+  def testSharedCipherCache(self):
+    """Test that frontend processes share the ciphers they verified."""
+    self.MakeClientAFF4Record()
+
+    shared_cache = frontend_cache.FrontendCacheClient(
+        frontend_cache.SharedFrontendCache())
+    servers = [ServerCommunicatorFake(certificate=self.server_certificate,
+                                      private_key=self.server_private_key,
+                                      token=self.token,
+                                      shared_cache=shared_cache)
+               for _ in range(2)]
+
+    # Only the first server has to decrypt the cipher, the second one finds it
+    # in the shared cache.
+    rsa_operations = stats.STATS.GetMetricValue("grr_rsa_operations")
+    for server in servers:
+      # Each server gets a new message, replayed ones would be desynchronized.
+      message_list = rdfvalue.MessageList()
+      message_list.job.Append(
+          session_id=rdfvalue.SessionID("aff4:/flows/W:1"))
+      result = rdfvalue.ClientCommunication()
+      self.client_communicator.EncodeMessages(message_list, result)
+
+      decoded_messages, source, _ = server.DecryptMessage(
+          result.SerializeToString())
+      self.assertEqual(source, self.client_communicator.common_name)
+      self.assertEqual(decoded_messages[0].auth_state,
+                       rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+    self.assertEqual(stats.STATS.GetMetricValue("grr_rsa_operations"),
+                     rsa_operations + 1)
+
   def testServerReplayAttack(self):
     """Test that replaying encrypted messages to the server invalidates them."""
     self.MakeClientAFF4Record()
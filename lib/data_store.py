@@ -513,3 +513,6 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    # Backends which can report it count the number of rows read from the
+    # underlying database.
+    stats.STATS.RegisterCounterMetric("datastore_rows_fetched")
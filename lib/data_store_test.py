@@ -889,6 +889,40 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
 
     self.AddResult("Process Messages", time_used, 1)
 
+  tasks_per_client = 10000
+
+  @test_lib.SetLabel("benchmark")
+  def testDrainClientQueue(self):
+    """Leases a large backlog of tasks the way the frontend does."""
+    client_queue = rdfvalue.ClientURN("C.1000000000000001").Queue()
+    manager = queue_manager.QueueManager(token=self.token)
+
+    tasks = [rdfvalue.GrrMessage(session_id="aff4:/flows/W:Benchmark%d" % i,
+                                 priority=i % 3, queue=client_queue)
+             for i in xrange(self.tasks_per_client)]
+
+    start_time = time.time()
+    manager.Schedule(tasks)
+    data_store.DB.Flush()
+    self.AddResult("Schedule %d tasks" % self.tasks_per_client,
+                   time.time() - start_time, 1)
+
+    start_time = time.time()
+    leased = manager.Query(client_queue, limit=100)
+    self.AddResult("Query 100 tasks", time.time() - start_time, 1)
+    self.assertEqual(len(leased), 100)
+
+    # The frontend leases 100 tasks per poll.
+    polls = 0
+    start_time = time.time()
+    while manager.QueryAndOwn(client_queue, lease_seconds=600, limit=100):
+      polls += 1
+
+    time_used = time.time() - start_time
+    self.assertEqual(polls, self.tasks_per_client / 100)
+    self.AddResult("Drain queue (100 tasks per poll)", time_used / polls,
+                   polls)
+
   @test_lib.SetLabel("benchmark")
   def testMicroBenchmarks(self):
 
@@ -903,6 +937,8 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
     self.BenchmarkWritingThreaded()
     self.BenchmarkReadingThreaded()
 
+    self.BenchmarkResolveNewest()
+
     self.BenchmarkAFF4Locks()
 
   def BenchmarkWriting(self):
@@ -1107,6 +1143,39 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
     self.AddResult("Multithreaded: Get large values",
                    (end_time - start_time) / self.small_n, self.small_n)
 
+  def BenchmarkResolveNewest(self):
+    """Reads the latest versions of a heavily versioned subject."""
+
+    subject = "aff4:/versionedrow"
+    value = os.urandom(100)
+
+    # Many versions of a few attributes and some unrelated attributes.
+    for i in xrange(self.small_n):
+      data_store.DB.MultiSet(
+          subject, {"aff4:versioned%d" % i: [
+              (value, j + 1) for j in xrange(self.n / self.small_n)]},
+          replace=False, token=self.token)
+      data_store.DB.Set(subject, "task:unrelated%d" % i, value,
+                        token=self.token)
+    data_store.DB.Flush()
+
+    fetched = stats.STATS.GetMetricValue("datastore_rows_fetched")
+    returned = 0
+
+    start_time = time.time()
+    for _ in xrange(self.small_n):
+      for _, values in data_store.DB.MultiResolveRegex(
+          [subject], "aff4:.*", timestamp=data_store.DB.NEWEST_TIMESTAMP,
+          token=self.token):
+        self.assertEqual(len(values), self.small_n)
+        returned += len(values)
+    end_time = time.time()
+
+    fetched = stats.STATS.GetMetricValue("datastore_rows_fetched") - fetched
+    self.AddResult("Get newest versions", (end_time - start_time) /
+                   self.small_n, self.small_n,
+                   "rows fetched: %d, rows returned: %d" % (fetched, returned))
+
   def BenchmarkAFF4Locks(self):
 
     self.client_id = "C.%016X" % 999
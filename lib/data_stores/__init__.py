@@ -6,6 +6,8 @@
 
 
 from grr.lib.data_stores import fake_data_store
+from grr.lib.data_stores import memory_data_store
+from grr.lib.data_stores import sharded_data_store
 try:
   from grr.lib.data_stores import mongo_data_store
   from grr.lib.data_stores import mongo_data_store_old
@@ -19,3 +21,9 @@ except ImportError:
   # MySql data store not supported.
   pass
 
+try:
+  from grr.lib.data_stores import sqlite_data_store
+except ImportError:
+  # SQLite data store not supported.
+  pass
+
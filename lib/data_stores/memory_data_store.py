@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""An indexed in-memory data store.
+
+This store has the same semantics as the FakeDataStore but is designed for large
+integration and load replay runs where the FakeDataStore becomes the
+bottleneck:
+
+  - The attribute names of each subject are kept sorted, so regexes which start
+    with a literal string (e.g. "aff4:.*" or "task:") are resolved with a bisect
+    based range scan instead of matching the regex against every attribute.
+
+  - The versions of each attribute are kept sorted by timestamp, so newest and
+    time range lookups do not scan all versions.
+
+  - Subjects are protected by a fixed set of striped locks instead of a single
+    global lock, so threads working on different subjects do not contend.
+"""
+
+
+import bisect
+import re
+import threading
+import time
+
+from grr.lib import utils
+from grr.lib.data_stores import fake_data_store
+
+
+class AttributeVersions(object):
+  """All the versions of a single attribute, sorted by timestamp."""
+
+  __slots__ = ("timestamps", "values")
+
+  def __init__(self):
+    self.timestamps = []
+    self.values = []
+
+  def Add(self, value, timestamp):
+    # Most writes are for the current time so this is usually an append.
+    index = bisect.bisect_right(self.timestamps, timestamp)
+    self.timestamps.insert(index, timestamp)
+    self.values.insert(index, value)
+
+  def Delete(self, start, end):
+    """Removes all versions with start <= timestamp <= end."""
+    first = bisect.bisect_left(self.timestamps, start)
+    last = bisect.bisect_right(self.timestamps, end)
+    del self.timestamps[first:last]
+    del self.values[first:last]
+
+  def Select(self, start, end, newest_only=False):
+    """Returns (value, timestamp) tuples in the range, oldest first."""
+    first = bisect.bisect_left(self.timestamps, start)
+    last = bisect.bisect_right(self.timestamps, end)
+    if newest_only:
+      first = max(first, last - 1)
+
+    return zip(self.values[first:last], self.timestamps[first:last])
+
+  def __len__(self):
+    return len(self.timestamps)
+
+
+class SubjectRecord(object):
+  """The attributes of a single subject, indexed by name."""
+
+  __slots__ = ("attributes", "names")
+
+  def __init__(self):
+    # Maps attribute names to AttributeVersions.
+    self.attributes = {}
+    # The sorted list of attribute names.
+    self.names = []
+
+  def GetVersions(self, name, create=False):
+    """Returns the AttributeVersions of this attribute."""
+    versions = self.attributes.get(name)
+    if versions is None and create:
+      versions = self.attributes[name] = AttributeVersions()
+      bisect.insort(self.names, name)
+
+    return versions
+
+  def DeleteAttribute(self, name):
+    if self.attributes.pop(name, None) is not None:
+      del self.names[bisect.bisect_left(self.names, name)]
+
+  def MatchAttributes(self, prefix, regex=None):
+    """Yields the attribute names starting with prefix which match the regex."""
+    index = bisect.bisect_left(self.names, prefix)
+    while index < len(self.names):
+      name = self.names[index]
+      if not name.startswith(prefix):
+        break
+
+      if regex is None or regex.match(utils.SmartStr(name)):
+        yield name
+
+      index += 1
+
+
+class MemoryDataStore(fake_data_store.FakeDataStore):
+  """An indexed in-memory data store with striped subject locks."""
+
+  # The number of locks subjects are spread over.
+  LOCK_STRIPES = 64
+
+  # The maximum number of compiled predicate regexes we keep.
+  MAX_REGEX_CACHE = 1000
+
+  def __init__(self):
+    super(MemoryDataStore, self).__init__()
+    self.subject_locks = [threading.RLock() for _ in xrange(self.LOCK_STRIPES)]
+    self.regex_cache = {}
+
+  def _GetLock(self, subject):
+    return self.subject_locks[hash(subject) % self.LOCK_STRIPES]
+
+  def _CompileRegex(self, regex):
+    """Returns the literal prefix and a matcher for the rest of the regex.
+
+    Args:
+      regex: The predicate regex.
+
+    Returns:
+      A tuple (prefix, compiled_regex). compiled_regex is None if every
+      attribute starting with prefix matches.
+    """
+    try:
+      return self.regex_cache[regex]
+    except KeyError:
+      pass
+
+    prefix, remainder = utils.RegexLiteralPrefix(regex)
+    if remainder in ("", ".*"):
+      result = (utils.SmartUnicode(prefix), None)
+    else:
+      result = (utils.SmartUnicode(prefix), re.compile(regex))
+
+    if len(self.regex_cache) >= self.MAX_REGEX_CACHE:
+      self.regex_cache = {}
+
+    self.regex_cache[regex] = result
+    return result
+
+  def _TimestampRange(self, timestamp):
+    """Converts a timestamp specification to a (start, end) tuple."""
+    if isinstance(timestamp, (list, tuple)):
+      start, end = timestamp
+      return int(start), int(end)
+
+    return -1, 1 << 65
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    subject = utils.SmartUnicode(subject)
+    with self._GetLock(subject):
+      self.subjects.pop(subject, None)
+
+  def Set(self, subject, attribute, value, timestamp=None, token=None,
+          replace=True, sync=True):
+    self.MultiSet(subject, {attribute: [value]}, timestamp=timestamp,
+                  token=token, replace=replace, sync=sync)
+
+  def MultiSet(self, subject, values, timestamp=None, token=None,
+               replace=True, sync=True, to_delete=None):
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = time.time() * 1000000
+
+    subject = utils.SmartUnicode(subject)
+    with self._GetLock(subject):
+      if to_delete:
+        self.DeleteAttributes(subject, to_delete, token=token)
+
+      record = self.subjects.get(subject)
+      if record is None:
+        record = self.subjects[subject] = SubjectRecord()
+
+      for attribute, seq in values.items():
+        attribute = utils.SmartUnicode(attribute)
+        if replace:
+          record.DeleteAttribute(attribute)
+
+        if not seq:
+          continue
+
+        versions = record.GetVersions(attribute, create=True)
+        for value in seq:
+          if isinstance(value, (list, tuple)):
+            value, element_timestamp = value
+          else:
+            element_timestamp = timestamp
+
+          if element_timestamp is None:
+            element_timestamp = timestamp
+
+          versions.Add(self._Encode(value), int(element_timestamp))
+
+  def DeleteAttributes(self, subject, attributes, start=None, end=None,
+                       token=None, sync=None):
+    _ = sync  # Unimplemented.
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    subject = utils.SmartUnicode(subject)
+    start = start or 0
+    end = end or (2 ** 63) - 1  # sys.maxint
+
+    with self._GetLock(subject):
+      record = self.subjects.get(subject)
+      if record is None:
+        return
+
+      for attribute in attributes:
+        attribute = utils.SmartUnicode(attribute)
+        versions = record.GetVersions(attribute)
+        if versions is None:
+          continue
+
+        versions.Delete(start, end)
+        if not versions:
+          record.DeleteAttribute(attribute)
+
+  def DeleteAttributesRegex(self, subject, regexes, token=None):
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    subject = utils.SmartUnicode(subject)
+
+    with self._GetLock(subject):
+      record = self.subjects.get(subject)
+      if record is None:
+        return
+
+      for regex in regexes:
+        prefix, compiled_regex = self._CompileRegex(regex)
+        for attribute in list(record.MatchAttributes(prefix, compiled_regex)):
+          record.DeleteAttribute(attribute)
+
+  def MultiResolveRegex(self, subjects, predicate_regex, token=None,
+                        timestamp=None, limit=None):
+    result = {}
+    for subject in subjects:
+      # If any of the subjects is forbidden we fail the entire request.
+      self.security_manager.CheckDataStoreAccess(token, [subject], "r")
+
+      values = self.ResolveRegex(subject, predicate_regex, token=token,
+                                 timestamp=timestamp, limit=limit)
+
+      if values:
+        result[subject] = values
+        if limit:
+          limit -= len(values)
+
+    return result.iteritems()
+
+  def ResolveMulti(self, subject, predicates, token=None, timestamp=None):
+    self.security_manager.CheckDataStoreAccess(token, [subject], "r")
+    start, end = self._TimestampRange(timestamp)
+    newest_only = timestamp == self.NEWEST_TIMESTAMP
+
+    if isinstance(predicates, basestring):
+      predicates = [predicates]
+
+    subject = utils.SmartUnicode(subject)
+    results = []
+    with self._GetLock(subject):
+      record = self.subjects.get(subject)
+      if record is None:
+        return
+
+      # Return the results in the same order they requested.
+      for predicate in predicates:
+        versions = record.GetVersions(utils.SmartUnicode(predicate))
+        if versions is None:
+          continue
+
+        for value, ts in versions.Select(start, end, newest_only=newest_only):
+          results.append((predicate, value, ts))
+
+    for result in results:
+      yield result
+
+  def ResolveRegex(self, subject, predicate_regex, token=None,
+                   timestamp=None, limit=None):
+    """Resolve all predicates for a subject matching a regex."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "r")
+    start, end = self._TimestampRange(timestamp)
+    newest_only = timestamp == self.NEWEST_TIMESTAMP
+
+    if isinstance(predicate_regex, basestring):
+      predicate_regex = [predicate_regex]
+
+    subject = utils.SmartUnicode(subject)
+    with self._GetLock(subject):
+      record = self.subjects.get(subject)
+      if record is None:
+        return []
+
+      # Each attribute is only reported once, even if several regexes match.
+      attributes = set()
+      for regex in predicate_regex:
+        prefix, compiled_regex = self._CompileRegex(regex)
+        attributes.update(record.MatchAttributes(prefix, compiled_regex))
+
+      result = []
+      for attribute in sorted(attributes):
+        for value, ts in record.attributes[attribute].Select(
+            start, end, newest_only=newest_only):
+          result.append((attribute, value, ts))
+
+          if limit and len(result) >= limit:
+            return result
+
+    return result
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Tests the indexed in-memory data store."""
+
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.data_stores import memory_data_store
+
+
+class MemoryTestMixin(object):
+  """A mixin for the memory data store tests."""
+
+  def InitTable(self):
+    """Initializes the data store."""
+    self.old_data_store = data_store.DB
+    data_store.DB = memory_data_store.MemoryDataStore()
+    data_store.DB.security_manager = test_lib.MockSecurityManager()
+
+  def RestoreTable(self):
+    data_store.DB = self.old_data_store
+
+  def testCorrectDataStore(self):
+    """Makes sure the correct implementation is tested."""
+    self.assertTrue(isinstance(data_store.DB,
+                               memory_data_store.MemoryDataStore))
+
+
+class MemoryDataStoreTest(MemoryTestMixin, data_store_test.DataStoreTest):
+  """Test the memory data store."""
+
+  def setUp(self):
+    super(MemoryDataStoreTest, self).setUp()
+    self.InitTable()
+
+  def tearDown(self):
+    self.RestoreTable()
+    super(MemoryDataStoreTest, self).tearDown()
+
+  def testPrefixScan(self):
+    """Regexes with a literal prefix only return attributes in the range."""
+    data_store.DB.MultiSet(self.test_row,
+                           {"aff4:a": ["1"], "aff4:b": ["2"], "aff5:c": ["3"],
+                            "aff:d": ["4"], "task:e": ["5"]},
+                           token=self.token)
+
+    result = data_store.DB.ResolveRegex(self.test_row, "aff4:.*",
+                                        token=self.token)
+    self.assertEqual([x[0] for x in result], ["aff4:a", "aff4:b"])
+
+    result = data_store.DB.ResolveRegex(self.test_row, "aff[45]:.*",
+                                        token=self.token)
+    self.assertEqual([x[0] for x in result], ["aff4:a", "aff4:b", "aff5:c"])
+
+    result = data_store.DB.ResolveRegex(self.test_row, ["aff4:b", "task:"],
+                                        token=self.token)
+    self.assertEqual([x[0] for x in result], ["aff4:b", "task:e"])
+
+  def testOutOfOrderVersions(self):
+    """Versions written out of order are still returned sorted."""
+    for timestamp in [30, 10, 20]:
+      data_store.DB.Set(self.test_row, "aff4:ooo", str(timestamp),
+                        timestamp=timestamp, replace=False, token=self.token)
+
+    result = data_store.DB.ResolveRegex(
+        self.test_row, "aff4:ooo", timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token)
+    self.assertEqual([x[2] for x in result], [10, 20, 30])
+
+    self.assertEqual(data_store.DB.Resolve(self.test_row, "aff4:ooo",
+                                           token=self.token), ("30", 30))
+
+
+class MemoryDataStoreBenchmarks(MemoryTestMixin,
+                                data_store_test.DataStoreBenchmarks):
+  """Benchmark the memory data store."""
+
+  def setUp(self):
+    super(MemoryDataStoreBenchmarks, self).setUp()
+    self.InitTable()
+
+  def tearDown(self):
+    self.RestoreTable()
+    super(MemoryDataStoreBenchmarks, self).tearDown()
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
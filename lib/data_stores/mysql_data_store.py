@@ -4,7 +4,9 @@
 """An implementation of a data store based on mysql."""
 
 
-import Queue
+import atexit
+import logging
+import re
 import threading
 import time
 import MySQLdb
@@ -13,6 +15,7 @@ from MySQLdb import cursors
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 
 
@@ -24,8 +27,22 @@ class Error(data_store.Error):
 class MySQLConnection(object):
   """A Class to manage MySQL database connections."""
 
-  def __init__(self, queue=None):
-    self.queue = queue
+  # MySQL client errors which mean the server connection was lost.
+  CONNECTION_LOST_ERRORS = (2006, 2013)
+
+  def __init__(self, pool=None):
+    self.pool = pool
+    # The time this connection was last returned to the pool.
+    self.last_used = time.time()
+    # Set when the connection can not be used any more.
+    self.broken = False
+    # Number of statements run since the last commit.
+    self.uncommitted = 0
+    # How many times this connection is pinned to its thread.
+    self.pin_count = 0
+    # The ident of the thread the connection is pinned to.
+    self.pin_thread = None
+
     try:
       self._MakeConnection(database=config_lib.CONFIG["Mysql.database_name"])
     except MySQLdb.OperationalError as e:
@@ -56,6 +73,7 @@ class MySQLConnection(object):
       self.dbh = MySQLdb.connect(**connection_args)
       self.cursor = self.dbh.cursor()
       self.cursor.connection.autocommit(False)
+      self.uncommitted = 0
 
       return self.dbh
     except MySQLdb.OperationalError as e:
@@ -64,54 +82,304 @@ class MySQLConnection(object):
         raise Error(str(e))
       raise
 
+  def _Reconnect(self):
+    stats.STATS.IncrementCounter("mysql_reconnects")
+    self.Close()
+    self._MakeConnection(database=config_lib.CONFIG["Mysql.database_name"])
+
   def __enter__(self):
     return self
 
   def __exit__(self, unused_type, unused_value, unused_traceback):
     try:
       self.Commit()
+    except MySQLdb.Error:
+      self.broken = True
+      raise
     finally:
-      # Return ourselves to the pool queue.
-      if self.queue:
-        self.queue.put(self)
+      # Return ourselves to the pool.
+      if self.pool:
+        self.pool.Release(self)
 
   def Commit(self):
     self.dbh.commit()
+    self.uncommitted = 0
+
+  def Close(self):
+    try:
+      self.dbh.close()
+    except MySQLdb.Error:
+      pass
+
+  def CheckHealth(self):
+    """Makes sure the connection is still usable, reconnecting if not.
+
+    Returns:
+      True if the connection is usable.
+    """
+    try:
+      self.dbh.ping()
+      return True
+    except MySQLdb.Error:
+      pass
+
+    try:
+      self._Reconnect()
+      return True
+    except MySQLdb.Error as e:
+      logging.warning("Unable to reconnect to mysql: %s", e)
+      self.broken = True
+      return False
 
   def Execute(self, *args):
+    """Runs a query, reconnecting if the server connection was lost.
+
+    The query is retried once on a fresh connection if nothing else was run
+    in the current transaction, since then nothing can be lost by the retry.
+
+    Args:
+      *args: The query and its arguments.
+
+    Returns:
+      All the rows returned by the query.
+    """
     try:
       self.cursor.execute(*args)
+      self.uncommitted += 1
 
       return self.cursor.fetchall()
+    except MySQLdb.OperationalError as e:
+      if e.args and e.args[0] in self.CONNECTION_LOST_ERRORS:
+        retry = self.uncommitted == 0
+        self._Reconnect()
+        if retry:
+          self.cursor.execute(*args)
+          self.uncommitted += 1
+          return self.cursor.fetchall()
+
+      else:
+        # If the connection becomes stale we reconnect.
+        self._Reconnect()
+
+      raise
     except MySQLdb.Error:
-      # If the connection becomes stale we reconnect.
-      self._MakeConnection(database=config_lib.CONFIG["Mysql.database_name"])
+      self._Reconnect()
       raise
 
 
 class ConnectionPool(object):
   """A pool of connections to the mysql server.
 
+  The pool opens connections on demand up to Mysql.conn_pool_max and closes
+  connections idle for longer than Mysql.conn_pool_idle_timeout, keeping at
+  least Mysql.conn_pool_min. Connections which were idle for a while are
+  checked before they are handed out.
+
+  A thread can pin a connection, after which all the connections it gets from
+  the pool are the pinned one until it is unpinned. This keeps code which holds
+  a lock, like MySQLTransaction, from waiting for a second connection.
+
   Usage:
 
   with data_store.DB.pool.GetConnection() as connection:
     connection.Execute(.....)
   """
 
-  def __init__(self, pool_size=5):
-    self.connections = Queue.Queue()
-    for _ in range(pool_size):
-      self.connections.put(MySQLConnection(self.connections))
+  # Connections idle for longer than this (in seconds) are pinged before use.
+  HEALTH_CHECK_INTERVAL = 60
+
+  def __init__(self, min_size=None, max_size=None, idle_timeout=None):
+    if min_size is None:
+      min_size = config_lib.CONFIG["Mysql.conn_pool_min"]
+    if max_size is None:
+      max_size = config_lib.CONFIG["Mysql.conn_pool_max"]
+    if idle_timeout is None:
+      idle_timeout = config_lib.CONFIG["Mysql.conn_pool_idle_timeout"]
+
+    self.min_size = min_size
+    self.max_size = max(min_size, max_size)
+    self.idle_timeout = idle_timeout
+
+    self.condition = threading.Condition()
+    # The idle connections, the least recently used first.
+    self.idle = []
+    # The number of connections which are open or being opened.
+    self.size = 0
+
+    self.local = threading.local()
+
+    stats.STATS.RegisterGaugeMetric("mysql_pool_connections", int)
+    stats.STATS.SetGaugeCallback("mysql_pool_connections", lambda: self.size)
+    stats.STATS.RegisterGaugeMetric("mysql_pool_idle_connections", int)
+    stats.STATS.SetGaugeCallback("mysql_pool_idle_connections",
+                                 lambda: len(self.idle))
+    stats.STATS.RegisterCounterMetric("mysql_pool_checkouts")
+    stats.STATS.RegisterCounterMetric("mysql_reconnects")
+    stats.STATS.RegisterEventMetric("mysql_pool_wait_time")
+
+    for _ in range(min_size):
+      self.size += 1
+      self.idle.append(self._NewConnection())
+
+  def _NewConnection(self):
+    try:
+      return MySQLConnection(self)
+    except Exception:
+      with self.condition:
+        self.size -= 1
+        self.condition.notify()
+      raise
 
   def GetConnection(self):
-    return self.connections.get(block=True)
+    """Returns a connection, waiting until one is available."""
+    pinned = getattr(self.local, "pinned", None)
+    if pinned is not None:
+      # The pin may have been released by another thread, after which the
+      # connection can be pinned by someone else.
+      current_thread = threading.current_thread().ident
+      with self.condition:
+        if pinned.pin_count and pinned.pin_thread == current_thread:
+          return pinned
+
+      self.local.pinned = None
+
+    while True:
+      connection = self._Checkout()
+      if (time.time() - connection.last_used < self.HEALTH_CHECK_INTERVAL or
+          connection.CheckHealth()):
+        return connection
+
+      self.Release(connection)
+
+  def _Checkout(self):
+    start = time.time()
+    with self.condition:
+      while not self.idle and self.size >= self.max_size:
+        self.condition.wait()
+
+      stats.STATS.IncrementCounter("mysql_pool_checkouts")
+      stats.STATS.RecordEvent("mysql_pool_wait_time", time.time() - start)
+
+      # Reuse the most recently used connection so the others can time out.
+      if self.idle:
+        return self.idle.pop()
+
+      self.size += 1
+
+    return self._NewConnection()
+
+  def Release(self, connection):
+    """Returns a connection to the pool."""
+    if connection.pin_count:
+      return
+
+    now = time.time()
+    to_close = []
+    with self.condition:
+      if connection.broken:
+        self.size -= 1
+        to_close.append(connection)
+      else:
+        connection.last_used = now
+        self.idle.append(connection)
+
+      # Shrink the pool by closing connections nobody used for a while.
+      while (self.size > self.min_size and self.idle and
+             now - self.idle[0].last_used > self.idle_timeout):
+        self.size -= 1
+        to_close.append(self.idle.pop(0))
+
+      self.condition.notify()
+
+    for connection in to_close:
+      connection.Close()
+
+  def PinConnection(self):
+    """Pins a connection to this thread until UnpinConnection is called.
+
+    Pins nest, the connection is only released on the last UnpinConnection.
+
+    Returns:
+      The pinned connection.
+    """
+    connection = self.GetConnection()
+    with self.condition:
+      connection.pin_count += 1
+      connection.pin_thread = threading.current_thread().ident
+    self.local.pinned = connection
+    return connection
+
+  def UnpinConnection(self, connection):
+    with self.condition:
+      connection.pin_count -= 1
+      if connection.pin_count:
+        return
+
+      # This might be called from a different thread (e.g. when a transaction
+      # is garbage collected). The owning thread then still refers to the
+      # connection, but GetConnection() only reuses it while it is pinned to
+      # that thread.
+      connection.pin_thread = None
+
+    if getattr(self.local, "pinned", None) is connection:
+      self.local.pinned = None
+
+    connection.Commit()
+    self.Release(connection)
+
+
+class PendingWrites(object):
+  """The coalesced writes waiting to be flushed for a single subject."""
+
+  def __init__(self):
+    # Attributes to delete before any of the rows are inserted.
+    self.to_delete = set()
+    # Maps attributes to lists of rows to insert.
+    self.rows = {}
+
+  def Add(self, to_delete, rows):
+    """Merges a write into the pending writes.
+
+    Rows which are still pending for deleted attributes are dropped since they
+    would be deleted right after being written.
+
+    Args:
+      to_delete: A set of attribute names to delete.
+      rows: A list of (attribute name, row) tuples to insert.
+
+    Returns:
+      The change in the number of pending rows.
+    """
+    delta = 0
+    for attribute in to_delete:
+      delta -= len(self.rows.pop(attribute, []))
+      self.to_delete.add(attribute)
+
+    for attribute, row in rows:
+      self.rows.setdefault(attribute, []).append(row)
+      delta += 1
+
+    return delta
 
 
 class MySQLDataStore(data_store.DataStore):
-  """A mysql based data store."""
+  """A mysql based data store.
+
+  Asynchronous writes (sync=False) are coalesced per subject in a bounded queue
+  and written by a background thread as multi row inserts and batched deletes.
+  The queue is flushed once it holds Mysql.write_batch_rows rows or every
+  Mysql.flush_interval seconds. Writers block while it is full and Flush() waits
+  until everything queued before it was called has been written.
+
+  Synchronous writes and deletes of a subject which has writes queued or being
+  flushed wait for those writes first, so they are never reordered.
+  """
 
   POOL = None
 
+  # Maximum number of subjects we delete from in one statement.
+  DELETE_BATCH_SUBJECTS = 100
+
   def __init__(self):
     # Use the global connection pool.
     if MySQLDataStore.POOL is None:
@@ -119,11 +387,70 @@ class MySQLDataStore(data_store.DataStore):
 
     self.pool = self.POOL
 
-    self.lock = threading.Lock()
-    self.to_set = []
+    # The pending writes keyed by subject and the total number of pending rows,
+    # protected by this condition.
+    self.pending_condition = threading.Condition()
+    self.pending = {}
+    self.pending_rows = 0
+
+    # Only one flush writes at the same time so writes are never reordered.
+    self.flush_lock = threading.Lock()
+    # The subjects the running flush is writing, protected by
+    # pending_condition.
+    self.flushing = set()
+
+    self.max_pending_rows = config_lib.CONFIG["Mysql.max_pending_rows"]
+    self.write_batch_rows = config_lib.CONFIG["Mysql.write_batch_rows"]
+    self.flush_interval = config_lib.CONFIG["Mysql.flush_interval"]
+
     self.table_name = config_lib.CONFIG["Mysql.table_name"]
+
+    stats.STATS.RegisterGaugeMetric("mysql_write_queue_rows", int)
+    stats.STATS.SetGaugeCallback("mysql_write_queue_rows",
+                                 lambda: self.pending_rows)
+    stats.STATS.RegisterCounterMetric("mysql_write_queue_blocked")
+    stats.STATS.RegisterEventMetric("mysql_insert_batch_size",
+                                    bins=[1, 10, 100, 1000, 10000])
+    stats.STATS.RegisterEventMetric("mysql_delete_batch_size",
+                                    bins=[1, 10, 100, 1000])
+
     super(MySQLDataStore, self).__init__()
 
+    # Cleared by Stop() to end the writer thread.
+    self.running = True
+    self.writer_thread = threading.Thread(target=self._WriterLoop)
+    self.writer_thread.daemon = True
+    self.writer_thread.start()
+
+    atexit.register(self.Stop)
+
+  def _WriterLoop(self):
+    """Flushes the pending writes when enough have queued up or on a timer."""
+    while self.running:
+      with self.pending_condition:
+        if self.running and self.pending_rows < self.write_batch_rows:
+          self.pending_condition.wait(self.flush_interval)
+
+      try:
+        self.Flush()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error("Error flushing mysql writes: %s", e)
+
+  def Stop(self):
+    """Stops the writer thread and writes everything still queued.
+
+    Writes made after this are synchronous.
+    """
+    with self.pending_condition:
+      if not self.running:
+        return
+
+      self.running = False
+      self.pending_condition.notify_all()
+
+    self.writer_thread.join()
+    self.Flush()
+
   def Initialize(self):
     with self.pool.GetConnection() as connection:
       try:
@@ -165,6 +492,7 @@ class MySQLDataStore(data_store.DataStore):
     if not attributes:
       return
 
+    self._FlushSubject(subject)
     with self.pool.GetConnection() as cursor:
       query = ("delete from `%s` where hash=md5(%%s) and "
                "subject=%%s and attribute in (%s) " % (
@@ -185,6 +513,7 @@ class MySQLDataStore(data_store.DataStore):
 
     conditions = ["attribute rlike (%s)"] * len(regexes)
 
+    self._FlushSubject(subject)
     with self.pool.GetConnection() as cursor:
       query = ("delete from `%s` where hash=md5(%%s) and "
                "subject=%%s and (%s) " % (
@@ -195,6 +524,7 @@ class MySQLDataStore(data_store.DataStore):
 
   def DeleteSubject(self, subject, token=None):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    self._FlushSubject(subject)
     with self.pool.GetConnection() as cursor:
       query = ("delete from `%s` where hash=md5(%%s) and subject=%%s  " %
                self.table_name)
@@ -203,11 +533,94 @@ class MySQLDataStore(data_store.DataStore):
       cursor.Execute(query, args)
 
   def Flush(self):
-    with self.lock:
-      to_set = self.to_set
-      self.to_set = []
+    """Writes all pending writes to the database.
+
+    When this returns all writes queued before it was called are written.
+    """
+    with self.flush_lock:
+      with self.pending_condition:
+        pending = self.pending
+        self.pending = {}
+        pending_rows = self.pending_rows
+        self.pending_rows = 0
+        self.flushing = set(pending)
+
+      if not pending:
+        return
 
-    self._MultiSet(to_set)
+      try:
+        self._WritePending(pending)
+      finally:
+        with self.pending_condition:
+          self.flushing = set()
+          # Wake up writers waiting for space in the queue.
+          self.pending_condition.notify_all()
+
+      logging.debug("Flushed %d rows for %d subjects.", pending_rows,
+                    len(pending))
+
+  def _HasPendingWrites(self, subject):
+    """Are there writes for this subject which are queued or being flushed?"""
+    with self.pending_condition:
+      return subject in self.pending or subject in self.flushing
+
+  def _FlushSubject(self, subject):
+    """Flushes pending writes if there are any for this subject."""
+    if self._HasPendingWrites(utils.SmartUnicode(subject)):
+      self.Flush()
+
+  def _QueueWrite(self, subject, to_delete, rows):
+    """Adds a write to the pending queue, blocking while it is full."""
+    with self.pending_condition:
+      if self.pending_rows >= self.max_pending_rows:
+        stats.STATS.IncrementCounter("mysql_write_queue_blocked")
+        while self.pending_rows >= self.max_pending_rows:
+          self.pending_condition.notify_all()
+          self.pending_condition.wait(self.flush_interval)
+
+      pending = self.pending.setdefault(subject, PendingWrites())
+      self.pending_rows += pending.Add(to_delete, rows)
+
+      # Wake up the writer thread if we have a full batch.
+      if self.pending_rows >= self.write_batch_rows:
+        self.pending_condition.notify_all()
+
+  def _WritePending(self, pending):
+    """Writes a dict of PendingWrites keyed by subject to the database."""
+    deletes = []
+    rows = []
+    for subject, writes in pending.iteritems():
+      if writes.to_delete:
+        deletes.append((subject, writes.to_delete))
+
+      for attribute_rows in writes.rows.itervalues():
+        rows.extend(attribute_rows)
+
+    with self.pool.GetConnection() as cursor:
+      # Deletes have to go first since they apply to older rows only.
+      for batch in utils.Grouper(deletes, self.DELETE_BATCH_SUBJECTS):
+        conditions = []
+        args = []
+        for subject, attributes in batch:
+          conditions.append("(hash=md5(%%s) and subject=%%s and "
+                            "attribute in (%s))" %
+                            ",".join(["%s"] * len(attributes)))
+          args.extend([subject, subject])
+          args.extend(attributes)
+
+        cursor.Execute("delete from `%s` where %s" % (
+            self.table_name, " or ".join(conditions)), args)
+        stats.STATS.RecordEvent("mysql_delete_batch_size", len(batch))
+
+      for batch in utils.Grouper(rows, self.write_batch_rows):
+        query = ("insert into `%s` (hash, subject, age, attribute, prefix, "
+                 "value_string, value_integer, value_binary) values " %
+                 self.table_name)
+        query += ", ".join(["(md5(%s), %s, %s, %s, %s, %s, %s, %s)"] *
+                           len(batch))
+
+        cursor.Execute(query, [arg for row in batch for arg in row])
+        stats.STATS.RecordEvent("mysql_insert_batch_size", len(batch))
 
   def Escape(self, string):
     """Escape the string so it can be interpolated into an sql statement."""
@@ -220,19 +633,15 @@ class MySQLDataStore(data_store.DataStore):
     """Resolves multiple predicates at once for one subject."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "r")
 
-    with self.pool.GetConnection() as cursor:
-      query = ("select * from `%s` where hash = md5(%%s) and "
-               "subject = %%s  and attribute in (%s) " % (
-                   self.table_name,
-                   ",".join(["%s"] * len(predicates)),
-                   ))
-
-      args = [subject, subject] + predicates[:]
-
-      query += self._TimestampToQuery(timestamp, args)
+    args = [subject, subject] + predicates[:]
+    condition = ("hash = md5(%%s) and subject = %%s and attribute in (%s)" %
+                 ",".join(["%s"] * len(predicates)))
 
-      result = cursor.Execute(query, args)
+    with self.pool.GetConnection() as cursor:
+      result = cursor.Execute(self._BuildQuery(condition, timestamp, args),
+                              args)
 
+    stats.STATS.IncrementCounter("datastore_rows_fetched", len(result))
     for row in result:
       subject = row["subject"]
       value = self.DecodeValue(row)
@@ -252,57 +661,136 @@ class MySQLDataStore(data_store.DataStore):
 
     return query
 
+  def _BuildQuery(self, condition, timestamp, args):
+    """Builds a select statement for rows matching the condition.
+
+    For NEWEST_TIMESTAMP queries the database only returns the latest version of
+    each attribute, rather than sending all versions over the wire to be
+    filtered here.
+
+    Args:
+      condition: An sql fragment selecting the rows of interest.
+      timestamp: The timestamp specification as passed to the Resolve methods.
+      args: The list of args for the condition. Any additional args needed by
+        the query will be appended to it.
+
+    Returns:
+      The query string.
+    """
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      # The null safe comparison (<=>) keeps rows without an age, such as the
+      # transaction locks.
+      return ("select t.* from `%(table)s` as t inner join ("
+              "select hash, subject, attribute, max(age) as age "
+              "from `%(table)s` where %(condition)s "
+              "group by hash, subject, attribute) as latest "
+              "on t.hash = latest.hash and t.subject = latest.subject and "
+              "t.attribute = latest.attribute and t.age <=> latest.age "
+              "order by t.age desc " % dict(table=self.table_name,
+                                            condition=condition))
+
+    query = "select * from `%s` where %s " % (self.table_name, condition)
+    return query + self._TimestampToQuery(timestamp, args)
+
+  def _EscapeLike(self, string):
+    return re.sub(r"([\\%_])", r"\\\1", string)
+
+  def _PredicateRegexToQuery(self, predicate_regex, args):
+    """Converts predicate regexes to an sql condition and adds args.
+
+    Regexes are anchored at the start of the attribute. Where a regex starts
+    with a literal string (e.g. "aff4:.*" or "task:") we use an indexed range
+    scan on the attribute (and an equality test on the prefix column) instead of
+    running rlike over all the attributes of the subject.
+
+    Args:
+      predicate_regex: A list of predicate regexes.
+      args: The list of args. Args for the condition are appended to it.
+
+    Returns:
+      An sql fragment which matches any of the predicate regexes.
+    """
+    conditions = []
+    for regex in predicate_regex:
+      regex = utils.SmartUnicode(regex)
+      literal, remainder = utils.RegexLiteralPrefix(regex)
+
+      if not literal:
+        conditions.append("attribute rlike %s")
+        args.append("^(%s)" % regex)
+        continue
+
+      condition = []
+      if ":" in literal:
+        # The prefix column holds everything before the first colon.
+        condition.append("prefix = %s")
+        args.append(literal.split(":", 1)[0])
+
+      if remainder == "$":
+        condition.append("attribute = %s")
+        args.append(literal)
+      else:
+        condition.append("attribute like %s")
+        args.append(self._EscapeLike(literal) + "%")
+
+        # A literal followed by .* needs no further filtering.
+        if remainder not in ("", ".*"):
+          condition.append("attribute rlike %s")
+          args.append("^(%s)" % regex)
+
+      conditions.append("(%s)" % " and ".join(condition))
+
+    return " or ".join(conditions)
+
   def MultiResolveRegex(self, subjects, predicate_regex, token=None,
                         timestamp=None, limit=None):
     self.security_manager.CheckDataStoreAccess(token, subjects, "r")
     if not subjects:
       return {}
 
-    with self.pool.GetConnection() as cursor:
-      query = "select * from `%s` where hash in (%s) and subject in (%s) " % (
-          self.table_name, ",".join(["md5(%s)"] * len(subjects)),
-          ",".join(["%s"] * len(subjects)),
-          )
-
-      # Allow users to specify a single string here.
-      if isinstance(predicate_regex, basestring):
-        predicate_regex = [predicate_regex]
+    # Allow users to specify a single string here.
+    if isinstance(predicate_regex, basestring):
+      predicate_regex = [predicate_regex]
 
-      query += "and (" + " or ".join(
-          ["attribute rlike %s"] * len(predicate_regex)) + ")"
+    args = list(subjects) + list(subjects)
+    condition = "hash in (%s) and subject in (%s) and (%s)" % (
+        ",".join(["md5(%s)"] * len(subjects)),
+        ",".join(["%s"] * len(subjects)),
+        self._PredicateRegexToQuery(predicate_regex, args))
 
-      args = list(subjects) + list(subjects) + predicate_regex
+    with self.pool.GetConnection() as cursor:
+      rows = cursor.Execute(self._BuildQuery(condition, timestamp, args), args)
 
-      query += self._TimestampToQuery(timestamp, args)
+    stats.STATS.IncrementCounter("datastore_rows_fetched", len(rows))
 
-      seen = set()
-      result = {}
+    seen = set()
+    result = {}
 
-      for row in cursor.Execute(query, args):
-        subject = row["subject"]
-        value = self.DecodeValue(row)
+    for row in rows:
+      subject = row["subject"]
+      value = self.DecodeValue(row)
 
-        # Only record the latest results. This is suboptimal since it always
-        # returns all the results from the db. Can we do better with better SQL?
-        if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
-          if (row["attribute"], row["subject"]) in seen:
-            continue
-          else:
-            seen.add((row["attribute"], row["subject"]))
+      # The database only returns the latest versions but there may be
+      # several of those if they share the same timestamp.
+      if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+        if (row["attribute"], row["subject"]) in seen:
+          continue
+        else:
+          seen.add((row["attribute"], row["subject"]))
 
-        result.setdefault(subject, []).append((row["attribute"], value,
-                                               row["age"]))
+      result.setdefault(subject, []).append((row["attribute"], value,
+                                             row["age"]))
 
-        if limit > 0 and len(result) > limit:
-          break
+      if limit > 0 and len(result) > limit:
+        break
 
-      return result.iteritems()
+    return result.iteritems()
 
   def MultiSet(self, subject, values, timestamp=None, token=None, replace=True,
                sync=True, to_delete=None):
     """Set multiple predicates' values for this subject in one operation."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
-    to_delete = set(to_delete or [])
+    to_delete = set(utils.SmartUnicode(x) for x in to_delete or [])
 
     if timestamp is None:
       timestamp = time.time() * 1e6
@@ -311,47 +799,41 @@ class MySQLDataStore(data_store.DataStore):
     subject = utils.SmartUnicode(subject)
     to_set = []
 
-    # Build a document for each unique timestamp.
+    # Build a row for each value.
     for attribute, sequence in values.items():
+      predicate = utils.SmartUnicode(attribute)
+      prefix = predicate.split(":", 1)[0]
+
+      # Replacing means to delete all versions of the attribute first.
+      if replace:
+        to_delete.add(predicate)
+
       for value in sequence:
         if isinstance(value, tuple):
           value, entry_timestamp = value
         else:
           entry_timestamp = timestamp
 
-        predicate = utils.SmartUnicode(attribute)
-        prefix = predicate.split(":", 1)[0]
-
-        # Replacing means to delete all versions of the attribute first.
-        if replace:
-          to_delete.add(attribute)
-
-        to_set.extend(
-            [subject, subject, int(entry_timestamp), predicate, prefix] +
-            self._Encode(attribute, value))
-
-    if to_delete:
-      self.DeleteAttributes(subject, to_delete, token=token)
-
-    if to_set:
-      if sync:
-        self._MultiSet(to_set)
-      else:
-        with self.lock:
-          self.to_set.extend(to_set)
+        to_set.append((predicate, [subject, subject, int(entry_timestamp),
+                                   predicate, prefix] +
+                       self._Encode(attribute, value)))
 
-  def _MultiSet(self, values):
-    if not values:
+    if not to_delete and not to_set:
       return
-    query = ("insert into `%s` (hash, subject, age, attribute, prefix, "
-             "value_string, value_integer, value_binary) values " %
-             self.table_name)
 
-    nr_items = len(values) / 8
-    query += ", ".join(["(md5(%s), %s, %s, %s, %s, %s, %s, %s)"] * nr_items)
+    if not sync and self.running:
+      self._QueueWrite(subject, to_delete, to_set)
 
-    with self.pool.GetConnection() as cursor:
-      cursor.Execute(query, values)
+    elif self._HasPendingWrites(subject):
+      # Keep the order with the writes already queued for this subject. Flush()
+      # waits for a flush in progress before writing.
+      self._QueueWrite(subject, to_delete, to_set)
+      self.Flush()
+
+    else:
+      writes = PendingWrites()
+      writes.Add(to_delete, to_set)
+      self._WritePending({subject: writes})
 
   def _Encode(self, attribute, value):
     """Return a list encoding this value."""
@@ -436,17 +918,28 @@ class MySQLTransaction(data_store.Transaction):
     self.table_name = store.table_name
     self.to_set = {}
     self.to_delete = set()
-    with store.pool.GetConnection() as connection:
-      self.expires_lock = int((time.time() + self.lock_time) * 1e6)
 
-      # This will take over the lock if the lock is too old.
-      connection.Execute(
-          "update `%s` set value_integer=%%s where "
-          "attribute='transaction' and subject=%%s and hash=md5(%%s) and "
-          "(value_integer < %%s)" % self.table_name,
-          (self.expires_lock, subject, subject, time.time() * 1e6))
+    # All the queries this thread makes while holding the lock use the same
+    # connection so we never wait for the pool with the subject locked.
+    self.connection = None
+    if config_lib.CONFIG["Mysql.pin_transaction_connections"]:
+      self.connection = store.pool.PinConnection()
 
-      self.CheckForLock(connection, subject)
+    try:
+      with store.pool.GetConnection() as connection:
+        self.expires_lock = int((time.time() + self.lock_time) * 1e6)
+
+        # This will take over the lock if the lock is too old.
+        connection.Execute(
+            "update `%s` set value_integer=%%s where "
+            "attribute='transaction' and subject=%%s and hash=md5(%%s) and "
+            "(value_integer < %%s)" % self.table_name,
+            (self.expires_lock, subject, subject, time.time() * 1e6))
+
+        self.CheckForLock(connection, subject)
+    except Exception:
+      self._UnpinConnection()
+      raise
 
   def UpdateLease(self, lease_time):
     self.expires_lock = int((time.time() + lease_time) * 1e6)
@@ -520,15 +1013,24 @@ class MySQLTransaction(data_store.Transaction):
   def _RemoveLock(self):
     # Remove the lock on the document. Note that this only resets the lock if
     # we actually hold it (value_integer == self.expires_lock).
-    with self.store.pool.GetConnection() as connection:
-      connection.Execute(
-          "update `%s` set value_integer=0 where "
-          "attribute='transaction' and value_integer=%%s and hash=md5(%%s) and "
-          "subject=%%s" % self.table_name,
-          (self.expires_lock, self.subject, self.subject))
+    try:
+      with self.store.pool.GetConnection() as connection:
+        connection.Execute(
+            "update `%s` set value_integer=0 where "
+            "attribute='transaction' and value_integer=%%s and "
+            "hash=md5(%%s) and subject=%%s" % self.table_name,
+            (self.expires_lock, self.subject, self.subject))
+    finally:
+      self._UnpinConnection()
+
+  def _UnpinConnection(self):
+    connection, self.connection = self.connection, None
+    if connection is not None:
+      self.store.pool.UnpinConnection(connection)
 
   def __del__(self):
     try:
       self.Abort()
     except Exception:  # This can raise on cleanup pylint: disable=broad-except
       pass
+
@@ -2,6 +2,8 @@
 """Tests the mysql data store."""
 
 
+import threading
+
 # pylint: disable=unused-import,g-bad-import-order
 from grr.lib import server_plugins
 # pylint: enable=unused-import,g-bad-import-order
@@ -29,6 +31,10 @@ class MysqlTestMixin(object):
     data_store.DB.security_manager = test_lib.MockSecurityManager()
     data_store.DB.RecreateDataBase()
 
+  def tearDown(self):
+    data_store.DB.Stop()
+    super(MysqlTestMixin, self).tearDown()
+
   def testCorrectDataStore(self):
     self.assertTrue(isinstance(data_store.DB, mysql_data_store.MySQLDataStore))
 
@@ -40,6 +46,85 @@ class MysqlDataStoreTest(MysqlTestMixin, data_store_test.DataStoreTest):
     super(MysqlDataStoreTest, self).setUp()
     self.InitTable()
 
+  def testPendingWritesAreCoalesced(self):
+    subject = "aff4:/pending"
+    predicate = "metadata:predicate"
+
+    for i in range(10):
+      data_store.DB.Set(subject, predicate, "value%d" % i, timestamp=i,
+                        replace=False, sync=False, token=self.token)
+
+    # A replacing write drops the rows still waiting in the queue.
+    data_store.DB.Set(subject, predicate, "replaced", timestamp=100,
+                      sync=False, token=self.token)
+    self.assertEqual(data_store.DB.pending_rows, 1)
+
+    # A synchronous write for the same subject flushes the queue in order.
+    data_store.DB.Set(subject, "metadata:other", "other", sync=True,
+                      token=self.token)
+    self.assertEqual(data_store.DB.pending_rows, 0)
+
+    values = list(data_store.DB.ResolveMulti(
+        subject, [predicate], timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token))
+    self.assertEqual(values, [(predicate, "replaced", 100)])
+
+  def testStopWritesQueuedRows(self):
+    subject = "aff4:/pending"
+    data_store.DB.Set(subject, "metadata:predicate", "value", sync=False,
+                      token=self.token)
+
+    data_store.DB.Stop()
+    self.assertFalse(data_store.DB.writer_thread.is_alive())
+    self.assertEqual(data_store.DB.pending_rows, 0)
+
+    # Writes after stopping are synchronous.
+    data_store.DB.Set(subject, "metadata:other", "other", sync=False,
+                      token=self.token)
+    self.assertEqual(data_store.DB.pending_rows, 0)
+    self.assertEqual(data_store.DB.Resolve(subject, "metadata:other",
+                                           token=self.token)[0], "other")
+
+  def testConnectionPinning(self):
+    pool = data_store.DB.pool
+    connection = pool.PinConnection()
+    try:
+      # While pinned this thread always gets the same connection back.
+      for _ in range(3):
+        with pool.GetConnection() as other:
+          self.assertTrue(other is connection)
+    finally:
+      pool.UnpinConnection(connection)
+
+    self.assertEqual(connection.pin_count, 0)
+    self.assertTrue(connection in pool.idle)
+
+  def testUnpinningFromAnotherThread(self):
+    pool = data_store.DB.pool
+    connection = pool.PinConnection()
+
+    # Release the pin from another thread, like a garbage collected
+    # transaction does.
+    unpinner = threading.Thread(target=pool.UnpinConnection,
+                                args=(connection,))
+    unpinner.start()
+    unpinner.join()
+
+    # Another thread pins the released connection.
+    pinned = []
+    pinner = threading.Thread(target=lambda: pinned.append(
+        pool.PinConnection()))
+    pinner.start()
+    pinner.join()
+    self.assertTrue(pinned[0] is connection)
+
+    try:
+      # This thread must not get it back through its old pin.
+      with pool.GetConnection() as other:
+        self.assertFalse(other is connection)
+    finally:
+      pool.UnpinConnection(connection)
+
 
 class MysqlDataStoreBenchmarks(MysqlTestMixin,
                                data_store_test.DataStoreBenchmarks):
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""A data store which spreads subjects over several child data stores.
+
+Each subject lives on exactly one shard. The shard is normally chosen by
+consistent hashing of the subject so adding a shard only moves a small part of
+the subjects, but subjects starting with a configured prefix can be sent to a
+dedicated shard instead (e.g. to keep aff4:/blobs on its own database).
+
+Since all the attributes of a subject are on the same shard, single subject
+operations and transactions are simply passed to that shard. MultiResolveRegex
+over subjects on several shards queries the shards in parallel.
+"""
+
+
+import bisect
+import hashlib
+import threading
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import threadpool
+from grr.lib import utils
+
+
+class ShardedDataStore(data_store.DataStore):
+  """Routes subjects to several child data stores."""
+
+  def __init__(self, shards=None, prefix_overrides=None, virtual_nodes=None):
+    """Constructor.
+
+    Args:
+      shards: A list of DataStore instances. If not given, one instance of each
+        implementation in ShardedDatastore.shards is created.
+      prefix_overrides: A list of (subject prefix, shard index) tuples. If not
+        given, they are read from ShardedDatastore.prefix_overrides.
+      virtual_nodes: The number of points each shard has on the hash ring.
+
+    Raises:
+      RuntimeError: If there are no shards or an override names a bad shard.
+    """
+    if shards is None:
+      shards = [data_store.DataStore.GetPlugin(name)()
+                for name in config_lib.CONFIG["ShardedDatastore.shards"]]
+
+    if not shards:
+      raise RuntimeError("No shards configured for the sharded data store.")
+
+    if prefix_overrides is None:
+      prefix_overrides = []
+      for override in config_lib.CONFIG["ShardedDatastore.prefix_overrides"]:
+        prefix, index = override.rsplit("=", 1)
+        prefix_overrides.append((prefix, int(index)))
+
+    if virtual_nodes is None:
+      virtual_nodes = config_lib.CONFIG["ShardedDatastore.virtual_nodes"]
+
+    self.shards = shards
+
+    # Longer prefixes are checked first so the most specific override wins.
+    self.prefix_overrides = []
+    for prefix, index in sorted(prefix_overrides,
+                                key=lambda x: len(x[0]), reverse=True):
+      if not 0 <= index < len(shards):
+        raise RuntimeError("Prefix override %s refers to unknown shard %d." %
+                           (prefix, index))
+      self.prefix_overrides.append((utils.SmartUnicode(prefix), index))
+
+    # The hash ring is a sorted list of points, each owned by a shard.
+    ring = []
+    for index in range(len(shards)):
+      for node in range(virtual_nodes):
+        ring.append((self._Hash("%d-%d" % (index, node)), index))
+
+    ring.sort()
+    self.ring_points = [point for point, _ in ring]
+    self.ring_shards = [index for _, index in ring]
+
+    self.pool_lock = threading.Lock()
+    self.pool = None
+
+    super(ShardedDataStore, self).__init__()
+
+  def _Hash(self, value):
+    return int(hashlib.md5(utils.SmartStr(value)).hexdigest()[:16], 16)
+
+  @property
+  def security_manager(self):
+    return self.shards[0].security_manager
+
+  @security_manager.setter
+  def security_manager(self, security_manager):
+    # The shards do the access checks, so they all use our security manager.
+    for shard in self.shards:
+      shard.security_manager = security_manager
+
+  def GetShardIndex(self, subject):
+    """Returns the index of the shard a subject is stored on."""
+    subject = utils.SmartUnicode(subject)
+    for prefix, index in self.prefix_overrides:
+      if subject.startswith(prefix):
+        return index
+
+    position = bisect.bisect(self.ring_points, self._Hash(subject))
+    return self.ring_shards[position % len(self.ring_shards)]
+
+  def GetShard(self, subject):
+    return self.shards[self.GetShardIndex(subject)]
+
+  def Initialize(self):
+    for shard in self.shards:
+      shard.Initialize()
+
+  def Flush(self):
+    for shard in self.shards:
+      shard.Flush()
+
+  def DeleteSubject(self, subject, token=None):
+    self.GetShard(subject).DeleteSubject(subject, token=token)
+
+  def Set(self, subject, predicate, value, timestamp=None, token=None,
+          replace=True, sync=True):
+    self.GetShard(subject).Set(subject, predicate, value, timestamp=timestamp,
+                               token=token, replace=replace, sync=sync)
+
+  def MultiSet(self, subject, values, timestamp=None, token=None,
+               replace=True, sync=True, to_delete=None):
+    self.GetShard(subject).MultiSet(subject, values, timestamp=timestamp,
+                                    token=token, replace=replace, sync=sync,
+                                    to_delete=to_delete)
+
+  def DeleteAttributes(self, subject, predicates, start=None, end=None,
+                       sync=False, token=None):
+    self.GetShard(subject).DeleteAttributes(subject, predicates, start=start,
+                                            end=end, sync=sync, token=token)
+
+  def DeleteAttributesRegex(self, subject, regexes, token=None):
+    self.GetShard(subject).DeleteAttributesRegex(subject, regexes, token=token)
+
+  def Resolve(self, subject, predicate, token=None):
+    return self.GetShard(subject).Resolve(subject, predicate, token=token)
+
+  def ResolveMulti(self, subject, predicates, token=None, timestamp=None):
+    return self.GetShard(subject).ResolveMulti(subject, predicates, token=token,
+                                               timestamp=timestamp)
+
+  def ResolveRegex(self, subject, predicate_regex, token=None,
+                   timestamp=None, limit=1000):
+    return self.GetShard(subject).ResolveRegex(
+        subject, predicate_regex, token=token, timestamp=timestamp,
+        limit=limit)
+
+  def _GetPool(self):
+    with self.pool_lock:
+      if self.pool is None:
+        self.pool = threadpool.ThreadPool.Factory(
+            "sharded_data_store",
+            min_threads=1,
+            max_threads=config_lib.CONFIG["ShardedDatastore.fanout_threads"])
+        self.pool.Start()
+
+      return self.pool
+
+  def MultiResolveRegex(self, subjects, predicate_regex, token=None,
+                        timestamp=None, limit=None):
+    """Resolves subjects on all their shards and merges the results."""
+    subjects = list(subjects)
+    shard_subjects = {}
+    for subject in subjects:
+      shard_subjects.setdefault(self.GetShardIndex(subject), []).append(subject)
+
+    if not shard_subjects:
+      return iter([])
+
+    if len(shard_subjects) == 1:
+      index, subjects_on_shard = shard_subjects.popitem()
+      return self.shards[index].MultiResolveRegex(
+          subjects_on_shard, predicate_regex, token=token, timestamp=timestamp,
+          limit=limit)
+
+    results = {}
+    errors = []
+    condition = threading.Condition()
+    outstanding = [len(shard_subjects)]
+
+    def ResolveShard(shard, subjects):
+      try:
+        shard_results = list(shard.MultiResolveRegex(
+            subjects, predicate_regex, token=token, timestamp=timestamp,
+            limit=limit))
+        with condition:
+          for subject, values in shard_results:
+            results[utils.SmartUnicode(subject)] = (subject, values)
+      except Exception as e:  # pylint: disable=broad-except
+        with condition:
+          errors.append(e)
+      finally:
+        with condition:
+          outstanding[0] -= 1
+          condition.notify()
+
+    # We run the last shard's query ourselves while the others are running.
+    shard_items = shard_subjects.items()
+    pool = self._GetPool()
+    for index, subjects_on_shard in shard_items[:-1]:
+      pool.AddTask(target=ResolveShard,
+                   args=(self.shards[index], subjects_on_shard),
+                   name="MultiResolveRegex")
+
+    index, subjects_on_shard = shard_items[-1]
+    ResolveShard(self.shards[index], subjects_on_shard)
+
+    with condition:
+      while outstanding[0]:
+        condition.wait()
+
+    if errors:
+      raise errors[0]
+
+    # Return the subjects in the order they were asked for and apply the limit
+    # to the merged results.
+    merged = []
+    for subject in subjects:
+      result = results.pop(utils.SmartUnicode(subject), None)
+      if not result or not result[1]:
+        continue
+
+      subject, values = result
+      if limit:
+        values = values[:limit]
+        limit -= len(values)
+
+      merged.append((subject, values))
+      if limit is not None and limit <= 0:
+        break
+
+    return iter(merged)
+
+  def Transaction(self, subject, lease_time=None, token=None):
+    return self.GetShard(subject).Transaction(subject, lease_time=lease_time,
+                                              token=token)
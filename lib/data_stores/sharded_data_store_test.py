@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Tests the sharded data store."""
+
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.data_stores import fake_data_store
+from grr.lib.data_stores import sharded_data_store
+
+
+class ShardedTestMixin(object):
+  """A mixin for the sharded data store tests."""
+
+  def InitTable(self):
+    """Initializes a sharded data store over several fake data stores."""
+    self.old_data_store = data_store.DB
+    self.shards = [fake_data_store.FakeDataStore() for _ in range(3)]
+    data_store.DB = sharded_data_store.ShardedDataStore(
+        shards=self.shards, prefix_overrides=[("aff4:/blobs", 2)])
+    data_store.DB.security_manager = test_lib.MockSecurityManager()
+
+  def RestoreTable(self):
+    data_store.DB = self.old_data_store
+
+  def testCorrectDataStore(self):
+    """Makes sure the correct implementation is tested."""
+    self.assertTrue(isinstance(data_store.DB,
+                               sharded_data_store.ShardedDataStore))
+
+
+class ShardedDataStoreTest(ShardedTestMixin, data_store_test.DataStoreTest):
+  """Test the sharded data store."""
+
+  def setUp(self):
+    super(ShardedDataStoreTest, self).setUp()
+    self.InitTable()
+
+  def tearDown(self):
+    self.RestoreTable()
+    super(ShardedDataStoreTest, self).tearDown()
+
+  def testSubjectsAreSpreadOverShards(self):
+    subjects = ["aff4:/row:%d" % i for i in range(100)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "aff4:shard", subject, token=self.token)
+
+    # Every shard has some of the subjects and each subject is on one shard.
+    counts = [len(shard.subjects) for shard in self.shards[:2]]
+    self.assertTrue(all(counts))
+
+    # Subjects are resolved from all shards, in the requested order.
+    results = list(data_store.DB.MultiResolveRegex(
+        subjects, "aff4:shard", token=self.token))
+    self.assertEqual([subject for subject, _ in results], subjects)
+
+  def testPrefixOverride(self):
+    data_store.DB.Set("aff4:/blobs/1234", "aff4:data", "data",
+                      token=self.token)
+    self.assertTrue(u"aff4:/blobs/1234" in self.shards[2].subjects)
+    self.assertEqual(data_store.DB.GetShardIndex("aff4:/blobs/5678"), 2)
+
+  def testAddingShardMovesFewSubjects(self):
+    subjects = ["aff4:/C.%016X" % i for i in range(1000)]
+    before = [data_store.DB.GetShardIndex(subject) for subject in subjects]
+
+    bigger = sharded_data_store.ShardedDataStore(
+        shards=self.shards + [fake_data_store.FakeDataStore()])
+    after = [bigger.GetShardIndex(subject) for subject in subjects]
+
+    # Only subjects moving to the new shard change place.
+    moved = [(b, a) for b, a in zip(before, after) if b != a]
+    self.assertTrue(all(a == 3 for _, a in moved))
+    self.assertTrue(len(moved) < len(subjects) / 2)
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+# -*- mode: python; encoding: utf-8 -*-
+
+"""An implementation of a data store based on an embedded SQLite database.
+
+This data store needs no external service, which makes it suitable for single
+node deployments and for running the data store tests locally.
+
+All versions of all attributes are kept in a single table which is clustered on
+(subject, attribute, timestamp). The typical AFF4 access pattern - reading some
+or all attributes of a single subject - is therefore a range scan over the
+primary key. The database runs in WAL mode so readers do not block the writer,
+and asynchronous writes are batched into a single commit by Flush().
+"""
+
+
+import itertools
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import utils
+
+
+# pylint: disable=nonstandard-exception
+class Error(data_store.Error):
+  """Base class for all exceptions in this module."""
+
+
+# Compiled regexes used by the regexp() sql function.
+REGEX_CACHE = {}
+
+
+def RegexMatch(regex, value):
+  """Implements "value regexp regex" for SQLite.
+
+  Like the other data stores, the regex is matched at the start of the value.
+
+  Args:
+    regex: The regex.
+    value: The value to match.
+
+  Returns:
+    True if the value matches.
+  """
+  try:
+    compiled_regex = REGEX_CACHE[regex]
+  except KeyError:
+    if len(REGEX_CACHE) > 1000:
+      REGEX_CACHE.clear()
+
+    compiled_regex = REGEX_CACHE[regex] = re.compile(regex)
+
+  return value is not None and compiled_regex.match(value) is not None
+
+
+class SqliteConnection(object):
+  """A connection to the database file.
+
+  Connections must only be used by the thread which created them.
+
+  Usage:
+
+  with data_store.DB.GetConnection() as connection:
+    connection.Execute(.....)
+
+  Entering the context begins a write transaction which is committed when the
+  context exits, or rolled back if an exception was raised. Reads may also be
+  done outside a context.
+  """
+
+  def __init__(self, database_path, write_lock):
+    self.write_lock = write_lock
+    # We manage transactions explicitly.
+    self.dbh = sqlite3.connect(
+        database_path, isolation_level=None,
+        timeout=config_lib.CONFIG["Sqlite.busy_timeout"])
+    self.dbh.create_function("regexp", 2, RegexMatch)
+    self.dbh.execute("PRAGMA journal_mode=WAL")
+    self.dbh.execute("PRAGMA synchronous=NORMAL")
+
+  def __enter__(self):
+    # Serialize writers within this process so they do not have to wait on the
+    # database lock. Other processes are handled by the busy timeout.
+    self.write_lock.acquire()
+    try:
+      self.dbh.execute("BEGIN IMMEDIATE")
+    except sqlite3.Error:
+      self.write_lock.release()
+      raise
+
+    return self
+
+  def __exit__(self, exc_type, unused_value, unused_traceback):
+    try:
+      if exc_type is None:
+        self.dbh.execute("COMMIT")
+      else:
+        self.dbh.execute("ROLLBACK")
+    finally:
+      self.write_lock.release()
+
+  def Execute(self, query, args=()):
+    return self.dbh.execute(query, args).fetchall()
+
+  def ExecuteMany(self, query, args):
+    self.dbh.executemany(query, args)
+
+
+class SqliteDataStore(data_store.DataStore):
+  """A data store based on an embedded SQLite database."""
+
+  # Maximum number of sql variables we use in a single statement.
+  MAX_VARIABLES = 500
+
+  def __init__(self):
+    self.database_path = config_lib.CONFIG["Sqlite.database_path"]
+
+    # Each thread gets its own connection.
+    self.local = threading.local()
+    self.write_lock = threading.RLock()
+
+    # Protects the pending asynchronous writes.
+    self.lock = threading.Lock()
+    self.to_set = []
+
+    # Distinguishes values written to the same attribute with the same
+    # timestamp.
+    self.sequence = itertools.count(int(time.time() * 1e6))
+
+    super(SqliteDataStore, self).__init__()
+
+  def GetConnection(self):
+    """Returns the connection for the current thread."""
+    try:
+      return self.local.connection
+    except AttributeError:
+      self.local.connection = SqliteConnection(self.database_path,
+                                               self.write_lock)
+      return self.local.connection
+
+  def Initialize(self):
+    self.CreateTables()
+
+  def CreateTables(self):
+    with self.GetConnection() as connection:
+      connection.Execute("""
+  CREATE TABLE IF NOT EXISTS aff4 (
+    subject TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    sequence INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (subject, attribute, timestamp, sequence)
+  ) WITHOUT ROWID""")
+      connection.Execute("""
+  CREATE TABLE IF NOT EXISTS locks (
+    subject TEXT NOT NULL PRIMARY KEY,
+    expires INTEGER NOT NULL,
+    owner INTEGER NOT NULL
+  ) WITHOUT ROWID""")
+
+  def RecreateDataBase(self):
+    """Drops the tables and creates new ones."""
+    with self.lock:
+      self.to_set = []
+
+    with self.GetConnection() as connection:
+      connection.Execute("DROP TABLE IF EXISTS aff4")
+      connection.Execute("DROP TABLE IF EXISTS locks")
+
+    self.CreateTables()
+
+  def _Encode(self, value):
+    """Encode the value into one of the types supported by SQLite.
+
+    Integers and unicode strings are kept, anything else is serialized and
+    stored as a blob.
+
+    Args:
+       value: The value to be encoded.
+
+    Returns:
+      An encoded value.
+    """
+    if not isinstance(value, (basestring, int, long, float)):
+      try:
+        value = value.SerializeToDataStore()
+      except AttributeError:
+        try:
+          value = value.SerializeToString()
+        except AttributeError:
+          value = utils.SmartStr(value)
+
+    if isinstance(value, str):
+      return sqlite3.Binary(value)
+
+    return value
+
+  def _Decode(self, value):
+    if isinstance(value, buffer):
+      return str(value)
+
+    return value
+
+  def _PrefixRange(self, prefix):
+    """Returns the range of strings which start with prefix."""
+    try:
+      return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    except ValueError:
+      return prefix, None
+
+  def _PredicateRegexToQuery(self, predicate_regex, args):
+    """Converts predicate regexes to an sql condition and adds args.
+
+    Where a regex starts with a literal string the condition is a range on the
+    attribute, so it can be resolved using the primary key.
+
+    Args:
+      predicate_regex: A list of predicate regexes.
+      args: The list of args. Args for the condition are appended to it.
+
+    Returns:
+      An sql fragment which matches any of the predicate regexes.
+    """
+    conditions = []
+    for regex in predicate_regex:
+      regex = utils.SmartUnicode(regex)
+      prefix, remainder = utils.RegexLiteralPrefix(regex)
+
+      condition = []
+      if remainder == "$":
+        condition.append("attribute = ?")
+        args.append(prefix)
+
+      elif prefix:
+        start, end = self._PrefixRange(prefix)
+        condition.append("attribute >= ?")
+        args.append(start)
+        if end is not None:
+          condition.append("attribute < ?")
+          args.append(end)
+
+      if remainder not in ("", ".*", "$"):
+        condition.append("attribute regexp ?")
+        args.append(regex)
+
+      conditions.append("(%s)" % (" and ".join(condition) or "1"))
+
+    return " or ".join(conditions)
+
+  def _TimestampToQuery(self, timestamp, args):
+    """Convert the timestamp to a query fragment and add args."""
+    if isinstance(timestamp, (tuple, list)):
+      args.append(int(timestamp[0]))
+      args.append(int(timestamp[1]))
+      return " and timestamp >= ? and timestamp <= ? "
+
+    return ""
+
+  def _ResolveSubject(self, connection, subject, condition, condition_args,
+                      timestamp=None, limit=None):
+    """Returns (attribute, value, timestamp) for matching rows of a subject."""
+    args = [subject] + condition_args
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      # SQLite returns the other columns from the row holding the maximum.
+      query = ("select attribute, value, max(timestamp) from aff4 "
+               "where subject = ? and (%s) group by attribute "
+               "order by attribute" % condition)
+    else:
+      query = ("select attribute, value, timestamp from aff4 "
+               "where subject = ? and (%s) %s "
+               "order by attribute, timestamp" % (
+                   condition, self._TimestampToQuery(timestamp, args)))
+
+    if limit:
+      query += " limit %d" % int(limit)
+
+    return [(attribute, self._Decode(value), ts)
+            for attribute, value, ts in connection.Execute(query, args)]
+
+  def ResolveMulti(self, subject, predicates, token=None, timestamp=None):
+    """Resolves multiple predicates at once for one subject."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "r")
+
+    subject = utils.SmartUnicode(subject)
+    connection = self.GetConnection()
+    results = {}
+
+    for batch in utils.Grouper(predicates, self.MAX_VARIABLES):
+      args = [utils.SmartUnicode(predicate) for predicate in batch]
+      condition = "attribute in (%s)" % ",".join(["?"] * len(batch))
+      for attribute, value, ts in self._ResolveSubject(
+          connection, subject, condition, args, timestamp=timestamp):
+        results.setdefault(attribute, []).append((value, ts))
+
+    # Return the results in the same order they requested.
+    for predicate in predicates:
+      for value, ts in results.get(utils.SmartUnicode(predicate), []):
+        yield predicate, value, ts
+
+  def ResolveRegex(self, subject, predicate_regex, token=None,
+                   timestamp=None, limit=None):
+    """Resolve all predicates for a subject matching a regex."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "r")
+
+    # Allow users to specify a single string here.
+    if isinstance(predicate_regex, basestring):
+      predicate_regex = [predicate_regex]
+
+    args = []
+    condition = self._PredicateRegexToQuery(predicate_regex, args)
+    return self._ResolveSubject(self.GetConnection(),
+                                utils.SmartUnicode(subject), condition, args,
+                                timestamp=timestamp, limit=limit)
+
+  def MultiResolveRegex(self, subjects, predicate_regex, token=None,
+                        timestamp=None, limit=None):
+    self.security_manager.CheckDataStoreAccess(token, subjects, "r")
+
+    # Allow users to specify a single string here.
+    if isinstance(predicate_regex, basestring):
+      predicate_regex = [predicate_regex]
+
+    args = []
+    condition = self._PredicateRegexToQuery(predicate_regex, args)
+    connection = self.GetConnection()
+
+    result = {}
+    for subject in subjects:
+      values = self._ResolveSubject(connection, utils.SmartUnicode(subject),
+                                    condition, args, timestamp=timestamp,
+                                    limit=limit)
+      if values:
+        result[subject] = values
+        if limit:
+          limit -= len(values)
+          if limit <= 0:
+            break
+
+    return result.iteritems()
+
+  def MultiSet(self, subject, values, timestamp=None, token=None, replace=True,
+               sync=True, to_delete=None):
+    """Set multiple predicates' values for this subject in one operation."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    to_delete = set(utils.SmartUnicode(x) for x in to_delete or [])
+
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = time.time() * 1e6
+
+    subject = utils.SmartUnicode(subject)
+    rows = []
+    for attribute, sequence in values.items():
+      attribute = utils.SmartUnicode(attribute)
+
+      # Replacing means to delete all versions of the attribute first.
+      if replace:
+        to_delete.add(attribute)
+
+      for value in sequence:
+        if isinstance(value, (list, tuple)):
+          value, entry_timestamp = value
+        else:
+          entry_timestamp = timestamp
+
+        if entry_timestamp is None:
+          entry_timestamp = timestamp
+
+        rows.append((subject, attribute, int(entry_timestamp),
+                     self.sequence.next(), self._Encode(value)))
+
+    operation = (subject, to_delete, rows)
+    if sync:
+      self._Write([operation])
+    else:
+      with self.lock:
+        self.to_set.append(operation)
+
+  def _Write(self, operations):
+    """Applies write operations in a single database transaction.
+
+    Any pending asynchronous writes are applied first so that synchronous and
+    asynchronous writes are never reordered.
+
+    Args:
+      operations: A list of (subject, attributes to delete, rows to insert).
+    """
+    with self.GetConnection() as connection:
+      self._WriteOperations(connection, operations)
+
+  def _WriteOperations(self, connection, operations):
+    """Applies pending asynchronous writes and then operations.
+
+    Args:
+      connection: A connection inside a transaction.
+      operations: A list of (subject, attributes to delete, rows to insert).
+    """
+    with self.lock:
+      operations = self.to_set + operations
+      self.to_set = []
+
+    for subject, to_delete, rows in operations:
+      if to_delete:
+        connection.ExecuteMany(
+            "delete from aff4 where subject = ? and attribute = ?",
+            [(subject, attribute) for attribute in to_delete])
+
+      if rows:
+        connection.ExecuteMany(
+            "insert or replace into aff4 (subject, attribute, timestamp, "
+            "sequence, value) values (?, ?, ?, ?, ?)", rows)
+
+  def Flush(self):
+    with self.lock:
+      if not self.to_set:
+        return
+
+    self._Write([])
+
+  def DeleteAttributes(self, subject, attributes, start=None, end=None,
+                       sync=None, token=None):
+    """Remove some attributes from a subject."""
+    _ = sync  # Unused
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if not attributes:
+      return
+
+    subject = utils.SmartUnicode(subject)
+    query = "delete from aff4 where subject = ? and attribute = ?"
+    args = [(subject, utils.SmartUnicode(attribute))
+            for attribute in attributes]
+
+    if start or end:
+      query += " and timestamp >= ? and timestamp <= ?"
+      args = [x + (int(start or 0), int(end or (2 ** 63) - 1)) for x in args]
+
+    # Pending writes must not bring the deleted values back later.
+    with self.GetConnection() as connection:
+      self._WriteOperations(connection, [])
+      connection.ExecuteMany(query, args)
+
+  def DeleteAttributesRegex(self, subject, regexes, token=None):
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if not regexes:
+      return
+
+    args = [utils.SmartUnicode(subject)]
+    query = "delete from aff4 where subject = ? and (%s)" % (
+        self._PredicateRegexToQuery(regexes, args))
+
+    with self.GetConnection() as connection:
+      self._WriteOperations(connection, [])
+      connection.Execute(query, args)
+
+  def DeleteSubject(self, subject, token=None):
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    with self.GetConnection() as connection:
+      self._WriteOperations(connection, [])
+      connection.Execute("delete from aff4 where subject = ?",
+                         (utils.SmartUnicode(subject),))
+
+  def Transaction(self, subject, lease_time=None, token=None):
+    return SqliteTransaction(self, subject, lease_time=lease_time, token=token)
+
+
+class SqliteTransaction(data_store.Transaction):
+  """The SQLite data store transaction object.
+
+  Transactions are implemented as leases held in the locks table. Only one
+  lease can be held on a subject at the same time, but a lease which has
+  expired can be taken over by another transaction.
+  """
+
+  def __init__(self, store, subject, lease_time=None, token=None):
+    """Ensure we can take a lock on this subject."""
+    self.store = store
+    if lease_time is None:
+      lease_time = config_lib.CONFIG["Datastore.transaction_timeout"]
+
+    self.token = token
+    self.subject = utils.SmartUnicode(subject)
+    self.to_set = {}
+    self.to_delete = set()
+    self.locked = False
+
+    # Identifies our lease so we never release someone else's.
+    self.owner = random.getrandbits(62)
+    self.expires = int((time.time() + lease_time) * 1e6)
+
+    with store.GetConnection() as connection:
+      for row in connection.Execute(
+          "select expires from locks where subject = ?", (self.subject,)):
+        if row[0] > time.time() * 1e6:
+          raise data_store.TransactionError("Subject %s is locked" % subject)
+
+      connection.Execute(
+          "insert or replace into locks (subject, expires, owner) "
+          "values (?, ?, ?)", (self.subject, self.expires, self.owner))
+
+    self.locked = True
+
+  def UpdateLease(self, duration):
+    self.expires = int((time.time() + duration) * 1e6)
+    with self.store.GetConnection() as connection:
+      connection.Execute(
+          "update locks set expires = ? where subject = ? and owner = ?",
+          (self.expires, self.subject, self.owner))
+
+  def CheckLease(self):
+    return max(0, self.expires / 1e6 - time.time())
+
+  def DeleteAttribute(self, predicate):
+    self.to_delete.add(predicate)
+
+  def Resolve(self, predicate):
+    if predicate in self.to_set:
+      return sorted(self.to_set[predicate], key=lambda vt: vt[1])[-1]
+    if predicate in self.to_delete:
+      return None
+    return self.store.Resolve(self.subject, predicate, token=self.token)
+
+  def ResolveRegex(self, predicate_regex, timestamp=None):
+    # TODO(user): Retrieve values from to_set as well.
+    return self.store.ResolveRegex(self.subject, predicate_regex,
+                                   token=self.token, timestamp=timestamp)
+
+  def Set(self, predicate, value, timestamp=None, replace=True):
+    if replace:
+      self.to_delete.add(predicate)
+
+    if timestamp is None:
+      timestamp = int(time.time() * 1e6)
+
+    self.to_set.setdefault(predicate, []).append((value, timestamp))
+
+  def Abort(self):
+    self._RemoveLock()
+
+  def Commit(self):
+    self.store.MultiSet(self.subject, self.to_set, to_delete=self.to_delete,
+                        replace=False, sync=True, token=self.token)
+    self._RemoveLock()
+
+  def _RemoveLock(self):
+    if not self.locked:
+      return
+
+    # This only removes the lock if we still hold it.
+    with self.store.GetConnection() as connection:
+      connection.Execute("delete from locks where subject = ? and owner = ?",
+                         (self.subject, self.owner))
+
+    self.locked = False
+
+  def __del__(self):
+    try:
+      self.Abort()
+    except Exception:  # This can raise on cleanup pylint: disable=broad-except
+      pass
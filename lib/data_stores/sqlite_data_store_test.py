@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Tests the SQLite data store."""
+
+
+import os
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import access_control
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.data_stores import sqlite_data_store
+
+
+class SqliteTestMixin(object):
+
+  def InitTable(self):
+    self.token = access_control.ACLToken(username="test",
+                                         reason="Running tests")
+    # Every test gets its own database in the temp dir.
+    config_lib.CONFIG.Set("Sqlite.database_path", os.path.join(
+        self.temp_dir, "grr_test_%s.sqlite" % self.__class__.__name__))
+
+    data_store.DB = sqlite_data_store.SqliteDataStore()
+    data_store.DB.security_manager = test_lib.MockSecurityManager()
+    data_store.DB.RecreateDataBase()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(isinstance(data_store.DB,
+                               sqlite_data_store.SqliteDataStore))
+
+
+class SqliteDataStoreTest(SqliteTestMixin, data_store_test.DataStoreTest):
+  """Test the SQLite data store abstraction."""
+
+  def setUp(self):
+    super(SqliteDataStoreTest, self).setUp()
+    self.InitTable()
+
+  def testSameTimestampVersions(self):
+    """Values written with the same timestamp are all kept."""
+    data_store.DB.MultiSet(self.test_row, {"aff4:same": ["1", "2", "3"]},
+                           timestamp=1000, replace=False, token=self.token)
+
+    result = data_store.DB.ResolveRegex(
+        self.test_row, "aff4:same", timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token)
+    self.assertItemsEqual([x[1] for x in result], ["1", "2", "3"])
+
+  def testDeletesApplyPendingWritesFirst(self):
+    """Values written asynchronously don't come back after a delete."""
+    subject = self.test_row
+
+    data_store.DB.Set(subject, "aff4:async1", "1", sync=False,
+                      token=self.token)
+    data_store.DB.DeleteAttributes(subject, ["aff4:async1"], token=self.token)
+
+    data_store.DB.Set(subject, "aff4:async2", "2", sync=False,
+                      token=self.token)
+    data_store.DB.DeleteAttributesRegex(subject, ["aff4:async2"],
+                                        token=self.token)
+
+    data_store.DB.Set(subject + "/sub", "aff4:async3", "3", sync=False,
+                      token=self.token)
+    data_store.DB.DeleteSubject(subject + "/sub", token=self.token)
+
+    data_store.DB.Flush()
+
+    self.assertEqual(data_store.DB.ResolveRegex(
+        subject, "aff4:async.*", timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token), [])
+    self.assertEqual(data_store.DB.ResolveRegex(
+        subject + "/sub", "aff4:async.*",
+        timestamp=data_store.DB.ALL_TIMESTAMPS, token=self.token), [])
+
+  def testExpiredLeaseIsTakenOver(self):
+    subject = u"aff4:/leaseexpiry"
+    t1 = data_store.DB.Transaction(subject, lease_time=100, token=self.token)
+    self.assertRaises(data_store.TransactionError, data_store.DB.Transaction,
+                      subject, token=self.token)
+
+    # Once the lease runs out the subject can be locked again.
+    t1.UpdateLease(-1)
+    t2 = data_store.DB.Transaction(subject, token=self.token)
+
+    # The old transaction must not release the new lease.
+    t1.Abort()
+    self.assertRaises(data_store.TransactionError, data_store.DB.Transaction,
+                      subject, token=self.token)
+    t2.Abort()
+
+
+class SqliteDataStoreBenchmarks(SqliteTestMixin,
+                                data_store_test.DataStoreBenchmarks):
+  """Benchmark the SQLite data store abstraction."""
+
+  def setUp(self):
+    super(SqliteDataStoreBenchmarks, self).setUp()
+    self.InitTable()
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -8,6 +8,8 @@ This module loads and registers all the data store tests.
 # These need to register plugins so, pylint: disable=unused-import,g-import-not-at-top
 
 from grr.lib.data_stores import fake_data_store_test
+from grr.lib.data_stores import memory_data_store_test
+from grr.lib.data_stores import sharded_data_store_test
 try:
   from grr.lib.data_stores import mongo_data_store_test
   # This is deprecated and some tests fail.
@@ -21,3 +23,8 @@ try:
   from grr.lib.data_stores import mysql_data_store_test
 except ImportError:
   pass
+
+try:
+  from grr.lib.data_stores import sqlite_data_store_test
+except ImportError:
+  pass
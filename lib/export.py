@@ -1100,6 +1100,64 @@ def ConvertValuesWithMetadata(metadata_value_pairs, token=None, options=None):
     raise NoConverterFound(no_converter_found_error)
 
 
+class StreamingConverter(object):
+  """Converts a stream of values in batches of bounded size.
+
+  ConvertValuesWithMetadata groups all the values by type before converting
+  any of them. StreamingConverter only groups batch_size values at a time, and
+  keeps the converters of each value type between batches so their caches
+  (e.g. the client metadata of GrrMessageConverter) are reused.
+  """
+
+  def __init__(self, options=None, batch_size=1000, token=None):
+    self.options = options
+    self.batch_size = batch_size
+    self.token = token
+
+    # Converter instances by value class name.
+    self.converters = {}
+
+  def _GetConverters(self, value):
+    class_name = value.__class__.__name__
+    try:
+      return self.converters[class_name]
+    except KeyError:
+      converters = [cls(self.options)
+                    for cls in ExportConverter.GetConvertersByValue(value)]
+      self.converters[class_name] = converters
+      return converters
+
+  def Convert(self, metadata_value_pairs):
+    """Converts values to export-friendly RDFValues.
+
+    Args:
+      metadata_value_pairs: An iterable of (metadata, rdf_value) tuples.
+
+    Yields:
+      Converted values. Converted values may be of different types.
+
+    Raises:
+      NoConverterFound: in case no suitable converters were found for some
+                        values, after all other values were converted.
+    """
+    no_converter_found_error = None
+    for batch in utils.Grouper(metadata_value_pairs, self.batch_size):
+      for _, group in utils.GroupBy(
+          batch, lambda pair: pair[1].__class__.__name__).iteritems():
+        converters = self._GetConverters(group[0][1])
+        if not converters:
+          no_converter_found_error = "No converters found for value: %s" % str(
+              group[0][1])
+          continue
+
+        for converter in converters:
+          for result in converter.BatchConvert(group, token=self.token):
+            yield result
+
+    if no_converter_found_error is not None:
+      raise NoConverterFound(no_converter_found_error)
+
+
 def ConvertValues(default_metadata, values, token=None, options=None):
   """Converts a set of RDFValues into a set of export-friendly RDFValues.
 
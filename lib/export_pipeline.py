@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""Streaming export of collections into files in a local directory.
+
+The StreamingExporter reads values in batches, converts them with the export
+converters and writes one file per exported type. The columns of each file are
+derived from the exported RDFValue class: nested messages, such as the
+ExportedMetadata, are flattened into "<field>.<subfield>" columns and repeated
+fields are skipped, like in DataAgnosticExportConverter.
+
+At most one batch of values and one row group per exported type are held in
+memory, so collections of any size can be exported. Files are always appended
+to, so an export can be written in several sessions, e.g. by a hunt output
+plugin.
+
+The following formats are supported:
+
+  csv       A header line followed by one line per row.
+  jsonl     One JSON object per row.
+  columnar  A sequence of row groups. Each row group starts with a header
+            giving its row count and the name, type and size of each column,
+            followed by each column as a zlib compressed JSON list. Readers can
+            skip the columns they don't need, see ColumnarReader.
+"""
+
+
+import base64
+import csv
+import json
+import os
+import struct
+import zlib
+
+
+from grr.lib import export
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import type_info
+from grr.lib import utils
+
+
+class Column(object):
+  """A column of an exported type."""
+
+  # Column types by the proto type names of primitive fields.
+  TYPES = {"string": "string",
+           "bytes": "bytes",
+           "bool": "bool",
+           "float": "float",
+           "double": "float",
+           "uint32": "integer",
+           "uint64": "integer",
+           "int32": "integer",
+           "int64": "integer",
+           "fixed32": "integer",
+           "sfixed32": "integer",
+           "sfixed64": "integer"}
+
+  def __init__(self, path, column_type):
+    self.path = path
+    self.name = ".".join(path)
+    self.type = column_type
+
+  def GetValue(self, value):
+    """Returns the value of this column for an exported value, or None."""
+    for name in self.path:
+      if not value.HasField(name):
+        return None
+
+      value = getattr(value, name)
+
+    if self.type == "string":
+      return utils.SmartUnicode(value)
+
+    if isinstance(value, rdfvalue.RDFValue):
+      value = value.SerializeToDataStore()
+
+    if self.type == "bytes":
+      return base64.b64encode(utils.SmartStr(value))
+    elif self.type == "bool":
+      return bool(value)
+    elif self.type == "float":
+      return float(value)
+    else:
+      return long(value)
+
+
+def GetSchema(rdf_cls, prefix=()):
+  """Returns the list of Columns of an exported RDFProtoStruct class."""
+  columns = []
+  for desc in sorted(rdf_cls.type_infos, key=lambda desc: desc.field_number):
+    path = prefix + (desc.name,)
+    if isinstance(desc, type_info.ProtoEmbedded):
+      columns.extend(GetSchema(desc.type, prefix=path))
+    elif isinstance(desc, (type_info.ProtoList,
+                           type_info.ProtoDynamicEmbedded)):
+      # Repeated and dynamic fields are not exported.
+      pass
+    elif isinstance(desc, type_info.ProtoBoolean):
+      columns.append(Column(path, "bool"))
+    elif isinstance(desc, type_info.ProtoEnum):
+      columns.append(Column(path, "string"))
+    else:
+      columns.append(Column(path, Column.TYPES.get(desc.proto_type_name,
+                                                   "string")))
+
+  return columns
+
+
+class ExportWriter(object):
+  """Appends rows to an export file."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # The format name and file extension.
+  name = None
+
+  def __init__(self, path, columns):
+    self.path = path
+    self.columns = columns
+    self.fd = open(path, "ab")
+
+  def WriteRows(self, rows):
+    """Writes a list of rows, each a list of column values."""
+    raise NotImplementedError()
+
+  def Close(self):
+    self.fd.close()
+
+  @classmethod
+  def GetWriterClass(cls, name):
+    for writer_cls in cls.classes.itervalues():
+      if writer_cls.name == name:
+        return writer_cls
+
+    raise ValueError("Unknown export format: %s" % name)
+
+
+class CSVWriter(ExportWriter):
+  """Writes CSV files with a header line."""
+
+  name = "csv"
+
+  def __init__(self, path, columns):
+    super(CSVWriter, self).__init__(path, columns)
+    self.writer = csv.writer(self.fd)
+
+    if not self.fd.tell():
+      self.writer.writerow([column.name for column in columns])
+
+  def WriteRows(self, rows):
+    for row in rows:
+      self.writer.writerow([u"" if value is None else
+                            utils.SmartStr(value) for value in row])
+
+
+class JSONLWriter(ExportWriter):
+  """Writes one JSON object per line."""
+
+  name = "jsonl"
+
+  def WriteRows(self, rows):
+    names = [column.name for column in self.columns]
+    for row in rows:
+      self.fd.write(json.dumps(dict(zip(names, row)), sort_keys=True) + "\n")
+
+
+class ColumnarWriter(ExportWriter):
+  """Writes each row group column by column."""
+
+  name = "columnar"
+
+  MAGIC = "GRRCOL01"
+
+  def WriteRows(self, rows):
+    if not rows:
+      return
+
+    data = []
+    for i in range(len(self.columns)):
+      data.append(zlib.compress(json.dumps([row[i] for row in rows])))
+
+    header = json.dumps(dict(
+        rows=len(rows),
+        columns=[(column.name, column.type, len(column_data))
+                 for column, column_data in zip(self.columns, data)]))
+
+    self.fd.write(self.MAGIC + struct.pack("<I", len(header)) + header)
+    for column_data in data:
+      self.fd.write(column_data)
+
+
+class ColumnarReader(object):
+  """Reads files written by the ColumnarWriter."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def ReadRowGroups(self, columns=None):
+    """Reads the row groups of the file.
+
+    Args:
+      columns: The names of the columns to read, None reads all of them. The
+        data of other columns is skipped.
+
+    Yields:
+      A dict of column name -> list of values for each row group.
+    """
+    magic = ColumnarWriter.MAGIC
+    with open(self.path, "rb") as fd:
+      while True:
+        data = fd.read(len(magic) + 4)
+        if not data:
+          break
+
+        if len(data) < len(magic) + 4 or not data.startswith(magic):
+          raise IOError("%s is not a columnar export file." % self.path)
+
+        header_length = struct.unpack("<I", data[len(magic):])[0]
+        header = json.loads(fd.read(header_length))
+
+        result = {}
+        for name, _, length in header["columns"]:
+          if columns is None or name in columns:
+            result[name] = json.loads(zlib.decompress(fd.read(length)))
+          else:
+            fd.seek(length, 1)
+
+        yield result
+
+  def ReadRows(self, columns=None):
+    """Yields each row as a dict of column name -> value."""
+    for row_group in self.ReadRowGroups(columns=columns):
+      names = sorted(row_group)
+      for values in zip(*[row_group[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+class StreamingExporter(object):
+  """Converts values and writes them into one file per exported type."""
+
+  def __init__(self, output_dir, export_format="columnar", options=None,
+               batch_size=1000, row_group_size=10000, token=None):
+    """Constructor.
+
+    Args:
+      output_dir: The directory the files are written to.
+      export_format: The name of the ExportWriter to use.
+      options: rdfvalue.ExportOptions passed to the converters.
+      batch_size: The number of values converted at once.
+      row_group_size: The number of rows of each type buffered before they are
+        written.
+      token: The token to use for data store access.
+    """
+    self.output_dir = output_dir
+    self.writer_cls = ExportWriter.GetWriterClass(export_format)
+    self.row_group_size = row_group_size
+    self.converter = export.StreamingConverter(options=options,
+                                               batch_size=batch_size,
+                                               token=token)
+
+    # Writers, their columns and buffered rows by exported type name.
+    self.writers = {}
+    self.buffers = {}
+
+    # The number of rows written for each exported type.
+    self.row_counts = {}
+
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+
+  def _GetWriter(self, exported_value):
+    type_name = exported_value.__class__.__name__
+    try:
+      return self.writers[type_name]
+    except KeyError:
+      path = os.path.join(self.output_dir,
+                          "%s.%s" % (type_name, self.writer_cls.name))
+      writer = self.writer_cls(path, GetSchema(exported_value.__class__))
+      self.writers[type_name] = writer
+      self.buffers[type_name] = []
+      self.row_counts.setdefault(type_name, 0)
+      return writer
+
+  def _FlushBuffer(self, type_name):
+    rows = self.buffers[type_name]
+    if rows:
+      self.writers[type_name].WriteRows(rows)
+      self.row_counts[type_name] += len(rows)
+      self.buffers[type_name] = []
+
+  def AddValues(self, metadata_value_pairs):
+    """Converts and writes (metadata, value) tuples."""
+    for exported_value in self.converter.Convert(metadata_value_pairs):
+      writer = self._GetWriter(exported_value)
+      type_name = exported_value.__class__.__name__
+
+      self.buffers[type_name].append(
+          [column.GetValue(exported_value) for column in writer.columns])
+      if len(self.buffers[type_name]) >= self.row_group_size:
+        self._FlushBuffer(type_name)
+
+  def AddCollection(self, collection, metadata=None):
+    """Converts and writes all the values of a collection.
+
+    Args:
+      collection: An RDFValueCollection.
+      metadata: The rdfvalue.ExportedMetadata of the values. Metadata of
+        GrrMessages is taken from their source client.
+    """
+    if metadata is None:
+      metadata = rdfvalue.ExportedMetadata(
+          source_urn=collection.urn, timestamp=rdfvalue.RDFDatetime().Now())
+
+    self.AddValues((metadata, value) for value in collection)
+
+  def Close(self):
+    """Writes the buffered rows and closes the files."""
+    for type_name, writer in self.writers.iteritems():
+      self._FlushBuffer(type_name)
+      writer.Close()
+
+    self.writers = {}
+    self.buffers = {}
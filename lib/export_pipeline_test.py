@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Tests for the streaming export pipeline."""
+
+
+import csv
+import json
+import os
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import aff4
+from grr.lib import export_pipeline
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+
+class StreamingExporterTest(test_lib.GRRBaseTest):
+  """Tests the StreamingExporter."""
+
+  def setUp(self):
+    super(StreamingExporterTest, self).setUp()
+    self.output_dir = os.path.join(self.temp_dir, "export")
+    self.metadata = rdfvalue.ExportedMetadata(
+        source_urn=rdfvalue.RDFURN("aff4:/hunts/W:000000/Results"))
+
+  def _Processes(self, count):
+    return [rdfvalue.Process(pid=i, ppid=1, name="proc%d" % i,
+                             cmdline=["cmd.exe", "/c"],
+                             ctime=long(1333718907.167083 * 1e6),
+                             open_files=["/some/a", "/some/b"])
+            for i in range(count)]
+
+  def _Export(self, values, export_format, **kwargs):
+    exporter = export_pipeline.StreamingExporter(
+        self.output_dir, export_format=export_format, batch_size=7,
+        token=self.token, **kwargs)
+    exporter.AddValues((self.metadata, value) for value in values)
+    exporter.Close()
+    return exporter
+
+  def testSchemaFlattensNestedMessages(self):
+    columns = dict((column.name, column.type) for column in
+                   export_pipeline.GetSchema(rdfvalue.ExportedProcess))
+
+    self.assertEqual(columns["metadata.source_urn"], "string")
+    self.assertEqual(columns["metadata.timestamp"], "integer")
+    self.assertEqual(columns["pid"], "integer")
+    self.assertEqual(columns["cmdline"], "string")
+    self.assertEqual(columns["memory_percent"], "float")
+    self.assertFalse("metadata" in columns)
+
+  def testWritesOneFilePerExportedType(self):
+    exporter = self._Export(self._Processes(20), "columnar")
+
+    self.assertEqual(sorted(os.listdir(self.output_dir)),
+                     ["ExportedOpenFile.columnar", "ExportedProcess.columnar"])
+    self.assertEqual(exporter.row_counts, {"ExportedProcess": 20,
+                                           "ExportedOpenFile": 40})
+
+  def testColumnarRoundTrip(self):
+    self._Export(self._Processes(20), "columnar", row_group_size=6)
+
+    reader = export_pipeline.ColumnarReader(
+        os.path.join(self.output_dir, "ExportedProcess.columnar"))
+
+    # 20 rows are written in row groups of at most 6 rows.
+    row_groups = list(reader.ReadRowGroups())
+    self.assertEqual([len(group["pid"]) for group in row_groups],
+                     [6, 6, 6, 2])
+
+    rows = list(reader.ReadRows(columns=["pid", "metadata.source_urn"]))
+    self.assertEqual(sorted(row["pid"] for row in rows), range(20))
+    for row in rows:
+      self.assertEqual(sorted(row), ["metadata.source_urn", "pid"])
+      self.assertEqual(row["metadata.source_urn"],
+                       "aff4:/hunts/W:000000/Results")
+
+  def testExportsAppendToExistingFiles(self):
+    self._Export(self._Processes(5), "columnar")
+    self._Export(self._Processes(5), "columnar")
+
+    reader = export_pipeline.ColumnarReader(
+        os.path.join(self.output_dir, "ExportedProcess.columnar"))
+    self.assertEqual(len(list(reader.ReadRows())), 10)
+
+  def testCSVExport(self):
+    self._Export(self._Processes(5), "csv")
+    self._Export(self._Processes(5), "csv")
+
+    with open(os.path.join(self.output_dir, "ExportedProcess.csv")) as fd:
+      rows = list(csv.DictReader(fd))
+
+    # The header is only written once.
+    self.assertEqual(len(rows), 10)
+    self.assertEqual(rows[3]["name"], "proc3")
+    self.assertEqual(rows[3]["cmdline"], "cmd.exe /c")
+    self.assertEqual(rows[3]["metadata.source_urn"],
+                     "aff4:/hunts/W:000000/Results")
+    self.assertEqual(rows[3]["username"], "")
+
+  def testJSONLExport(self):
+    self._Export(self._Processes(5), "jsonl")
+
+    with open(os.path.join(self.output_dir, "ExportedOpenFile.jsonl")) as fd:
+      rows = [json.loads(line) for line in fd]
+
+    self.assertEqual(len(rows), 10)
+    self.assertEqual(rows[3]["path"], "/some/b")
+    self.assertEqual(rows[3]["pid"], 1)
+    self.assertEqual(rows[3]["metadata.hostname"], None)
+
+  def testAddCollectionFetchesClientMetadata(self):
+    client_ids = self.SetupClients(3)
+
+    fd = aff4.FACTORY.Create("aff4:/testcoll", "RDFValueCollection",
+                             token=self.token)
+    for client_id, process in zip(client_ids, self._Processes(3)):
+      fd.Add(rdfvalue.GrrMessage(payload=process, source=client_id))
+    fd.Close()
+
+    exporter = export_pipeline.StreamingExporter(self.output_dir,
+                                                 token=self.token)
+    exporter.AddCollection(aff4.FACTORY.Open("aff4:/testcoll",
+                                             token=self.token))
+    exporter.Close()
+
+    reader = export_pipeline.ColumnarReader(
+        os.path.join(self.output_dir, "ExportedProcess.columnar"))
+    rows = sorted(reader.ReadRows(), key=lambda row: row["pid"])
+
+    self.assertEqual([row["metadata.client_urn"] for row in rows],
+                     [str(client_id) for client_id in client_ids])
+    self.assertEqual([row["metadata.hostname"] for row in rows],
+                     ["Host-0", "Host-1", "Host-2"])
+    for row in rows:
+      self.assertEqual(row["metadata.source_urn"], "aff4:/testcoll")
+
+  def testUnknownFormatRaises(self):
+    self.assertRaises(ValueError, export_pipeline.StreamingExporter,
+                      self.output_dir, export_format="parquet")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
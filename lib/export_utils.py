@@ -6,17 +6,15 @@
 import os
 import Queue
 import stat
-import time
 
 import logging
 
 from grr.lib import aff4
+from grr.lib import fleet_scan
 from grr.lib import rdfvalue
 from grr.lib import serialize
 from grr.lib import threadpool
-from grr.lib import type_info
 from grr.lib import utils
-from grr.lib.aff4_objects import aff4_grr
 
 
 BUFFER_SIZE = 16 * 1024 * 1024
@@ -24,13 +22,7 @@ BUFFER_SIZE = 16 * 1024 * 1024
 
 def GetAllClients(token=None):
   """Return a list of all client urns."""
-  results = []
-  for urn in aff4.FACTORY.Open(aff4.ROOT_URN, token=token).ListChildren():
-    try:
-      results.append(rdfvalue.ClientURN(urn))
-    except type_info.TypeValueError:
-      pass
-  return results
+  return fleet_scan.ListClients(token=token)
 
 
 class IterateAllClientUrns(object):
@@ -97,31 +89,27 @@ class IterateAllClientUrns(object):
 class IterateAllClients(IterateAllClientUrns):
   """Class to iterate over all GRR Client objects."""
 
-  def __init__(self, max_age, client_chunksize=25, **kwargs):
+  def __init__(self, max_age, client_chunksize=25, attributes=None, **kwargs):
     """Iterate over all clients in a threadpool.
 
     Args:
       max_age: Maximum age in seconds of clients to check.
-      client_chunksize: A function to call with each client urn.
+      client_chunksize: The number of clients opened at once.
+      attributes: If set, only these client attributes are read.
       **kwargs: Arguments passed to init.
     """
     super(IterateAllClients, self).__init__(**kwargs)
     self.client_chunksize = client_chunksize
     self.max_age = max_age
+    self.attributes = attributes
 
   def GetInput(self):
-    """Yield client urns."""
-    client_list = GetAllClients(token=self.token)
-    logging.debug("Got %d clients", len(client_list))
-    for client_group in utils.Grouper(client_list, self.client_chunksize):
-      for fd in aff4.FACTORY.MultiOpen(client_group, mode="r",
-                                       aff4_type="VFSGRRClient",
-                                       token=self.token):
-        if isinstance(fd, aff4_grr.VFSGRRClient):
-          # Skip if older than max_age
-          oldest_time = (time.time() - self.max_age) * 1e6
-        if fd.Get(aff4.VFSGRRClient.SchemaCls.PING) >= oldest_time:
-          yield fd
+    """Yield client objects seen in the last max_age seconds."""
+    scan = fleet_scan.FleetScan(attributes=self.attributes,
+                                max_age=self.max_age,
+                                chunk_size=self.client_chunksize,
+                                token=self.token)
+    return scan.IterateClients()
 
 
 def DownloadFile(file_obj, target_path, buffer_size=BUFFER_SIZE):
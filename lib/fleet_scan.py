@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""A single pass scan over all clients which feeds many consumers.
+
+Jobs which look at every client, such as the fleet stats cron jobs, client
+reports and exports, used to list aff4:/ and open every client with all its
+attributes, each of them on its own. A FleetScan lists the clients once, opens
+them in chunks reading only the attributes its consumers declare, and feeds
+every client to all consumers.
+
+Chunks are fetched in parallel by a thread pool while earlier chunks are fed to
+the consumers in order on the calling thread, so consumers need no locking.
+
+A named scan writes a checkpoint after each chunk: the last client processed
+and the consumers themselves. If a scan with the same name is started while a
+recent checkpoint exists, e.g. because a cron job lost its lease half way, it
+resumes from the checkpoint. The checkpoint is removed when the scan finishes.
+"""
+
+
+import bisect
+import cPickle
+import Queue
+import time
+
+import logging
+
+from grr.lib import aff4
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import threadpool
+from grr.lib import type_info
+from grr.lib import utils
+from grr.lib.aff4_objects import aff4_grr
+
+
+config_lib.DEFINE_integer("FleetScan.chunk_size", 200,
+                          "The number of clients opened at once by fleet "
+                          "scans.")
+
+config_lib.DEFINE_integer("FleetScan.threads", 5,
+                          "The number of chunks fleet scans fetch in "
+                          "parallel.")
+
+config_lib.DEFINE_integer("FleetScan.checkpoint_max_age", 24 * 60 * 60,
+                          "Fleet scans only resume from checkpoints younger "
+                          "than this many seconds.")
+
+
+class FleetScanConsumer(object):
+  """Receives every client of a fleet scan.
+
+  Consumers are pickled into checkpoints, so they should only hold plain data.
+  """
+
+  # The client attributes this consumer reads, None reads all of them.
+  ATTRIBUTES = []
+
+  def Begin(self):
+    """Called before the first client of a scan."""
+
+  def ProcessClient(self, client):
+    """Called with each client, opened read only."""
+    raise NotImplementedError()
+
+  def Finish(self):
+    """Called after the last client of a scan."""
+
+
+def ListClients(token=None):
+  """Returns the urns of all clients, sorted."""
+  results = []
+  for urn in aff4.FACTORY.Open(aff4.ROOT_URN, token=token).ListChildren():
+    try:
+      results.append(rdfvalue.ClientURN(urn))
+    except type_info.TypeValueError:
+      pass
+
+  return sorted(results)
+
+
+class FleetScan(object):
+  """Streams all clients to consumers in a single pass."""
+
+  ROOT = rdfvalue.RDFURN("aff4:/fleet_scans")
+  CHECKPOINT = "scan:checkpoint"
+  THREAD_POOL_NAME = "FleetScan"
+
+  def __init__(self, consumers=None, attributes=None, name=None, max_age=None,
+               chunk_size=None, threads=None, heartbeat=None, token=None):
+    """Constructor.
+
+    Args:
+      consumers: A list of FleetScanConsumer instances.
+      attributes: Client attributes to read in addition to the ones the
+        consumers declare.
+      name: If set, the scan is checkpointed under this name.
+      max_age: If set, only clients which were seen in the last max_age
+        seconds are scanned.
+      chunk_size: The number of clients opened at once.
+      threads: The number of chunks fetched in parallel.
+      heartbeat: A callable called after each chunk, e.g. a flow's HeartBeat.
+      token: The token to use for data store access.
+    """
+    self.consumers = consumers or []
+    self.name = name
+    self.max_age = max_age
+    self.chunk_size = chunk_size or config_lib.CONFIG["FleetScan.chunk_size"]
+    self.threads = threads or config_lib.CONFIG["FleetScan.threads"]
+    self.heartbeat = heartbeat
+    self.token = token
+
+    # The union of all attributes, None if a consumer reads all of them.
+    self.attributes = set(attributes or [])
+    for consumer in self.consumers:
+      if consumer.ATTRIBUTES is None:
+        self.attributes = None
+        break
+
+      self.attributes.update(consumer.ATTRIBUTES)
+
+    if self.attributes is not None and max_age is not None:
+      self.attributes.add(aff4_grr.VFSGRRClient.SchemaCls.PING)
+
+  def _FetchChunk(self, urns, result_queue):
+    """Opens the clients of a chunk, in the order of urns."""
+    try:
+      clients = dict((utils.SmartUnicode(client.urn), client)
+                     for client in aff4.FACTORY.MultiOpen(
+                         urns, mode="r", aff4_type="VFSGRRClient",
+                         attributes=self.attributes, token=self.token))
+
+      # MultiOpen returns the objects in data store order.
+      result_queue.put([clients[utils.SmartUnicode(urn)] for urn in urns
+                        if utils.SmartUnicode(urn) in clients])
+    except Exception as e:  # pylint: disable=broad-except
+      result_queue.put(e)
+
+  def _IterateChunks(self, urns):
+    """Yields the clients of each chunk, fetching chunks in parallel."""
+    chunks = [urns[i:i + self.chunk_size]
+              for i in range(0, len(urns), self.chunk_size)]
+
+    pool = threadpool.ThreadPool.Factory(self.THREAD_POOL_NAME, self.threads)
+    pool.Start()
+
+    pending = []
+    next_chunk = 0
+    while next_chunk < len(chunks) or pending:
+      while next_chunk < len(chunks) and len(pending) < self.threads:
+        result_queue = Queue.Queue(1)
+        pool.AddTask(target=self._FetchChunk,
+                     args=(chunks[next_chunk], result_queue),
+                     name=self.THREAD_POOL_NAME)
+        pending.append((chunks[next_chunk], result_queue))
+        next_chunk += 1
+
+      chunk, result_queue = pending.pop(0)
+      clients = result_queue.get()
+      if isinstance(clients, Exception):
+        raise clients
+
+      if self.max_age is not None:
+        oldest_time = (time.time() - self.max_age) * 1e6
+        clients = [client for client in clients
+                   if client.Get(client.Schema.PING) >= oldest_time]
+
+      yield chunk, clients
+
+  def IterateClients(self):
+    """Yields all clients, without consumers or checkpoints."""
+    for _, clients in self._IterateChunks(ListClients(token=self.token)):
+      for client in clients:
+        yield client
+
+  def _ReadCheckpoint(self):
+    """Returns the checkpoint as (last urn, consumers) or None."""
+    value, timestamp = data_store.DB.Resolve(
+        self.ROOT.Add(self.name), self.CHECKPOINT, token=self.token)
+    if not value:
+      return None
+
+    max_age = config_lib.CONFIG["FleetScan.checkpoint_max_age"]
+    if timestamp < (time.time() - max_age) * 1e6:
+      return None
+
+    try:
+      return cPickle.loads(str(value))
+    except Exception as e:  # pylint: disable=broad-except
+      logging.warning("Ignoring broken checkpoint of scan %s: %s", self.name, e)
+      return None
+
+  def _WriteCheckpoint(self, last_urn):
+    data_store.DB.Set(self.ROOT.Add(self.name), self.CHECKPOINT,
+                      cPickle.dumps((last_urn, self.consumers), -1),
+                      sync=True, token=self.token)
+
+  def _DeleteCheckpoint(self):
+    data_store.DB.DeleteAttributes(self.ROOT.Add(self.name), [self.CHECKPOINT],
+                                   sync=True, token=self.token)
+
+  def Run(self):
+    """Feeds all clients to the consumers.
+
+    Returns:
+      The number of clients processed by this run.
+    """
+    urns = ListClients(token=self.token)
+
+    checkpoint = self.name and self._ReadCheckpoint()
+    if checkpoint:
+      last_urn, self.consumers = checkpoint
+      urns = urns[bisect.bisect_right(urns, last_urn):]
+      logging.info("Resuming scan %s after %s.", self.name, last_urn)
+    else:
+      for consumer in self.consumers:
+        consumer.Begin()
+
+    processed_count = 0
+    for chunk, clients in self._IterateChunks(urns):
+      for client in clients:
+        for consumer in self.consumers:
+          consumer.ProcessClient(client)
+
+      processed_count += len(clients)
+
+      if self.name:
+        self._WriteCheckpoint(chunk[-1])
+
+      if self.heartbeat:
+        self.heartbeat()
+
+    for consumer in self.consumers:
+      consumer.Finish()
+
+    if self.name:
+      self._DeleteCheckpoint()
+
+    return processed_count
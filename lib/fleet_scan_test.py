@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Tests for the fleet scan."""
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import aff4
+from grr.lib import flags
+from grr.lib import fleet_scan
+from grr.lib import test_lib
+
+
+class ClientCounter(fleet_scan.FleetScanConsumer):
+  """Remembers the clients and the hostnames it has seen."""
+
+  ATTRIBUTES = [aff4.AFF4Object.classes["VFSGRRClient"].SchemaCls.PING]
+
+  # Raise after processing this many clients, once.
+  fail_after = None
+
+  def Begin(self):
+    self.begin_count = getattr(self, "begin_count", 0) + 1
+    self.clients = []
+    self.hostnames = []
+    self.finished = False
+
+  def ProcessClient(self, client):
+    if ClientCounter.fail_after == len(self.clients):
+      ClientCounter.fail_after = None
+      raise RuntimeError("Lost the lease.")
+
+    self.clients.append(client.urn)
+    self.hostnames.append(client.Get(client.Schema.HOSTNAME))
+
+  def Finish(self):
+    self.finished = True
+
+
+class HostnameCounter(ClientCounter):
+  ATTRIBUTES = [aff4.AFF4Object.classes["VFSGRRClient"].SchemaCls.HOSTNAME]
+
+
+class FleetScanTest(test_lib.GRRBaseTest):
+  """Tests the FleetScan."""
+
+  def setUp(self):
+    super(FleetScanTest, self).setUp()
+    self.client_ids = self.SetupClients(10)
+
+  def tearDown(self):
+    ClientCounter.fail_after = None
+    super(FleetScanTest, self).tearDown()
+
+  def testSinglePassFeedsAllConsumers(self):
+    consumers = [ClientCounter(), HostnameCounter()]
+    scan = fleet_scan.FleetScan(consumers, chunk_size=3, threads=2,
+                                token=self.token)
+    self.assertEqual(scan.Run(), 10)
+
+    for consumer in consumers:
+      self.assertEqual(consumer.clients, self.client_ids)
+      self.assertTrue(consumer.finished)
+
+    # Both consumers see the union of the attributes they declare.
+    self.assertEqual(consumers[0].hostnames,
+                     ["Host-%s" % i for i in range(10)])
+
+  def testOnlyDeclaredAttributesAreRead(self):
+    consumer = ClientCounter()
+    fleet_scan.FleetScan([consumer], token=self.token).Run()
+    self.assertEqual(consumer.hostnames, [None] * 10)
+
+  def testIterateClientsSkipsOldClients(self):
+    scan = fleet_scan.FleetScan(max_age=3600, token=self.token)
+    self.assertEqual(len(list(scan.IterateClients())), 10)
+
+    with test_lib.FakeTime(1e10):
+      scan = fleet_scan.FleetScan(max_age=3600, token=self.token)
+      self.assertEqual(list(scan.IterateClients()), [])
+
+  def testScanResumesFromCheckpoint(self):
+    ClientCounter.fail_after = 5
+    scan = fleet_scan.FleetScan([ClientCounter()], name="test", chunk_size=3,
+                                threads=1, token=self.token)
+    self.assertRaises(RuntimeError, scan.Run)
+
+    # The first chunk was checkpointed, the rest is scanned again with the
+    # consumer state from the checkpoint.
+    scan = fleet_scan.FleetScan([ClientCounter()], name="test", chunk_size=3,
+                                threads=1, token=self.token)
+    self.assertEqual(scan.Run(), 7)
+
+    consumer = scan.consumers[0]
+    self.assertEqual(consumer.begin_count, 1)
+    self.assertEqual(consumer.clients, self.client_ids)
+    self.assertTrue(consumer.finished)
+
+    # The finished scan removed its checkpoint, so the next one starts over.
+    scan = fleet_scan.FleetScan([ClientCounter()], name="test", chunk_size=3,
+                                token=self.token)
+    self.assertEqual(scan.Run(), 10)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
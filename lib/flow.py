@@ -57,6 +57,7 @@ from grr.lib import communicator
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flow_runner
+from grr.lib import frontend_cache
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -639,7 +640,12 @@ class GRRFlow(aff4.AFF4Volume):
     result.source = self.session_id
     result.priority = priority
 
-    self.runner.Publish(event_name, result)
+    delivery = Events.GetDelivery(event_name)
+    if delivery == Events.INLINE:
+      Events.DeliverInline(event_name, [result], token=self.token)
+    else:
+      self.runner.Publish(event_name, result,
+                          batch=delivery == Events.BATCHED)
 
   # The following methods simply delegate to the runner. They are meant to only
   # be called from within the flow's state handling methods (i.e. a runner
@@ -976,6 +982,10 @@ class WellKnownFlow(GRRFlow):
   # Well known flows are not browsable.
   category = None
 
+  # ProcessResponses() is called once this many responses were fetched,
+  # possibly from many requests.
+  response_batch_size = 1
+
   @classmethod
   def GetAllWellKnownFlows(cls, token=None):
     """Get instances of all well known flows."""
@@ -1016,29 +1026,86 @@ class WellKnownFlow(GRRFlow):
 
   def ProcessRequests(self, thread_pool):
     """For WellKnownFlows we receive these messages directly."""
-    try:
-      priority = rdfvalue.GrrMessage.Priority.MEDIUM_PRIORITY
-      with queue_manager.WellKnownQueueManager(
-          token=self.token) as manager:
-        for request, responses in manager.FetchRequestsAndResponses(
+    priority = rdfvalue.GrrMessage.Priority.MEDIUM_PRIORITY
+    more_data = False
+    with queue_manager.WellKnownQueueManager(token=self.token) as manager:
+      requests = []
+      responses = []
+      try:
+        for request, request_responses in manager.FetchRequestsAndResponses(
             self.session_id):
-          for msg in responses:
-            # Even though we use the thread pool here, it may be exhausted so we
-            # end up running inline. We still need to heartbeat here so the
-            # lease on the well known flow does not expire.
-            self.HeartBeat()
+          for msg in request_responses:
             priority = msg.priority
-            thread_pool.AddTask(target=self._SafeProcessMessage,
-                                args=(msg,), name=self.__class__.__name__)
 
-          manager.DeleteFlowRequestStates(self.session_id, request)
+          requests.append(request)
+          responses.extend(self.UnpackEventBatches(request_responses))
+
+          if len(responses) >= self.response_batch_size:
+            self._ProcessBatch(manager, requests, responses, thread_pool)
+            requests = []
+            responses = []
 
-    except queue_manager.MoreDataException:
+      except queue_manager.MoreDataException:
+        more_data = True
+
+      if requests:
+        self._ProcessBatch(manager, requests, responses, thread_pool)
+
+    if more_data:
       # There is more data for this flow so we have to tell the worker to
       # fetch more messages later.
       queue_manager.QueueManager(token=self.token).NotifyQueue(
           self.state.context.session_id, priority=priority)
 
+  def _ProcessBatch(self, manager, requests, responses, thread_pool):
+    self.ProcessResponses(responses, thread_pool)
+
+    for request in requests:
+      manager.DeleteFlowRequestStates(self.session_id, request)
+
+  @staticmethod
+  def UnpackEventBatches(messages):
+    """Replaces the batched event records in messages by their events.
+
+    Only batches queued by the server are unpacked. Batches sent by clients are
+    passed on as they are, so clients can't forge the events inside them.
+
+    Args:
+      messages: A list of GrrMessages.
+
+    Returns:
+      A list of GrrMessages.
+    """
+    result = []
+    for msg in messages:
+      if (msg.name == queue_manager.QueueManager.EVENT_BATCH_NAME and
+          msg.auth_state == msg.AuthorizationState.AUTHENTICATED and
+          not (msg.source and rdfvalue.ClientURN.Validate(msg.source)) and
+          isinstance(msg.payload, rdfvalue.MessageList)):
+        result.extend(msg.payload.job)
+      else:
+        result.append(msg)
+
+    return result
+
+  def ProcessResponses(self, responses, thread_pool):
+    """Processes the messages of a request on the thread pool.
+
+    By default each message is passed to ProcessMessage() separately. Flows
+    which can handle many messages more efficiently at once may override this.
+
+    Args:
+      responses: A list of GrrMessages.
+      thread_pool: The thread pool to process the messages on.
+    """
+    for msg in responses:
+      # Even though we use the thread pool here, it may be exhausted so we
+      # end up running inline. We still need to heartbeat here so the
+      # lease on the well known flow does not expire.
+      self.HeartBeat()
+      thread_pool.AddTask(target=self._SafeProcessMessage,
+                          args=(msg,), name=self.__class__.__name__)
+
   def ProcessMessage(self, msg):
     """This is where messages get processed.
 
@@ -1170,11 +1237,27 @@ class EventListener(WellKnownFlow):
 
 
 class Events(object):
-  """A class that provides event publishing methods."""
+  """A class that provides event publishing methods.
+
+  How events are delivered is configured by event name:
+
+    DURABLE: Each event is queued for each listener with its own notification.
+      This is the default.
+    BATCHED: Events which are published together, e.g. by one flow state or
+      one PublishMultipleEvents() call, are queued for each listener as one
+      batched record with a single notification (Events.batched_events).
+    INLINE: Events are passed to the listeners in the publishing process right
+      away, without being queued. They are lost if the process dies before
+      the listener is done (Events.inline_events).
+  """
 
   # This lookup map is built at runtime for fast lookups.
   EVENT_NAME_MAP = {}
 
+  DURABLE = "durable"
+  BATCHED = "batched"
+  INLINE = "inline"
+
   @classmethod
   def BuildCache(cls):
     # Build a lookup map for EventListener objects.
@@ -1186,6 +1269,48 @@ class Events(object):
 
     EventListener.EVENT_NAME_MAP = Events.EVENT_NAME_MAP
 
+  @classmethod
+  def GetDelivery(cls, event_name):
+    """Returns how events with this name are delivered.
+
+    Args:
+      event_name: Either a URN of an event listener or an event name. Events
+        sent to a listener URN are always durable.
+
+    Returns:
+      One of DURABLE, BATCHED or INLINE.
+    """
+    if not isinstance(event_name, basestring):
+      return cls.DURABLE
+
+    if event_name in config_lib.CONFIG["Events.inline_events"]:
+      return cls.INLINE
+
+    if event_name in config_lib.CONFIG["Events.batched_events"]:
+      return cls.BATCHED
+
+    return cls.DURABLE
+
+  @classmethod
+  def DeliverInline(cls, event_name, messages, token=None, safe=True):
+    """Passes GrrMessages to the listeners of an event in this process.
+
+    Args:
+      event_name: The name of the event.
+      messages: A list of GrrMessages.
+      token: ACL token.
+      safe: If set, exceptions raised by a listener are logged instead of
+        passed on to the caller.
+    """
+    for event_cls in cls.EVENT_NAME_MAP.get(event_name, []):
+      listener = event_cls(event_cls.well_known_session_id, mode="rw",
+                           token=token)
+      for msg in messages:
+        if safe:
+          listener._SafeProcessMessage(msg)  # pylint: disable=protected-access
+        else:
+          listener.ProcessMessage(msg)
+
   @classmethod
   def PublishEvent(cls, event_name, msg, token=None, sync=None):
     """Publish the message into all listeners of the event.
@@ -1227,8 +1352,10 @@ class Events(object):
       ValueError: If the message is invalid. The message must be a Semantic
         Value (instance of RDFValue) or a full GrrMessage.
     """
+    inline_events = {}
     with queue_manager.WellKnownQueueManager(token=token, sync=sync) as manager:
       for event_name, messages in events.iteritems():
+        delivery = cls.GetDelivery(event_name)
         handler_urns = []
         if isinstance(event_name, basestring):
           for event_cls in cls.EVENT_NAME_MAP.get(event_name, []):
@@ -1251,6 +1378,10 @@ class Events(object):
           if not isinstance(msg, rdfvalue.GrrMessage):
             msg = rdfvalue.GrrMessage(payload=msg)
 
+          if delivery == cls.INLINE:
+            inline_events.setdefault(event_name, []).append(msg)
+            continue
+
           # Randomize the response id or events will get overwritten.
           msg.response_id = msg.task_id = msg.GenerateTaskID()
           # Well known flows always listen for request id 0.
@@ -1258,8 +1389,14 @@ class Events(object):
 
           # Forward the message to the well known flow's queue.
           for event_urn in handler_urns:
-            manager.QueueResponse(event_urn, msg)
-            manager.QueueNotification(event_urn, priority=msg.priority)
+            if delivery == cls.BATCHED:
+              manager.QueueEvent(event_urn, msg)
+            else:
+              manager.QueueResponse(event_urn, msg)
+              manager.QueueNotification(event_urn, priority=msg.priority)
+
+    for event_name, messages in inline_events.iteritems():
+      cls.DeliverInline(event_name, messages, token=token)
 
   @classmethod
   def PublishEventInline(cls, event_name, msg, token=None):
@@ -1275,18 +1412,17 @@ class Events(object):
     # Event name must be a string.
     if not isinstance(event_name, basestring):
       raise ValueError("Event name must be a string.")
-    for event_cls in cls.EVENT_NAME_MAP.get(event_name, []):
-      event_obj = event_cls(event_cls.well_known_session_id,
-                            mode="rw", token=token)
-      event_obj.ProcessMessage(msg)
+
+    cls.DeliverInline(event_name, [msg], token=token, safe=False)
 
 
 class ServerPubKeyCache(communicator.PubKeyCache):
   """A public key cache used by servers getting the key from the AFF4 client."""
 
-  def __init__(self, client_cache, token=None):
+  def __init__(self, client_cache, token=None, shared_cache=None):
     self.client_cache = client_cache
     self.token = token
+    self.shared_cache = shared_cache
 
   def GetRSAPublicKey(self, common_name="Server"):
     """Retrieves the public key for the common_name from data_store.
@@ -1312,32 +1448,49 @@ class ServerPubKeyCache(communicator.PubKeyCache):
       return cert.GetPubKey()
 
     except (KeyError, AttributeError):
-      # Fetch the client's cert - We will be updating its clock attribute.
-      client = aff4.FACTORY.Create(common_name, "VFSGRRClient", mode="rw",
-                                   token=self.token, ignore_cache=True)
-      cert = client.Get(client.Schema.CERT)
-      if not cert:
-        stats.STATS.IncrementCounter("grr_unique_clients")
-        raise communicator.UnknownClientCert("Cert not found")
+      pass
 
-      if rdfvalue.RDFURN(cert.common_name) != rdfvalue.RDFURN(common_name):
-        logging.error("Stored cert mismatch for %s", common_name)
-        raise communicator.UnknownClientCert("Stored cert mismatch")
+    # Another frontend process might have read the cert already.
+    if self.shared_cache is not None:
+      cert = self.shared_cache.GetCert(common_name)
+      if cert:
+        return cert.GetPubKey()
 
-      self.client_cache.Put(common_name, client)
+    # Fetch the client's cert - We will be updating its clock attribute.
+    client = aff4.FACTORY.Create(common_name, "VFSGRRClient", mode="rw",
+                                 token=self.token, ignore_cache=True)
+    cert = client.Get(client.Schema.CERT)
+    if not cert:
+      stats.STATS.IncrementCounter("grr_unique_clients")
+      raise communicator.UnknownClientCert("Cert not found")
 
-      return cert.GetPubKey()
+    if rdfvalue.RDFURN(cert.common_name) != rdfvalue.RDFURN(common_name):
+      logging.error("Stored cert mismatch for %s", common_name)
+      raise communicator.UnknownClientCert("Stored cert mismatch")
+
+    self.client_cache.Put(common_name, client)
+    if self.shared_cache is not None:
+      self.shared_cache.PutCert(common_name, cert)
+
+    return cert.GetPubKey()
 
 
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
-  def __init__(self, certificate, private_key, token=None):
+  def __init__(self, certificate, private_key, token=None, shared_cache=None):
     self.client_cache = utils.FastStore(1000)
     self.token = token
     super(ServerCommunicator, self).__init__(certificate=certificate,
                                              private_key=private_key)
-    self.pub_key_cache = ServerPubKeyCache(self.client_cache, token=token)
+    self.pub_key_cache = ServerPubKeyCache(self.client_cache, token=token,
+                                           shared_cache=shared_cache)
+
+    # Ciphers verified by other frontend processes can be used without doing
+    # the RSA operations again.
+    if shared_cache is not None:
+      self.encrypted_cipher_cache = frontend_cache.SharedCipherStore(
+          self.encrypted_cipher_cache, shared_cache)
 
   def GetCipher(self, common_name="Server"):
     # This ensures the client is cached
@@ -1445,7 +1598,7 @@ class FrontEndServer(object):
 
   def __init__(self, certificate, private_key, max_queue_size=50,
                message_expiry_time=120, max_retransmission_time=10, store=None,
-               threadpool_prefix="grr_threadpool"):
+               threadpool_prefix="grr_threadpool", shared_cache=None):
     # Identify ourselves as the server.
     self.token = access_control.ACLToken(username="FrontEndServer",
                                          reason="Implied.")
@@ -1454,14 +1607,18 @@ class FrontEndServer(object):
     self.SetThrottleBundlesRatio(None)
 
     # This object manages our crypto.
+    self.shared_cache = shared_cache
     self._communicator = ServerCommunicator(
-        certificate=certificate, private_key=private_key, token=self.token)
+        certificate=certificate, private_key=private_key, token=self.token,
+        shared_cache=shared_cache)
 
     self.data_store = store or data_store.DB
     self.receive_thread_pool = {}
     self.message_expiry_time = message_expiry_time
     self.max_retransmission_time = max_retransmission_time
     self.max_queue_size = max_queue_size
+    self.passthrough_messages = config_lib.CONFIG[
+        "Frontend.passthrough_messages"]
     self.thread_pool = threadpool.ThreadPool.Factory(
         threadpool_prefix, min_threads=2,
         max_threads=config_lib.CONFIG["Threadpool.size"])
@@ -1567,6 +1724,12 @@ class FrontEndServer(object):
     messages, source, timestamp = self._communicator.DecodeMessages(
         request_comms)
 
+    if self.passthrough_messages:
+      # Store the messages as the client sent them, only the fields we need
+      # for routing are decoded.
+      for msg in messages:
+        msg.passthrough = True
+
     now = time.time()
     if messages:
       # Receive messages in line.
@@ -1601,6 +1764,9 @@ class FrontEndServer(object):
       queue_manager.QueueManager(token=self.token).Schedule(tasks)
       raise
 
+    if self.shared_cache is not None:
+      self.shared_cache.RecordRequest(len(messages))
+
     return source, len(messages)
 
   def DrainTaskSchedulerQueueForClient(self, client, max_count,
@@ -1654,6 +1820,7 @@ class FrontEndServer(object):
       messages: A list of GrrMessage RDFValues.
     """
     now = time.time()
+    crashes = []
     with queue_manager.QueueManager(
         token=self.token, store=self.data_store) as manager:
       for msg in messages:
@@ -1672,8 +1839,7 @@ class FrontEndServer(object):
           status = rdfvalue.GrrStatus(msg.args)
           if status.status == rdfvalue.GrrStatus.ReturnedStatus.CLIENT_KILLED:
             # A client crashed while performing an action, fire an event.
-            Events.PublishEvent("ClientCrash", rdfvalue.GrrMessage(msg),
-                                token=self.token)
+            crashes.append(rdfvalue.GrrMessage(msg))
 
       sessions_handled = []
       for session_id, messages in utils.GroupBy(
@@ -1690,6 +1856,9 @@ class FrontEndServer(object):
         for msg in messages:
           manager.QueueResponse(session_id, msg)
 
+    if crashes:
+      Events.PublishMultipleEvents({"ClientCrash": crashes}, token=self.token)
+
     logging.debug("Received %s messages in %s sec", len(messages),
                   time.time() - now)
 
@@ -1760,6 +1929,7 @@ class FlowInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_well_known_flow_requests")
     stats.STATS.RegisterCounterMetric("grr_worker_requests_complete")
     stats.STATS.RegisterCounterMetric("grr_worker_requests_issued")
+    stats.STATS.RegisterCounterMetric("grr_worker_sessions_stolen")
     stats.STATS.RegisterCounterMetric("grr_worker_states_run")
     stats.STATS.RegisterCounterMetric("grr_worker_well_known_flow_requests")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
@@ -597,8 +597,17 @@ class FlowRunner(object):
 
     self.QueueRequest(state)
 
-  def Publish(self, event_name, msg, delay=0):
-    """Sends the message to event listeners."""
+  def Publish(self, event_name, msg, delay=0, batch=False):
+    """Sends the message to event listeners.
+
+    Args:
+      event_name: Either a URN of an event listener or an event name.
+      msg: The RDFValue to send.
+      delay: Delay in seconds before the listeners are notified.
+      batch: If set, the message is written together with the other events
+        published for the same listener until the queue manager is flushed.
+        Delayed messages are never batched.
+    """
     handler_urns = []
 
     # This is the cache of event names to handlers.
@@ -636,6 +645,10 @@ class FlowRunner(object):
 
     # Forward the message to the well known flow's queue.
     for event_urn in handler_urns:
+      if batch and not delay:
+        self.queue_manager.QueueEvent(event_urn, msg)
+        continue
+
       self.queue_manager.QueueResponse(event_urn, msg)
       self.queue_manager.QueueNotification(event_urn, priority=msg.priority,
                                            timestamp=timestamp)
@@ -13,6 +13,7 @@ from grr.lib.flows import tests
 from grr.client import actions
 from grr.client import vfs
 from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
@@ -498,6 +499,29 @@ class FlowTest(test_lib.FlowTestsBaseclass):
     # ProcessMessage method):
     self.assertEqual(test_flow.messages, range(10))
 
+  def testWellKnownFlowBatchesResponsesOfManyRequests(self):
+    session_id = test_lib.WellKnownSessionTest.well_known_session_id
+    with queue_manager.WellKnownQueueManager(token=self.token) as manager:
+      for i in range(12):
+        msg = rdfvalue.GrrMessage(session_id=session_id, request_id=0,
+                                  args=str(i))
+        msg.response_id = msg.task_id = msg.GenerateTaskID()
+        manager.QueueResponse(session_id, msg)
+
+    batches = []
+    well_known_flow = test_lib.WellKnownSessionTest(session_id, mode="rw",
+                                                    token=self.token)
+    well_known_flow.response_batch_size = 5
+    well_known_flow.ProcessResponses = (
+        lambda responses, _: batches.append(len(responses)))
+
+    well_known_flow.ProcessRequests(None)
+    self.assertEqual(batches, [5, 5, 2])
+
+    # All the processed responses are gone.
+    manager = queue_manager.WellKnownQueueManager(token=self.token)
+    self.assertEqual(list(manager.FetchRequestsAndResponses(session_id)), [])
+
   def testArgParsing(self):
     """Test that arguments can be extracted and annotated successfully."""
 
@@ -764,6 +788,74 @@ class GeneralFlowsTest(test_lib.FlowTestsBaseclass):
                        "aff4:/Source%d" % i)
       self.assertEqual(NoClientListener.received_events[i][1].path, "foobar")
 
+  def testBatchedEventNotification(self):
+    """Test that events published together are queued as one batch."""
+    config_lib.CONFIG.Set("Events.batched_events", ["TestEvent"])
+    NoClientListener.received_events = []
+
+    events = []
+    for i in xrange(10):
+      events.append(rdfvalue.GrrMessage(
+          session_id="aff4:/W:SomeFlow", name="test message",
+          payload=rdfvalue.PathSpec(path="foobar%d" % i, pathtype="TSK"),
+          source="Source%d" % i, auth_state="AUTHENTICATED"))
+
+    flow.Events.PublishMultipleEvents({"TestEvent": events}, token=self.token)
+
+    # All the events are in a single response with a single notification.
+    manager = queue_manager.WellKnownQueueManager(token=self.token)
+    session_id = NoClientListener.well_known_session_id
+    responses = list(manager.FetchRequestsAndResponses(session_id))
+    self.assertEqual(len(responses), 1)
+    self.assertEqual(responses[0][1][0].name,
+                     queue_manager.QueueManager.EVENT_BATCH_NAME)
+
+    worker = test_lib.MockWorker(token=self.token)
+    worker.Simulate()
+
+    self.assertEqual(len(NoClientListener.received_events), 10)
+    NoClientListener.received_events.sort(key=lambda x: x[0].source)
+    for i in range(10):
+      self.assertEqual(NoClientListener.received_events[i][0].source,
+                       "aff4:/Source%d" % i)
+      self.assertEqual(NoClientListener.received_events[i][1].path,
+                       "foobar%d" % i)
+
+  def testEventBatchesFromClientsAreNotUnpacked(self):
+    message_list = rdfvalue.MessageList()
+    message_list.job.Append(rdfvalue.GrrMessage(source="Source",
+                                                auth_state="AUTHENTICATED"))
+
+    batch = rdfvalue.GrrMessage(
+        name=queue_manager.QueueManager.EVENT_BATCH_NAME, payload=message_list,
+        source="aff4:/W:SomeFlow", auth_state="AUTHENTICATED")
+    messages = flow.WellKnownFlow.UnpackEventBatches([batch])
+    self.assertEqual(len(messages), 1)
+    self.assertEqual(messages[0].source, "aff4:/Source")
+
+    batch.source = "aff4:/C.0000000000000001"
+    messages = flow.WellKnownFlow.UnpackEventBatches([batch])
+    self.assertEqual(messages, [batch])
+
+  def testInlineEventNotification(self):
+    """Test that inline events are delivered without a worker."""
+    config_lib.CONFIG.Set("Events.inline_events", ["TestEvent"])
+    NoClientListener.received_events = []
+
+    event = rdfvalue.GrrMessage(
+        session_id="aff4:/W:SomeFlow", name="test message",
+        payload=rdfvalue.PathSpec(path="foobar", pathtype="TSK"),
+        source="Source", auth_state="AUTHENTICATED")
+    flow.Events.PublishEvent("TestEvent", event, token=self.token)
+
+    self.assertEqual(len(NoClientListener.received_events), 1)
+    self.assertEqual(NoClientListener.received_events[0][1].path, "foobar")
+
+    # Nothing was queued for the listener.
+    manager = queue_manager.WellKnownQueueManager(token=self.token)
+    self.assertEqual(list(manager.FetchRequestsAndResponses(
+        NoClientListener.well_known_session_id)), [])
+
   def testClientPrioritization(self):
     """Test that flow priorities work on the client side."""
 
@@ -2,10 +2,31 @@
 """These cron flows perform data compaction in various subsystems."""
 
 
+import Queue
+
+import logging
+
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import flow
+from grr.lib import hash_filter
 from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import threadpool
+from grr.lib import utils
+from grr.lib.aff4_objects import cronjobs
+
+
+class CompactorsInit(registry.InitHook):
+  """Registers the compaction metrics."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("grr_collection_compacted_items")
+    stats.STATS.RegisterGaugeMetric("grr_collection_compaction_lag", float,
+                                    fields=[("collection", str)])
 
 
 class PackedVersionedCollectionCompactor(flow.GRRFlow):
@@ -15,6 +36,10 @@ class PackedVersionedCollectionCompactor(flow.GRRFlow):
   frequency = rdfvalue.Duration("1h")
   lifetime = rdfvalue.Duration("20h")
 
+  # Collections are compacted in parallel by this many threads.
+  THREAD_POOL_NAME = "CollectionCompactor"
+  MAX_THREADS = 5
+
   @flow.StateHandler(next_state="Process")
   def Start(self):
     """Calls "Process" state to avoid spending too much time in Start method."""
@@ -24,31 +49,99 @@ class PackedVersionedCollectionCompactor(flow.GRRFlow):
   def Process(self):
     """Check all the dirty versioned collections, and compact them."""
     # Detect all changed collections:
-    for predicate, urn, _ in data_store.DB.ResolveRegex(
+    changed = data_store.DB.ResolveRegex(
         self.URN, "index:changed/.+", timestamp=data_store.DB.NEWEST_TIMESTAMP,
-        token=self.token):
-      data_store.DB.DeleteAttributes(self.URN, [predicate], token=self.token)
+        limit=None, token=self.token)
+    if not changed:
+      return
+
+    pool = threadpool.ThreadPool.Factory(self.THREAD_POOL_NAME,
+                                         self.MAX_THREADS)
+    pool.Start()
+
+    results = Queue.Queue()
+    pending = 0
+    for predicate, urn, timestamp in changed:
+      while True:
+        # Never compact inline: this thread has to keep our lease.
+        try:
+          pool.AddTask(target=self._CompactTask,
+                       args=(predicate, urn, timestamp, results),
+                       name=self.THREAD_POOL_NAME, blocking=False,
+                       inline=False)
+          pending += 1
+          break
+        except threadpool.Full:
+          self._WaitForResult(results)
+          pending -= 1
+
+    for _ in xrange(pending):
+      self._WaitForResult(results)
+
+  def _WaitForResult(self, results):
+    """Waits for a compaction to finish, keeping our lease meanwhile."""
+    while True:
       try:
-        self.Compact(urn)
-      except IOError:
-        pass
+        urn, result = results.get(timeout=60)
+        break
+      except Queue.Empty:
+        self.HeartBeat()
+
+    if isinstance(result, Exception):
+      self.Log("Compacting %s failed: %s", urn, result)
+    elif result is not None:
+      compacted, lag = result
+      self.Log("Compacted %d items of %s, lag %.0f seconds.", compacted, urn,
+               lag)
+
+  def _CompactTask(self, predicate, urn, timestamp, results):
+    try:
+      result = self.Compact(urn)
+
+      # A collection which was changed again since we listed it stays marked.
+      data_store.DB.DeleteAttributes(self.URN, [predicate], end=timestamp,
+                                     sync=True, token=self.token)
+    except IOError:
+      # The collection does not exist anymore.
+      data_store.DB.DeleteAttributes(self.URN, [predicate], end=timestamp,
+                                     sync=True, token=self.token)
+      result = None
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error while compacting %s: %s", urn, e)
+      result = e
+
+    results.put((urn, result))
 
   def Compact(self, urn):
-    """Run a compaction cycle on a PackedVersionedCollection."""
+    """Run a compaction cycle on a PackedVersionedCollection.
+
+    Args:
+      urn: The urn of the collection.
+
+    Returns:
+      A tuple of the number of compacted items and the age in seconds of the
+      oldest one.
+    """
     fd = aff4.FACTORY.Open(urn, aff4_type="PackedVersionedCollection",
-                           mode="rw", age=aff4.ALL_TIMES, token=self.token)
+                           mode="rw", token=self.token)
+    compacted, lag = fd.Compact()
+
+    stats.STATS.IncrementCounter("grr_collection_compacted_items", compacted)
+    stats.STATS.SetGaugeValue("grr_collection_compaction_lag", lag,
+                              fields=[utils.SmartStr(urn)])
 
-    # Update the collection size.
-    size = fd.Get(fd.Schema.SIZE)
+    return compacted, lag
 
-    for item in sorted(fd.GetValuesForAttribute(fd.Schema.DATA),
-                       key=lambda x: x.age):
-      super(fd.__class__, fd).Add(item.payload)
-      size += 1
 
-    # Clear the data predicate now that its in the aff4 stream.
-    fd.DeleteAttribute(fd.Schema.DATA)
-    fd.Set(size)
+class HashFilterCompactor(cronjobs.SystemCronFlow):
+  """Writes new snapshots of the hash filters and trims their journals."""
 
-    # Flush to the data store.
-    fd.Close()
+  frequency = rdfvalue.Duration("1h")
+  lifetime = rdfvalue.Duration("20h")
+
+  @flow.StateHandler()
+  def Start(self):
+    for name, hash_filter_obj in sorted(hash_filter.FILTERS.items()):
+      self.HeartBeat()
+      hash_filter_obj.Compact(token=self.token)
+      self.Log("Compacted hash filter %s.", name)
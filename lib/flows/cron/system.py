@@ -10,10 +10,13 @@ import logging
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import export_utils
+from grr.lib import fleet_scan
 from grr.lib import flow
 from grr.lib import hunts
 from grr.lib import rdfvalue
+from grr.lib import timeseries_store
 from grr.lib import utils
+from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import cronjobs
 from grr.lib.rdfvalues import stats
 
@@ -29,13 +32,14 @@ class _ActiveCounter(object):
 
   active_days = [1, 7, 14, 30]
 
-  def __init__(self, attribute):
+  def __init__(self, attribute_name):
     """Constructor.
 
     Args:
-       attribute: The histogram object will be stored in this attribute.
+       attribute_name: The histogram object will be stored in the
+         ClientFleetStats attribute of this name.
     """
-    self.attribute = attribute
+    self.attribute_name = attribute_name
     self.categories = dict([(x, {}) for x in self.active_days])
 
   def Add(self, category, age):
@@ -60,7 +64,7 @@ class _ActiveCounter(object):
 
   def Save(self, fd):
     """Generate a histogram object and store in the specified attribute."""
-    histogram = self.attribute()
+    histogram = getattr(fd.Schema, self.attribute_name)()
     for active_time in self.active_days:
       graph = stats.Graph(title="%s day actives" % active_time)
       for k, v in sorted(self.categories[active_time].items()):
@@ -99,66 +103,22 @@ class ClientFleetStats(aff4.AFF4Object):
                                               "Last contacted time")
 
 
-class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
-  """A cron job which opens every client in the system.
-
-  We feed all the client objects to the AbstractClientStatsCollector instances.
-  """
-
-  CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
-
-  def BeginProcessing(self):
-    pass
+class ClientStatsConsumer(fleet_scan.FleetScanConsumer):
+  """A fleet scan consumer which saves its results in ClientFleetStats."""
 
-  def ProcessClient(self, client):
+  def Save(self, fd):
+    """Writes the results into the ClientFleetStats object fd."""
     raise NotImplementedError()
 
-  def FinishProcessing(self):
-    pass
-
-  @flow.StateHandler()
-  def Start(self):
-    """Retrieve all the clients for the AbstractClientStatsCollectors."""
-    try:
-      self.stats = aff4.FACTORY.Create(self.CLIENT_STATS_URN,
-                                       "ClientFleetStats",
-                                       mode="w", token=self.token)
-      self.BeginProcessing()
-
-      root = aff4.FACTORY.Open(aff4.ROOT_URN, token=self.token)
-      children_urns = list(root.ListChildren())
-      logging.debug("Found %d children.", len(children_urns))
-
-      processed_count = 0
-      for child in aff4.FACTORY.MultiOpen(
-          children_urns, mode="r", token=self.token, age=aff4.NEWEST_TIME):
-        if isinstance(child, aff4.AFF4Object.VFSGRRClient):
-          self.ProcessClient(child)
-          processed_count += 1
-
-        # This flow is not dead: we don't want to run out of lease time.
-        self.HeartBeat()
-
-      self.FinishProcessing()
-      self.stats.Close()
-
-      logging.info("%s: processed %d clients.", self.__class__.__name__,
-                   processed_count)
-    except Exception as e:  # pylint: disable=broad-except
-      logging.exception("Error while calculating stats: %s", e)
-      raise
-
-
-class GRRVersionBreakDown(AbstractClientStatsCronFlow):
-  """Records relative ratios of GRR versions in 7 day actives."""
 
-  frequency = rdfvalue.Duration("4h")
+class GRRVersionCounter(ClientStatsConsumer):
+  """Counts the GRR versions of active clients."""
 
-  def BeginProcessing(self):
-    self.counter = _ActiveCounter(self.stats.Schema.GRRVERSION_HISTOGRAM)
+  ATTRIBUTES = [aff4_grr.VFSGRRClient.SchemaCls.PING,
+                aff4_grr.VFSGRRClient.SchemaCls.CLIENT_INFO]
 
-  def FinishProcessing(self):
-    self.counter.Save(self.stats)
+  def Begin(self):
+    self.counter = _ActiveCounter("GRRVERSION_HISTOGRAM")
 
   def ProcessClient(self, client):
     ping = client.Get(client.Schema.PING)
@@ -169,22 +129,25 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
 
       self.counter.Add(category, ping)
 
+  def Save(self, fd):
+    self.counter.Save(fd)
 
-class OSBreakDown(AbstractClientStatsCronFlow):
-  """Records relative ratios of OS versions in 7 day actives."""
 
-  def BeginProcessing(self):
+class OSCounter(ClientStatsConsumer):
+  """Counts the operating systems, versions and releases of active clients."""
+
+  ATTRIBUTES = [aff4_grr.VFSGRRClient.SchemaCls.PING,
+                aff4_grr.VFSGRRClient.SchemaCls.SYSTEM,
+                aff4_grr.VFSGRRClient.SchemaCls.OS_VERSION,
+                aff4_grr.VFSGRRClient.SchemaCls.OS_RELEASE]
+
+  def Begin(self):
     self.counters = [
-        _ActiveCounter(self.stats.Schema.OS_HISTOGRAM),
-        _ActiveCounter(self.stats.Schema.VERSION_HISTOGRAM),
-        _ActiveCounter(self.stats.Schema.RELEASE_HISTOGRAM),
+        _ActiveCounter("OS_HISTOGRAM"),
+        _ActiveCounter("VERSION_HISTOGRAM"),
+        _ActiveCounter("RELEASE_HISTOGRAM"),
         ]
 
-  def FinishProcessing(self):
-    # Write all the counter attributes.
-    for counter in self.counters:
-      counter.Save(self.stats)
-
   def ProcessClient(self, client):
     """Update counters for system, version and release attributes."""
     ping = client.Get(client.Schema.PING)
@@ -194,7 +157,7 @@ class OSBreakDown(AbstractClientStatsCronFlow):
     # Windows, Linux, Darwin
     self.counters[0].Add(system, ping)
 
-    version = client.Get(client.Schema.VERSION, "Unknown")
+    version = client.Get(client.Schema.OS_VERSION, "Unknown")
     # Windows XP, Linux Ubuntu, Darwin OSX
     self.counters[1].Add("%s %s" % (system, version), ping)
 
@@ -202,28 +165,25 @@ class OSBreakDown(AbstractClientStatsCronFlow):
     # Windows XP 5.1.2600 SP3, Linux Ubuntu 12.04, Darwin OSX 10.8.2
     self.counters[2].Add("%s %s %s" % (system, version, release), ping)
 
+  def Save(self, fd):
+    # Write all the counter attributes.
+    for counter in self.counters:
+      counter.Save(fd)
+
 
-class LastAccessStats(AbstractClientStatsCronFlow):
-  """Calculates a histogram statistics of clients last contacted times."""
+class LastAccessCounter(ClientStatsConsumer):
+  """Counts clients by the number of days since they last contacted us."""
+
+  ATTRIBUTES = [aff4_grr.VFSGRRClient.SchemaCls.PING]
 
-  # The number of clients fall into these bins (number of hours ago)
+  # The number of clients fall into these bins (number of days ago)
   _bins = [1, 2, 3, 7, 14, 30, 60]
 
-  def BeginProcessing(self):
-    self._bins = [long(x*1e6*24*60*60) for x in self._bins]
+  def Begin(self):
+    self.bins = [long(x*1e6*24*60*60) for x in self._bins]
 
     # We will count them in this bin
-    self._value = [0] * len(self._bins)
-
-  def FinishProcessing(self):
-    # Build and store the graph now. Day actives are cumulative.
-    cumulative_count = 0
-    graph = self.stats.Schema.LAST_CONTACTED_HISTOGRAM()
-    for x, y in zip(self._bins, self._value):
-      cumulative_count += y
-      graph.Append(x_value=x, y_value=cumulative_count)
-
-    self.stats.AddAttribute(graph)
+    self.value = [0] * len(self.bins)
 
   def ProcessClient(self, client):
     now = rdfvalue.RDFDatetime().Now()
@@ -231,14 +191,87 @@ class LastAccessStats(AbstractClientStatsCronFlow):
     ping = client.Get(client.Schema.PING)
     if ping:
       time_ago = now - ping
-      pos = bisect.bisect(self._bins, time_ago.microseconds)
+      pos = bisect.bisect(self.bins, time_ago.microseconds)
 
       # If clients are older than the last bin forget them.
       try:
-        self._value[pos] += 1
+        self.value[pos] += 1
       except IndexError:
         pass
 
+  def Save(self, fd):
+    # Build and store the graph now. Day actives are cumulative.
+    cumulative_count = 0
+    graph = fd.Schema.LAST_CONTACTED_HISTOGRAM()
+    for x, y in zip(self.bins, self.value):
+      cumulative_count += y
+      graph.Append(x_value=x, y_value=cumulative_count)
+
+    fd.AddAttribute(graph)
+
+
+class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
+  """A cron job which feeds every client in the system to some consumers.
+
+  All consumers are fed in a single fleet scan, which resumes from its last
+  checkpoint if the previous run of the job lost its lease.
+  """
+
+  CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
+
+  # The ClientStatsConsumer classes run by this job.
+  consumers = []
+
+  @flow.StateHandler()
+  def Start(self):
+    """Scan all clients and save the results of the consumers."""
+    try:
+      # The scan heartbeats after each chunk, so we don't run out of lease
+      # time.
+      scan = fleet_scan.FleetScan([cls() for cls in self.consumers],
+                                  name=self.__class__.__name__,
+                                  heartbeat=self.HeartBeat, token=self.token)
+      processed_count = scan.Run()
+
+      with aff4.FACTORY.Create(self.CLIENT_STATS_URN, "ClientFleetStats",
+                               mode="w", token=self.token) as stats_fd:
+        for consumer in scan.consumers:
+          consumer.Save(stats_fd)
+
+      logging.info("%s: processed %d clients.", self.__class__.__name__,
+                   processed_count)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error while calculating stats: %s", e)
+      raise
+
+
+class ClientFleetStatsCronFlow(AbstractClientStatsCronFlow):
+  """Records all client fleet statistics in a single pass over the clients."""
+
+  frequency = rdfvalue.Duration("4h")
+
+  consumers = [GRRVersionCounter, OSCounter, LastAccessCounter]
+
+
+class GRRVersionBreakDown(AbstractClientStatsCronFlow):
+  """Records relative ratios of GRR versions in 7 day actives."""
+
+  frequency = rdfvalue.Duration("4h")
+
+  consumers = [GRRVersionCounter]
+
+
+class OSBreakDown(AbstractClientStatsCronFlow):
+  """Records relative ratios of OS versions in 7 day actives."""
+
+  consumers = [OSCounter]
+
+
+class LastAccessStats(AbstractClientStatsCronFlow):
+  """Calculates a histogram statistics of clients last contacted times."""
+
+  consumers = [LastAccessCounter]
+
 
 class InterrogateClientsCronFlow(cronjobs.SystemCronFlow):
   """A cron job which runs an interrogate hunt on all clients.
@@ -292,11 +325,17 @@ class PurgeClientStats(cronjobs.SystemCronFlow):
 
     client_urns = export_utils.GetAllClients(token=self.token)
 
+    client_stats_cls = aff4.AFF4Object.classes["ClientStats"]
     for client_urn in client_urns:
       data_store.DB.DeleteAttributes(client_urn.Add("stats"),
                                      [u"aff4:stats", u"aff4:type"],
                                      start=self.start, end=self.end, sync=False,
                                      token=self.token)
+
+      # The time series rollups have their own retention.
+      timeseries_store.TimeSeriesStore(
+          client_urn.Add("stats"), token=self.token).DeleteExpired(
+              client_stats_cls.METRICS)
       self.HeartBeat()
 
     data_store.DB.Flush()
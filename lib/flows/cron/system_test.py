@@ -116,6 +116,27 @@ class SystemCronFlowTest(test_lib.FlowTestsBaseclass):
         (2592000000000L, 20L),
         (5184000000000L, 20L)])
 
+  def testClientFleetStatsCronFlow(self):
+    """Check that one job records all client fleet stats."""
+    for _ in test_lib.TestFlowHelper("ClientFleetStatsCronFlow",
+                                     token=self.token):
+      pass
+
+    fd = aff4.FACTORY.Open("aff4:/stats/ClientFleetStats", token=self.token)
+
+    histogram = fd.Get(fd.Schema.GRRVERSION_HISTOGRAM)
+    self.assertEqual(histogram[2][0].label, "GRR Monitor 1")
+    self.assertEqual(histogram[2][0].y_value, 20)
+
+    histogram = fd.Get(fd.Schema.OS_HISTOGRAM)
+    self.assertEqual(histogram[2][0].label, "Linux")
+    self.assertEqual(histogram[2][0].y_value, 10)
+    self.assertEqual(histogram[2][1].label, "Windows")
+    self.assertEqual(histogram[2][1].y_value, 10)
+
+    histogram = fd.Get(fd.Schema.LAST_CONTACTED_HISTOGRAM)
+    self.assertEqual([x.y_value for x in histogram], [0, 0, 0, 0, 20, 20, 20])
+
   def testPurgeClientStats(self):
     max_age = system.PurgeClientStats.MAX_AGE
 
@@ -101,6 +101,7 @@ class GetClientStats(flow.GRRFlow):
     # Only keep the average of all values that fall within one minute.
     response.DownSample()
     stats_fd.AddAttribute(stats_fd.Schema.STATS(response))
+    stats_fd.AddTimeSeriesSamples(response)
 
     stats_fd.Close()
 
@@ -330,16 +331,16 @@ class Foreman(flow.WellKnownFlow):
 
   lock = threading.Lock()
 
-  def ProcessMessage(self, message):
-    """Run the foreman on the client."""
-    # Only accept authenticated messages
-    if (message.auth_state !=
-        rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED):
-      return
+  # The number of clients the foreman checks in one go.
+  batch_size = 100
 
+  # Every client ping is its own request, so batch the responses of many.
+  response_batch_size = batch_size
+
+  def _GetForeman(self):
+    """Returns the foreman object, which is cached for a while."""
     now = time.time()
 
-    # Maintain a cache of the foreman
     with self.lock:
       if (self.foreman_cache is None or
           now > self.foreman_cache.age + self.cache_refresh_time):
@@ -347,8 +348,38 @@ class Foreman(flow.WellKnownFlow):
                                                token=self.token)
         self.foreman_cache.age = now
 
-    if message.source:
-      self.foreman_cache.AssignTasksToClient(message.source)
+      return self.foreman_cache
+
+  def _IsValidMessage(self, message):
+    # Only accept authenticated messages
+    return (message.source and message.auth_state ==
+            rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+  def ProcessResponses(self, responses, thread_pool):
+    """Runs the foreman on all the clients which pinged us, in batches."""
+    client_ids = []
+    seen = set()
+    for message in responses:
+      if self._IsValidMessage(message) and message.source not in seen:
+        seen.add(message.source)
+        client_ids.append(message.source)
+
+    for batch in utils.Grouper(client_ids, self.batch_size):
+      self.HeartBeat()
+      thread_pool.AddTask(target=self._SafeAssignTasks, args=(batch,),
+                          name=self.__class__.__name__)
+
+  def _SafeAssignTasks(self, client_ids):
+    try:
+      self._GetForeman().AssignTasksToClients(client_ids)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error assigning foreman tasks to %d clients: %s",
+                        len(client_ids), e)
+
+  def ProcessMessage(self, message):
+    """Run the foreman on the client."""
+    if self._IsValidMessage(message):
+      self._GetForeman().AssignTasksToClient(message.source)
 
 
 class OnlineNotificationArgs(rdfvalue.RDFProtoStruct):
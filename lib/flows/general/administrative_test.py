@@ -402,3 +402,11 @@ sys.test_code_ran_here = py_args['value']
 
     self.assertAlmostEqual(sample.cpu_samples[0].user_cpu_time, 15.0)
     self.assertAlmostEqual(sample.cpu_samples[1].system_cpu_time, 31.0)
+
+    # The downsampled samples are also in the time series rollups.
+    rollups = stats_fd.QueryTimeSeries(0, 120 * 1000000)
+    cpu = rollups["cpu_percent"]
+    self.assertEqual([timestamp for timestamp, _ in cpu], [0, 60 * 1000000])
+    self.assertAlmostEqual(cpu[0][1].mean, sum(range(10, 16))/6.0)
+    self.assertEqual([a.maximum for _, a in rollups["io_read_bytes"]],
+                     [15.0, 21.0])
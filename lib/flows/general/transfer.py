@@ -2,14 +2,15 @@
 """These flows are designed for high performance transfers."""
 
 
-import hashlib
 import time
 import zlib
 
 import logging
 from grr.lib import aff4
+from grr.lib import blob_store
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.aff4_objects import filestore
 from grr.proto import flows_pb2
 
@@ -177,8 +178,7 @@ class HashTracker(object):
   def __init__(self, hash_response, is_known=False):
     self.hash_response = hash_response
     self.is_known = is_known
-    self.blob_urn = rdfvalue.RDFURN("aff4:/blobs").Add(
-        hash_response.data.encode("hex"))
+    self.digest = hash_response.data
 
 
 class FileTracker(object):
@@ -441,7 +441,7 @@ class MultiGetFile(flow.GRRFlow):
     hash_tracker = HashTracker(hash_response)
     file_tracker.hash_list.append(hash_tracker)
 
-    self.state.blobs_we_need.add(hash_tracker.blob_urn)
+    self.state.blobs_we_need.add(hash_tracker.digest)
 
     if len(self.state.blobs_we_need) > self.MIN_CALL_TO_FILE_STORE:
       self.FetchFileContent()
@@ -455,9 +455,9 @@ class MultiGetFile(flow.GRRFlow):
     if not self.state.pending_files:
       return
 
-    # Check if we have all the blobs in the blob AFF4 namespace..
-    stats = aff4.FACTORY.Stat(self.state.blobs_we_need, token=self.token)
-    blobs_we_have = set([x["urn"] for x in stats])
+    # Check if we have all the blobs in the blob store.
+    blobs_we_have = blob_store.BLOB_STORE.BlobsExist(self.state.blobs_we_need,
+                                                     token=self.token)
     self.state.blobs_we_need = set()
 
     # Now iterate over all the blobs and add them directly to the blob image.
@@ -466,7 +466,7 @@ class MultiGetFile(flow.GRRFlow):
         # Make sure we read the correct pathspec on the client.
         hash_tracker.hash_response.pathspec = file_tracker.pathspec
 
-        if hash_tracker.blob_urn in blobs_we_have:
+        if blobs_we_have.get(hash_tracker.digest):
           # If we have the data we may call our state directly.
           self.CallState([hash_tracker.hash_response],
                          next_state="WriteBuffer",
@@ -619,45 +619,90 @@ class TransferStore(flow.WellKnownFlow):
   """Store a buffer into a determined location."""
   well_known_session_id = rdfvalue.SessionID("aff4:/flows/W:TransferStore")
 
-  def ProcessMessage(self, message):
-    """Write the blob into the AFF4 blob storage area."""
+  # The number of blobs written to the blob store at once.
+  batch_size = 50
+
+  # Every blob arrives in its own request, so batch the responses of many.
+  response_batch_size = batch_size
+
+  def _IsValidMessage(self, message):
     # Check that the message is authenticated
     if (message.auth_state !=
         rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED):
       logging.error("TransferStore request from %s is not authenticated.",
                     message.source)
-      return
+      return False
+
+    return True
+
+  def ProcessResponses(self, responses, thread_pool):
+    """Writes the blobs of all the messages to the blob store in batches."""
+    messages = [message for message in responses
+                if self._IsValidMessage(message)]
+
+    for batch in utils.Grouper(messages, self.batch_size):
+      self.HeartBeat()
+      thread_pool.AddTask(target=self._SafeStoreBlobs, args=(batch,),
+                          name=self.__class__.__name__)
+
+  def _SafeStoreBlobs(self, messages):
+    try:
+      self.StoreBlobs(messages)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error storing %d blobs: %s", len(messages), e)
+
+  def StoreBlobs(self, messages):
+    """Writes the blobs sent in the messages into the blob store.
 
-    read_buffer = rdfvalue.DataBlob(message.args)
+    Messages with broken or unsupported compression are logged and skipped,
+    the blobs of the other messages are still stored.
 
-    # Only store non empty buffers
-    if read_buffer.data:
-      data = read_buffer.data
+    Args:
+      messages: A list of GrrMessages carrying DataBlobs.
+    """
+    blobs = []
+    compressed_blobs = []
+    for message in messages:
+      read_buffer = rdfvalue.DataBlob(message.args)
 
+      # Only store non empty buffers
+      if not read_buffer.data:
+        continue
+
+      # The blob store does not compress data which arrived compressed again.
       if (read_buffer.compression ==
           rdfvalue.DataBlob.CompressionType.ZCOMPRESSION):
-        cdata = data
-        data = zlib.decompress(cdata)
+        try:
+          blob = zlib.decompress(read_buffer.data)
+        except zlib.error as e:
+          logging.error("TransferStore blob from %s can not be "
+                        "decompressed: %s", message.source, e)
+          continue
+
+        compressed_blobs.append(read_buffer.data)
+        blobs.append(blob)
       elif (read_buffer.compression ==
             rdfvalue.DataBlob.CompressionType.UNCOMPRESSED):
-        cdata = zlib.compress(data)
+        compressed_blobs.append(None)
+        blobs.append(read_buffer.data)
       else:
-        raise RuntimeError("Unsupported compression")
-
-      # The hash is done on the uncompressed data
-      digest = hashlib.sha256(data).digest()
-      urn = rdfvalue.RDFURN("aff4:/blobs").Add(digest.encode("hex"))
-
-      # Write the blob to the data store. We cheat here and just store the
-      # compressed data to avoid recompressing it.
-      fd = aff4.FACTORY.Create(urn, "AFF4MemoryStream", mode="w",
-                               token=self.token)
-      fd.Set(fd.Schema.CONTENT(cdata))
-      fd.Set(fd.Schema.SIZE(len(data)))
-      super(aff4.AFF4MemoryStream, fd).Close(sync=True)
-
-      logging.debug("Got blob %s (length %s)", digest.encode("hex"),
-                    len(cdata))
+        logging.error("TransferStore blob from %s has unsupported "
+                      "compression %s.", message.source,
+                      read_buffer.compression)
+
+    if not blobs:
+      return
+
+    digests = blob_store.BLOB_STORE.WriteBlobs(
+        blobs, compressed_blobs=compressed_blobs, token=self.token)
+
+    for blob, digest in zip(blobs, digests):
+      logging.debug("Got blob %s (length %s)", digest.encode("hex"), len(blob))
+
+  def ProcessMessage(self, message):
+    """Write the blob into the blob store."""
+    if self._IsValidMessage(message):
+      self.StoreBlobs([message])
 
 
 class SendFile(flow.GRRFlow):
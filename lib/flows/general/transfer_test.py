@@ -2,11 +2,14 @@
 """Test the file transfer mechanism."""
 
 
+import hashlib
 import os
+import zlib
 
 
 from grr.client.client_actions import standard
 from grr.lib import aff4
+from grr.lib import blob_store
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib import utils
@@ -36,6 +39,26 @@ class TestTransfer(test_lib.FlowTestsBaseclass):
     transfer.GetFile.WINDOW_SIZE = self.old_window_size
     transfer.GetFile.CHUNK_SIZE = self.old_chunk_size
 
+  def testTransferStoreSkipsBrokenBlobs(self):
+    messages = []
+    for data, compression in [
+        ("foo", rdfvalue.DataBlob.CompressionType.UNCOMPRESSED),
+        ("not zlib", rdfvalue.DataBlob.CompressionType.ZCOMPRESSION),
+        (zlib.compress("bar"), rdfvalue.DataBlob.CompressionType.ZCOMPRESSION)]:
+      messages.append(rdfvalue.GrrMessage(
+          source=self.client_id, auth_state="AUTHENTICATED",
+          payload=rdfvalue.DataBlob(data=data, compression=compression)))
+
+    transfer_store = transfer.TransferStore(
+        transfer.TransferStore.well_known_session_id, mode="rw",
+        token=self.token)
+    transfer_store.StoreBlobs(messages)
+
+    # The broken blob does not keep the others from being stored.
+    digests = [hashlib.sha256(data).digest() for data in ["foo", "bar"]]
+    blobs = blob_store.BLOB_STORE.ReadBlobs(digests, token=self.token)
+    self.assertEqual(sorted(blobs.values()), ["bar", "foo"])
+
   def testGetMBR(self):
     """Test that the GetMBR flow works."""
 
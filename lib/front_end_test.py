@@ -2,7 +2,7 @@
 """Unittest for grr frontend server."""
 
 
-
+import time
 
 # pylint: disable=unused-import,g-bad-import-order
 from grr.lib import server_plugins
@@ -354,6 +354,49 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(tasks[0].task_ttl - new_tasks[0].task_ttl, 1)
 
 
+class FrontEndServerBenchmark(test_lib.MicroBenchmarks):
+  """Measures how fast the frontend receives client messages."""
+
+  units = "s"
+
+  def testReceiveMessages(self):
+    """Messages received per second by one frontend process."""
+    client_id = rdfvalue.ClientURN("C." + "1" * 16)
+    session_id = client_id.Add("flows/W:123456")
+
+    message_list = rdfvalue.MessageList()
+    for i in range(1, 1001):
+      message_list.job.Append(
+          session_id=session_id, request_id=1, response_id=i,
+          payload=rdfvalue.StatEntry(
+              aff4path=client_id.Add("fs/os/file%d" % i), st_size=i,
+              pathspec=rdfvalue.PathSpec(path="/file%d" % i, pathtype=0)))
+    serialized = message_list.SerializeToString()
+
+    server = flow.FrontEndServer(
+        certificate=config_lib.CONFIG["Frontend.certificate"],
+        private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+        threadpool_prefix="pool-%s" % self._testMethodName)
+
+    for passthrough in [False, True]:
+      def ReceiveMessages():
+        # This is what the communicator does with a decrypted message list.
+        messages = rdfvalue.MessageList(serialized).job
+        for msg in messages:
+          msg.auth_state = rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED
+          msg.SetWireFormat("source", client_id.Basename())
+          msg.passthrough = passthrough  # pylint: disable=cell-var-from-loop
+
+        server.ReceiveMessages(client_id, messages)
+
+      start = time.time()
+      for _ in range(5):
+        ReceiveMessages()
+
+      self.AddResult("Messages/second (passthrough=%s)" % passthrough,
+                     5 * len(message_list) / (time.time() - start), 5)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""A cache shared by the processes of a pre-forked frontend.
+
+Decrypting and verifying the session cipher of a new client needs an RSA
+private key operation and a signature check, which is the most expensive part
+of a client session. A frontend process remembers the ciphers it verified, but
+when the frontend runs several processes a client can reach a different process
+on its next poll and would pay for the RSA operations again.
+
+The SharedFrontendCache lives in a manager process which is started before the
+frontend forks. The workers reach it over a local socket and share:
+
+- The ciphers which were already verified, keyed on a digest of the encrypted
+  cipher the client sends with every request.
+- The certificates of the clients, so the public keys do not have to be read
+  from the data store by every worker.
+- The number of requests and messages each worker handled, so every worker can
+  export the throughput of the whole frontend.
+"""
+
+
+import hashlib
+import os
+import threading
+import time
+
+
+import logging
+
+from multiprocessing import managers
+
+from grr.lib import communicator
+from grr.lib import config_lib
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class SharedFrontendCache(object):
+  """The cache, this object lives in the manager process."""
+
+  def __init__(self, max_size=10000, cert_max_age=600):
+    """Constructor.
+
+    Args:
+      max_size: The maximum number of ciphers and certificates to keep.
+      cert_max_age: Certificates are only handed out for this many seconds
+        after they were read from the data store, so a worker picks up the new
+        certificate of a client which enrolled again.
+    """
+    self.ciphers = utils.FastStore(max_size)
+    self.certs = utils.FastStore(max_size)
+    self.cert_max_age = cert_max_age
+    self.lock = threading.Lock()
+    self.process_stats = {}
+
+  def GetCipher(self, key):
+    """Returns a (serialized cipher, serialized metadata) tuple or None."""
+    try:
+      return self.ciphers.Get(key)
+    except KeyError:
+      return None
+
+  def PutCipher(self, key, serialized_cipher, serialized_metadata):
+    self.ciphers.Put(key, (serialized_cipher, serialized_metadata))
+
+  def GetCert(self, common_name):
+    """Returns the PEM encoded certificate of a client or None."""
+    try:
+      timestamp, cert = self.certs.Get(common_name)
+    except KeyError:
+      return None
+
+    if time.time() - timestamp > self.cert_max_age:
+      return None
+
+    return cert
+
+  def PutCert(self, common_name, cert):
+    self.certs.Put(common_name, (time.time(), cert))
+
+  def RecordRequests(self, pid, requests, messages):
+    """Adds to the number of requests and messages a worker handled."""
+    with self.lock:
+      total_requests, total_messages = self.process_stats.get(pid, (0, 0))
+      self.process_stats[pid] = (total_requests + requests,
+                                 total_messages + messages)
+
+  def GetProcessStats(self):
+    """Returns a dict of pid -> (requests, messages) for all the workers."""
+    with self.lock:
+      return dict(self.process_stats)
+
+
+class FrontendCacheManager(managers.BaseManager):
+  """Serves the SharedFrontendCache to the frontend processes."""
+
+
+# There is exactly one cache in the manager process.
+_SHARED_CACHE = None
+_SHARED_CACHE_LOCK = threading.Lock()
+
+
+def _GetSharedCache():
+  global _SHARED_CACHE  # pylint: disable=global-statement
+
+  with _SHARED_CACHE_LOCK:
+    if _SHARED_CACHE is None:
+      _SHARED_CACHE = SharedFrontendCache(
+          max_size=config_lib.CONFIG["Frontend.shared_cache_size"],
+          cert_max_age=config_lib.CONFIG["Frontend.shared_cache_cert_max_age"])
+
+    return _SHARED_CACHE
+
+FrontendCacheManager.register("GetCache", callable=_GetSharedCache)
+
+
+class FrontendCacheClient(object):
+  """The frontend side of the shared cache.
+
+  The manager process might go away, so errors talking to it are logged and
+  treated as cache misses. The frontend then simply falls back to doing the
+  RSA operations itself.
+  """
+
+  # How often (in seconds) the request counts are sent to the manager.
+  stats_interval = 10
+
+  def __init__(self, cache):
+    """Constructor.
+
+    Args:
+      cache: A SharedFrontendCache or a proxy to the one in the manager process.
+    """
+    self.cache = cache
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.messages = 0
+    self.last_report = time.time()
+
+  def _CipherKey(self, encrypted_cipher):
+    return hashlib.sha256(encrypted_cipher).digest()
+
+  def _Call(self, method, *args):
+    try:
+      return getattr(self.cache, method)(*args)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.warning("Shared frontend cache failed: %s", e)
+      stats.STATS.IncrementCounter("grr_frontend_shared_cache_errors")
+
+  def GetCipher(self, encrypted_cipher):
+    """Returns a verified ReceivedCipher from the shared cache.
+
+    Args:
+      encrypted_cipher: The encrypted cipher the client sent.
+
+    Returns:
+      A communicator.ReceivedCipher.
+
+    Raises:
+      KeyError: If no worker verified this cipher yet.
+    """
+    result = self._Call("GetCipher", self._CipherKey(encrypted_cipher))
+    if result is None:
+      stats.STATS.IncrementCounter("grr_frontend_shared_cache_misses")
+      raise KeyError("Cipher not in the shared cache.")
+
+    stats.STATS.IncrementCounter("grr_frontend_shared_cache_hits")
+    serialized_cipher, serialized_metadata = result
+    return communicator.ReceivedCipher.FromSerializedCipher(
+        encrypted_cipher, serialized_cipher, serialized_metadata)
+
+  def PutCipher(self, cipher):
+    """Shares a ReceivedCipher whose signature was verified."""
+    self._Call("PutCipher", self._CipherKey(cipher.encrypted_cipher),
+               cipher.serialized_cipher,
+               cipher.cipher_metadata.SerializeToString())
+
+  def GetCert(self, common_name):
+    """Returns the RDFX509Cert of a client or None."""
+    cert = self._Call("GetCert", utils.SmartStr(common_name))
+    if cert:
+      return rdfvalue.RDFX509Cert(cert)
+
+  def PutCert(self, common_name, cert):
+    self._Call("PutCert", utils.SmartStr(common_name), cert.SerializeToString())
+
+  def RecordRequest(self, messages):
+    """Counts a request handled by this process.
+
+    The counts are sent to the manager in batches, at most every
+    stats_interval seconds.
+
+    Args:
+      messages: The number of messages the client sent with the request.
+    """
+    with self.lock:
+      self.requests += 1
+      self.messages += messages
+
+      now = time.time()
+      if now - self.last_report < self.stats_interval:
+        return
+
+      requests, self.requests = self.requests, 0
+      messages, self.messages = self.messages, 0
+      self.last_report = now
+
+    self._Call("RecordRequests", os.getpid(), requests, messages)
+    self.ExportStats()
+
+  def ExportStats(self):
+    """Exports the per process and aggregate throughput of the frontend."""
+    process_stats = self._Call("GetProcessStats") or {}
+
+    total_requests = total_messages = 0
+    for pid, (requests, messages) in process_stats.items():
+      stats.STATS.SetGaugeValue("grr_frontend_process_requests", requests,
+                                fields=[str(pid)])
+      stats.STATS.SetGaugeValue("grr_frontend_process_messages", messages,
+                                fields=[str(pid)])
+      total_requests += requests
+      total_messages += messages
+
+    stats.STATS.SetGaugeValue("grr_frontend_total_requests", total_requests)
+    stats.STATS.SetGaugeValue("grr_frontend_total_messages", total_messages)
+
+
+class SharedCipherStore(object):
+  """A cipher cache which falls back to the shared cache.
+
+  This replaces the Communicator's encrypted_cipher_cache. Ciphers are looked
+  up in the process' own store first. Ciphers found in the shared cache are
+  kept in the local store, and newly verified ciphers are shared with the
+  other workers.
+  """
+
+  def __init__(self, local_store, shared_cache):
+    self.local_store = local_store
+    self.shared_cache = shared_cache
+
+  def Get(self, encrypted_cipher):
+    try:
+      return self.local_store.Get(encrypted_cipher)
+    except KeyError:
+      cipher = self.shared_cache.GetCipher(encrypted_cipher)
+      self.local_store.Put(encrypted_cipher, cipher)
+      return cipher
+
+  def Put(self, encrypted_cipher, cipher):
+    self.local_store.Put(encrypted_cipher, cipher)
+    self.shared_cache.PutCipher(cipher)
+
+
+def StartSharedCache():
+  """Starts the manager process, must be called before forking the workers.
+
+  Returns:
+    A FrontendCacheClient connected to the manager.
+  """
+  manager = FrontendCacheManager()
+  manager.start()
+
+  return FrontendCacheClient(manager.GetCache())
+
+
+class FrontendCacheInit(registry.InitHook):
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    """Exports our vars."""
+    stats.STATS.RegisterCounterMetric("grr_frontend_shared_cache_hits")
+    stats.STATS.RegisterCounterMetric("grr_frontend_shared_cache_misses")
+    stats.STATS.RegisterCounterMetric("grr_frontend_shared_cache_errors")
+    stats.STATS.RegisterGaugeMetric("grr_frontend_process_requests", int,
+                                    fields=[("pid", str)])
+    stats.STATS.RegisterGaugeMetric("grr_frontend_process_messages", int,
+                                    fields=[("pid", str)])
+    stats.STATS.RegisterGaugeMetric("grr_frontend_total_requests", int)
+    stats.STATS.RegisterGaugeMetric("grr_frontend_total_messages", int)
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+"""Bloom filters over the hashes known to the server.
+
+Checking whether a hash is known, e.g. whether a blob is in the blob store or a
+file is in the hash file store, costs a data store query even if the answer is
+no, and when collecting files from many clients most answers are no. A
+HashFilter keeps a Bloom filter of the known hashes in memory: a negative answer
+is certain and needs no data store query, while a positive answer is checked
+against the data store as before.
+
+Filters are persisted under aff4:/hash_filters/<name>. A snapshot holds the
+filter bits, and keys added since the snapshot are appended to a journal, so a
+process adding keys only writes the new ones. Processes load the snapshot and
+replay the journal when they start, and pick up new journal entries (or a new
+snapshot) every HashFilter.refresh_interval seconds. The HashFilterCompactor
+cron job writes new snapshots and trims the journal.
+
+A filter is only used for lookups once it has a snapshot, since only then it
+covers everything in the store: the first snapshot is built from a full scan
+of the store. Keys added by another process are not seen before the next
+refresh, so in the meantime they may be reported as unknown and fetched again.
+Both the blob store and the file store handle this since writes to them are
+idempotent.
+"""
+
+
+import hashlib
+import math
+import struct
+import threading
+import time
+import zlib
+
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+# The loaded filters by name, set by HashFilterInit.
+FILTERS = {}
+
+
+# The number of set bits in each byte value.
+_POPCOUNT = [bin(i).count("1") for i in range(256)]
+
+
+class BloomFilter(object):
+  """A Bloom filter over strings."""
+
+  def __init__(self, num_bits, num_hashes, bits=None, count=0):
+    """Constructor.
+
+    Args:
+      num_bits: The size of the filter in bits, a multiple of 8.
+      num_hashes: The number of bits set for each key.
+      bits: An optional bytearray with the filter content.
+      count: The number of distinct keys in the filter.
+    """
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+    self.count = count
+
+    if bits is None:
+      self.bits = bytearray(num_bits // 8)
+      self.set_bits = 0
+    else:
+      self.bits = bits
+      self.set_bits = sum(_POPCOUNT[b] for b in bits)
+
+  @classmethod
+  def ForCapacity(cls, capacity, error_rate):
+    """Creates a filter sized for capacity keys at the given error rate."""
+    capacity = max(1, capacity)
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+    num_bits = max(64, (num_bits + 7) // 8 * 8)
+    num_hashes = max(1, int(round(num_bits * math.log(2) / capacity)))
+
+    return cls(num_bits, num_hashes)
+
+  def _Positions(self, key):
+    # Double hashing, the positions are h1 + i * h2 for i < num_hashes.
+    h1, h2 = struct.unpack("<QQ", hashlib.sha256(key).digest()[:16])
+    for i in xrange(self.num_hashes):
+      yield (h1 + i * h2) % self.num_bits
+
+  def Add(self, key):
+    """Adds a key, returns True if the filter did not contain it."""
+    new = False
+    for position in self._Positions(key):
+      mask = 1 << (position & 7)
+      if not self.bits[position >> 3] & mask:
+        self.bits[position >> 3] |= mask
+        self.set_bits += 1
+        new = True
+
+    if new:
+      self.count += 1
+
+    return new
+
+  def __contains__(self, key):
+    for position in self._Positions(key):
+      if not self.bits[position >> 3] & (1 << (position & 7)):
+        return False
+
+    return True
+
+  def FalsePositiveRate(self):
+    """Estimates the false positive rate from the fraction of set bits."""
+    return (self.set_bits / float(self.num_bits)) ** self.num_hashes
+
+  def MemorySize(self):
+    """The memory used by the filter bits in bytes."""
+    return len(self.bits)
+
+
+class HashFilter(object):
+  """A persisted, incrementally updated Bloom filter.
+
+  Subclasses name the filter and list all keys in the store it covers, which is
+  used to build the first snapshot.
+  """
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # The name of the filter, filters without a name are not created.
+  name = None
+
+  ROOT = rdfvalue.RDFURN("aff4:/hash_filters")
+
+  # The snapshot header holds the filter shape and the number of pages, which
+  # hold the filter bits. Pages are written with the timestamp of the header.
+  HEADER = "filter:snapshot"
+  PAGE_PREFIX = "filter:snapshot/"
+  PAGE_SIZE = 1024 * 1024
+  HEADER_FORMAT = "<QIQI"
+
+  # Each journal entry holds the hex encoded keys of one Add call, one per
+  # line.
+  JOURNAL = "filter:journal"
+
+  # Journal entries younger than this are kept by Compact(), so entries which
+  # are not visible yet when the journal is read are not dropped.
+  JOURNAL_GRACE = 10 * 60 * 1000000
+
+  # The largest data store timestamp.
+  MAX_TIMESTAMP = 2 ** 63 - 1
+
+  def __init__(self, capacity=None, error_rate=None, refresh_interval=None):
+    """Constructor.
+
+    Args:
+      capacity: The number of keys the filter is sized for.
+      error_rate: The target false positive rate at capacity.
+      refresh_interval: How often to pick up changes from other processes, in
+        seconds.
+    """
+    if capacity is None:
+      capacity = config_lib.CONFIG["HashFilter.capacity"]
+
+    if error_rate is None:
+      error_rate = config_lib.CONFIG["HashFilter.error_rate"]
+
+    if refresh_interval is None:
+      refresh_interval = config_lib.CONFIG["HashFilter.refresh_interval"]
+
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.refresh_interval = refresh_interval
+    self.urn = self.ROOT.Add(self.name)
+
+    # The filter is None until a snapshot was loaded.
+    self.bloom = None
+    self.snapshot_timestamp = None
+    self.journal_timestamp = 0
+    self.last_refresh = 0
+    self.lock = threading.RLock()
+
+  def ListKeys(self, token=None):
+    """Yields all keys in the store covered by this filter."""
+    raise NotImplementedError()
+
+  def _ReadSnapshot(self, token=None):
+    """Returns the newest snapshot as (BloomFilter, timestamp).
+
+    Returns:
+      (None, None) if there is no complete snapshot.
+    """
+    header, timestamp = data_store.DB.Resolve(self.urn, self.HEADER,
+                                              token=token)
+    if not header:
+      return None, None
+
+    num_bits, num_hashes, count, num_pages = struct.unpack(
+        self.HEADER_FORMAT, utils.SmartStr(header))
+
+    pages = {}
+    for predicate, value, _ in data_store.DB.ResolveMulti(
+        self.urn, [self.PAGE_PREFIX + str(i) for i in range(num_pages)],
+        timestamp=(timestamp, timestamp), token=token):
+      pages[int(predicate[len(self.PAGE_PREFIX):])] = zlib.decompress(
+          utils.SmartStr(value))
+
+    # A new snapshot is being written.
+    if len(pages) != num_pages:
+      return None, None
+
+    bits = bytearray("".join(pages[i] for i in range(num_pages)))
+    return BloomFilter(num_bits, num_hashes, bits=bits, count=count), timestamp
+
+  def _WriteSnapshot(self, bloom, timestamp, token=None):
+    """Writes the pages first, so the header only refers to complete pages."""
+    values = {}
+    for i in range(0, len(bloom.bits), self.PAGE_SIZE):
+      values[self.PAGE_PREFIX + str(i // self.PAGE_SIZE)] = [zlib.compress(
+          str(bloom.bits[i:i + self.PAGE_SIZE]))]
+
+    data_store.DB.MultiSet(self.urn, values, timestamp=timestamp, sync=True,
+                           token=token)
+
+    header = struct.pack(self.HEADER_FORMAT, bloom.num_bits, bloom.num_hashes,
+                         bloom.count, len(values))
+    data_store.DB.Set(self.urn, self.HEADER, header, timestamp=timestamp,
+                      sync=True, token=token)
+
+  def _ReplayJournal(self, bloom, start, token=None):
+    """Adds the keys journaled since start, returns the newest timestamp."""
+    newest = start
+    for _, value, timestamp in data_store.DB.ResolveMulti(
+        self.urn, [self.JOURNAL], timestamp=(start, self.MAX_TIMESTAMP),
+        token=token):
+      for hex_key in utils.SmartStr(value).split("\n"):
+        bloom.Add(hex_key.decode("hex"))
+
+      newest = max(newest, timestamp)
+
+    return newest
+
+  def _UpdateStats(self):
+    if self.bloom is None:
+      return
+
+    stats.STATS.SetGaugeValue("grr_hash_filter_false_positive_rate",
+                              self.bloom.FalsePositiveRate(),
+                              fields=[self.name])
+    stats.STATS.SetGaugeValue("grr_hash_filter_memory_bytes",
+                              self.bloom.MemorySize(), fields=[self.name])
+
+  def Load(self, token=None):
+    """Loads the newest snapshot and replays the journal."""
+    bloom, snapshot_timestamp = self._ReadSnapshot(token=token)
+    journal_timestamp = 0
+    if bloom is not None:
+      journal_timestamp = self._ReplayJournal(bloom, 0, token=token)
+
+    with self.lock:
+      self.bloom = bloom
+      self.snapshot_timestamp = snapshot_timestamp
+      self.journal_timestamp = journal_timestamp
+      self.last_refresh = time.time()
+      self._UpdateStats()
+
+  def Refresh(self, token=None):
+    """Picks up keys added by other processes since the last refresh."""
+    _, timestamp = data_store.DB.Resolve(self.urn, self.HEADER, token=token)
+    if self.bloom is None or timestamp != self.snapshot_timestamp:
+      return self.Load(token=token)
+
+    with self.lock:
+      # Entries with the newest timestamp we saw are read again, in case
+      # another process added an entry with the same timestamp.
+      self.journal_timestamp = self._ReplayJournal(
+          self.bloom, self.journal_timestamp, token=token)
+      self.last_refresh = time.time()
+      self._UpdateStats()
+
+  def Add(self, keys, token=None):
+    """Records that keys were added to the store.
+
+    Keys are journaled even if this process did not load the filter, so other
+    processes and the next snapshot see them.
+
+    Args:
+      keys: A list of keys.
+      token: The token to use for data store access.
+    """
+    keys = list(keys)
+    if not keys:
+      return
+
+    data_store.DB.Set(self.urn, self.JOURNAL,
+                      "\n".join(key.encode("hex") for key in keys),
+                      replace=False, sync=False, token=token)
+
+    with self.lock:
+      if self.bloom is not None:
+        for key in keys:
+          self.bloom.Add(key)
+
+  def MayContain(self, keys, token=None):
+    """Returns the keys which may be in the store.
+
+    Keys which are not returned are certainly not in the store. If no snapshot
+    of the filter was loaded, all keys are returned. A snapshot written later
+    is picked up on the next refresh.
+
+    Args:
+      keys: A list of keys.
+      token: The token to use for data store access.
+
+    Returns:
+      A list of keys.
+    """
+    if time.time() - self.last_refresh > self.refresh_interval:
+      self.Refresh(token=token)
+
+    with self.lock:
+      if self.bloom is None:
+        return list(keys)
+
+      result = [key for key in keys if key in self.bloom]
+
+    stats.STATS.IncrementCounter("grr_hash_filter_lookups", len(keys),
+                                 fields=[self.name])
+    stats.STATS.IncrementCounter("grr_hash_filter_negatives",
+                                 len(keys) - len(result), fields=[self.name])
+    return result
+
+  def RecordFalsePositives(self, count):
+    """Records keys returned by MayContain() which were not in the store."""
+    stats.STATS.IncrementCounter("grr_hash_filter_false_positives", count,
+                                 fields=[self.name])
+
+  def Compact(self, token=None):
+    """Writes a new snapshot and removes the journal entries it covers.
+
+    The filter is built from a scan of the store if there is no snapshot yet,
+    or if the snapshot filled up beyond twice the target error rate.
+
+    Args:
+      token: The token to use for data store access.
+    """
+    now = int(rdfvalue.RDFDatetime().Now())
+
+    bloom, _ = self._ReadSnapshot(token=token)
+    if bloom is None or bloom.FalsePositiveRate() > 2 * self.error_rate:
+      count = bloom.count if bloom is not None else 0
+      bloom = BloomFilter.ForCapacity(max(self.capacity, 2 * count),
+                                      self.error_rate)
+      for key in self.ListKeys(token=token):
+        bloom.Add(key)
+
+    journal_timestamp = self._ReplayJournal(bloom, 0, token=token)
+    self._WriteSnapshot(bloom, now, token=token)
+
+    data_store.DB.DeleteAttributes(self.urn, [self.JOURNAL], start=0,
+                                   end=now - self.JOURNAL_GRACE, sync=True,
+                                   token=token)
+
+    with self.lock:
+      self.bloom = bloom
+      self.snapshot_timestamp = now
+      self.journal_timestamp = journal_timestamp
+      self.last_refresh = time.time()
+      self._UpdateStats()
+
+
+def LoadFilters(token=None):
+  """Loads all filters, called by processes which look up many hashes."""
+  for hash_filter in FILTERS.values():
+    hash_filter.Load(token=token)
+
+
+class HashFilterInit(registry.InitHook):
+  """Creates the hash filters."""
+
+  pre = ["DataStoreInit"]
+
+  def Run(self):
+    FILTERS.clear()
+    if not config_lib.CONFIG["HashFilter.enabled"]:
+      return
+
+    for cls in HashFilter.classes.values():
+      if cls.name:
+        FILTERS[cls.name] = cls()
+
+  def RunOnce(self):
+    for name in ["grr_hash_filter_lookups", "grr_hash_filter_negatives",
+                 "grr_hash_filter_false_positives"]:
+      stats.STATS.RegisterCounterMetric(name, fields=[("filter", str)])
+
+    stats.STATS.RegisterGaugeMetric("grr_hash_filter_false_positive_rate",
+                                    float, fields=[("filter", str)])
+    stats.STATS.RegisterGaugeMetric("grr_hash_filter_memory_bytes", int,
+                                    fields=[("filter", str)])
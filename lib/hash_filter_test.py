@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Tests for the hash filters."""
+
+
+import hashlib
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import blob_store
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import hash_filter
+from grr.lib import test_lib
+
+
+class BloomFilterTest(test_lib.GRRBaseTest):
+  """Tests the BloomFilter."""
+
+  def testFalsePositiveRate(self):
+    bloom = hash_filter.BloomFilter.ForCapacity(1000, 0.01)
+    for i in range(1000):
+      bloom.Add("key%d" % i)
+
+    # Keys which are false positives when added are not counted.
+    self.assertFalse(bloom.Add("key1"))
+    self.assertTrue(980 < bloom.count <= 1000)
+
+    for i in range(1000):
+      self.assertTrue("key%d" % i in bloom)
+
+    false_positives = len([i for i in range(10000) if "other%d" % i in bloom])
+    self.assertTrue(false_positives < 300)
+    self.assertTrue(0.001 < bloom.FalsePositiveRate() < 0.03)
+    self.assertEqual(bloom.MemorySize(), bloom.num_bits / 8)
+
+
+class BlobHashFilterTest(test_lib.GRRBaseTest):
+  """Tests the persisted filter over the blob store."""
+
+  def setUp(self):
+    super(BlobHashFilterTest, self).setUp()
+    self.store = blob_store.BlobStore(segment_prefix_length=1)
+    self.blobs = ["blob%d" % i for i in range(100)]
+    self.digests = [hashlib.sha256(blob).digest() for blob in self.blobs]
+    self.unknown = [hashlib.sha256("unknown%d" % i).digest()
+                    for i in range(100)]
+
+  def _MakeFilter(self):
+    return blob_store.BlobHashFilter(capacity=1000, error_rate=0.001,
+                                     refresh_interval=0)
+
+  def testFilterIsNotUsedWithoutSnapshot(self):
+    blob_filter = self._MakeFilter()
+    blob_filter.Load(token=self.token)
+    self.assertEqual(blob_filter.MayContain(self.unknown, token=self.token),
+                     self.unknown)
+
+  def testSnapshotWrittenLaterIsLoaded(self):
+    reader = self._MakeFilter()
+    reader.Load(token=self.token)
+    self.assertEqual(reader.MayContain(self.unknown, token=self.token),
+                     self.unknown)
+
+    self._MakeFilter().Compact(token=self.token)
+
+    # The reader picks up the new snapshot on refresh.
+    self.assertTrue(len(reader.MayContain(self.unknown,
+                                          token=self.token)) < 5)
+
+  def testCompactBuildsFilterFromStore(self):
+    self.store.WriteBlobs(self.blobs, token=self.token)
+
+    # Drop the journal, so the filter can only be built from the store.
+    data_store.DB.DeleteSubject(self._MakeFilter().urn, token=self.token)
+
+    with test_lib.Stubber(blob_store, "BLOB_STORE", self.store):
+      self._MakeFilter().Compact(token=self.token)
+
+    blob_filter = self._MakeFilter()
+    blob_filter.Load(token=self.token)
+    self.assertEqual(blob_filter.MayContain(self.digests, token=self.token),
+                     self.digests)
+    self.assertTrue(len(blob_filter.MayContain(self.unknown,
+                                               token=self.token)) < 5)
+
+  def testJournalIsReplayed(self):
+    writer = self._MakeFilter()
+    writer.Compact(token=self.token)
+
+    reader = self._MakeFilter()
+    reader.Load(token=self.token)
+    self.assertTrue(len(reader.MayContain(self.digests,
+                                          token=self.token)) < 5)
+
+    writer.Add(self.digests[:50], token=self.token)
+    self.assertEqual(writer.MayContain(self.digests[:50], token=self.token),
+                     self.digests[:50])
+
+    # The reader picks up the journal on refresh.
+    self.assertEqual(reader.MayContain(self.digests[:50], token=self.token),
+                     self.digests[:50])
+
+    # A new snapshot includes the journal.
+    writer.Compact(token=self.token)
+    reader = self._MakeFilter()
+    reader.Load(token=self.token)
+    self.assertEqual(reader.MayContain(self.digests[:50], token=self.token),
+                     self.digests[:50])
+
+  def testBlobsExistSkipsDataStoreForUnknownBlobs(self):
+    blob_filter = self._MakeFilter()
+    blob_filter.Compact(token=self.token)
+    blob_filter.refresh_interval = 1000
+
+    with test_lib.Stubber(hash_filter, "FILTERS",
+                          {blob_store.BlobHashFilter.name: blob_filter}):
+      self.store.WriteBlobs(self.blobs, token=self.token)
+
+      queried = []
+      resolve_multi = data_store.DB.ResolveMulti
+
+      def ResolveMulti(subject, predicates, **kwargs):
+        queried.extend(predicates)
+        return resolve_multi(subject, predicates, **kwargs)
+
+      with test_lib.Stubber(data_store.DB, "ResolveMulti", ResolveMulti):
+        exists = self.store.BlobsExist(self.unknown, token=self.token)
+        self.assertFalse(any(exists.values()))
+        self.assertTrue(len(queried) < 5)
+
+        exists = self.store.BlobsExist(self.digests, token=self.token)
+        self.assertTrue(all(exists.values()))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
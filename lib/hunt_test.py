@@ -279,6 +279,21 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     # One flow should have been started.
     self.assertEqual(len(flows), 1)
 
+  def testClientsOfOldHuntsAreMigrated(self):
+    client_ids = self.SetupClients(3)
+    with hunts.GRRHunt.StartHunt(
+        hunt_name="SampleHunt", client_rate=0, token=self.token) as hunt:
+      # Hunts created before the client sets kept their clients in versioned
+      # attributes.
+      for client_id in client_ids:
+        hunt.AddAttribute(hunt.Schema.CLIENTS(client_id))
+      hunt.AddAttribute(hunt.Schema.FINISHED(client_ids[0]))
+
+    hunt = aff4.FACTORY.Open(hunt.urn, token=self.token)
+    self.assertEqual(hunt.NumClients(), 3)
+    self.assertEqual(hunt.NumCompleted(), 1)
+    self.assertEqual(hunt.GetOutstandingClients(), client_ids[1:])
+
   def testCallbackWithLimit(self):
 
     self.assertRaises(RuntimeError, self.testCallback, 2000)
@@ -314,8 +329,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
         hunt.session_id, mode="r", age=aff4.ALL_TIMES,
         aff4_type="SampleHunt", token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
 
     self.assertEqual(len(set(started)), 10)
     self.assertEqual(len(set(finished)), 10)
@@ -349,8 +364,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.session_id, mode="rw",
                                  age=aff4.ALL_TIMES, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
 
     # We started the hunt on 10 clients.
     self.assertEqual(len(set(started)), 10)
@@ -427,8 +442,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.urn, mode="rw",
                                  age=aff4.ALL_TIMES, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
 
     # We limited here to 5 clients.
     self.assertEqual(len(set(started)), 5)
@@ -464,8 +479,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.session_id, mode="rw",
                                  age=aff4.ALL_TIMES, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
     errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
     self.assertEqual(len(set(started)), 10)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Sets of the clients a hunt has run on.
+
+A hunt can run on hundreds of thousands of clients, so the clients it was
+started, completed or failed on are not kept in versioned attributes of the
+hunt object, where every count or listing has to load all of them. Instead each
+set is split into shards by the first hex digit of the client id. Each shard is
+a data store subject with one attribute per member and a counter of its
+members, which is updated in the same transaction as the members.
+
+Counting a set only reads the counters. Paging through a set uses the counters
+to skip whole shards, and set differences are computed one shard at a time.
+Since the shards follow the client id order, results come out sorted.
+"""
+
+
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+
+class HuntClientSet(object):
+  """A sharded set of client ids belonging to a hunt."""
+
+  # Client ids are "C." followed by hex digits, the first of which selects the
+  # shard.
+  SHARDS = "0123456789abcdef"
+
+  MEMBER_PREFIX = "client:"
+  COUNT_PREDICATE = "client_set:count"
+
+  def __init__(self, hunt_urn, name, token=None):
+    """Constructor.
+
+    Args:
+      hunt_urn: The urn of the hunt this set belongs to.
+      name: The name of the set, e.g. "completed".
+      token: The token to use for data store access.
+    """
+    self.urn = rdfvalue.RDFURN(hunt_urn).Add("ClientSets").Add(name)
+    self.token = token
+
+  def _ShardSubject(self, shard):
+    return self.urn.Add(shard)
+
+  def _GetShard(self, client_id):
+    return client_id.Basename()[2].lower()
+
+  def _MemberPredicate(self, client_id):
+    return self.MEMBER_PREFIX + client_id.Basename()
+
+  def Add(self, client_ids):
+    """Adds clients to the set.
+
+    Args:
+      client_ids: A list of client ids. Clients already in the set are ignored.
+    """
+    client_ids = [rdfvalue.ClientURN(client_id) for client_id in client_ids]
+
+    for shard, shard_clients in utils.GroupBy(
+        client_ids, self._GetShard).iteritems():
+      data_store.DB.RetryWrapper(self._ShardSubject(shard), self._AddToShard,
+                                 client_ids=shard_clients, token=self.token)
+
+  def _AddToShard(self, transaction, client_ids=None):
+    """Adds new members and updates the counter while holding the shard lock."""
+    members = dict((self._MemberPredicate(client_id), client_id)
+                   for client_id in client_ids)
+
+    existing = set(predicate for predicate, _, _ in data_store.DB.ResolveMulti(
+        transaction.subject, members.keys(), token=self.token))
+
+    new_members = [predicate for predicate in members
+                   if predicate not in existing]
+    if not new_members:
+      return
+
+    count, _ = data_store.DB.Resolve(transaction.subject, self.COUNT_PREDICATE,
+                                     token=self.token)
+
+    for predicate in new_members:
+      transaction.Set(predicate, utils.SmartStr(members[predicate]))
+
+    transaction.Set(self.COUNT_PREDICATE, int(count or 0) + len(new_members))
+
+  def _ShardCounts(self):
+    """Returns a dict with the number of members in each shard."""
+    counts = dict.fromkeys(self.SHARDS, 0)
+
+    for subject, values in data_store.DB.MultiResolveRegex(
+        [self._ShardSubject(shard) for shard in self.SHARDS],
+        self.COUNT_PREDICATE, timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        token=self.token):
+      for _, count, _ in values:
+        counts[rdfvalue.RDFURN(subject).Basename()] = int(count)
+
+    return counts
+
+  def _ReadShard(self, shard):
+    """Returns the members of a shard, sorted by client id.
+
+    The age of each client urn is the time it was added to the set.
+
+    Args:
+      shard: The shard to read.
+
+    Returns:
+      A list of ClientURNs.
+    """
+    return [rdfvalue.ClientURN(value, age=timestamp)
+            for _, value, timestamp in data_store.DB.ResolveRegex(
+                self._ShardSubject(shard), self.MEMBER_PREFIX + ".*",
+                timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token,
+                limit=None)]
+
+  def __len__(self):
+    return sum(self._ShardCounts().values())
+
+  def __iter__(self):
+    for shard in self.SHARDS:
+      for client_id in self._ReadShard(shard):
+        yield client_id
+
+  def List(self, offset=0, count=None):
+    """Returns a page of the set, sorted by client id.
+
+    Args:
+      offset: The number of members to skip.
+      count: The maximum number of members to return, or None for all of them.
+
+    Returns:
+      A list of ClientURNs.
+    """
+    counts = self._ShardCounts()
+    result = []
+    for shard in self.SHARDS:
+      if count is not None and len(result) >= count:
+        break
+
+      # Whole shards before the page are skipped without being read.
+      if offset >= counts[shard]:
+        offset -= counts[shard]
+        continue
+
+      result.extend(self._ReadShard(shard)[offset:])
+      offset = 0
+
+    if count is not None:
+      return result[:count]
+
+    return result
+
+  def Difference(self, other, offset=0, count=None):
+    """Returns a page of the members which are not in another set.
+
+    Args:
+      other: The HuntClientSet with the members to leave out.
+      offset: The number of results to skip.
+      count: The maximum number of results to return, or None for all of them.
+
+    Returns:
+      A list of ClientURNs, sorted by client id.
+    """
+    result = []
+    for shard in self.SHARDS:
+      members = self._ReadShard(shard)
+      if not members:
+        continue
+
+      excluded = set(client_id.Basename()
+                     for client_id in other._ReadShard(shard))  # pylint: disable=protected-access
+
+      for client_id in members:
+        if client_id.Basename() in excluded:
+          continue
+
+        if offset:
+          offset -= 1
+          continue
+
+        result.append(client_id)
+        if count is not None and len(result) >= count:
+          return result
+
+    return result
+
+  def Filter(self, client_ids):
+    """Returns the clients from client_ids which are members of this set."""
+    client_ids = [rdfvalue.ClientURN(client_id) for client_id in client_ids]
+    result = set()
+
+    for shard, shard_clients in utils.GroupBy(
+        client_ids, self._GetShard).iteritems():
+      members = dict((self._MemberPredicate(client_id), client_id)
+                     for client_id in shard_clients)
+
+      for predicate, _, _ in data_store.DB.ResolveMulti(
+          self._ShardSubject(shard), members.keys(), token=self.token):
+        result.add(members[predicate])
+
+    return result
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Tests for the hunt client sets."""
+
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib.hunts import client_sets
+
+
+class HuntClientSetTest(test_lib.GRRBaseTest):
+  """Tests the sharded client sets."""
+
+  hunt_urn = rdfvalue.RDFURN("aff4:/hunts/W:123456")
+
+  def MakeClientIds(self, n):
+    # Spread the clients over all the shards.
+    return [rdfvalue.ClientURN("C.%016X" % (i * 0x0111111111111111))
+            for i in range(n)]
+
+  def testAddAndCount(self):
+    client_set = client_sets.HuntClientSet(self.hunt_urn, "clients",
+                                           token=self.token)
+    self.assertEqual(len(client_set), 0)
+
+    client_ids = self.MakeClientIds(20)
+    client_set.Add(client_ids[:10])
+    self.assertEqual(len(client_set), 10)
+
+    # Adding clients twice does not change the counters.
+    client_set.Add(client_ids)
+    self.assertEqual(len(client_set), 20)
+    self.assertEqual(list(client_set), sorted(client_ids))
+
+  def testPaging(self):
+    client_set = client_sets.HuntClientSet(self.hunt_urn, "clients",
+                                           token=self.token)
+    client_ids = sorted(self.MakeClientIds(40))
+    client_set.Add(client_ids)
+
+    self.assertEqual(client_set.List(), client_ids)
+    self.assertEqual(client_set.List(offset=5, count=10), client_ids[5:15])
+    self.assertEqual(client_set.List(offset=35, count=10), client_ids[35:])
+    self.assertEqual(client_set.List(offset=50, count=10), [])
+
+  def testDifferenceAndFilter(self):
+    started = client_sets.HuntClientSet(self.hunt_urn, "clients",
+                                        token=self.token)
+    completed = client_sets.HuntClientSet(self.hunt_urn, "completed",
+                                          token=self.token)
+    client_ids = sorted(self.MakeClientIds(30))
+    started.Add(client_ids)
+    completed.Add(client_ids[::2])
+
+    outstanding = client_ids[1::2]
+    self.assertEqual(started.Difference(completed), outstanding)
+    self.assertEqual(started.Difference(completed, offset=3, count=5),
+                     outstanding[3:8])
+
+    self.assertEqual(completed.Filter(client_ids[:4]),
+                     set([client_ids[0], client_ids[2]]))
+
+  def testMembersKeepTheTimeTheyWereAdded(self):
+    client_set = client_sets.HuntClientSet(self.hunt_urn, "clients",
+                                           token=self.token)
+    client_ids = self.MakeClientIds(2)
+
+    with test_lib.FakeTime(1000):
+      client_set.Add(client_ids[:1])
+
+    with test_lib.FakeTime(2000):
+      client_set.Add(client_ids)
+
+    self.assertEqual([client_id.age.AsSecondsFromEpoch()
+                      for client_id in client_set], [1000, 2000])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
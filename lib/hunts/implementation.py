@@ -30,6 +30,7 @@ from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import type_info
 from grr.lib import utils
+from grr.lib.hunts import client_sets
 from grr.lib.rdfvalues import flows
 from grr.proto import flows_pb2
 
@@ -72,8 +73,7 @@ class HuntRunner(flow_runner.FlowRunner):
       self._RegisterAndRunClient(client_id)
 
   def _RegisterAndRunClient(self, client_id):
-    self.flow_obj.AddAttribute(
-        self.flow_obj.Schema.CLIENTS(client_id))
+    self.flow_obj.MarkClient(client_id, self.flow_obj.CLIENTS_SET)
     self.RunStateMethod("RunClient", direct_response=[client_id])
 
   def _Process(self, request, responses, thread_pool=None, events=None):
@@ -424,23 +424,27 @@ class GRRHunt(flow.GRRFlow):
     This object stores the persistent information for the hunt.
     """
 
-    CLIENTS = aff4.Attribute("aff4:clients", rdfvalue.RDFURN,
-                             "The list of clients this hunt was run against.",
-                             creates_new_object_version=False)
-
     CLIENT_COUNT = aff4.Attribute("aff4:client_count", rdfvalue.RDFInteger,
                                   "The total number of clients scheduled.",
                                   versioned=False,
                                   creates_new_object_version=False)
 
-    FINISHED = aff4.Attribute("aff4:finished", rdfvalue.RDFURN,
-                              "The list of clients the hunt has completed on.",
-                              creates_new_object_version=False)
-
     ERRORS = aff4.Attribute("aff4:errors", rdfvalue.HuntError,
                             "The list of clients that returned an error.",
                             creates_new_object_version=False)
 
+    # Hunts created before the client sets kept their clients in these
+    # attributes. They are only read to migrate the clients into the sets.
+    CLIENTS = aff4.Attribute("aff4:clients", rdfvalue.RDFURN,
+                             "Deprecated: The list of clients this hunt was "
+                             "run against.",
+                             creates_new_object_version=False)
+
+    FINISHED = aff4.Attribute("aff4:finished", rdfvalue.RDFURN,
+                              "Deprecated: The list of clients the hunt has "
+                              "completed on.",
+                              creates_new_object_version=False)
+
     LOG = aff4.Attribute("aff4:result_log", rdfvalue.HuntLog,
                          "The log entries.",
                          creates_new_object_version=False)
@@ -456,11 +460,26 @@ class GRRHunt(flow.GRRFlow):
 
   runner_cls = HuntRunner
 
+  # The client sets kept for every hunt (see client_sets.HuntClientSet).
+  CLIENTS_SET = "clients"
+  COMPLETED_SET = "completed"
+  ERRORS_SET = "errors"
+
+  # The schema attributes which held the client sets of old hunts.
+  LEGACY_CLIENT_ATTRIBUTES = {CLIENTS_SET: "CLIENTS",
+                              COMPLETED_SET: "FINISHED"}
+
   def Initialize(self):
     super(GRRHunt, self).Initialize()
     # Hunts run in multiple threads so we need to protect access.
     self.lock = threading.RLock()
 
+    # Clients to add to the client sets when the hunt is flushed.
+    self.client_set_updates = {}
+
+    # The client sets checked for clients in legacy attributes.
+    self.migrated_client_sets = set()
+
     if "r" in self.mode:
       self.client_count = self.Get(self.Schema.CLIENT_COUNT)
 
@@ -713,7 +732,7 @@ class GRRHunt(flow.GRRFlow):
 
   def MarkClientDone(self, client_id):
     """Adds a client_id to the list of completed tasks."""
-    self.MarkClient(client_id, self.SchemaCls.FINISHED)
+    self.MarkClient(client_id, self.COMPLETED_SET)
 
     if self.state.context.args.notification_event:
       status = rdfvalue.HuntNotification(session_id=self.session_id,
@@ -731,6 +750,9 @@ class GRRHunt(flow.GRRFlow):
       error.backtrace = backtrace
     self.AddAttribute(error)
 
+    if client_id:
+      self.MarkClient(client_id, self.ERRORS_SET)
+
   def LogResult(self, client_id, log_message=None, urn=None):
     """Logs a message for a client."""
     log_entry = self.Schema.LOG()
@@ -741,9 +763,73 @@ class GRRHunt(flow.GRRFlow):
       log_entry.urn = utils.SmartUnicode(urn)
     self.AddAttribute(log_entry)
 
-  def MarkClient(self, client_id, attribute):
-    """Adds a client to the list indicated by attribute."""
-    self.AddAttribute(attribute(client_id))
+  def MarkClient(self, client_id, set_name):
+    """Adds a client to one of the hunt's client sets.
+
+    The client sets are updated when the hunt is flushed.
+
+    Args:
+      client_id: The client to add.
+      set_name: The name of the client set, e.g. COMPLETED_SET.
+    """
+    with self.lock:
+      self.client_set_updates.setdefault(set_name, set()).add(client_id)
+
+  def GetClientSet(self, set_name):
+    client_set = client_sets.HuntClientSet(self.urn, set_name,
+                                           token=self.token)
+    self._MigrateLegacyClients(set_name, client_set)
+    return client_set
+
+  def _MigrateLegacyClients(self, set_name, client_set):
+    """Adds the clients of hunts created before the client sets to the set.
+
+    Such hunts kept their clients in versioned attributes. Adding clients to a
+    set is idempotent, so this is done once for every hunt object which has any
+    of these attributes.
+
+    Args:
+      set_name: The name of the client set.
+      client_set: The HuntClientSet.
+    """
+    with self.lock:
+      if set_name in self.migrated_client_sets:
+        return
+      self.migrated_client_sets.add(set_name)
+
+    attribute_name = self.LEGACY_CLIENT_ATTRIBUTES.get(set_name)
+    if attribute_name is None:
+      return
+
+    attribute = getattr(self.Schema, attribute_name)
+    if self.Get(attribute) is None:
+      return
+
+    # Hunts are usually opened with only the newest attribute versions, so
+    # all versions are read from the data store.
+    client_set.Add(set(value for _, value, _ in data_store.DB.ResolveMulti(
+        self.urn, [attribute.predicate], token=self.token,
+        timestamp=data_store.DB.ALL_TIMESTAMPS)))
+
+  def _FlushClientSets(self):
+    """Writes the pending client set updates."""
+    if "w" not in self.mode:
+      return
+
+    with self.lock:
+      updates = self.client_set_updates
+      self.client_set_updates = {}
+
+    for set_name, client_ids in updates.iteritems():
+      self.GetClientSet(set_name).Add(client_ids)
+
+  def Flush(self, sync=True):
+    self._FlushClientSets()
+    super(GRRHunt, self).Flush(sync=sync)
+
+  def Close(self, sync=True):
+    self._FlushClientSets()
+    super(GRRHunt, self).Close(sync=sync)
 
   def ProcessClientResourcesStats(self, client_id, status):
     """Process status message from a client and update the stats.
@@ -756,20 +842,16 @@ class GRRHunt(flow.GRRFlow):
       status: Status returned from the client.
     """
 
-  def _Num(self, attribute):
-    return len(set(self.GetValuesForAttribute(attribute)))
-
   def NumClients(self):
-    return self._Num(self.Schema.CLIENTS)
+    return len(self.GetClientSet(self.CLIENTS_SET))
 
   def NumCompleted(self):
-    return self._Num(self.Schema.FINISHED)
+    return len(self.GetClientSet(self.COMPLETED_SET))
 
   def NumOutstanding(self):
     return self.NumClients() - self.NumCompleted()
 
-  def _List(self, attribute):
-    items = self.GetValuesForAttribute(attribute)
+  def _List(self, items):
     if items:
       print len(items), "items:"
       for item in items:
@@ -777,19 +859,25 @@ class GRRHunt(flow.GRRFlow):
     else:
       print "Nothing found."
 
+  def GetClients(self, offset=0, count=None):
+    """Returns a page of the clients this hunt was started on."""
+    return self.GetClientSet(self.CLIENTS_SET).List(offset=offset, count=count)
+
   def ListClients(self):
-    self._List(self.Schema.CLIENTS)
+    self._List(self.GetClients())
 
-  def GetCompletedClients(self):
-    return sorted(self.GetValuesForAttribute(self.Schema.FINISHED))
+  def GetCompletedClients(self, offset=0, count=None):
+    """Returns a page of the clients this hunt has completed on."""
+    return self.GetClientSet(self.COMPLETED_SET).List(offset=offset,
+                                                      count=count)
 
   def ListCompletedClients(self):
-    self._List(self.Schema.FINISHED)
+    self._List(self.GetCompletedClients())
 
-  def GetOutstandingClients(self):
-    started = self.GetValuesForAttribute(self.Schema.CLIENTS)
-    done = self.GetValuesForAttribute(self.Schema.FINISHED)
-    return sorted(list(set(started) - set(done)))
+  def GetOutstandingClients(self, offset=0, count=None):
+    """Returns a page of the clients which have not completed yet."""
+    return self.GetClientSet(self.CLIENTS_SET).Difference(
+        self.GetClientSet(self.COMPLETED_SET), offset=offset, count=count)
 
   def ListOutstandingClients(self):
     outstanding = self.GetOutstandingClients()
@@ -801,11 +889,13 @@ class GRRHunt(flow.GRRFlow):
     for client in outstanding:
       print client
 
+  def GetClientsWithErrors(self, offset=0, count=None):
+    """Returns a page of the clients which reported an error."""
+    return self.GetClientSet(self.ERRORS_SET).List(offset=offset, count=count)
+
   def GetClientsByStatus(self):
     """Get all the clients in a dict of {status: [client_list]}."""
-    completed = set(self.GetCompletedClients())
-
-    return {"COMPLETED": sorted(completed),
+    return {"COMPLETED": self.GetCompletedClients(),
             "OUTSTANDING": self.GetOutstandingClients()}
 
   def GetClientStates(self, client_list, client_chunk=50):
@@ -821,7 +911,7 @@ class GRRHunt(flow.GRRFlow):
 
   def PrintLog(self, client_id=None):
     if not client_id:
-      self._List(self.Schema.LOG)
+      self._List(self.GetValuesForAttribute(self.Schema.LOG))
       return
 
     for log in self.GetValuesForAttribute(self.Schema.LOG):
@@ -830,7 +920,7 @@ class GRRHunt(flow.GRRFlow):
 
   def PrintErrors(self, client_id=None):
     if not client_id:
-      self._List(self.Schema.ERRORS)
+      self._List(self.GetValuesForAttribute(self.Schema.ERRORS))
       return
 
     for error in self.GetValuesForAttribute(self.Schema.ERRORS):
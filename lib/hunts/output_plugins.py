@@ -3,15 +3,18 @@
 
 
 
+import os
 import threading
 import urllib
 
 from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import email_alerts
+from grr.lib import export_pipeline
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import rendering
+from grr.lib import type_info
 from grr.lib import utils
 from grr.proto import flows_pb2
 
@@ -184,6 +187,97 @@ class EmailPlugin(HuntOutputPlugin):
       self.ProcessResponse(response)
 
 
+class LocalExportPluginArgs(rdfvalue.RDFProtoStruct):
+  """Arguments for the LocalExportPlugin."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoString(
+          name="output_dir", field_number=1,
+          description="The directory the files are written to, relative to "
+          "LocalExport.root."),
+      type_info.ProtoString(
+          name="format", field_number=2, default="columnar",
+          description="The file format: columnar, csv or jsonl."),
+      type_info.ProtoEmbedded(
+          name="export_options", field_number=3, nested="ExportOptions",
+          description="Options passed to the export converters."),
+      type_info.ProtoUnsignedInteger(
+          name="row_group_size", field_number=4, default=10000,
+          description="The number of rows of each type buffered before they "
+          "are written."),
+      )
+
+
+class LocalExportPlugin(HuntOutputPlugin):
+  """An output plugin that writes results into one file per exported type."""
+
+  name = "local_export"
+  description = "Export results into local csv, jsonl or columnar files."
+  args_type = LocalExportPluginArgs
+
+  def __init__(self, *args, **kwargs):
+    super(LocalExportPlugin, self).__init__(*args, **kwargs)
+    self.exporter = None
+
+  def Initialize(self):
+    # Reject bad directories when the hunt is created.
+    self.GetOutputDir(self.state.args)
+
+    self.state.Register("rows_written", 0)
+    super(LocalExportPlugin, self).Initialize()
+
+  @staticmethod
+  def GetOutputDir(args):
+    """Returns the directory to write to, inside LocalExport.root.
+
+    Args:
+      args: The LocalExportPluginArgs.
+
+    Returns:
+      The absolute path of the output directory.
+
+    Raises:
+      ValueError: If the output directory is not a relative path inside the
+        export root.
+    """
+    output_dir = args.output_dir
+    if (not output_dir or os.path.isabs(output_dir) or
+        ".." in output_dir.replace("\\", "/").split("/")):
+      raise ValueError("The export directory must be a relative path without "
+                       "'..': %s" % output_dir)
+
+    # Symlinks must not lead out of the root either.
+    root = os.path.realpath(config_lib.CONFIG["LocalExport.root"])
+    path = os.path.realpath(os.path.join(root, output_dir))
+    if not path.startswith(root + os.sep):
+      raise ValueError("The export directory is outside of %s: %s" % (
+          root, output_dir))
+
+    return path
+
+  def _CreateExporter(self):
+    return export_pipeline.StreamingExporter(
+        self.GetOutputDir(self.args), export_format=self.args.format,
+        options=self.args.export_options,
+        row_group_size=self.args.row_group_size, token=self.token)
+
+  @utils.Synchronized
+  def ProcessResponses(self, responses):
+    if self.exporter is None:
+      self.exporter = self._CreateExporter()
+
+    metadata = rdfvalue.ExportedMetadata(
+        source_urn=self.state.collection_urn,
+        timestamp=rdfvalue.RDFDatetime().Now())
+    self.exporter.AddValues((metadata, response) for response in responses)
+
+  def Flush(self):
+    if self.exporter is not None:
+      self.exporter.Close()
+      self.state.rows_written += sum(self.exporter.row_counts.itervalues())
+      self.exporter = None
+
+
 class OutputPlugin(rdfvalue.RDFProtoStruct):
   """A proto describing the output plugin to create."""
   protobuf = flows_pb2.OutputPlugin
@@ -2,6 +2,7 @@
 """Tests for hunts output plugins."""
 
 
+import os
 
 
 # pylint: disable=unused-import,g-bad-import-order
@@ -11,10 +12,12 @@ from grr.lib import server_plugins
 from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import email_alerts
+from grr.lib import export_pipeline
 from grr.lib import flags
 from grr.lib import hunts
 from grr.lib import rdfvalue
 from grr.lib import test_lib
+from grr.lib.hunts import output_plugins
 
 
 class OutputPluginsTest(test_lib.FlowTestsBaseclass):
@@ -94,8 +97,8 @@ class OutputPluginsTest(test_lib.FlowTestsBaseclass):
       hunt_obj = aff4.FACTORY.Open(hunt_urn, age=aff4.ALL_TIMES,
                                    token=self.token)
 
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       self.assertEqual(len(set(started)), 40)
@@ -120,6 +123,47 @@ class OutputPluginsTest(test_lib.FlowTestsBaseclass):
       self.assertTrue("sending of emails will be disabled now"
                       in self.email_messages[-1]["message"])
 
+  def testLocalExportPlugin(self):
+    config_lib.CONFIG.Set("LocalExport.root", self.temp_dir)
+    output_dir = os.path.join(self.temp_dir, "export")
+    hunt_urn = self.RunHunt("LocalExportPlugin", rdfvalue.LocalExportPluginArgs(
+        output_dir="export", format="columnar"))
+
+    # Half of the clients return a StatEntry, exported as an ExportedFile.
+    self.assertEqual(os.listdir(output_dir), ["ExportedFile.columnar"])
+
+    reader = export_pipeline.ColumnarReader(
+        os.path.join(output_dir, "ExportedFile.columnar"))
+    rows = list(reader.ReadRows(columns=["metadata.client_urn",
+                                         "metadata.source_urn", "urn"]))
+    self.assertEqual(len(rows), 20)
+    self.assertEqual(len(set(row["metadata.client_urn"] for row in rows)), 20)
+    for row in rows:
+      self.assertEqual(row["metadata.source_urn"],
+                       str(hunt_urn.Add("Results")))
+      self.assertTrue(row["urn"].endswith("fs/os/tmp/evil.txt"))
+
+  def testLocalExportPluginOnlyWritesInsideTheExportRoot(self):
+    config_lib.CONFIG.Set("LocalExport.root", self.temp_dir)
+
+    for output_dir in ["", "/tmp/export", "../export", "export/../../x"]:
+      self.assertRaises(
+          ValueError, output_plugins.LocalExportPlugin, "aff4:/hunts/Results",
+          args=rdfvalue.LocalExportPluginArgs(output_dir=output_dir),
+          token=self.token)
+
+    # Symlinks can't lead out of the root either.
+    os.symlink("/tmp", os.path.join(self.temp_dir, "link"))
+    self.assertRaises(
+        ValueError, output_plugins.LocalExportPlugin, "aff4:/hunts/Results",
+        args=rdfvalue.LocalExportPluginArgs(output_dir="link/export"),
+        token=self.token)
+
+    self.assertEqual(
+        output_plugins.LocalExportPlugin.GetOutputDir(
+            rdfvalue.LocalExportPluginArgs(output_dir="hunts/export")),
+        os.path.join(os.path.realpath(self.temp_dir), "hunts", "export"))
+
 
 class FlowTestLoader(test_lib.GRRTestLoader):
   base_class = test_lib.FlowTestsBaseclass
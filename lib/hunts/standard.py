@@ -5,6 +5,7 @@
 
 
 
+import Queue
 import re
 import stat
 
@@ -14,6 +15,7 @@ from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import threadpool
 from grr.lib import utils
 from grr.lib.aff4_objects import cronjobs
 from grr.lib.hunts import implementation
@@ -601,7 +603,17 @@ class RunKeysHunt(implementation.GRRHunt):
 
 
 class HuntResultsMetadata(aff4.AFF4Object):
-  """Metadata AFF4 object used by CronHuntOutputFlow."""
+  """Metadata AFF4 object used by CronHuntOutputFlow.
+
+  OUTPUT_PLUGINS holds the output plugins of the hunt. The
+  ProcessHuntResultsCronFlow checkpoints the state and progress of each plugin
+  in its own predicate (CHECKPOINT_PREFIX + plugin name) after every batch, so
+  plugins move through the results independently. The attributes below are
+  only updated at the end of a run, and are used by plugins which have no
+  checkpoint yet.
+  """
+
+  CHECKPOINT_PREFIX = "output_plugin:checkpoint/"
 
   class SchemaCls(aff4.AFF4Object.SchemaCls):
     """AFF4 schema for CronHuntOutputMetadata."""
@@ -623,13 +635,48 @@ class HuntResultsMetadata(aff4.AFF4Object):
         "aff4:output_plugins_state", rdfvalue.FlowState,
         "Pickled output plugins.", versioned=False)
 
+  def ReadPluginCheckpoint(self, plugin_name):
+    """Returns the checkpoint of an output plugin as a FlowState or None."""
+    value, _ = data_store.DB.Resolve(
+        self.urn, self.CHECKPOINT_PREFIX + plugin_name, token=self.token)
+    if value is None:
+      return None
+
+    return rdfvalue.FlowState(value)
+
+  def WritePluginCheckpoint(self, plugin_name, state, offset, num_processed):
+    """Checkpoints the state and progress of an output plugin.
+
+    Args:
+      plugin_name: The name of the plugin in OUTPUT_PLUGINS.
+      state: The plugin's state.
+      offset: The raw offset in the results collection after the last result
+        processed by the plugin.
+      num_processed: The number of results processed by the plugin.
+    """
+    checkpoint = rdfvalue.FlowState()
+    checkpoint.Register("state", state)
+    checkpoint.Register("offset", offset)
+    checkpoint.Register("num_processed", num_processed)
+
+    data_store.DB.Set(self.urn, self.CHECKPOINT_PREFIX + plugin_name,
+                      checkpoint.SerializeToString(), sync=True,
+                      token=self.token)
+
 
 class ProcessHuntResultsCronFlowArgs(rdfvalue.RDFProtoStruct):
   protobuf = flows_pb2.ProcessHuntResultsCronFlowArgs
 
 
 class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
-  """Periodic cron flow that processes hunts results with output plugins."""
+  """Periodic cron flow that processes hunts results with output plugins.
+
+  Every output plugin of every hunt with new results is run as its own task on
+  a thread pool, so a slow or failing plugin doesn't hold up the others. Each
+  task reads the results from the plugin's own offset and checkpoints the
+  plugin after every batch, so at most one batch is processed again if this
+  flow dies.
+  """
   frequency = rdfvalue.Duration("5m")
   lifetime = rdfvalue.Duration("40m")
 
@@ -637,80 +684,198 @@ class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
 
   DEFAULT_BATCH_SIZE = 1000
 
-  def ProcessHunt(self, session_id):
-    metadata_urn = session_id.Add("ResultsMetadata")
-    last_exception = None
+  THREAD_POOL_NAME = "HuntResultsProcessor"
+  MAX_THREADS = 10
 
-    with aff4.FACTORY.Open(
-        metadata_urn, mode="rw", token=self.token) as metadata_obj:
+  def _IsOverTime(self):
+    """Returns True if this flow is running for more than max_running_time."""
+    if not self.state.args.max_running_time:
+      return False
 
-      output_plugins = metadata_obj.Get(metadata_obj.Schema.OUTPUT_PLUGINS)
+    elapsed = (rdfvalue.RDFDatetime().Now().AsSecondsFromEpoch() -
+               self.start_time.AsSecondsFromEpoch())
+    return elapsed > self.state.args.max_running_time
+
+  def ProcessPlugin(self, session_id, metadata_obj, plugin_name, plugin_def,
+                    initial_state):
+    """Runs one output plugin over the new results of a hunt.
+
+    Args:
+      session_id: The urn of the hunt.
+      metadata_obj: The hunt's HuntResultsMetadata.
+      plugin_name: The name of the plugin in OUTPUT_PLUGINS.
+      plugin_def: The plugin's rdfvalue.OutputPlugin.
+      initial_state: The plugin's state in OUTPUT_PLUGINS.
+
+    Returns:
+      A tuple of the plugin's state, the number of results it has processed,
+      the raw collection offset it has reached, whether it has reached the end
+      of the results and a list of the exceptions raised by the plugin.
+    """
+    checkpoint = metadata_obj.ReadPluginCheckpoint(plugin_name)
+    if checkpoint is not None:
+      state = checkpoint.state
+      offset = checkpoint.offset
+      num_processed = checkpoint.num_processed
+    else:
+      state = initial_state
+      offset = int(metadata_obj.Get(metadata_obj.Schema.COLLECTION_RAW_OFFSET))
       num_processed = int(metadata_obj.Get(
           metadata_obj.Schema.NUM_PROCESSED_RESULTS))
-      raw_offset = int(metadata_obj.Get(
-          metadata_obj.Schema.COLLECTION_RAW_OFFSET))
-      results = aff4.FACTORY.Open(session_id.Add("Results"), mode="r",
-                                  token=self.token)
-
-      batch_size = self.state.args.batch_size or self.DEFAULT_BATCH_SIZE
-      batches = utils.Grouper(results.GenerateItems(offset=raw_offset),
-                              batch_size)
-
-      used_plugins = {}
-      for batch_index, batch in enumerate(batches):
-        if not used_plugins:
-          for plugin_name, (plugin_def,
-                            state) in output_plugins.data.iteritems():
-            used_plugins[plugin_name] = plugin_def.GetPluginForState(state)
-
-        # If this flow is working for more than max_running_time - stop
-        # processing.
-        if self.state.args.max_running_time:
-          elapsed = (rdfvalue.RDFDatetime().Now().AsSecondsFromEpoch() -
-                     self.start_time.AsSecondsFromEpoch())
-          if elapsed > self.state.args.max_running_time:
-            self.Log("Running for too long, skipping rest of batches for %s.",
-                     session_id)
-            break
 
-        batch = list(batch)
-        num_processed += len(batch)
+    plugin = plugin_def.GetPluginForState(state)
+    results = aff4.FACTORY.Open(session_id.Add("Results"), mode="r",
+                                token=self.token)
 
-        for plugin_name, plugin in used_plugins.iteritems():
-          logging.debug("Processing hunt %s with %s, batch %d", session_id,
-                        plugin_name, batch_index)
+    batch_size = self.state.args.batch_size or self.DEFAULT_BATCH_SIZE
+    batches = utils.Grouper(results.GenerateItems(offset=offset), batch_size)
 
-          try:
-            plugin.ProcessResponses(batch)
-          except Exception as e:  # pylint: disable=broad-except
-            logging.exception("Error processing hunt results: hunt %s, "
-                              "plugin %s, batch %d", session_id, plugin_name,
-                              batch_index)
-            self.Log("Error processing hunt results (hunt %s, "
-                     "plugin %s, batch %d): %s" %
-                     (session_id, plugin_name, batch_index, e))
-            last_exception = e
+    errors = []
+    for batch_index, batch in enumerate(batches):
+      logging.debug("Processing hunt %s with %s, batch %d", session_id,
+                    plugin_name, batch_index)
+
+      # The plugin is flushed after every batch so its state can be
+      # checkpointed. A failing batch is not retried.
+      try:
+        plugin.ProcessResponses(batch)
+        plugin.Flush()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error processing hunt results: hunt %s, "
+                          "plugin %s, batch %d", session_id, plugin_name,
+                          batch_index)
+        errors.append(e)
+
+      offset = results.current_offset
+      num_processed += len(batch)
+      metadata_obj.WritePluginCheckpoint(plugin_name, plugin.state, offset,
+                                         num_processed)
+
+      # If this flow is working for more than max_running_time - stop
+      # processing. The remaining results are processed by the next run.
+      if self._IsOverTime():
+        logging.info("Running for too long, skipping rest of batches of %s "
+                     "for %s.", plugin_name, session_id)
+        return plugin.state, num_processed, offset, False, errors
+
+    return plugin.state, num_processed, offset, True, errors
+
+  def _ProcessPluginTask(self, session_id, metadata_obj, plugin_name,
+                         plugin_def, state, results):
+    try:
+      result = self.ProcessPlugin(session_id, metadata_obj, plugin_name,
+                                  plugin_def, state)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error processing hunt %s with %s.", session_id,
+                        plugin_name)
+      result = e
+
+    results.put((session_id, plugin_name, result))
+
+  def _WaitForPluginResult(self, results, hunts):
+    """Waits for a plugin task to finish, keeping our lease meanwhile."""
+    while True:
+      try:
+        session_id, plugin_name, result = results.get(timeout=60)
+        break
+      except Queue.Empty:
         self.HeartBeat()
 
-      for plugin in used_plugins.itervalues():
-        try:
-          plugin.Flush()
-        except Exception as e:  # pylint: disable=broad-except
-          logging.exception("Error flushing hunt results: hunt %s, "
-                            "plugin %s", session_id, str(plugin))
-          self.Log("Error processing hunt results (hunt %s, "
-                   "plugin %s): %s" % (session_id, str(plugin), e))
+    hunts[session_id][2][plugin_name] = result
+
+  def ProcessHunts(self, session_ids):
+    """Runs the output plugins of some hunts in parallel.
+
+    Args:
+      session_ids: The urns of the hunts.
+
+    Returns:
+      A dict of session id -> (finished, last exception). finished is False if
+      some plugins of the hunt stopped before the end of its results, because
+      this flow ran out of time or the plugin's task failed.
+    """
+    hunts = {}
+    tasks = []
+    for session_id in session_ids:
+      try:
+        metadata_obj = aff4.FACTORY.Open(session_id.Add("ResultsMetadata"),
+                                         mode="rw", token=self.token)
+        output_plugins = metadata_obj.Get(metadata_obj.Schema.OUTPUT_PLUGINS)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error processing hunt %s.", session_id)
+        self.Log("Error processing hunt %s: %s", session_id, e)
+        hunts[session_id] = (None, None, {}, e)
+        continue
+
+      hunts[session_id] = (metadata_obj, output_plugins, {}, None)
+      if output_plugins:
+        for plugin_name, (plugin_def,
+                          state) in output_plugins.data.iteritems():
+          tasks.append((session_id, metadata_obj, plugin_name, plugin_def,
+                        state))
+
+    results = Queue.Queue()
+    pending = 0
+    if tasks:
+      pool = threadpool.ThreadPool.Factory(self.THREAD_POOL_NAME,
+                                           self.MAX_THREADS)
+      pool.Start()
+
+      for task in tasks:
+        while True:
+          # Never run a plugin inline: this thread has to keep our lease.
+          try:
+            pool.AddTask(target=self._ProcessPluginTask,
+                         args=task + (results,), name=self.THREAD_POOL_NAME,
+                         blocking=False, inline=False)
+            pending += 1
+            break
+          except threadpool.Full:
+            self._WaitForPluginResult(results, hunts)
+            pending -= 1
+
+    for _ in xrange(pending):
+      self._WaitForPluginResult(results, hunts)
+
+    status = {}
+    for session_id, (metadata_obj, output_plugins, plugin_results,
+                     last_exception) in hunts.iteritems():
+      finished = True
+      progress = []
+      for plugin_name, result in sorted(plugin_results.iteritems()):
+        if isinstance(result, Exception):
+          self.Log("Error processing hunt %s with %s: %s", session_id,
+                   plugin_name, result)
+          last_exception = result
+          finished = False
+          continue
+
+        state, num_processed, offset, plugin_finished, errors = result
+        plugin_def = output_plugins.data[plugin_name][0]
+        output_plugins.data[plugin_name] = (plugin_def, state)
+        progress.append((num_processed, offset))
+        finished = finished and plugin_finished
+
+        for e in errors:
+          self.Log("Error processing hunt results (hunt %s, plugin %s): %s",
+                   session_id, plugin_name, e)
           last_exception = e
 
-      metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(output_plugins))
-      metadata_obj.Set(metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
-      metadata_obj.Set(metadata_obj.Schema.COLLECTION_RAW_OFFSET(
-          results.current_offset))
+      if metadata_obj is not None:
+        # The progress of the slowest plugin is used by plugins without a
+        # checkpoint.
+        if progress:
+          num_processed, offset = min(progress)
+          metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(output_plugins))
+          metadata_obj.Set(
+              metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
+          metadata_obj.Set(metadata_obj.Schema.COLLECTION_RAW_OFFSET(offset))
+
+        metadata_obj.Close()
 
-      # TODO(user): throw proper exception which will contain all the
-      # exceptions that were raised while processing this hunt.
-      if last_exception:
-        raise last_exception  # pylint: disable=raising-bad-type
+      status[session_id] = (finished, last_exception)
+
+    return status
 
   @flow.StateHandler()
   def Start(self):
@@ -721,42 +886,46 @@ class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
       self.state.args.max_running_time = rdfvalue.Duration(
           "%ds" % int(ProcessHuntResultsCronFlow.lifetime.seconds * 0.6))
 
-    last_exception = None
     self.start_time = rdfvalue.RDFDatetime().Now()
+
+    notifications = {}
     for session_id, timestamp, _ in data_store.DB.ResolveRegex(
         GenericHunt.RESULTS_QUEUE, ".*", token=self.token):
-
       logging.info("Found new results for hunt %s.", session_id)
-      try:
-        self.ProcessHunt(rdfvalue.RDFURN(session_id))
-        self.HeartBeat()
+      notifications[rdfvalue.RDFURN(session_id)] = (session_id, timestamp)
 
-      except Exception as e:  # pylint: disable=broad-except
-        logging.exception("Error processing hunt %s.", session_id)
-        self.Log("Error processing hunt %s: %s", session_id, e)
-        last_exception = e
-
-      # We will delete hunt's results notification even if ProcessHunt has
-      # failed
-      finally:
-        results = data_store.DB.ResolveRegex(
-            GenericHunt.RESULTS_QUEUE, session_id, token=self.token)
-        if results and len(results) == 1:
-          _, latest_timestamp, _ = results[0]
-        else:
-          logging.warning("Inconsistent state in hunt results queue for "
-                          "hunt %s", session_id)
-          latest_timestamp = None
-
-        # We don't want to delete notification that was written after we
-        # started processing.
-        if latest_timestamp and latest_timestamp > timestamp:
-          logging.debug("Not deleting results notification: it was written "
-                        "after processing has started.")
-        else:
-          data_store.DB.DeleteAttributes(GenericHunt.RESULTS_QUEUE,
-                                         [session_id], sync=True,
-                                         token=self.token)
+    last_exception = None
+    for session_id, (finished, exception) in self.ProcessHunts(
+        sorted(notifications)).iteritems():
+      predicate, timestamp = notifications[session_id]
+      if exception is not None:
+        last_exception = exception
+
+      # Hunts with unprocessed results keep their notification, so the next
+      # run picks them up.
+      if not finished:
+        continue
+
+      # We will delete hunt's results notification even if the plugins have
+      # failed on some batches.
+      results = data_store.DB.ResolveRegex(
+          GenericHunt.RESULTS_QUEUE, predicate, token=self.token)
+      if results and len(results) == 1:
+        _, latest_timestamp, _ = results[0]
+      else:
+        logging.warning("Inconsistent state in hunt results queue for "
+                        "hunt %s", session_id)
+        latest_timestamp = None
+
+      # We don't want to delete notification that was written after we
+      # started processing.
+      if latest_timestamp and latest_timestamp > timestamp:
+        logging.debug("Not deleting results notification: it was written "
+                      "after processing has started.")
+      else:
+        data_store.DB.DeleteAttributes(GenericHunt.RESULTS_QUEUE,
+                                       [predicate], sync=True,
+                                       token=self.token)
 
     # TODO(user): throw proper exception which will contain all the
     # exceptions that were raised while processing the hunts.
@@ -849,8 +1018,8 @@ class GenericHunt(implementation.GRRHunt):
       A list of flow URNs.
     """
     result = None
-    all_clients = set(self.GetValuesForAttribute(self.Schema.CLIENTS))
-    finished_clients = set(self.GetValuesForAttribute(self.Schema.FINISHED))
+    all_clients = set(self.GetClients())
+    finished_clients = set(self.GetCompletedClients())
     outstanding_clients = all_clients - finished_clients
 
     if flow_type == "all":
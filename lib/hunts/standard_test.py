@@ -4,6 +4,7 @@
 
 
 import math
+import threading
 import time
 
 
@@ -18,6 +19,7 @@ from grr.lib import hunts
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib.hunts import output_plugins
+from grr.lib.hunts import standard
 
 
 class DummyHuntOutputPlugin(output_plugins.HuntOutputPlugin):
@@ -55,6 +57,14 @@ class LongRunningDummyHuntOutputPlugin(output_plugins.HuntOutputPlugin):
     time.time = lambda: 100
 
 
+class ThreadRecordingDummyHuntOutputPlugin(output_plugins.HuntOutputPlugin):
+  threads = []
+
+  def ProcessResponses(self, unused_responses):
+    ThreadRecordingDummyHuntOutputPlugin.threads.append(
+        threading.current_thread())
+
+
 class StandardHuntTest(test_lib.FlowTestsBaseclass):
   """Tests the Hunt."""
 
@@ -67,6 +77,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     DummyHuntOutputPlugin.num_responses = 0
     StatefulDummyHuntOutputPlugin.data = []
     LongRunningDummyHuntOutputPlugin.num_calls = 0
+    ThreadRecordingDummyHuntOutputPlugin.threads = []
 
     with test_lib.FakeTime(0):
       # Clean up the foreman to remove any rules.
@@ -128,8 +139,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
 
     with aff4.FACTORY.Open(hunt_urn, age=aff4.ALL_TIMES,
                            token=self.token) as hunt_obj:
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       self.assertEqual(len(set(started)), 10)
@@ -190,6 +201,23 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(DummyHuntOutputPlugin.num_calls, 2)
     self.assertEqual(DummyHuntOutputPlugin.num_responses, 10)
 
+  def testOutputPluginsNeverRunInTheFlowThread(self):
+    self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
+        plugin_name="ThreadRecordingDummyHuntOutputPlugin")] * 5)
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    # A single worker gets a full queue, so the flow has to wait for it.
+    with test_lib.MultiStubber(
+        (standard.ProcessHuntResultsCronFlow, "THREAD_POOL_NAME",
+         "HuntResultsProcessorTest"),
+        (standard.ProcessHuntResultsCronFlow, "MAX_THREADS", 1)):
+      self.ProcessHuntOutputPlugins()
+
+    threads = ThreadRecordingDummyHuntOutputPlugin.threads
+    self.assertEqual(len(threads), 5)
+    self.assertFalse(threading.current_thread() in threads)
+
   def testFailingOutputPluginDoesNotAffectOtherOutputPlugins(self):
     self.StartHunt(output_plugins=[
         rdfvalue.OutputPlugin(plugin_name="FailingDummyHuntOutputPlugin"),
@@ -296,6 +324,80 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
       # In normal conditions, there should be 10 results generated.
       self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 10)
 
+  def testProcessHuntResultsCronFlowResumesAfterRunningTooLong(self):
+    test = [0]
+    def TimeStub():
+      test[0] += 1e-6
+      return test[0]
+
+    with test_lib.Stubber(time, "time", TimeStub):
+      self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
+          plugin_name="LongRunningDummyHuntOutputPlugin")])
+      self.AssignTasksToClients()
+      self.RunHunt(failrate=-1)
+
+      self.ProcessHuntOutputPlugins(batch_size=1,
+                                    max_running_time=rdfvalue.Duration("99s"))
+      self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 1)
+
+      # The hunt still has unprocessed results, so the next run continues
+      # where the plugin stopped even though no new results have arrived.
+      self.ProcessHuntOutputPlugins(batch_size=1)
+      self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 10)
+
+  def testOutputPluginsAreCheckpointedAfterEveryBatch(self):
+    self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
+        plugin_name="StatefulDummyHuntOutputPlugin")])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    original = standard.HuntResultsMetadata.WritePluginCheckpoint
+    calls = [0]
+    def WritePluginCheckpointStub(metadata_obj, *args):
+      calls[0] += 1
+      if calls[0] == 3:
+        raise RuntimeError("Lost the lease.")
+      original(metadata_obj, *args)
+
+    with test_lib.Stubber(standard.HuntResultsMetadata,
+                          "WritePluginCheckpoint", WritePluginCheckpointStub):
+      self.assertRaises(RuntimeError, self.ProcessHuntOutputPlugins,
+                        batch_size=2)
+
+    self.assertListEqual(StatefulDummyHuntOutputPlugin.data, [0, 1, 2])
+
+    # Only the batch which was not checkpointed is processed again.
+    self.ProcessHuntOutputPlugins(batch_size=2)
+    self.assertListEqual(StatefulDummyHuntOutputPlugin.data,
+                         [0, 1, 2, 2, 3, 4])
+
+  def testOutputPluginsOfDifferentHuntsProgressIndependently(self):
+    self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
+        plugin_name="LongRunningDummyHuntOutputPlugin")])
+    self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
+        plugin_name="DummyHuntOutputPlugin")])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    test = [0]
+    def TimeStub():
+      test[0] += 1e-6
+      return test[0]
+
+    with test_lib.Stubber(time, "time", TimeStub):
+      self.ProcessHuntOutputPlugins(batch_size=1,
+                                    max_running_time=rdfvalue.Duration("99s"))
+
+      # The slow plugin stopped after its first batch. The other plugin ran
+      # concurrently and kept its own progress.
+      self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 1)
+      self.assertTrue(DummyHuntOutputPlugin.num_calls >= 1)
+
+      self.ProcessHuntOutputPlugins(batch_size=1)
+      self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 10)
+      self.assertEqual(DummyHuntOutputPlugin.num_calls, 10)
+      self.assertEqual(DummyHuntOutputPlugin.num_responses, 10)
+
   def testHuntResultsArrivingWhileOldResultsAreProcessedAreHandled(self):
     self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
         plugin_name="DummyHuntOutputPlugin")])
@@ -368,8 +470,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.session_id, age=aff4.ALL_TIMES,
                                  token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
     errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
     self.assertEqual(len(set(started)), 2)
@@ -408,8 +510,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
       hunt_obj = aff4.FACTORY.Open(hunt.session_id, age=aff4.ALL_TIMES,
                                    token=self.token)
 
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       self.assertEqual(len(set(started)), 5)
@@ -460,8 +562,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
       test_lib.TestHuntHelper(client_mock, self.client_ids,
                               check_flow_errors=False, token=self.token)
 
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       # No client should be processed since the hunt is expired.
@@ -512,7 +614,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt_session_id, age=aff4.ALL_TIMES,
                                  ignore_cache=True, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
+    started = hunt_obj.GetClients()
 
     # There should be only one client, due to the limit
     self.assertEqual(len(set(started)), 1)
@@ -537,7 +639,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
 
     hunt_obj = aff4.FACTORY.Open(hunt_session_id, age=aff4.ALL_TIMES,
                                  token=self.token)
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
+    started = hunt_obj.GetClients()
     # There should be only one client, due to the limit
     self.assertEqual(len(set(started)), 10)
 
@@ -2,6 +2,7 @@
 """Loads up all hunts tests."""
 
 # These need to register tests so, pylint: disable=unused-import
+from grr.lib.hunts import client_sets_test
 from grr.lib.hunts import output_plugins_test
 from grr.lib.hunts import standard_test
 # pylint: enable=unused-import
@@ -3,6 +3,7 @@
 
 
 
+import hashlib
 import logging
 import os
 import random
@@ -21,6 +22,12 @@ config_lib.DEFINE_integer("Worker.queue_shards", 1,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_integer("Worker.shard_lease_time", 60,
+                          "Workers renew their lease on the queue notification "
+                          "shards within this many seconds. Shards of workers "
+                          "whose lease expired are given to the other "
+                          "workers.")
+
 
 class Error(Exception):
   """Base class for errors in this module."""
@@ -87,6 +94,10 @@ class QueueManager(object):
   TASK_PREDICATE_PREFIX = "task:%s"
   NOTIFY_PREDICATE_PREFIX = "notify:%s"
 
+  # Events queued for a well known flow with QueueEvent() are written as one
+  # response with this name, carrying the events in a MessageList.
+  EVENT_BATCH_NAME = "EventBatch"
+
   request_limit = 1000000
   response_limit = 1000000
 
@@ -110,6 +121,9 @@ class QueueManager(object):
     self.new_client_messages = []
     self.notifications = {}
 
+    # Events to be batched, by the session id of the well known flow.
+    self.events = {}
+
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
@@ -120,16 +134,18 @@ class QueueManager(object):
         QueueManager.notification_shard_counter % self.num_notification_shards)
 
   def GetNotificationShard(self, queue):
-    if self.notification_shard_index > 0:
-      return queue.Add(str(self.notification_shard_index))
+    return self.GetNotificationShardByIndex(queue,
+                                            self.notification_shard_index)
+
+  def GetNotificationShardByIndex(self, queue, index):
+    if index > 0:
+      return queue.Add(str(index))
     else:
       return queue
 
   def GetAllNotificationShards(self, queue):
-    result = [queue]
-    for i in range(1, self.num_notification_shards):
-      result.append(queue.Add(str(i)))
-    return result
+    return [self.GetNotificationShardByIndex(queue, i)
+            for i in range(self.num_notification_shards)]
 
   def Copy(self):
     """Return a copy of the queue mananger.
@@ -338,6 +354,8 @@ class QueueManager(object):
 
   def Flush(self):
     """Writes the changes in this object to the datastore."""
+    self._QueueEventBatches()
+
     session_ids = set(self.to_write) | set(self.to_delete)
     for session_id in session_ids:
       try:
@@ -359,7 +377,14 @@ class QueueManager(object):
       self.data_store.Flush()
 
     for session_id, notifications in self.notifications.items():
+      # A session is notified once for each timestamp, with the highest
+      # priority requested for it.
+      priorities = {}
       for priority, timestamp in notifications:
+        priorities[timestamp] = max(priority, priorities.get(timestamp,
+                                                             priority))
+
+      for timestamp, priority in priorities.iteritems():
         self.NotifyQueue(
             session_id, timestamp=timestamp, sync=False, priority=priority)
 
@@ -396,6 +421,40 @@ class QueueManager(object):
             response.request_id, response.response_id),
         []).append((response.SerializeToString(), timestamp))
 
+  def QueueEvent(self, session_id, message):
+    """Queues an event message for a well known flow.
+
+    All the events queued for a flow until the next Flush() are written as a
+    single response, see WellKnownFlow.UnpackEventBatches().
+
+    Args:
+      session_id: The session id of the well known flow.
+      message: The GrrMessage carrying the event.
+    """
+    self.events.setdefault(session_id, []).append(message)
+
+  def _QueueEventBatches(self):
+    """Queues the responses and notifications for the batched events."""
+    for session_id, messages in self.events.iteritems():
+      if len(messages) == 1:
+        batch = messages[0]
+      else:
+        message_list = rdfvalue.MessageList()
+        for message in messages:
+          message_list.job.Append(message)
+
+        batch = rdfvalue.GrrMessage(
+            session_id=session_id, name=self.EVENT_BATCH_NAME, request_id=0,
+            payload=message_list,
+            priority=max(message.priority for message in messages),
+            auth_state=rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
+        batch.response_id = batch.task_id = batch.GenerateTaskID()
+
+      self.QueueResponse(session_id, batch)
+      self.QueueNotification(session_id, priority=batch.priority)
+
+    self.events = {}
+
   def QueueRequest(self, session_id, request_state, timestamp=None):
     # TODO(user): remove int() conversion when datastores accept
     # RDFDatetime instead of ints.
@@ -467,23 +526,42 @@ class QueueManager(object):
             queue, to_schedule, timestamp=timestamp, sync=sync,
             token=self.token)
 
-  def GetSessionsFromQueue(self, queue):
-    """Retrieves candidate session ids for processing from the datastore."""
+  def GetSessionsFromQueue(self, queue, shard_indexes=None):
+    """Retrieves candidate session ids for processing from the datastore.
+
+    Args:
+      queue: The queue to read the notifications of.
+      shard_indexes: The indexes of the notification shards to read. By default
+        only the shard used by this queue manager is read.
+
+    Returns:
+      A list of session ids, highest priority first.
+    """
+    if shard_indexes is None:
+      shard_indexes = [self.notification_shard_index]
 
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
     sessions_by_priority = {}
-    for predicate, priority, _ in data_store.DB.ResolveRegex(
-        self.GetNotificationShard(queue), self.NOTIFY_PREDICATE_PREFIX % ".*",
-        # TODO(user): remove int() conversion when datastores accept
-        # RDFDatetime instead of ints.
-        timestamp=(0,
-                   int(self.frozen_timestamp or rdfvalue.RDFDatetime().Now())),
-        token=self.token, limit=10000):
-      # Strip the prefix from the predicate.
-      predicate = predicate[len(self.NOTIFY_PREDICATE_PREFIX % ""):]
-
-      sessions_by_priority.setdefault(priority, []).append(predicate)
+    for index in shard_indexes:
+      shard = self.GetNotificationShardByIndex(queue, index)
+      backlog = 0
+      for predicate, priority, _ in data_store.DB.ResolveRegex(
+          shard, self.NOTIFY_PREDICATE_PREFIX % ".*",
+          # TODO(user): remove int() conversion when datastores accept
+          # RDFDatetime instead of ints.
+          timestamp=(0,
+                     int(self.frozen_timestamp or
+                         rdfvalue.RDFDatetime().Now())),
+          token=self.token, limit=10000):
+        # Strip the prefix from the predicate.
+        predicate = predicate[len(self.NOTIFY_PREDICATE_PREFIX % ""):]
+
+        sessions_by_priority.setdefault(priority, []).append(predicate)
+        backlog += 1
+
+      stats.STATS.SetGaugeValue("grr_notification_shard_backlog", backlog,
+                                fields=[str(shard)])
 
     # We want to return the sessions by order of priority,
     # but with all sessions at the same priority randomly shuffled.
@@ -581,7 +659,7 @@ class QueueManager(object):
 
     for _, serialized, ts in self.data_store.ResolveRegex(
         queue, regex, timestamp=self.data_store.ALL_TIMESTAMPS,
-        token=self.token):
+        token=self.token, limit=None):
       task = rdfvalue.GrrMessage(serialized)
       task.eta = ts
       all_tasks.append(task)
@@ -626,46 +704,76 @@ class QueueManager(object):
 
   def _QueryAndOwn(self, transaction, lease_seconds=100,
                    limit=1, user=""):
-    """Does the real work of self.QueryAndOwn()."""
-    tasks = []
+    """Does the real work of self.QueryAndOwn().
+
+    The tasks are leased in order of priority. Not all data stores return
+    them sorted by predicate, so they are sorted here. All the leases and the
+    removal of tasks which ran out of retransmissions are written in a single
+    MultiSet while we hold the queue lock.
+
+    Args:
+      transaction: The transaction holding the lock on the queue.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of tasks to lease.
+      user: The user leasing the tasks, recorded in the tasks.
 
-    lease = long(lease_seconds * 1e6)
+    Returns:
+      A list of GrrMessage() objects leased.
+    """
+    tasks = []
+    to_lease = {}
+    to_delete = []
 
-    ttl_exceeded_count = 0
+    lease_timestamp = long(time.time() * 1e6) + long(lease_seconds * 1e6)
+    last_lease = "%s@%s:%d" % (user, socket.gethostname(), os.getpid())
 
-    # Only grab attributes with timestamps in the past.
-    for predicate, task, timestamp in transaction.ResolveRegex(
-        self.TASK_PREDICATE_PREFIX % ".*",
+    # Only grab attributes with timestamps in the past, i.e. tasks which are
+    # not currently leased.
+    all_tasks = []
+    for predicate, serialized, timestamp in self.data_store.ResolveRegex(
+        transaction.subject, self.TASK_PREDICATE_PREFIX % ".*",
         timestamp=(0,
                    # TODO(user): remove int() conversion when datastores
                    # accept RDFDatetime instead of ints.
-                   int(self.frozen_timestamp or rdfvalue.RDFDatetime().Now()))):
-      task = rdfvalue.GrrMessage(task)
+                   int(self.frozen_timestamp or rdfvalue.RDFDatetime().Now())),
+        token=self.token, limit=None):
+      task = rdfvalue.GrrMessage(serialized)
       task.eta = timestamp
-      task.last_lease = "%s@%s:%d" % (user,
-                                      socket.gethostname(),
-                                      os.getpid())
+      all_tasks.append((predicate, task))
+
+    # Sort the tasks in order of priority.
+    all_tasks.sort(key=lambda item: item[1].priority, reverse=True)
+
+    for predicate, task in all_tasks:
+      task.last_lease = last_lease
+
       # Decrement the ttl
       task.task_ttl -= 1
       if task.task_ttl <= 0:
         # Remove the task if ttl is exhausted.
-        transaction.DeleteAttribute(predicate)
-        ttl_exceeded_count += 1
-        stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
+        to_delete.append(predicate)
       else:
         if task.task_ttl != rdfvalue.GrrMessage.max_ttl - 1:
           stats.STATS.IncrementCounter("grr_task_retransmission_count")
 
         # Update the timestamp on the value to be in the future
-        transaction.Set(predicate, task.SerializeToString(), replace=True,
-                        timestamp=long(time.time() * 1e6) + lease)
+        to_lease[predicate] = [(task.SerializeToString(), lease_timestamp)]
         tasks.append(task)
         if len(tasks) >= limit:
           break
 
-    if ttl_exceeded_count:
+    if to_lease or to_delete:
+      # Leasing a task replaces the old version of it.
+      self.data_store.MultiSet(transaction.subject, to_lease,
+                               to_delete=to_delete, replace=True, sync=True,
+                               token=self.token)
+
+    if to_delete:
+      stats.STATS.IncrementCounter("grr_task_ttl_expired_count",
+                                   len(to_delete))
       logging.info("TTL exceeded for %d messages on queue %s",
-                   ttl_exceeded_count, transaction.subject)
+                   len(to_delete), transaction.subject)
+
     return tasks
 
 
@@ -702,6 +810,128 @@ class WellKnownQueueManager(QueueManager):
       yield rdfvalue.RequestState(id=0), [response]
 
 
+class NotificationShardLeases(object):
+  """Spreads the notification shards of a queue over the running workers.
+
+  Every worker holds a lease on the queue, which it renews periodically. The
+  shards are assigned to the workers holding a live lease by rendezvous
+  hashing: each shard goes to the worker with the highest hash of (worker,
+  shard). All workers therefore compute the same assignment without talking to
+  each other, and when a worker joins or leaves only the shards it gains or
+  loses change owner.
+  """
+
+  LEASE_PREDICATE_PREFIX = "lease:%s"
+
+  # Leases which expired this many lease times ago are removed.
+  STALE_LEASE_FACTOR = 10
+
+  def __init__(self, queue, worker_id=None, lease_time=None, store=None,
+               token=None):
+    """Constructor.
+
+    Args:
+      queue: The queue whose notification shards we lease.
+      worker_id: A unique name for this worker. By default one is made up from
+        the host name and process id.
+      lease_time: How long the lease lasts, in seconds.
+      store: The data store to keep the leases in.
+      token: The token to use for data store access.
+    """
+    if store is None:
+      store = data_store.DB
+
+    if worker_id is None:
+      worker_id = "%s:%d:%x" % (socket.gethostname(), os.getpid(), id(self))
+
+    if lease_time is None:
+      lease_time = config_lib.CONFIG["Worker.shard_lease_time"]
+
+    self.data_store = store
+    self.token = token
+    self.subject = queue.Add("workers")
+    self.worker_id = worker_id
+    self.lease_time = lease_time
+    self.num_shards = config_lib.CONFIG["Worker.queue_shards"]
+
+    # The workers holding a live lease and the shards we own.
+    self.workers = []
+    self.shards = []
+    self.last_renewal = 0
+
+  def _Weight(self, worker_id, shard):
+    return hashlib.md5("%s-%d" % (worker_id, shard)).digest()
+
+  def AssignShards(self, workers):
+    """Returns a dict mapping each shard index to the worker owning it."""
+    if not workers:
+      return {}
+
+    return dict((shard, max(workers,
+                            key=lambda worker: self._Weight(worker, shard)))
+                for shard in range(self.num_shards))
+
+  def Renew(self):
+    """Renews our lease and recalculates which shards we own.
+
+    Returns:
+      A sorted list of the indexes of the shards we own.
+    """
+    now = long(time.time() * 1e6)
+    lease_time = long(self.lease_time * 1e6)
+    own_predicate = self.LEASE_PREDICATE_PREFIX % self.worker_id
+
+    # The value is the time the lease expires.
+    self.data_store.Set(self.subject, own_predicate, now + lease_time,
+                        replace=True, sync=True, token=self.token)
+
+    workers = set([self.worker_id])
+    stale = []
+    for predicate, expires, _ in self.data_store.ResolveRegex(
+        self.subject, self.LEASE_PREDICATE_PREFIX % ".*",
+        timestamp=self.data_store.NEWEST_TIMESTAMP, token=self.token,
+        limit=None):
+      expires = long(expires)
+      if expires > now:
+        workers.add(predicate[len(self.LEASE_PREDICATE_PREFIX % ""):])
+      elif expires < now - self.STALE_LEASE_FACTOR * lease_time:
+        stale.append(predicate)
+
+    if stale:
+      self.data_store.DeleteAttributes(self.subject, stale, sync=False,
+                                       token=self.token)
+
+    self.workers = sorted(workers)
+    self.shards = sorted(
+        shard for shard, worker in self.AssignShards(self.workers).iteritems()
+        if worker == self.worker_id)
+    self.last_renewal = time.time()
+
+    return self.shards
+
+  def GetShards(self):
+    """Returns the shards we own, renewing our lease when it is due."""
+    if time.time() - self.last_renewal > self.lease_time / 3.0:
+      self.Renew()
+
+    return self.shards
+
+  def GetOtherShards(self):
+    """Returns the shards owned by other workers in random order."""
+    shards = [shard for shard in range(self.num_shards)
+              if shard not in self.shards]
+    random.shuffle(shards)
+    return shards
+
+  def Release(self):
+    """Gives up our lease so the other workers take over our shards."""
+    self.data_store.DeleteAttributes(
+        self.subject, [self.LEASE_PREDICATE_PREFIX % self.worker_id],
+        sync=True, token=self.token)
+    self.shards = []
+    self.last_renewal = 0
+
+
 class QueueManagerInit(registry.InitHook):
   """Registers vars used by the QueueManager."""
 
@@ -711,3 +941,5 @@ class QueueManagerInit(registry.InitHook):
     # Counters used by the QueueManager.
     stats.STATS.RegisterCounterMetric("grr_task_retransmission_count")
     stats.STATS.RegisterCounterMetric("grr_task_ttl_expired_count")
+    stats.STATS.RegisterGaugeMetric("grr_notification_shard_backlog", int,
+                                    fields=[("shard", str)])
@@ -515,6 +515,75 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     self.assertFalse(shard2_sessions)
 
 
+class NotificationShardLeasesTest(test_lib.GRRBaseTest):
+  """Tests for spreading the notification shards over the workers."""
+
+  def setUp(self):
+    super(NotificationShardLeasesTest, self).setUp()
+    config_lib.CONFIG.Set("Worker.queue_shards", 10)
+    self.queue = rdfvalue.RDFURN("aff4:/W")
+
+  def tearDown(self):
+    config_lib.CONFIG.Set("Worker.queue_shards", 1)
+    super(NotificationShardLeasesTest, self).tearDown()
+
+  def StartWorkers(self, worker_ids):
+    leases = [queue_manager.NotificationShardLeases(
+        self.queue, worker_id=worker_id, token=self.token)
+              for worker_id in worker_ids]
+
+    # Once everyone holds a lease, all workers agree on the assignment.
+    for lease in leases:
+      lease.Renew()
+
+    for lease in leases:
+      lease.Renew()
+
+    return leases
+
+  def testShardsAreSpreadOverWorkers(self):
+    leases = self.StartWorkers(["worker1", "worker2", "worker3"])
+
+    shards = []
+    for lease in leases:
+      self.assertEqual(lease.workers, ["worker1", "worker2", "worker3"])
+      shards.extend(lease.shards)
+
+    # Every shard is owned by exactly one worker.
+    self.assertEqual(sorted(shards), range(10))
+
+    # The other shards are everything we do not own.
+    self.assertEqual(sorted(leases[0].GetOtherShards() + leases[0].shards),
+                     range(10))
+
+  def testLeavingWorkerOnlyMovesItsShards(self):
+    leases = self.StartWorkers(["worker1", "worker2", "worker3"])
+    before = [list(lease.shards) for lease in leases]
+
+    leases[2].Release()
+    for lease in leases[:2]:
+      lease.Renew()
+
+    # The remaining workers keep their shards and share the released ones.
+    for old_shards, lease in zip(before, leases[:2]):
+      self.assertEqual(lease.workers, ["worker1", "worker2"])
+      self.assertTrue(set(old_shards).issubset(lease.shards))
+
+    self.assertEqual(sorted(leases[0].shards + leases[1].shards), range(10))
+
+  def testExpiredLeasesLoseTheirShards(self):
+    with test_lib.FakeTime(1000):
+      lease = queue_manager.NotificationShardLeases(
+          self.queue, worker_id="dead_worker", lease_time=60, token=self.token)
+      lease.Renew()
+
+    with test_lib.FakeTime(1100):
+      leases = self.StartWorkers(["worker1"])
+
+    self.assertEqual(leases[0].workers, ["worker1"])
+    self.assertEqual(leases[0].shards, range(10))
+
+
 def main(argv):
   test_lib.main(argv)
 
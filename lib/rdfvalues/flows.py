@@ -3,6 +3,7 @@
 
 
 import cPickle
+import cStringIO
 import pickle
 import StringIO
 import threading
@@ -25,6 +26,16 @@ class GrrMessage(rdfvalue.RDFProtoStruct):
   # for this so there can't be more than 8 different levels of priority.
   max_priority = 7
 
+  # If set, SerializeToString() reuses the serialized form the message was
+  # parsed from instead of encoding every field again. The frontend uses this
+  # to store client messages without decoding their payloads.
+  passthrough = False
+
+  # The serialized form the message was parsed from and the fields which were
+  # set since then.
+  _serialized = None
+  _updated_fields = None
+
   def __init__(self, initializer=None, age=None, payload=None, **kwarg):
     super(GrrMessage, self).__init__(initializer=initializer, age=age, **kwarg)
 
@@ -65,6 +76,59 @@ class GrrMessage(rdfvalue.RDFProtoStruct):
 
     return task_id
 
+  def ParseFromString(self, string):
+    super(GrrMessage, self).ParseFromString(string)
+    self._serialized = string
+    self._updated_fields = set()
+
+  def Clear(self):
+    super(GrrMessage, self).Clear()
+    self._serialized = None
+
+  def _RecordUpdate(self, attr, value):
+    """Remembers the fields set after parsing, to append them on serializing.
+
+    A field which is written again after the serialized form overrides the
+    earlier value when the message is parsed, but a field can not be cleared
+    this way, so clearing a field disables passthrough serialization.
+
+    Args:
+      attr: The name of the field being set.
+      value: The new value, None to clear the field.
+    """
+    if self._serialized is None:
+      return
+
+    if value is None:
+      self._serialized = None
+    else:
+      self._updated_fields.add(attr)
+
+  def _Set(self, attr, value, type_descriptor):
+    self._RecordUpdate(attr, value)
+    return super(GrrMessage, self)._Set(attr, value, type_descriptor)
+
+  def SetWireFormat(self, attr, value):
+    self._RecordUpdate(attr, value)
+    super(GrrMessage, self).SetWireFormat(attr, value)
+
+  def SerializeToString(self):
+    if not self.passthrough or self._serialized is None:
+      return super(GrrMessage, self).SerializeToString()
+
+    stream = cStringIO.StringIO()
+    stream.write(self._serialized)
+
+    raw_data = self.GetRawData()
+    for attr in sorted(self._updated_fields):
+      python_format, wire_format, type_descriptor = raw_data[attr]
+      if wire_format is None:
+        wire_format = type_descriptor.ConvertToWireFormat(python_format)
+
+      type_descriptor.Write(stream, wire_format)
+
+    return stream.getvalue()
+
   @property
   def payload(self):
     """The payload property automatically decodes the encapsulated data."""
@@ -72,3 +72,38 @@ class FlowStateTest(test_base.RDFValueTestCase):
       result = rdfvalue.FlowState(serialized)
       self.assertTrue(isinstance(result.errors, AttributeError))
       self.assertTrue(isinstance(result.urn, flows.UnknownObject))
+
+
+class GrrMessageTest(test_lib.GRRBaseTest):
+
+  def testPassthroughSerialization(self):
+    original = rdfvalue.GrrMessage(
+        session_id="aff4:/flows/W:1234", request_id=1, response_id=2,
+        payload=rdfvalue.DataBlob(string="hello"))
+    serialized = original.SerializeToString()
+
+    msg = rdfvalue.GrrMessage(serialized)
+    msg.passthrough = True
+    msg.auth_state = rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED
+    msg.SetWireFormat("source", "C.1234567812345678")
+
+    # The original bytes are kept and the new fields are appended.
+    result = msg.SerializeToString()
+    self.assertTrue(result.startswith(serialized))
+
+    decoded = rdfvalue.GrrMessage(result)
+    self.assertEqual(decoded.session_id, original.session_id)
+    self.assertEqual(decoded.payload.string, "hello")
+    self.assertEqual(decoded.auth_state,
+                     rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
+    self.assertEqual(decoded.source, "aff4:/C.1234567812345678")
+
+    # A changed field overrides the original value.
+    msg.request_id = 5
+    self.assertEqual(rdfvalue.GrrMessage(msg.SerializeToString()).request_id, 5)
+
+    # Clearing a field needs a full serialization.
+    msg.request_id = None
+    result = msg.SerializeToString()
+    self.assertFalse(result.startswith(serialized))
+    self.assertEqual(rdfvalue.GrrMessage(result).request_id, 0)
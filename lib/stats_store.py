@@ -15,6 +15,7 @@ from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
+from grr.lib import timeseries_store
 
 
 config_lib.DEFINE_string("StatsStore.process_id", default="",
@@ -63,7 +64,11 @@ class StatsStore(object):
 
     subject = self.DATA_STORE_ROOT.Add(process_id)
 
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+
     to_set = {}
+    samples = []
     metrics_metadata = stats.STATS.GetAllMetricsMetadata()
     for name, metadata in metrics_metadata.iteritems():
       if metadata.fields_defs:
@@ -73,18 +78,29 @@ class StatsStore(object):
         # TODO(user): implement support for distributions
         continue
 
-      to_set[self.STATS_STORE_PREFIX + name] = [
-          stats.STATS.GetMetricValue(name)]
+      value = stats.STATS.GetMetricValue(name)
+      to_set[self.STATS_STORE_PREFIX + name] = [value]
+
+      if metadata.value_type in (int, long, float) and value is not None:
+        samples.append((name, timestamp, value))
 
     # Write this to mark that this process_id was used
     data_store.DB.Set(
         self.DATA_STORE_ROOT, self.STATS_STORE_PREFIX + process_id,
-        timestamp or rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch(),
-        sync=sync, token=self.token)
+        timestamp, sync=sync, token=self.token)
     # Write actual data
     data_store.DB.MultiSet(subject, to_set, replace=False,
                            token=self.token, timestamp=timestamp, sync=sync)
 
+    # Numeric metrics are also kept with rollups for graphs over long time
+    # ranges.
+    self.GetTimeSeriesStore(process_id).WriteSamples(samples, sync=sync)
+
+  def GetTimeSeriesStore(self, process_id):
+    """Returns the time series store of a process."""
+    return timeseries_store.TimeSeriesStore(
+        self.DATA_STORE_ROOT.Add(process_id), token=self.token)
+
   def ListUsedProcessIds(self):
     """List process ids that were used when saving data to stats store."""
     results = data_store.DB.ResolveRegex(self.DATA_STORE_ROOT,
@@ -207,6 +223,8 @@ class StatsStoreWorker(object):
             timestamp=(0, now -
                        config_lib.CONFIG["StatsStore.ttl"] * 1000),
             sync=False)
+        self.stats_store.GetTimeSeriesStore(self.process_id).DeleteExpired(
+            stats.STATS.GetAllMetricsMetadata().keys(), now=now)
       except Exception as e:  # pylint: disable=broad-except
         logging.exception(
             "StatsStore exception caught during DeleteStats(): %s", e)
@@ -10,17 +10,21 @@ from grr.lib import access_control_test
 from grr.lib import aff4_test
 from grr.lib import artifact_lib_test
 from grr.lib import artifact_test
+from grr.lib import blob_store_test
 from grr.lib import build_test
 from grr.lib import communicator_test
 from grr.lib import config_lib_test
 from grr.lib import config_validation_test
 from grr.lib import data_store_test
+from grr.lib import export_pipeline_test
 from grr.lib import export_test
 from grr.lib import export_utils_test
+from grr.lib import fleet_scan_test
 from grr.lib import flow_test
 from grr.lib import flow_utils_test
 from grr.lib import front_end_test
 from grr.lib import fuse_mount_test
+from grr.lib import hash_filter_test
 from grr.lib import hunt_test
 from grr.lib import lexer_test
 from grr.lib import objectfilter_test
@@ -31,6 +35,7 @@ from grr.lib import stats_store_test
 from grr.lib import stats_test
 from grr.lib import test_lib
 from grr.lib import threadpool_test
+from grr.lib import timeseries_store_test
 from grr.lib import type_info_test
 from grr.lib import utils_test
 
@@ -40,4 +45,5 @@ from grr.lib.flows import tests
 from grr.lib.hunts import tests
 from grr.lib.rdfvalues import tests
 from grr.tools import entry_point_test
+from grr.tools import http_server_test
 # pylint: enable=unused-import
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Storage for time series with rollups at fixed resolutions.
+
+Graphs of stats over long time ranges used to read every sample in the range
+and downsample them on each page view. Next to the raw samples, a
+TimeSeriesStore keeps an Aggregate of the samples in each fixed-width time
+bucket of one minute, one hour and one day. The rollups are updated when samples
+are written, and a range query reads the finest resolution which gives at most
+the requested number of points, so its cost does not depend on the number of
+samples in the range.
+
+A store keeps its series in predicates of one data store subject, next to the
+data they describe:
+
+  timeseries:raw/<metric>  Every sample, at its own timestamp.
+  timeseries:1m/<metric>   One Aggregate per minute, at the start of the minute.
+  timeseries:1h/<metric>   One Aggregate per hour.
+  timeseries:1d/<metric>   One Aggregate per day.
+
+These are not AFF4 attributes, so opening an AFF4 object at the subject does not
+read them.
+"""
+
+
+import struct
+
+
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+
+class Aggregate(object):
+  """The count, sum, minimum, maximum and last value of some samples."""
+
+  FORMAT = "<Qdddqd"
+
+  def __init__(self, count=0, total=0.0, minimum=None, maximum=None,
+               last_timestamp=0, last=None):
+    self.count = count
+    self.total = total
+    self.minimum = minimum
+    self.maximum = maximum
+    self.last_timestamp = last_timestamp
+    self.last = last
+
+  def Add(self, timestamp, value):
+    self.Merge(Aggregate(1, value, value, value, timestamp, value))
+
+  def Merge(self, other):
+    """Adds the samples aggregated in other."""
+    if not other.count:
+      return
+
+    if not self.count:
+      self.minimum = other.minimum
+      self.maximum = other.maximum
+    else:
+      self.minimum = min(self.minimum, other.minimum)
+      self.maximum = max(self.maximum, other.maximum)
+
+    self.count += other.count
+    self.total += other.total
+
+    if other.last_timestamp >= self.last_timestamp:
+      self.last_timestamp = other.last_timestamp
+      self.last = other.last
+
+  @property
+  def mean(self):
+    return self.total / self.count if self.count else None
+
+  def SerializeToString(self):
+    return struct.pack(self.FORMAT, self.count, self.total, self.minimum,
+                       self.maximum, self.last_timestamp, self.last)
+
+  @classmethod
+  def FromString(cls, data):
+    return cls(*struct.unpack(cls.FORMAT, utils.SmartStr(data)))
+
+  def __repr__(self):
+    return "<Aggregate count=%d mean=%s min=%s max=%s last=%s>" % (
+        self.count, self.mean, self.minimum, self.maximum, self.last)
+
+
+class TimeSeriesStore(object):
+  """Writes and queries the time series stored at a data store subject."""
+
+  PREFIX = "timeseries:"
+  RAW = "raw"
+
+  # The rollup resolutions and their bucket widths in seconds, finest first.
+  RESOLUTIONS = [("1m", 60), ("1h", 60 * 60), ("1d", 24 * 60 * 60)]
+
+  # How long the data of each resolution is kept in seconds, None keeps it
+  # forever.
+  RETENTION = {"raw": 7 * 24 * 3600,
+               "1m": 7 * 24 * 3600,
+               "1h": 366 * 24 * 3600,
+               "1d": None}
+
+  def __init__(self, subject, token=None):
+    self.subject = subject
+    self.token = token
+
+  def _Predicate(self, resolution, metric):
+    return "%s%s/%s" % (self.PREFIX, resolution, metric)
+
+  def WriteSamples(self, samples, sync=False):
+    """Writes samples and updates the rollups.
+
+    Concurrent writers of the same subject may lose each others rollup
+    updates, so each subject should only be written by one process at a time.
+
+    Args:
+      samples: A list of (metric, timestamp, value) tuples, timestamps are in
+        microseconds since the epoch.
+      sync: Should the writes be synced immediately.
+    """
+    samples = [(metric, int(timestamp), float(value))
+               for metric, timestamp, value in samples]
+    if not samples:
+      return
+
+    raw = {}
+    for metric, timestamp, value in samples:
+      raw.setdefault(self._Predicate(self.RAW, metric), []).append(
+          (value, timestamp))
+
+    data_store.DB.MultiSet(self.subject, raw, replace=False, sync=sync,
+                           token=self.token)
+
+    for resolution, width in self.RESOLUTIONS:
+      self._UpdateRollups(resolution, width * 1000000, samples, sync=sync)
+
+  def _UpdateRollups(self, resolution, width, samples, sync=False):
+    """Merges samples into the buckets of one resolution."""
+    buckets = {}
+    for metric, timestamp, value in samples:
+      key = (self._Predicate(resolution, metric),
+             timestamp - timestamp % width)
+      buckets.setdefault(key, Aggregate()).Add(timestamp, value)
+
+    predicates = sorted(set(predicate for predicate, _ in buckets))
+    start = min(bucket for _, bucket in buckets)
+    end = max(bucket for _, bucket in buckets)
+
+    # All buckets in the range are rewritten, including ones which got no new
+    # samples, since they are deleted below.
+    for predicate, value, timestamp in data_store.DB.ResolveMulti(
+        self.subject, predicates, timestamp=(start, end), token=self.token):
+      buckets.setdefault((predicate, timestamp), Aggregate()).Merge(
+          Aggregate.FromString(value))
+
+    data_store.DB.DeleteAttributes(self.subject, predicates, start=start,
+                                   end=end, sync=True, token=self.token)
+
+    values = {}
+    for (predicate, bucket), aggregate in buckets.iteritems():
+      values.setdefault(predicate, []).append(
+          (aggregate.SerializeToString(), bucket))
+
+    data_store.DB.MultiSet(self.subject, values, replace=False, sync=sync,
+                           token=self.token)
+
+  def ChooseResolution(self, start, end, max_points, now=None):
+    """Returns the finest rollup with at most max_points buckets in a range.
+
+    Rollups which are not kept long enough to cover the start of the range are
+    skipped, since their data was deleted already.
+
+    Args:
+      start: The start of the range in microseconds since the epoch.
+      end: The end of the range in microseconds since the epoch.
+      max_points: The maximum number of buckets in the range.
+      now: The current time in microseconds since the epoch.
+
+    Returns:
+      The name of the resolution.
+    """
+    if now is None:
+      now = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+
+    for resolution, width in self.RESOLUTIONS:
+      retention = self.RETENTION[resolution]
+      if retention is not None and start < now - retention * 1000000:
+        continue
+
+      if (end - start) / (width * 1000000) <= max_points:
+        return resolution
+
+    return self.RESOLUTIONS[-1][0]
+
+  def Query(self, metrics, start, end, max_points=500, resolution=None):
+    """Reads the series of some metrics in a time range.
+
+    Args:
+      metrics: A list of metric names.
+      start: The start of the range in microseconds since the epoch.
+      end: The end of the range in microseconds since the epoch.
+      max_points: The maximum number of points per metric, used to choose the
+        resolution.
+      resolution: Read this resolution ("raw", "1m", "1h" or "1d") instead of
+        choosing one.
+
+    Returns:
+      A dict of metric -> list of (timestamp, Aggregate) sorted by timestamp.
+      Raw samples are returned as Aggregates of one sample.
+    """
+    if resolution is None:
+      resolution = self.ChooseResolution(start, end, max_points)
+
+    # Include the bucket which covers the start of the range.
+    widths = dict(self.RESOLUTIONS)
+    if resolution in widths:
+      start -= start % (widths[resolution] * 1000000)
+
+    predicates = dict((self._Predicate(resolution, metric), metric)
+                      for metric in metrics)
+
+    results = dict((metric, []) for metric in metrics)
+    for predicate, value, timestamp in data_store.DB.ResolveMulti(
+        self.subject, list(predicates), timestamp=(start, end),
+        token=self.token):
+      if resolution == self.RAW:
+        aggregate = Aggregate()
+        aggregate.Add(timestamp, float(value))
+      else:
+        aggregate = Aggregate.FromString(value)
+
+      results[predicates[predicate]].append((timestamp, aggregate))
+
+    for series in results.itervalues():
+      series.sort(key=lambda x: x[0])
+
+    return results
+
+  def DeleteExpired(self, metrics, now=None, sync=False):
+    """Deletes the data which is older than the retention of its resolution.
+
+    Args:
+      metrics: A list of metric names.
+      now: The current time in microseconds since the epoch.
+      sync: Should the deletes be synced immediately.
+    """
+    if now is None:
+      now = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+
+    for resolution, retention in self.RETENTION.iteritems():
+      if retention is None:
+        continue
+
+      data_store.DB.DeleteAttributes(
+          self.subject, [self._Predicate(resolution, metric)
+                         for metric in metrics],
+          start=0, end=now - retention * 1000000, sync=sync, token=self.token)
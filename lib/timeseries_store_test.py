@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Tests for the time series store."""
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import timeseries_store
+
+
+MINUTE = 60 * 1000000
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# Samples start here, since data stores treat a zero timestamp as unset.
+BASE = 1000 * DAY
+
+
+class TimeSeriesStoreTest(test_lib.GRRBaseTest):
+  """Tests the TimeSeriesStore."""
+
+  def setUp(self):
+    super(TimeSeriesStoreTest, self).setUp()
+    self.store = timeseries_store.TimeSeriesStore(
+        rdfvalue.RDFURN("aff4:/timeseries_test"), token=self.token)
+
+  def testRollups(self):
+    # Two samples per minute for two hours.
+    self.store.WriteSamples([("metric", BASE + i * MINUTE / 2, i)
+                             for i in range(240)])
+
+    result = self.store.Query(["metric"], BASE, BASE + 2 * HOUR,
+                              resolution="1m")
+    self.assertEqual(len(result["metric"]), 120)
+    timestamp, aggregate = result["metric"][1]
+    self.assertEqual(timestamp, BASE + MINUTE)
+    self.assertEqual(aggregate.count, 2)
+    self.assertEqual(aggregate.mean, 2.5)
+    self.assertEqual(aggregate.last, 3)
+
+    result = self.store.Query(["metric"], BASE, BASE + 2 * HOUR,
+                              resolution="1h")
+    self.assertEqual([a.count for _, a in result["metric"]], [120, 120])
+    self.assertEqual([a.maximum for _, a in result["metric"]], [119, 239])
+
+    result = self.store.Query(["metric"], BASE, BASE + 2 * HOUR,
+                              resolution="raw")
+    self.assertEqual(len(result["metric"]), 240)
+
+  def testLaterSamplesAreMergedIntoBuckets(self):
+    self.store.WriteSamples([("metric", BASE + 10, 1),
+                             ("metric", BASE + 2 * HOUR, 5)])
+    self.store.WriteSamples([("metric", BASE + 20, 3)])
+
+    result = self.store.Query(["metric"], BASE, BASE + DAY, resolution="1h")
+    self.assertEqual([(t - BASE, a.count, a.total)
+                      for t, a in result["metric"]],
+                     [(0, 2, 4.0), (2 * HOUR, 1, 5.0)])
+
+    # Samples spanning several buckets do not drop the buckets in between.
+    self.store.WriteSamples([("metric", BASE + 30, 1),
+                             ("metric", BASE + 3 * HOUR, 1)])
+    result = self.store.Query(["metric"], BASE, BASE + DAY, resolution="1h")
+    self.assertEqual([(t - BASE, a.count) for t, a in result["metric"]],
+                     [(0, 3), (2 * HOUR, 1), (3 * HOUR, 1)])
+
+  def testQueryChoosesResolution(self):
+    now = 10000 * DAY
+    for start, end, resolution in [
+        (now - 5 * HOUR, now, "1m"),
+        (now - 7 * DAY, now, "1h"),
+        (now - 90 * DAY, now, "1d"),
+        (now - 9000 * DAY, now, "1d"),
+        # The minute rollups of this range were deleted already.
+        (now - 30 * DAY, now - 30 * DAY + 5 * HOUR, "1h"),
+        (now - 400 * DAY, now - 400 * DAY + 5 * HOUR, "1d")]:
+      self.assertEqual(
+          self.store.ChooseResolution(start, end, 500, now=now), resolution)
+
+    self.store.WriteSamples([("metric", BASE + i * HOUR, i)
+                             for i in range(24 * 90)])
+
+    queried = []
+    resolve_multi = data_store.DB.ResolveMulti
+
+    def ResolveMulti(subject, predicates, **kwargs):
+      queried.extend(predicates)
+      return resolve_multi(subject, predicates, **kwargs)
+
+    with test_lib.Stubber(data_store.DB, "ResolveMulti", ResolveMulti):
+      result = self.store.Query(["metric"], BASE, BASE + 90 * DAY)
+
+    self.assertEqual(queried, ["timeseries:1d/metric"])
+    self.assertEqual(len(result["metric"]), 90)
+    self.assertEqual(result["metric"][0][1].count, 24)
+
+  def testDeleteExpired(self):
+    now = 400 * DAY
+    self.store.WriteSamples([("metric", now - 30 * DAY, 1),
+                             ("metric", now - MINUTE, 2)])
+
+    self.store.DeleteExpired(["metric"], now=now, sync=True)
+
+    for resolution, count in [("raw", 1), ("1m", 1), ("1h", 2), ("1d", 2)]:
+      result = self.store.Query(["metric"], 0, now, resolution=resolution)
+      self.assertEqual(len(result["metric"]), count)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
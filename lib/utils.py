@@ -740,6 +740,68 @@ def EscapeRegex(string):
                 SmartUnicode(string))
 
 
+# Characters which have a special meaning when they follow an escape char in a
+# regex (e.g. \d or \b), as opposed to escaping a literal.
+regex_escape_classes = "0123456789ABDGSWZabdfnrstvwxz"
+
+# Characters which end the literal prefix of a regex.
+regex_special_chars = ".^$*+?{}[]|()"
+
+
+def RegexLiteralPrefix(regex):
+  """Splits a regex into its literal prefix and the remainder.
+
+  Data stores use this to turn regexes like "aff4:.*" into prefix scans.
+
+  Args:
+    regex: The regex, which is assumed to be matched at the start of a string.
+
+  Returns:
+    A tuple (prefix, remainder) where prefix is the literal string every match
+    of the regex must start with and remainder is the part of the regex after
+    it.
+  """
+  prefix = []
+  i = 0
+  while i < len(regex):
+    char = regex[i]
+    if char == "\\":
+      if i + 1 >= len(regex) or regex[i + 1] in regex_escape_classes:
+        break
+      char = regex[i + 1]
+      length = 2
+    elif char in regex_special_chars:
+      break
+    else:
+      length = 1
+
+    # A quantifier makes this character optional so it is not part of the
+    # literal prefix.
+    if regex[i + length:i + length + 1] in ("*", "?", "{"):
+      break
+
+    prefix.append(char)
+    i += length
+
+  # A top level alternation means matches do not have to start with the prefix
+  # at all.
+  depth = 0
+  escaped = False
+  for char in regex[i:]:
+    if escaped:
+      escaped = False
+    elif char == "\\":
+      escaped = True
+    elif char == "(":
+      depth += 1
+    elif char == ")":
+      depth -= 1
+    elif char == "|" and depth == 0:
+      return regex[:0], regex
+
+  return regex[:0].join(prefix), regex[i:]
+
+
 def GeneratePassphrase(length=20):
   """Create a 20 char passphrase with easily typeable chars."""
   valid_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
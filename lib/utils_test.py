@@ -275,6 +275,21 @@ class UtilsTest(test_lib.GRRBaseTest):
     for in_str, result in fixture:
       self.assertTrue(result in g(in_str))
 
+  def testRegexLiteralPrefix(self):
+    data = [
+        ("aff4:.*", ("aff4:", ".*")),
+        ("task:", ("task:", "")),
+        (r"aff4:\.foo$", ("aff4:.foo", "$")),
+        (r"aff4:\d+", ("aff4:", r"\d+")),
+        ("aff4:sizes?", ("aff4:size", "s?")),
+        ("aff4:(a|b)", ("aff4:", "(a|b)")),
+        ("aff4:a|task:b", ("", "aff4:a|task:b")),
+        (".*", ("", ".*")),
+        ]
+
+    for test, expected in data:
+      self.assertEqual(expected, utils.RegexLiteralPrefix(test))
+
 
 def main(argv):
   test_lib.main(argv)
@@ -76,6 +76,10 @@ class GRRWorker(object):
     self.token = token
     self.last_active = 0
 
+    # The notification shards of the queue are spread over all the workers.
+    self.shard_leases = queue_manager_lib.NotificationShardLeases(
+        self.queue, token=token)
+
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
@@ -101,6 +105,7 @@ class GRRWorker(object):
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
+      self.shard_leases.Release()
       self.thread_pool.Join()
 
   def RunOnce(self):
@@ -119,7 +124,12 @@ class GRRWorker(object):
     # notifications to avoid possible race conditions.
     queue_manager.FreezeTimestamp()
 
-    sessions_available = queue_manager.GetSessionsFromQueue(self.queue)
+    sessions_available = queue_manager.GetSessionsFromQueue(
+        self.queue, shard_indexes=self.shard_leases.GetShards())
+
+    # Only help out other workers when there is nothing to do on our shards.
+    if not sessions_available:
+      sessions_available = self.StealSessions(queue_manager)
 
     time_to_fetch_messages = time.time() - now
 
@@ -151,6 +161,29 @@ class GRRWorker(object):
 
       return 0
 
+  def StealSessions(self, queue_manager):
+    """Takes sessions from the shards of other workers.
+
+    The owner of a shard works through its sessions from the front of the list,
+    so we take the back half of the first busy shard we find. This way we
+    rarely try to lock the same flows as the owner.
+
+    Args:
+      queue_manager: QueueManager object used to read the notifications.
+
+    Returns:
+      A list of session ids.
+    """
+    for shard in self.shard_leases.GetOtherShards():
+      sessions = queue_manager.GetSessionsFromQueue(self.queue,
+                                                    shard_indexes=[shard])
+      if sessions:
+        stolen = sessions[len(sessions) / 2:]
+        stats.STATS.IncrementCounter("grr_worker_sessions_stolen", len(stolen))
+        return stolen
+
+    return []
+
   def ProcessMessages(self, active_sessions, queue_manager, time_limit=0):
     """Processes all the flows in the messages.
 
@@ -2,15 +2,21 @@
 """This is the GRR frontend HTTP Server."""
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
 import cStringIO
+import mimetools
 
 from multiprocessing import freeze_support
 from multiprocessing import Process
+import os
 import pdb
 import socket
 import SocketServer
+import threading
+import time
 
 
 import ipaddr
@@ -25,12 +31,90 @@ from grr.lib import communicator
 from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import flow
+from grr.lib import frontend_cache
 from grr.lib import rdfvalue
 from grr.lib import startup
+from grr.lib import threadpool
 from grr.lib import type_info
 from grr.lib import utils
 
 
+def CreateFrontEnd(shared_cache=None):
+  return flow.FrontEndServer(
+      certificate=config_lib.CONFIG["Frontend.certificate"],
+      private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config_lib.CONFIG[
+          "Frontend.max_retransmission_time"],
+      shared_cache=shared_cache)
+
+
+def ProcessControlRequest(frontend, path, raw_headers, post_data, client_ip):
+  """Hands a message bundle POSTed by a client to the frontend.
+
+  Args:
+    frontend: The FrontEndServer.
+    path: The request path, which may contain the api version.
+    raw_headers: The HTTP headers of the request as a string.
+    post_data: The body of the request.
+    client_ip: The ip address the request came from.
+
+  Returns:
+    A tuple of (HTTP status, response body).
+  """
+  # Get the api version
+  try:
+    api_version = int(cgi.parse_qs(path.split("?")[1])["api"][0])
+  except (ValueError, KeyError, IndexError):
+    # The oldest api version we support if not specified.
+    api_version = 3
+
+  try:
+    request_comms = rdfvalue.ClientCommunication(post_data)
+
+    # If the client did not supply the version in the protobuf we use the get
+    # parameter.
+    if not request_comms.api_version:
+      request_comms.api_version = api_version
+
+    # Reply using the same version we were requested with.
+    responses_comms = rdfvalue.ClientCommunication(
+        api_version=request_comms.api_version)
+
+    source_ip = ipaddr.IPAddress(client_ip)
+
+    if source_ip.version == 6:
+      source_ip = source_ip.ipv4_mapped or source_ip
+
+    request_comms.orig_request = rdfvalue.HttpRequest(
+        raw_headers=utils.SmartStr(raw_headers),
+        source_ip=utils.SmartStr(source_ip))
+
+    source, nr_messages = frontend.HandleMessageBundles(
+        request_comms, responses_comms)
+
+    logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
+                 " %d messages sent.",
+                 source, utils.SmartStr(source_ip), len(post_data),
+                 nr_messages, responses_comms.num_messages)
+
+    return 200, responses_comms.SerializeToString()
+
+  except communicator.UnknownClientCert:
+    # "406 Not Acceptable: The server can only generate a response that is not
+    # accepted by the client". This is because we can not encrypt for the
+    # client appropriately.
+    return 406, "Enrollment required"
+
+  except Exception as e:  # pylint: disable=broad-except
+    if flags.FLAGS.debug:
+      pdb.post_mortem()
+
+    logging.error("Had to respond with status 500: %s.", e)
+    return 500, "Error"
+
+
 # pylint: disable=g-bad-name
 
 
@@ -38,6 +122,7 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   """GRR HTTP handler for receiving client posts."""
 
   statustext = {200: "200 OK",
+                400: "400 Bad Request",
                 406: "406 Not Acceptable",
                 500: "500 Internal Server Error"}
 
@@ -84,58 +169,16 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     self.Control()
 
   def Control(self):
-    # Get the api version
-    try:
-      api_version = int(cgi.parse_qs(self.path.split("?")[1])["api"][0])
-    except (ValueError, KeyError, IndexError):
-      # The oldest api version we support if not specified.
-      api_version = 3
-
     try:
       length = int(self.headers.getheader("content-length"))
-
-      request_comms = rdfvalue.ClientCommunication(self._GetPOSTData(length))
-
-      # If the client did not supply the version in the protobuf we use the get
-      # parameter.
-      if not request_comms.api_version:
-        request_comms.api_version = api_version
-
-      # Reply using the same version we were requested with.
-      responses_comms = rdfvalue.ClientCommunication(
-          api_version=request_comms.api_version)
-
-      source_ip = ipaddr.IPAddress(self.client_address[0])
-
-      if source_ip.version == 6:
-        source_ip = source_ip.ipv4_mapped or source_ip
-
-      request_comms.orig_request = rdfvalue.HttpRequest(
-          raw_headers=utils.SmartStr(self.headers),
-          source_ip=utils.SmartStr(source_ip))
-
-      source, nr_messages = self.server.frontend.HandleMessageBundles(
-          request_comms, responses_comms)
-
-      logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
-                   " %d messages sent.",
-                   source, utils.SmartStr(source_ip), length, nr_messages,
-                   responses_comms.num_messages)
-
-      self.Send(responses_comms.SerializeToString())
-
-    except communicator.UnknownClientCert:
-      # "406 Not Acceptable: The server can only generate a response that is not
-      # accepted by the client". This is because we can not encrypt for the
-      # client appropriately.
-      self.Send("Enrollment required", status=406)
-
-    except Exception as e:
-      if flags.FLAGS.debug:
-        pdb.post_mortem()
-
-      logging.error("Had to respond with status 500: %s.", e)
+    except (TypeError, ValueError):
       self.Send("Error", status=500)
+      return
+
+    status, data = ProcessControlRequest(
+        self.server.frontend, self.path, self.headers,
+        self._GetPOSTData(length), self.client_address[0])
+    self.Send(data, status=status)
 
 
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
@@ -147,16 +190,7 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
   address_family = socket.AF_INET6
 
   def __init__(self, server_address, handler, frontend=None, *args, **kwargs):
-    if frontend:
-      self.frontend = frontend
-    else:
-      self.frontend = flow.FrontEndServer(
-          certificate=config_lib.CONFIG["Frontend.certificate"],
-          private_key=config_lib.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config_lib.CONFIG[
-              "Frontend.max_retransmission_time"])
+    self.frontend = frontend or CreateFrontEnd()
     self.server_cert = config_lib.CONFIG["Frontend.certificate"]
 
     (address, _) = server_address
@@ -170,11 +204,287 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
+  def SetFrontEnd(self, frontend):
+    self.frontend = frontend
+
+
+class LoopTrigger(asyncore.file_dispatcher):
+  """Runs callbacks from other threads in the event loop thread.
+
+  The event loop is not thread safe, so worker threads queue a callback and
+  wake the loop up by writing to a pipe the loop is watching.
+  """
+
+  def __init__(self, socket_map):
+    read_fd, self.write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+    self.lock = threading.Lock()
+    self.callbacks = []
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(8192)
+    except (OSError, socket.error):
+      pass
+
+    with self.lock:
+      callbacks, self.callbacks = self.callbacks, []
+
+    for callback in callbacks:
+      callback()
+
+  def Call(self, callback):
+    with self.lock:
+      self.callbacks.append(callback)
+
+    os.write(self.write_fd, "x")
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self.write_fd)
+
+
+class AsyncGRRHTTPChannel(asynchat.async_chat):
+  """A client connection to the AsyncGRRHTTPServer.
+
+  The channel reads one request at a time. While a request is processed by a
+  worker thread we stop reading from the connection, and once the response is
+  sent the connection is kept open for the next request if the client asked
+  for keep-alive.
+  """
+
+  statustext = GRRHTTPServerHandler.statustext
+
+  def __init__(self, server, sock, client_address):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.server = server
+    self.client_address = client_address
+    self.data = []
+    self.request = None
+    self.busy = False
+    self.keep_alive = False
+    self.last_activity = time.time()
+    self.set_terminator("\r\n\r\n")
+
+  def readable(self):
+    # Requests are not read while we are busy with the last one or all the
+    # workers are busy. The client then waits in the TCP buffers.
+    return (not self.busy and self.server.HasCapacity() and
+            asynchat.async_chat.readable(self))
+
+  def collect_incoming_data(self, data):
+    self.data.append(data)
+    self.last_activity = time.time()
+
+  def found_terminator(self):
+    data = "".join(self.data)
+    self.data = []
+
+    if self.request is not None:
+      self._HandleRequest(data)
+      return
+
+    # We got the request line and headers.
+    request_line, _, raw_headers = data.partition("\r\n")
+    try:
+      method, path, version = request_line.split()
+      headers = mimetools.Message(cStringIO.StringIO(raw_headers))
+      length = int(headers.getheader("content-length") or 0)
+    except ValueError:
+      self.busy = True
+      self.keep_alive = False
+      self.SendResponse(400, "Bad request")
+      return
+
+    connection = (headers.getheader("connection") or "").lower()
+    if version == "HTTP/1.0":
+      self.keep_alive = connection == "keep-alive"
+    else:
+      self.keep_alive = connection != "close"
+
+    self.request = (method, path, version, raw_headers)
+    if length > 0:
+      self.set_terminator(length)
+    else:
+      self._HandleRequest("")
+
+  def _HandleRequest(self, post_data):
+    method, path, version, raw_headers = self.request
+    self.request = None
+    self.busy = True
+
+    if method == "POST":
+      self.server.Submit(self, path, raw_headers, post_data)
+    elif method == "GET" and path.startswith("/server.pem"):
+      self.SendResponse(200, utils.SmartStr(self.server.server_cert))
+    else:
+      self.SendResponse(400, "Bad request")
+
+  def SendResponse(self, status, data):
+    """Sends the response and gets ready for the next request."""
+    self.push(("HTTP/1.1 %s\r\n"
+               "Server: GRR\r\n"
+               "Content-type: application/octet-stream\r\n"
+               "Content-Length: %d\r\n"
+               "Connection: %s\r\n"
+               "\r\n") % (self.statustext.get(status, status), len(data),
+                          "keep-alive" if self.keep_alive else "close"))
+    self.push(data)
+    self.last_activity = time.time()
+
+    if self.keep_alive:
+      self.busy = False
+      self.set_terminator("\r\n\r\n")
+    else:
+      self.close_when_done()
+
+  def handle_error(self):
+    logging.exception("Error on connection from %s", self.client_address)
+    self.close()
+
+
+class AsyncGRRHTTPServer(asyncore.dispatcher):
+  """An event loop based GRR HTTP frontend server.
+
+  All connections are served by a single event loop thread, so idle and slow
+  clients only cost a socket. Decrypting the messages and the data store work
+  is done by a bounded pool of worker threads. When all workers are busy we
+  stop reading requests, and the frontend stops handing out new work to
+  clients so they come back more slowly.
+  """
+
+  request_queue_size = 500
+
+  def __init__(self, server_address, frontend=None, max_workers=None,
+               keep_alive_timeout=None, threadpool_prefix="grr_http_server"):
+    self.socket_map = {}
+    self.threadpool_prefix = threadpool_prefix
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    self.server_cert = config_lib.CONFIG["Frontend.certificate"]
+
+    self.max_workers = (max_workers or
+                        config_lib.CONFIG["Frontend.event_loop_workers"])
+    self.keep_alive_timeout = (keep_alive_timeout or
+                               config_lib.CONFIG["Frontend.keep_alive_timeout"])
+
+    # The number of requests handed to the workers. This is only modified in
+    # the event loop thread.
+    self.pending = 0
+
+    self.SetFrontEnd(frontend or CreateFrontEnd())
+
+    # These are created when we start serving, so the server can be shared
+    # by several processes.
+    self.pool = None
+    self.trigger = None
+
+    (address, _) = server_address
+    if ipaddr.IPAddress(address).version == 4:
+      family = socket.AF_INET
+    else:
+      family = socket.AF_INET6
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.create_socket(family, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(server_address)
+    self.listen(self.request_queue_size)
+
+  @property
+  def server_address(self):
+    return self.socket.getsockname()
+
+  def HasCapacity(self):
+    return self.pending < self.max_workers
+
+  def readable(self):
+    return self.HasCapacity()
+
+  def writable(self):
+    return False
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is not None:
+      sock, client_address = pair
+      AsyncGRRHTTPChannel(self, sock, client_address)
+
+  def Submit(self, channel, path, raw_headers, post_data):
+    """Processes a POST on the worker pool."""
+    self.pending += 1
+    self.pool.AddTask(target=self._ProcessRequest,
+                      args=(channel, path, raw_headers, post_data),
+                      name="HTTPRequest", inline=False)
+
+  def _ProcessRequest(self, channel, path, raw_headers, post_data):
+    """Runs in a worker thread."""
+    status, data = 500, "Error"
+    try:
+      status, data = ProcessControlRequest(self.frontend, path, raw_headers,
+                                           post_data, channel.client_address[0])
+    finally:
+      self.trigger.Call(lambda: self._RequestDone(channel, status, data))
+
+  def _RequestDone(self, channel, status, data):
+    """Runs in the event loop thread when a worker is done."""
+    self.pending -= 1
+    if channel.connected:
+      channel.SendResponse(status, data)
+
+  def CloseIdleConnections(self):
+    cutoff = time.time() - self.keep_alive_timeout
+    for dispatcher in self.socket_map.values():
+      if (isinstance(dispatcher, AsyncGRRHTTPChannel) and
+          not dispatcher.busy and dispatcher.last_activity < cutoff):
+        dispatcher.close()
+
+  def SetFrontEnd(self, frontend):
+    self.frontend = frontend
+
+    # Do not give clients new work if we can not keep up with them.
+    self.frontend.SetThrottleCallBack(self.HasCapacity)
+
+  def serve_forever(self):
+    self.pool = threadpool.ThreadPool.Factory(
+        self.threadpool_prefix, min_threads=min(2, self.max_workers),
+        max_threads=self.max_workers)
+    self.pool.Start()
+    self.trigger = LoopTrigger(self.socket_map)
+
+    last_cleanup = time.time()
+    while self.socket_map:
+      asyncore.loop(timeout=1, map=self.socket_map, count=1)
+
+      if time.time() - last_cleanup > 1:
+        self.CloseIdleConnections()
+        last_cleanup = time.time()
+
+  def shutdown(self):
+    """Stops serve_forever(), can be called from any thread."""
+    if self.trigger is None:
+      self.close()
+    else:
+      self.trigger.Call(self._Shutdown)
+
+  def _Shutdown(self):
+    for dispatcher in self.socket_map.values():
+      dispatcher.close()
+
+    self.pool.Stop()
+
 
 def CreateServer(frontend=None):
   server_address = (config_lib.CONFIG["Frontend.bind_address"],
                     config_lib.CONFIG["Frontend.bind_port"])
-  httpd = GRRHTTPServer(server_address, GRRHTTPServerHandler, frontend=frontend)
+  if config_lib.CONFIG["Frontend.event_loop"]:
+    httpd = AsyncGRRHTTPServer(server_address, frontend=frontend)
+  else:
+    httpd = GRRHTTPServer(server_address, GRRHTTPServerHandler,
+                          frontend=frontend)
 
   sa = httpd.socket.getsockname()
   logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
@@ -188,17 +498,36 @@ def Serve(server):
     pass
 
 
+def ServeWorker(server, shared_cache):
+  """Serves requests in a pre-forked worker process.
+
+  Threads do not survive a fork, so each worker needs its own frontend. The
+  workers share the verified client ciphers through the shared cache.
+
+  Args:
+    server: The HTTP server, its listening socket is shared by all workers.
+    shared_cache: A frontend_cache.FrontendCacheClient.
+  """
+  server.SetFrontEnd(CreateFrontEnd(shared_cache=shared_cache))
+  Serve(server)
+
+
 def main(unused_argv):
   """Main."""
   config_lib.CONFIG.AddContext("HTTPServer Context")
 
   startup.Init()
 
-  httpd = CreateServer()
-  if config_lib.CONFIG["Frontend.processes"] > 1:
-    # Multiprocessing
-    for _ in range(config_lib.CONFIG["Frontend.processes"] - 1):
-      Process(target=Serve, args=(httpd,)).start()
+  processes = config_lib.CONFIG["Frontend.processes"]
+  if processes > 1:
+    # The cache must be running before the workers are forked.
+    shared_cache = frontend_cache.StartSharedCache()
+    httpd = CreateServer(frontend=CreateFrontEnd(shared_cache=shared_cache))
+
+    for _ in range(processes - 1):
+      Process(target=ServeWorker, args=(httpd, shared_cache)).start()
+  else:
+    httpd = CreateServer()
 
   try:
     httpd.serve_forever()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Tests for the event loop based frontend HTTP server."""
+
+
+import httplib
+import threading
+import time
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.tools import http_server
+
+
+class MockFrontEnd(object):
+  """Echoes the number of requests it handled back to the client.
+
+  The count is sent in the queue_size field, since it has to be serialized.
+  """
+
+  def __init__(self, delay=0):
+    self.delay = delay
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.throttle_callback = None
+
+  def SetThrottleCallBack(self, callback):
+    self.throttle_callback = callback
+
+  def HandleMessageBundles(self, request_comms, response_comms):
+    time.sleep(self.delay)
+    with self.lock:
+      self.requests += 1
+      response_comms.queue_size = self.requests
+
+    return "C.1234567812345678", 0
+
+
+class AsyncGRRHTTPServerTest(test_lib.GRRBaseTest):
+  """Tests the AsyncGRRHTTPServer."""
+
+  def StartServer(self, frontend, max_workers=2):
+    server = http_server.AsyncGRRHTTPServer(
+        ("127.0.0.1", 0), frontend=frontend, max_workers=max_workers,
+        threadpool_prefix="pool-%s" % self._testMethodName)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, thread
+
+  def Post(self, connection):
+    request_comms = rdfvalue.ClientCommunication(api_version=3)
+    connection.request("POST", "/control?api=3",
+                       request_comms.SerializeToString())
+    response = connection.getresponse()
+    self.assertEqual(response.status, 200)
+
+    return rdfvalue.ClientCommunication(response.read())
+
+  def testKeepAlive(self):
+    server, thread = self.StartServer(MockFrontEnd())
+    try:
+      connection = httplib.HTTPConnection("127.0.0.1",
+                                          server.server_address[1])
+      # All the requests are served on the same connection.
+      for i in range(1, 4):
+        self.assertEqual(self.Post(connection).queue_size, i)
+    finally:
+      server.shutdown()
+      thread.join()
+
+  def testWorkersAreBounded(self):
+    frontend = MockFrontEnd(delay=0.1)
+    server, thread = self.StartServer(frontend, max_workers=2)
+    try:
+      responses = []
+
+      def Post():
+        connection = httplib.HTTPConnection("127.0.0.1",
+                                            server.server_address[1])
+        responses.append(self.Post(connection))
+
+      start = time.time()
+      clients = [threading.Thread(target=Post) for _ in range(10)]
+      for client in clients:
+        client.start()
+      for client in clients:
+        client.join()
+
+      # All clients were served, but only two requests ran at the same time.
+      self.assertEqual(len(responses), 10)
+      self.assertGreaterEqual(time.time() - start, 0.5)
+
+      # The frontend is told when the server is saturated.
+      self.assertTrue(frontend.throttle_callback())
+    finally:
+      server.shutdown()
+      thread.join()
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -18,6 +18,7 @@ from grr.lib import server_plugins
 from grr.lib import access_control
 from grr.lib import config_lib
 from grr.lib import flags
+from grr.lib import hash_filter
 from grr.lib import startup
 from grr.lib import worker
 
@@ -72,6 +73,11 @@ def main(unused_argv):
 
 def StartWorker():
   token = access_control.ACLToken(username="GRRWorker")
+
+  # Workers check many hashes against the stores, the filters save data store
+  # queries for unknown hashes.
+  hash_filter.LoadFilters(token=token)
+
   worker_obj = worker.GRRWorker(queue=worker.DEFAULT_WORKER_QUEUE,
                                 token=token)
   worker_obj.Run()
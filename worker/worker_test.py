@@ -234,6 +234,22 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
 
     self.CheckNotificationsDisappear(session_id)
 
+  def testWorkerStealsSessionsWhenItsShardsAreIdle(self):
+    worker_obj = worker.GRRWorker(worker.DEFAULT_WORKER_QUEUE,
+                                  token=self.token)
+    session_id = rdfvalue.SessionID("aff4:/flows/W:123456")
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.NotifyQueue(session_id)
+
+    # This worker owns no shards, so it has to take the session from the shard
+    # of another worker.
+    with test_lib.Stubber(worker_obj.shard_leases, "GetShards", lambda: []):
+      self.assertEqual(worker_obj.RunOnce(), 1)
+      worker_obj.thread_pool.Join()
+
+    sessions = manager.GetSessionsFromQueue(worker.DEFAULT_WORKER_QUEUE)
+    self.assertEqual(len(sessions), 0)
+
 
 def main(_):
   test_lib.main()